@@ -1,6 +1,7 @@
 import os
 import json
 from sqlmodel import SQLModel, Field, create_engine, Session, select, Column, Text, TEXT, Relationship
+from sqlalchemy import Index
 from typing import Optional, List
 from unidecode import unidecode 
 from datetime import datetime, timezone
@@ -15,6 +16,28 @@ engine = create_engine(sqlite_url, echo=True, connect_args=connect_args)
 def create_db_and_tables():
     os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
     SQLModel.metadata.create_all(engine)
+    ensure_columns()
+    ensure_indexes()
+
+# Hàm bổ sung cột mới cho DB cũ (create_all không ALTER bảng đã tồn tại)
+# Lưu ý: Cột thêm vào sẽ là NULL với dữ liệu cũ -> Model phải chấp nhận None
+def ensure_columns():
+    with engine.begin() as conn:
+        for table in SQLModel.metadata.sorted_tables:
+            existing = {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+            if not existing:
+                continue
+            for column in table.columns:
+                if column.name not in existing:
+                    col_type = column.type.compile(engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}')
+                    print(f"🧩 Đã thêm cột {table.name}.{column.name}")
+
+# Hàm bổ sung Index cho DB cũ (create_all chỉ tạo index khi tạo bảng mới)
+def ensure_indexes():
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
 
 # Hàm cấp phát session chuẩn cho FastAPI 
 def get_db():
@@ -54,7 +77,7 @@ class Player(SQLModel, table=True):
     class_type: str = Field(default="NOVICE") # WARRIOR / MAGE
     skill_points: int = Field(default=0)
     equipped_skill: Optional[str] = Field(default=None)
-    skills_data: str = Field(default="{}")    # Lưu danh sách skill đã học (JSON)
+    skills_data: str = Field(default="{}")    # (Cũ) JSON skill đã học - đã chuyển sang bảng PlayerSkill
 
     # --- 3. HỆ THỐNG KPI & HỌC TẬP ---
     kpi: float = Field(default=0.0) # Điểm KPI
@@ -112,6 +135,7 @@ class Player(SQLModel, table=True):
     companion_slot_3: Optional[str] = Field(default=None)
 # 4
 class Inventory(SQLModel, table=True):
+    __table_args__ = (Index("ix_inventory_player_item", "player_id", "item_id"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     player_id: int = Field(foreign_key="player.id")
     item_id: int = Field(foreign_key="item.id")
@@ -210,6 +234,16 @@ class ShopHistory(SQLModel, table=True):
     item_id: int
     purchase_date: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     amount: int = 1
+
+class ShopPurchaseCounter(SQLModel, table=True):
+    """Bộ đếm lượt mua theo (người chơi, vật phẩm, kỳ) để chặn limit_type mà không phải quét ShopHistory"""
+    __table_args__ = (Index("ux_shoppurchase_player_item_period", "player_id", "item_id", "period", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    player_id: int = Field(foreign_key="player.id")
+    item_id: int
+    period: str = Field(default="")       # "" = trọn đời, "2026-03" = theo tháng
+    count: int = Field(default=0)
+    updated_at: datetime = Field(default_factory=datetime.now)
 #11--- THÁP THÍ LUYỆN ---
 class TowerQuestion(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -241,6 +275,8 @@ class SystemStatus(SQLModel, table=True):
     updated_at: str = Field(default="")
 #15. Bảng PlayerPet (Thú cưng người chơi sở hữu)
 class PlayerPet(SQLModel, table=True):
+    # Gom Pet cùng loại + cùng sao để tiến hóa 3-trong-1 hàng loạt (game_logic/pets.py)
+    __table_args__ = (Index("ix_playerpet_player_item_star", "player_id", "item_id", "star_level"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     player_id: int = Field(foreign_key="player.id")
     
@@ -255,10 +291,18 @@ class PlayerPet(SQLModel, table=True):
     # Trạng thái Aura
     is_active: bool = Field(default=False) # True = Đang bay theo chủ
     active_start_time: Optional[datetime] = None # Thời gian bắt đầu kích hoạt
+    # Aura đã cộng vào bonus trang bị lúc bật (tắt / đổi Pet trừ đúng số này, dù Admin sửa / xóa phôi Pet)
+    aura_atk: Optional[int] = Field(default=0)
+    aura_hp: Optional[int] = Field(default=0)
 #16 [MỚI] BẢNG CHỢ ĐEN (MARKET) ---
 class MarketListing(SQLModel, table=True):
+    # Index phục vụ duyệt chợ: lọc tiền tệ / loại hàng rồi sắp theo giá (id để phân trang cursor)
+    __table_args__ = (
+        Index("ix_marketlisting_currency_price", "currency", "price", "id"),
+        Index("ix_marketlisting_item_price", "item_id", "price", "id"),
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
-    seller_id: int = Field(foreign_key="player.id")
+    seller_id: int = Field(foreign_key="player.id", index=True)
     item_id: int = Field(foreign_key="item.id") 
     
     amount: int = Field(default=1)
@@ -270,6 +314,60 @@ class MarketListing(SQLModel, table=True):
     
     # 👇 THÊM CỘT NÀY ĐỂ LƯU DỮ LIỆU CHARM 👇
     item_data_json: Optional[str] = Field(default=None)
+    # Độ hiếm tách ra từ item_data_json (Charm / Thẻ bài) để lọc bằng index
+    rarity: Optional[str] = Field(default=None, index=True)
+
+class MarketTrade(SQLModel, table=True):
+    """Nhật ký giao dịch Chợ Đen (chỉ ghi thêm) - dùng cho biểu đồ lịch sử giá"""
+    __table_args__ = (Index("ix_markettrade_key_time", "item_id", "rarity", "currency", "created_at"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    listing_id: int
+    item_id: int                          # 999999 = Charm, 999998 = Thẻ bài, còn lại = Item
+    rarity: str = Field(default="")       # Chỉ có với Charm / Thẻ bài
+    currency: str
+    price: int                            # Giá cả lô
+    amount: int = Field(default=1)
+    unit_price: float                     # price / amount
+    seller_id: int
+    buyer_id: int
+    created_at: datetime = Field(default_factory=datetime.now)
+
+class WalletLedger(SQLModel, table=True):
+    """Sổ cái ví (chỉ ghi thêm): mỗi lần cộng / trừ tri_thuc, chien_tich, vinh_du, kpi"""
+    __table_args__ = (Index("ix_walletledger_player_currency", "player_id", "currency", "id"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    player_id: int = Field(foreign_key="player.id")
+    currency: str                         # tri_thuc / chien_tich / vinh_du / kpi
+    delta: float                          # Dương = cộng, Âm = trừ
+    balance_after: float                  # Số dư ngay sau giao dịch
+    reason: str = Field(index=True)       # VD: shop_buy, market_sale, boss_reward...
+    ref: Optional[str] = Field(default=None)  # Mã tham chiếu (id đơn hàng, trận đấu...)
+    created_at: datetime = Field(default_factory=datetime.now)
+
+class WalletSnapshot(SQLModel, table=True):
+    """Ảnh chụp số dư định kỳ: số dư hiện tại = snapshot + tổng delta của sổ cái sau ledger_id"""
+    __table_args__ = (Index("ix_walletsnapshot_player_currency", "player_id", "currency", "ledger_id"),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    player_id: int
+    currency: str
+    balance: float
+    ledger_id: int = Field(default=0)     # id sổ cái lớn nhất đã tính vào snapshot
+    created_at: datetime = Field(default_factory=datetime.now)
+
+class MarketPriceIndex(SQLModel, table=True):
+    """Bảng giá tổng hợp theo (item_id | độ hiếm, tiền tệ) - cập nhật khi bán / mua / hủy"""
+    __table_args__ = (Index("ix_marketpriceindex_key", "item_id", "rarity", "currency", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    item_id: int
+    rarity: str = Field(default="")
+    currency: str
+    listing_count: int = Field(default=0)               # Số đơn đang treo
+    min_price: Optional[float] = Field(default=None)    # Giá / 1 cái thấp nhất đang treo
+    median_price: Optional[float] = Field(default=None)
+    last_trade_price: Optional[float] = Field(default=None)
+    last_trade_at: Optional[datetime] = Field(default=None)
+    trade_count: int = Field(default=0)
+    updated_at: datetime = Field(default_factory=datetime.now)
 # bảng kỹ năng
 class SkillTemplate(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
@@ -286,6 +384,8 @@ class SkillTemplate(SQLModel, table=True):
     config_data: str = Field(default="{}")
 # BẢNG MỚI: LƯU KỸ NĂNG CỦA NGƯỜI CHƠI
 class PlayerSkill(SQLModel, table=True):
+    # Mỗi người chơi học 1 skill đúng 1 lần (services/skill_tree.py); thay cho JSON Player.skills_data
+    __table_args__ = (Index("ux_playerskill_player_skill", "player_id", "skill_id", unique=True),)
     id: Optional[int] = Field(default=None, primary_key=True)
     player_id: int = Field(foreign_key="player.id", index=True)
     
@@ -306,6 +406,24 @@ class QuestionBank(SQLModel, table=True):
     correct_answer: str                   # Đáp án đúng (A, B, C, hoặc D)
     explanation: str = Field(default="")
     grade: int = Field(default=6, index=True)
+    content_hash: Optional[str] = Field(default=None, index=True)  # Dấu vân tay để chống trùng câu hỏi
+    question_type: Optional[str] = Field(default="mcq")  # mcq (trắc nghiệm) / statement (câu luyện gõ, không có đáp án)
+    file_only: Optional[bool] = Field(default=False)  # Chỉ có trong file 'data câu hỏi' (Boss, minigame...) -> không vào đề Tháp / Lôi Đài
+
+class QuestionSource(SQLModel, table=True):
+    """Câu hỏi thuộc file JSON nào trong 'data câu hỏi' (1 câu có thể nằm ở nhiều file)"""
+    __table_args__ = (Index("ix_questionsource_source_question", "source", "question_id", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    question_id: int = Field(foreign_key="questionbank.id", index=True)
+    source: str                           # Đường dẫn tương đối, VD: "sinh/sinh-hard-boss.json"
+    position: int = Field(default=0)      # Thứ tự trong file
+
+class QuestionTag(SQLModel, table=True):
+    """Gắn chủ đề (tag) cho câu hỏi - Index theo tag để bốc đề không phải quét cả bảng"""
+    __table_args__ = (Index("ix_questiontag_tag_question", "tag", "question_id", unique=True),)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    question_id: int = Field(foreign_key="questionbank.id", index=True)
+    tag: str                              # Đã chuẩn hóa: không dấu, chữ thường (VD: "phan-so")
 
 class ArenaMatch(SQLModel, table=True):
     """Quản lý thông tin trận đấu"""
@@ -317,7 +435,7 @@ class ArenaMatch(SQLModel, table=True):
     # Trạng thái: pending (chờ nhận), active (đang đấu), completed (xong), cancelled (hủy/hết hạn)
     status: str = Field(default="pending", index=True) 
     
-    created_by: str                       # Username người tạo
+    created_by: str = Field(index=True)   # Username người tạo
     created_at: datetime = Field(default_factory=datetime.now)
     expires_at: datetime                  # Thời hạn 24h (tính từ lúc tạo hoặc lúc start)
     
@@ -327,7 +445,7 @@ class ArenaMatch(SQLModel, table=True):
 class ArenaParticipant(SQLModel, table=True):
     """Danh sách người tham gia từng trận"""
     id: Optional[int] = Field(default=None, primary_key=True)
-    match_id: int = Field(foreign_key="arenamatch.id")
+    match_id: int = Field(foreign_key="arenamatch.id", index=True)
     username: str = Field(index=True)
     team: str                             # 'A' (Đội thách đấu) hoặc 'B' (Đội bị thách đấu)
     
@@ -370,6 +488,9 @@ class PlayerItem(SQLModel, table=True):
     
     # Chỉ số sức mạnh (Lưu JSON: {"atk": 10, "hp": 50})
     stats_data: str = Field(default="{}")
+    # Bản số đã tách sẵn từ stats_data (None = dòng cũ chưa tách, xem stats.backfill_charm_stats)
+    stat_atk: Optional[int] = Field(default=None)
+    stat_hp: Optional[int] = Field(default=None)
     
     # Cường hóa
     enhance_level: int = Field(default=0) # Cấp cộng (+0 đến +10)
@@ -453,6 +574,26 @@ class Companion(SQLModel, table=True):
     template: Optional["CompanionTemplate"] = Relationship(back_populates="companions")
     is_equipped: bool = Field(default=False)
     slot_index: int = Field(default=0)
+    # Thống kê theo phôi / gộp thẻ trùng / lọc bộ sưu tập theo người chơi
+    __table_args__ = (Index("ix_companion_player_template_star", "player_id", "template_id", "star"),)
+
+# ID cũ mà giao diện từng gửi lên ({rarity}_{template_id}_{4 ký tự cuối}) -> ID thật của thẻ.
+# Chỉ tạo 1 lần lúc nâng cấp (companion_lookup.migrate_legacy_companion_ids); ID mới luôn là Companion.id
+class CompanionAlias(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    player_id: int = Field(foreign_key="player.id")
+    alias: str                                   # Đã chuẩn hóa: bỏ khoảng trắng, chữ thường
+    companion_id: str = Field(foreign_key="companion.id", index=True)
+    __table_args__ = (Index("ux_companionalias_player_alias", "player_id", "alias", unique=True),)
+
+# Chỉ mục file ảnh thẻ trong frontend/assets/card (services/companion_assets.py):
+# lần quét sau chỉ đọc lại file mới / đổi mtime-size, hash giống thì coi như không đổi
+class CompanionAssetFile(SQLModel, table=True):
+    path: str = Field(primary_key=True)           # Đường dẫn tương đối, VD: "sr/vo-nguyen-giap.png"
+    mtime: float = Field(default=0)
+    size: int = Field(default=0)
+    content_hash: str = Field(default="")         # sha1 nội dung file
+    template_id: str = Field(index=True)          # Phôi sinh ra từ file này
 
 # ==========================================
 # 1. BẢNG CHIẾN DỊCH (Quản lý Mùa giải & Kho Chung)
@@ -478,6 +619,7 @@ class Campaign(SQLModel, table=True):
 # 2. BẢNG QUÂN ĐOÀN CÁ NHÂN (Người chơi tham gia)
 # ==========================================
 class CampaignPlayer(SQLModel, table=True):
+    __table_args__ = (Index("ix_campaignplayer_campaign_faction", "campaign_id", "faction"),)
     id: Optional[int] = Field(default=None, primary_key=True)
     campaign_id: int = Field(foreign_key="campaign.id")
     player_id: int = Field(foreign_key="player.id")
@@ -502,6 +644,24 @@ class CampaignPlayer(SQLModel, table=True):
     current_kill_streak: int = Field(default=0)
     last_kill_time: datetime = Field(default=None, nullable=True)
 
+    # Mốc đã nhận thưởng cuối mùa (NULL = chưa phát) -> chạy lại quyết toán không phát trùng
+    rewarded_at: Optional[datetime] = Field(default=None)
+
+# ==========================================
+# 2b. BẢNG QUYẾT TOÁN THƯỞNG CUỐI MÙA
+# ==========================================
+class CampaignSettlement(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    campaign_id: int = Field(foreign_key="campaign.id", unique=True)
+    winner_faction: str
+    status: str = Field(default="PENDING") # PENDING, RUNNING, DONE, FAILED
+    total: int = Field(default=0)          # Số lãnh chúa cần phát thưởng
+    processed: int = Field(default=0)      # Số lãnh chúa đã phát
+    error: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.now)
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+
 # ==========================================
 # 3. BẢNG BẢN ĐỒ / CỨ ĐIỂM (Map Nodes)
 # ==========================================
@@ -0,0 +1,137 @@
+import threading
+import time
+from datetime import datetime
+from sqlmodel import Session, select
+from database import Player, ArenaMatch, ArenaParticipant
+
+# Danh sách đối thủ được cache trong bao lâu (giây) trước khi đọc lại DB
+OPPONENTS_TTL = 30
+
+
+class ArenaLobby:
+    """
+    Sổ đăng ký phòng chờ Lôi Đài nằm trong RAM (dùng chung cho cả process).
+    - Giữ các trận 'pending' (kèo mở 1vs1 + phòng 2vs2) để /lobby không phải query DB mỗi lần poll.
+    - Mỗi thay đổi tăng 'version' -> Frontend dùng ETag/304 hoặc WebSocket để biết có gì mới.
+    - ArenaManager gọi sync_match / remove_match sau mỗi lần commit.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._matches = {}      # match_id -> dict thông tin phòng
+        self._loaded = False
+        self.version = 0
+
+        # Cache danh sách đối thủ (toàn bộ người chơi trừ admin)
+        self._opponents = []
+        self._opponents_at = 0.0
+        self._opponents_key = None
+        self.opponents_version = 0
+
+    # --- 1. NẠP & ĐỒNG BỘ ---
+
+    def _build_entry(self, match: ArenaMatch, participants: list):
+        return {
+            "id": match.id,
+            "mode": match.mode,
+            "bet": match.bet_amount,
+            "difficulty": match.difficulty,
+            "created_by": match.created_by,
+            "expires_at": match.expires_at,
+            "team_a": [p.username for p in participants if p.team == 'A'],
+            "team_b": [p.username for p in participants if p.team == 'B'],
+            "count": len(participants)
+        }
+
+    def ensure_loaded(self, db: Session):
+        """Lần đầu tiên: nạp toàn bộ trận pending từ DB (2 query)."""
+        if self._loaded:
+            return
+        matches = db.exec(select(ArenaMatch).where(ArenaMatch.status == "pending")).all()
+        ids = [m.id for m in matches]
+        participants = db.exec(
+            select(ArenaParticipant).where(ArenaParticipant.match_id.in_(ids))
+        ).all() if ids else []
+
+        by_match = {}
+        for p in participants:
+            by_match.setdefault(p.match_id, []).append(p)
+
+        with self._lock:
+            if self._loaded:
+                return
+            self._matches = {m.id: self._build_entry(m, by_match.get(m.id, [])) for m in matches}
+            self._loaded = True
+            self.version += 1
+
+    def sync_match(self, db: Session, match_id: int):
+        """Đọc lại 1 trận từ DB: còn pending thì cập nhật, không thì gỡ khỏi sảnh."""
+        if not self._loaded:
+            return  # Chưa ai xem sảnh -> lần nạp đầu sẽ lấy dữ liệu mới nhất
+        match = db.get(ArenaMatch, match_id)
+        if not match or match.status != "pending":
+            self.remove_match(match_id)
+            return
+        participants = db.exec(
+            select(ArenaParticipant).where(ArenaParticipant.match_id == match_id)
+        ).all()
+        with self._lock:
+            self._matches[match_id] = self._build_entry(match, participants)
+            self.version += 1
+
+    def remove_match(self, match_id: int):
+        with self._lock:
+            if self._matches.pop(match_id, None) is not None:
+                self.version += 1
+
+    def invalidate(self):
+        """Xóa cache (VD: Admin can thiệp trực tiếp vào bảng trận đấu)."""
+        with self._lock:
+            self._matches = {}
+            self._loaded = False
+            self._opponents_at = 0.0
+            self.version += 1
+
+    # --- 2. ĐỌC DỮ LIỆU ---
+
+    def has_expired(self) -> bool:
+        """True nếu có phòng pending đã quá hạn -> cần chạy process_lazy_timeouts."""
+        now = datetime.now()
+        with self._lock:
+            return any(m["expires_at"] < now for m in self._matches.values())
+
+    def snapshot(self, mode: str = "2vs2"):
+        with self._lock:
+            rooms = [
+                {k: m[k] for k in ("id", "bet", "difficulty", "team_a", "team_b", "count")}
+                for m in self._matches.values() if m["mode"] == mode
+            ]
+            return self.version, rooms
+
+    def get_opponents(self, db: Session):
+        """Danh sách người chơi (trừ admin), đọc lại DB tối đa 1 lần mỗi OPPONENTS_TTL giây."""
+        if time.monotonic() - self._opponents_at < OPPONENTS_TTL:
+            return self.opponents_version, self._opponents
+
+        rows = db.exec(
+            select(Player.username, Player.full_name, Player.class_type, Player.kpi)
+            .where(Player.username != "admin")
+            .order_by(Player.id)
+        ).all()
+        opponents = [{
+            "username": username,
+            "full_name": full_name if full_name else username,
+            "class_type": class_type if class_type else "Novice",
+            "kpi": kpi if kpi is not None else 0
+        } for username, full_name, class_type, kpi in rows]
+
+        with self._lock:
+            key = tuple((o["username"], o["full_name"], o["class_type"], o["kpi"]) for o in opponents)
+            if key != self._opponents_key:
+                self._opponents_key = key
+                self._opponents = opponents
+                self.opponents_version += 1
+            self._opponents_at = time.monotonic()
+            return self.opponents_version, self._opponents
+
+
+lobby = ArenaLobby()
@@ -3,7 +3,13 @@ import random
 from datetime import datetime, timedelta
 from sqlmodel import Session, select, col, text
 from database import Player, ArenaMatch, ArenaParticipant, QuestionBank
-from sqlalchemy import text
+from sqlalchemy import text, func, or_
+from game_logic.arena_lobby import lobby
+from services.question_store import question_store
+from services import wallet
+
+# Số trận lịch sử trả về trong hộp thư Lôi Đài
+INBOX_HISTORY_LIMIT = 5
 
 class ArenaManager:
     def __init__(self, db: Session):
@@ -22,12 +28,13 @@ class ArenaManager:
         """
         # 1. Kiểm tra tiền cược
         creator = self.db.exec(select(Player).where(Player.username == username)).first()
-        if not creator or (creator.kpi or 0) < bet_amount:
+        if not creator:
             return {"success": False, "message": "Bạn không đủ KPI để cược lôi đài!"}
 
-        # 2. Trừ tiền cọc (Escrow)
-        creator.kpi = (creator.kpi or 0) - bet_amount
-        self.db.add(creator)
+        # 2. Trừ tiền cọc (Escrow) - chỉ trừ khi đủ số dư
+        if wallet.debit(self.db, creator.id, "kpi", bet_amount, reason="arena_bet") is None:
+            self.db.rollback()
+            return {"success": False, "message": "Bạn không đủ KPI để cược lôi đài!"}
 
         # 3. Tạo Match
         # Thời hạn tạm thời là 24h kể từ lúc tạo (để chờ accept), 
@@ -67,6 +74,7 @@ class ArenaManager:
             self.db.add(p2)
 
         self.db.commit()
+        lobby.sync_match(self.db, new_match.id)
         return {"success": True, "match_id": new_match.id, "message": "Đã gửi thư khiêu chiến!"}
 
     def accept_match_1vs1(self, match_id: int, username: str):
@@ -114,13 +122,11 @@ class ArenaManager:
         if not accepter:
             return {"success": False, "message": "Không tìm thấy thông tin người chơi."}
             
-        if (accepter.kpi or 0) < match.bet_amount:
+        # 3. Trừ tiền cọc ngay lập tức (chỉ trừ khi đủ số dư)
+        if wallet.debit(self.db, accepter.id, "kpi", match.bet_amount, reason="arena_bet", ref=match_id) is None:
+            self.db.rollback()
             return {"success": False, "message": f"Bạn cần {match.bet_amount} KPI để nhận kèo này!"}
 
-        # 3. Trừ tiền cọc ngay lập tức
-        accepter.kpi = (accepter.kpi or 0) - match.bet_amount
-        self.db.add(accepter)
-
         # 4. Xử lý Participant (Người tham gia)
         # Tìm xem đã có slot sẵn chưa (Trường hợp thách đấu chỉ định)
         participant = self.db.exec(select(ArenaParticipant).where(
@@ -157,6 +163,7 @@ class ArenaManager:
         
         # 6. Lưu tất cả thay đổi
         self.db.commit()
+        lobby.remove_match(match_id)
         
         return {"success": True, "message": "Chấp nhận thành công! Vào trận ngay.", "data": {"status": "active"}}
 
@@ -186,12 +193,11 @@ class ArenaManager:
 
         # Check tiền
         joiner = self.db.exec(select(Player).where(Player.username == username)).first()
-        if (joiner.kpi or 0) < match.bet_amount:
+        if not joiner or wallet.debit(self.db, joiner.id, "kpi", match.bet_amount, reason="arena_bet", ref=match_id) is None:
+            self.db.rollback()
             return {"success": False, "message": "Bạn không đủ KPI để cược lôi đài!."}
 
-        # Trừ tiền & Thêm vào phòng
-        joiner.kpi -= match.bet_amount
-        self.db.add(joiner)
+        # Thêm vào phòng
 
         new_p = ArenaParticipant(
             match_id=match_id,
@@ -210,8 +216,10 @@ class ArenaManager:
             match.expires_at = datetime.now() + timedelta(hours=24)
             self.db.add(match)
             self.db.commit()
+            lobby.remove_match(match_id)
             return {"success": True, "message": "Đã tham gia. Phòng đủ người, trận đấu BẮT ĐẦU!"}
         
+        lobby.sync_match(self.db, match_id)
         return {"success": True, "message": f"Đã tham gia Team {team}. Chờ đủ người..."}
 
     # =========================================================================
@@ -232,25 +240,18 @@ class ArenaManager:
         # Kiểm tra xem trận này đã có đề chưa (Lưu trong field match.logs tạm thời hoặc 1 bảng riêng)
         # Để đơn giản, ta sẽ random mỗi lần (nhưng tốt nhất là lưu lại ID câu hỏi vào match.logs)
         
-        # Logic đơn giản: Random 5 câu theo độ khó
-        questions = self.db.exec(select(QuestionBank).where(
-            QuestionBank.difficulty == match.difficulty
-        )).all()
-        
-        if len(questions) < 5:
-            # Fallback nếu thiếu câu hỏi
-            selected_qs = questions
-        else:
-            selected_qs = random.sample(questions, 5)
+        # Logic đơn giản: Random 5 câu theo độ khó (bốc từ kho chung trong RAM)
+        # Fallback nếu thiếu câu hỏi: sample trả về tối đa số câu đang có
+        selected_qs = question_store.sample(self.db, 5, difficulty=match.difficulty)
 
         # Format dữ liệu trả về Frontend (Ẩn đáp án đúng)
         quiz_data = []
         for q in selected_qs:
             quiz_data.append({
-                "id": q.id,
-                "subject": q.subject,
-                "content": q.content,
-                "options": json.loads(q.options_json), # String -> List
+                "id": q["id"],
+                "subject": q["subject"],
+                "content": q["content"],
+                "options": q["options"],
                 # KHÔNG TRẢ VỀ correct_answer
             })
             
@@ -276,8 +277,8 @@ class ArenaManager:
             q_id = ans.get("id")
             user_choice = ans.get("answer")
             
-            question = self.db.get(QuestionBank, q_id)
-            if question and question.correct_answer == user_choice:
+            question = question_store.get(self.db, q_id)
+            if question and question["correct_answer"] == user_choice:
                 score += 1
 
         # 3. Lưu điểm số và Commit (LƯU Ý: Phải commit ngay để DB cập nhật)
@@ -358,30 +359,20 @@ class ArenaManager:
         
         # --- Trường hợp HÒA ---
         if winner_team == "Draw":
-            for p in participants:
-                player = self.db.get(Player, p.username)
-                if player:
-                    # Hoàn tiền
-                    player.kpi = (player.kpi or 0) + match.bet_amount
-                    self.db.add(player)
-                    print(f"   Draw -> Hoàn tiền cho {p.username}")
+            # Hoàn tiền cho tất cả
+            wallet.batch_credit(self.db, self._player_ids([p.username for p in participants]),
+                                {"kpi": match.bet_amount}, reason="arena_refund", ref=match.id)
+            print(f"   Draw -> Hoàn tiền cho {len(participants)} người")
 
         # --- Trường hợp CÓ NGƯỜI THẮNG ---
         else:
             winners = [p for p in participants if p.team == winner_team]
             if winners:
                 reward = int(total_pot / len(winners))
-                for w in winners:
-                    player = self.db.get(Player, w.username)
-                    if player:
-                        # 1. Cộng KPI
-                        player.kpi = (player.kpi or 0) + reward
-                        
-                        # 2. Cộng Chiến Tích (Đã đồng bộ với API)
-                        player.chien_tich = (player.chien_tich or 0) + 1
-                        
-                        self.db.add(player)
-                        print(f"   🏆 Thắng -> {w.username} (+{reward} KPI, +1 Chiến Tích)")
+                # Cộng KPI + 1 Chiến Tích (Đã đồng bộ với API)
+                wallet.batch_credit(self.db, self._player_ids([w.username for w in winners]),
+                                    {"kpi": reward, "chien_tich": 1}, reason="arena_win", ref=match.id)
+                print(f"   🏆 Thắng -> {[w.username for w in winners]} (+{reward} KPI, +1 Chiến Tích)")
 
         # 5. CẬP NHẬT TRẠNG THÁI & LOGS
         match.status = "finished"
@@ -432,19 +423,17 @@ class ArenaManager:
             ArenaParticipant.match_id == match_id
         )).all()
 
-        for p in participants:
-            # Chỉ hoàn tiền nếu họ đã bị trừ (status accepted hoặc creator)
-            # Với 1vs1: Opponent status='pending' chưa bị trừ tiền -> Ko cần hoàn
-            # Với Creator: status='accepted' -> Hoàn
-            if p.status == "accepted":
-                player = self.db.exec(select(Player).where(Player.username == p.username)).first()
-                if player:
-                    player.kpi = (player.kpi or 0) + match.bet_amount
-                    self.db.add(player)
+        # Chỉ hoàn tiền nếu họ đã bị trừ (status accepted hoặc creator)
+        # Với 1vs1: Opponent status='pending' chưa bị trừ tiền -> Ko cần hoàn
+        # Với Creator: status='accepted' -> Hoàn
+        paid = [p.username for p in participants if p.status == "accepted"]
+        wallet.batch_credit(self.db, self._player_ids(paid), {"kpi": match.bet_amount},
+                            reason="arena_refund", ref=match_id)
 
         match.status = "cancelled"
         self.db.add(match)
         self.db.commit()
+        lobby.remove_match(match_id)
         return {"success": True, "message": "Đã hủy trận và hoàn tiền."}
 
     def process_lazy_timeouts(self):
@@ -471,16 +460,131 @@ class ArenaManager:
             # Tái sử dụng logic hủy trận (nhưng cho phép system hủy)
             # Copy logic hoàn tiền ở trên xuống đây để tránh circular dependency phức tạp
             participants = self.db.exec(select(ArenaParticipant).where(ArenaParticipant.match_id == match.id)).all()
-            for p in participants:
-                if p.status == "accepted":
-                    player = self.db.exec(select(Player).where(Player.username == p.username)).first()
-                    if player:
-                        player.kpi = (player.kpi or 0) + match.bet_amount
-                        self.db.add(player)
+            paid = [p.username for p in participants if p.status == "accepted"]
+            wallet.batch_credit(self.db, self._player_ids(paid), {"kpi": match.bet_amount},
+                                reason="arena_refund", ref=match.id)
             
             match.status = "cancelled"
             match.logs = json.dumps({"reason": "Expired (24h no response)"})
             self.db.add(match)
         
+        expired_ids = [m.id for m in expired_pending_matches]
         self.db.commit()
 
+        # Gỡ các phòng đã hủy khỏi sảnh chờ (RAM)
+        for match_id in expired_ids:
+            lobby.remove_match(match_id)
+
+
+    def _player_ids(self, usernames: list) -> list:
+        """username -> player.id (1 query)"""
+        if not usernames:
+            return []
+        return self.db.exec(select(Player.id).where(Player.username.in_(usernames))).all()
+
+    # =========================================================================
+    # 5. HỘP THƯ LÔI ĐÀI (INCOMING / OUTGOING / HISTORY)
+    # =========================================================================
+
+    def get_match_inbox(self, username: str, history_limit: int = INBOX_HISTORY_LIMIT):
+        """
+        Gom 3 danh sách (lời mời đến, lời mời đi, lịch sử) bằng 1 câu query duy nhất.
+        - Lọc các trận mình tạo HOẶC mình tham gia.
+        - Lịch sử chỉ lấy N trận 'finished' gần nhất (dùng ROW_NUMBER, không lọc trùng bằng Python).
+        - Join sẵn Participant + Player để có tên đối thủ.
+        """
+        my_match_ids = select(ArenaParticipant.match_id).where(ArenaParticipant.username == username)
+
+        # 1. Xếp hạng trận theo thời gian, tách riêng nhóm đã xong để cắt lịch sử
+        ranked = (
+            select(
+                ArenaMatch.id.label("match_id"),
+                func.row_number().over(
+                    partition_by=(ArenaMatch.status == "finished"),
+                    order_by=ArenaMatch.created_at.desc()
+                ).label("rn")
+            )
+            .where(or_(ArenaMatch.created_by == username, ArenaMatch.id.in_(my_match_ids)))
+            .where(ArenaMatch.status.in_(["pending", "active", "finished"]))
+            .subquery()
+        )
+
+        # 2. Một lượt round-trip: Trận + Người tham gia + Tên hiển thị
+        rows = self.db.exec(
+            select(ArenaMatch, ArenaParticipant, Player.full_name)
+            .join(ranked, ranked.c.match_id == ArenaMatch.id)
+            .outerjoin(ArenaParticipant, ArenaParticipant.match_id == ArenaMatch.id)
+            .outerjoin(Player, Player.username == ArenaParticipant.username)
+            .where(or_(ArenaMatch.status != "finished", ranked.c.rn <= history_limit))
+            .order_by(ArenaMatch.created_at.desc(), ArenaMatch.id.desc(), ArenaParticipant.id)
+        ).all()
+
+        # 3. Gom các dòng theo trận (giữ nguyên thứ tự mới nhất trước)
+        matches = {}
+        for m, p, full_name in rows:
+            entry = matches.setdefault(m.id, {"match": m, "members": []})
+            if p is not None:
+                entry["members"].append({
+                    "username": p.username,
+                    "full_name": full_name or p.username,
+                    "team": p.team,
+                    "status": p.status
+                })
+
+        incoming, outgoing, history = [], [], []
+        for entry in matches.values():
+            m = entry["match"]
+            members = entry["members"]
+            me = next((x for x in members if x["username"] == username), None)
+
+            # Đối thủ = những người khác phe với mình (chủ phòng mặc định là phe A)
+            my_team = me["team"] if me else "A"
+            opponents = [
+                {"username": x["username"], "full_name": x["full_name"]}
+                for x in members if x["team"] != my_team
+            ]
+            opponent_label = ", ".join(o["username"] for o in opponents) or "???"
+
+            if m.status == "finished":
+                history.append({
+                    "match_id": m.id,
+                    "created_at": m.created_at,
+                    "bet": m.bet_amount,
+                    "mode": m.mode,
+                    "winner_team": m.winner_team,
+                    "logs": m.logs,
+                    "created_by": m.created_by,
+                    "opponents": opponents
+                })
+                continue
+
+            if me:
+                creator = next((x for x in members if x["username"] == m.created_by), None)
+                incoming.append({
+                    "match_id": m.id,
+                    "creator": m.created_by,
+                    "creator_name": creator["full_name"] if creator else m.created_by,
+                    "bet": m.bet_amount,
+                    "mode": m.mode,
+                    "difficulty": m.difficulty,
+                    "status": m.status,
+                    "logs": m.logs,
+                    "my_status": me["status"],
+                    "opponents": opponents
+                })
+
+            if m.created_by == username:
+                outgoing.append({
+                    "match_id": m.id,
+                    "created_at": m.created_at,
+                    "bet": m.bet_amount,
+                    "mode": m.mode,
+                    "difficulty": m.difficulty,
+                    "status": m.status,
+                    "logs": m.logs,
+                    "player_1": m.created_by,
+                    "player_2": opponent_label,
+                    "opponents": opponents
+                })
+
+        return {"incoming": incoming, "outgoing": outgoing, "history": history}
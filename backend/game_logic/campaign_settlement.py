@@ -0,0 +1,202 @@
+import threading
+import traceback
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import insert, or_
+from sqlmodel import Session, select, update, func
+from database import engine, Player, CampaignPlayer, CampaignSettlement, ScoreLog
+from services import wallet
+import campaign_config as cfg
+
+# Số lãnh chúa xử lý trong 1 transaction (mỗi lô commit 1 lần -> có tiến độ, không giữ khóa DB lâu)
+SETTLEMENT_CHUNK = 500
+
+# Các quyết toán đang chạy trong thread (tránh chạy trùng trong cùng 1 tiến trình)
+_running = set()
+_running_lock = threading.Lock()
+
+
+# =========================================================
+# 1. BẢNG THƯỞNG THEO KẾT QUẢ
+# =========================================================
+def reward_for(outcome: str) -> dict:
+    """outcome: 'WIN' (phe thắng) hoặc 'LOSE' (phe còn lại)."""
+    if outcome == "WIN":
+        return {
+            "kpi": getattr(cfg, 'WIN_REWARD_KPI', 20),
+            "tri_thuc": getattr(cfg, 'WIN_REWARD_TRI_THUC', 50),
+            "chien_tich": getattr(cfg, 'WIN_REWARD_CHIEN_TICH', 10),
+        }
+    return {
+        "kpi": getattr(cfg, 'LOSE_REWARD_KPI', 10),
+        "tri_thuc": getattr(cfg, 'LOSE_REWARD_TRI_THUC', 10),
+        "chien_tich": getattr(cfg, 'LOSE_REWARD_CHIEN_TICH', 3),
+    }
+
+
+# =========================================================
+# 2. XẾP HÀNG (Gọi trong tick của Battle Engine - chỉ 1 lệnh INSERT, chưa commit)
+# =========================================================
+def queue_settlement(db: Session, campaign_id: int, winner_faction: str):
+    exists = db.exec(select(CampaignSettlement.id).where(CampaignSettlement.campaign_id == campaign_id)).first()
+    if not exists:
+        db.add(CampaignSettlement(campaign_id=campaign_id, winner_faction=winner_faction))
+
+def start_settlement(campaign_id: int) -> bool:
+    """Chạy quyết toán trong thread riêng (không chặn Battle Engine). False nếu đang chạy rồi."""
+    with _running_lock:
+        if campaign_id in _running:
+            return False
+        _running.add(campaign_id)
+
+    def job():
+        try:
+            run_settlement(campaign_id)
+        finally:
+            with _running_lock:
+                _running.discard(campaign_id)
+
+    threading.Thread(target=job, name=f"settlement-{campaign_id}", daemon=True).start()
+    return True
+
+def resume_pending_settlements():
+    """Lúc bật server: chạy tiếp các quyết toán dang dở (server tắt giữa chừng)."""
+    with Session(engine) as db:
+        db.exec(
+            update(CampaignSettlement)
+            .where(CampaignSettlement.status == "RUNNING")
+            .values(status="PENDING")
+        )
+        db.commit()
+        pending = db.exec(select(CampaignSettlement.campaign_id).where(CampaignSettlement.status == "PENDING")).all()
+    for campaign_id in pending:
+        print(f"🎁 Tiếp tục phát thưởng chiến dịch #{campaign_id}...")
+        start_settlement(campaign_id)
+
+
+# =========================================================
+# 3. QUYẾT TOÁN (Set-based, chạy lại bao nhiêu lần cũng không phát trùng)
+# =========================================================
+def _settle_chunk(db: Session, settlement: CampaignSettlement, outcome: str, rewards: dict) -> int:
+    """
+    1 lô của 1 kết quả (thắng / thua):
+    - UPDATE #1: đánh dấu rewarded_at cho tối đa SETTLEMENT_CHUNK lãnh chúa chưa nhận (RETURNING player_id)
+    - UPDATE #2: cộng tiền cả lô qua ví (kèm sổ cái)
+    - 1 lần chèn ScoreLog hàng loạt
+    """
+    faction_cond = (
+        CampaignPlayer.faction == settlement.winner_faction if outcome == "WIN"
+        # "!=" với NULL là NULL trong SQL -> lãnh chúa chưa chọn phe cũng nhận thưởng Tham gia
+        else or_(CampaignPlayer.faction == None, CampaignPlayer.faction != settlement.winner_faction)
+    )
+    chunk = (
+        select(CampaignPlayer.id)
+        .where(
+            CampaignPlayer.campaign_id == settlement.campaign_id,
+            faction_cond,
+            CampaignPlayer.rewarded_at == None
+        )
+        .limit(SETTLEMENT_CHUNK)
+        .scalar_subquery()
+    )
+    player_ids = db.exec(
+        update(CampaignPlayer)
+        .where(CampaignPlayer.id.in_(chunk))
+        .values(rewarded_at=datetime.now())
+        .returning(CampaignPlayer.player_id)
+        .execution_options(synchronize_session=False)
+    ).scalars().all()
+    if not player_ids:
+        return 0
+
+    wallet.batch_credit(db, player_ids, rewards, reason="campaign_reward", ref=settlement.campaign_id)
+
+    status_text = "Chiến thắng" if outcome == "WIN" else "Tham gia"
+    description = (
+        f"Thưởng {status_text} chiến dịch mùa này: +{rewards['kpi']} KPI, "
+        f"+{rewards['tri_thuc']} Tri Thức, +{rewards['chien_tich']} Chiến Tích."
+    )
+    now = datetime.now()
+    players = db.exec(select(Player.id, Player.username).where(Player.id.in_(player_ids))).all()
+    if players:
+        db.exec(insert(ScoreLog), params=[
+            {
+                "target_id": pid, "target_name": username, "sender_id": 0, "sender_name": "Hệ Thống",
+                "category": "TÀI NGUYÊN", "description": description,
+                "value_change": rewards["kpi"], "created_at": now
+            }
+            for pid, username in players
+        ])
+    return len(player_ids)
+
+def run_settlement(campaign_id: int) -> Optional[dict]:
+    """Phát thưởng cuối mùa theo từng lô. Trả về tiến độ, None nếu không có gì để chạy."""
+    with Session(engine) as db:
+        # 1. Giành quyền chạy (chỉ 1 tiến trình chuyển được PENDING/FAILED -> RUNNING)
+        claimed = db.exec(
+            update(CampaignSettlement)
+            .where(
+                CampaignSettlement.campaign_id == campaign_id,
+                CampaignSettlement.status.in_(["PENDING", "FAILED"])
+            )
+            .values(status="RUNNING", started_at=datetime.now(), error=None)
+            .returning(CampaignSettlement.id)
+        ).first()
+        if not claimed:
+            db.rollback()
+            return None
+        settlement = db.get(CampaignSettlement, claimed[0])
+        settlement.total, settlement.processed = db.exec(
+            select(func.count(CampaignPlayer.id), func.count(CampaignPlayer.rewarded_at))
+            .where(CampaignPlayer.campaign_id == campaign_id)
+        ).one()
+        db.add(settlement)
+        db.commit()
+
+        # 2. Phát thưởng từng lô, commit sau mỗi lô (tiến độ hiện ngay cho Admin)
+        try:
+            for outcome in ("WIN", "LOSE"):
+                rewards = reward_for(outcome)
+                while True:
+                    done = _settle_chunk(db, settlement, outcome, rewards)
+                    if not done:
+                        break
+                    settlement.processed += done
+                    db.add(settlement)
+                    db.commit()
+
+            settlement.status = "DONE"
+            settlement.finished_at = datetime.now()
+            db.add(settlement)
+            db.commit()
+            print(f"🎁 Đã phát thưởng thành công cho {settlement.processed} lãnh chúa tham gia!")
+        except Exception as e:
+            db.rollback()
+            print(f"❌ LỖI PHÁT THƯỞNG CHIẾN DỊCH #{campaign_id}: {traceback.format_exc()}")
+            settlement = db.get(CampaignSettlement, claimed[0])
+            settlement.status = "FAILED"
+            settlement.error = str(e)[:500]
+            db.add(settlement)
+            db.commit()
+
+        return get_settlement_status(db, campaign_id)
+
+
+# =========================================================
+# 4. TIẾN ĐỘ
+# =========================================================
+def get_settlement_status(db: Session, campaign_id: int) -> Optional[dict]:
+    s = db.exec(select(CampaignSettlement).where(CampaignSettlement.campaign_id == campaign_id)).first()
+    if not s:
+        return None
+    return {
+        "campaign_id": s.campaign_id,
+        "winner_faction": s.winner_faction,
+        "status": s.status,
+        "total": s.total,
+        "processed": s.processed,
+        "percent": round(s.processed * 100 / s.total, 1) if s.total else (100.0 if s.status == "DONE" else 0.0),
+        "error": s.error,
+        "started_at": s.started_at,
+        "finished_at": s.finished_at,
+    }
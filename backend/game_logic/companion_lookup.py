@@ -0,0 +1,92 @@
+from collections import Counter
+from typing import Dict, List, Optional
+from sqlalchemy import insert
+from sqlmodel import Session, select
+from database import engine, Companion, CompanionAlias, CompanionTemplate, SystemConfig
+
+# Khóa đánh dấu đã chuyển đổi ID cũ (lưu trong SystemConfig)
+MIGRATION_KEY = "migration_companion_alias_v1"
+
+
+def normalize_id(raw_id) -> str:
+    return str(raw_id).strip().lower()
+
+def legacy_ui_id(rarity: str, template_id: str, companion_id: str) -> str:
+    """ID giao diện kiểu cũ của /api/my-cards: {rarity}_{template_id}_{4 ký tự cuối viết hoa}."""
+    return f"{rarity}_{template_id}_{str(companion_id)[-4:].upper()}"
+
+
+# =========================================================
+# 1. TRA CỨU THEO ID CHUẨN (Companion.id) HOẶC ID CŨ ĐÃ CHUYỂN ĐỔI
+# =========================================================
+def resolve_companions(db: Session, player_id: int, raw_ids: List) -> Dict[str, Companion]:
+    """
+    Tra nhiều thẻ cùng lúc: tối đa 2 query có index (khóa chính, rồi bảng alias cho ID cũ).
+    Trả về {ID gửi lên: Companion}; ID không thuộc người chơi / không tồn tại thì không có trong kết quả.
+    """
+    wanted = {str(r).strip(): r for r in raw_ids if r is not None and str(r).strip()}
+    if not wanted:
+        return {}
+
+    found = {}
+    for comp in db.exec(select(Companion).where(
+        Companion.id.in_(list(wanted)),
+        Companion.player_id == player_id
+    )).all():
+        found[comp.id] = comp
+
+    missing = {normalize_id(k): k for k in wanted if k not in found}
+    if missing:
+        rows = db.exec(
+            select(CompanionAlias.alias, Companion)
+            .join(Companion, Companion.id == CompanionAlias.companion_id)
+            .where(
+                CompanionAlias.player_id == player_id,
+                CompanionAlias.alias.in_(list(missing)),
+                Companion.player_id == player_id
+            )
+        ).all()
+        for alias, comp in rows:
+            found[missing[alias]] = comp
+
+    return {wanted[k]: comp for k, comp in found.items()}
+
+def resolve_companion(db: Session, player_id: int, raw_id) -> Optional[Companion]:
+    return resolve_companions(db, player_id, [raw_id]).get(raw_id)
+
+
+# =========================================================
+# 2. CHUYỂN ĐỔI 1 LẦN: GHI ALIAS CHO ID GIAO DIỆN CŨ
+# =========================================================
+def migrate_legacy_companion_ids():
+    """
+    Lúc bật server (chỉ chạy 1 lần): tính ID giao diện cũ của mọi thẻ đang có và lưu vào CompanionAlias.
+    ID cũ bị trùng trong cùng 1 người chơi (2 thẻ cùng phôi, cùng 4 ký tự cuối) là mơ hồ -> không lưu,
+    giao diện mới đã gửi ID chuẩn nên chỉ ảnh hưởng trang đang mở từ trước khi nâng cấp.
+    """
+    with Session(engine) as db:
+        if db.get(SystemConfig, MIGRATION_KEY):
+            return
+
+        rows = db.exec(
+            select(Companion.id, Companion.player_id, Companion.template_id, CompanionTemplate.rarity)
+            .join(CompanionTemplate, CompanionTemplate.template_id == Companion.template_id)
+        ).all()
+        aliases = [
+            (player_id, normalize_id(legacy_ui_id(rarity, template_id, comp_id)), comp_id)
+            for comp_id, player_id, template_id, rarity in rows
+        ]
+        counts = Counter((player_id, alias) for player_id, alias, _ in aliases)
+        unique = [
+            {"player_id": player_id, "alias": alias, "companion_id": comp_id}
+            for player_id, alias, comp_id in aliases
+            # ID cũ trùng với chính ID chuẩn thì không cần alias
+            if counts[(player_id, alias)] == 1 and alias != normalize_id(comp_id)
+        ]
+        if unique:
+            db.exec(insert(CompanionAlias), params=unique)
+        db.add(SystemConfig(key=MIGRATION_KEY, value=str(len(unique))))
+        db.commit()
+
+        ambiguous = sum(1 for c in counts.values() if c > 1)
+        print(f"🪪 Đã chuyển đổi ID thẻ cũ: {len(unique)} alias, {ambiguous} ID mơ hồ bị bỏ qua")
@@ -0,0 +1,148 @@
+from collections import defaultdict
+from typing import Optional
+from sqlalchemy import bindparam, case, delete, update
+from sqlmodel import Session, select, func
+from database import Player, Companion, CompanionAlias, CampaignPlayer
+from game_logic.stats import apply_stat_delta
+
+# Mỗi lần đột phá: 1 thẻ chính + FODDER_PER_BREAKTHROUGH thẻ nguyên liệu cùng phôi, cùng sao
+FODDER_PER_BREAKTHROUGH = 2
+# Mỗi lần đột phá tăng 5% HP / ATK (làm tròn xuống như API đột phá lẻ)
+BREAKTHROUGH_MULTIPLIER = 1.05
+
+
+def _power(card: dict) -> int:
+    return card["atk"] + card["hp"]
+
+def _breakthrough(card: dict):
+    card["star"] += 1
+    card["hp"] = int(card["hp"] * BREAKTHROUGH_MULTIPLIER)
+    card["atk"] = int(card["atk"] * BREAKTHROUGH_MULTIPLIER)
+
+
+# =========================================================
+# 1. LÊN KẾ HOẠCH GHÉP (thuần Python, không đụng DB)
+# =========================================================
+def plan_merges(cards: list) -> tuple:
+    """
+    cards: [{id, template_id, star, atk, hp, protected}] - protected = khóa / đang mặc / đang làm Chủ Tướng
+    (chỉ được làm thẻ chính, không bao giờ bị đem làm nguyên liệu).
+    Ghép từ sao thấp lên cao, thẻ vừa lên sao được xét tiếp ở mức sao mới.
+    Thẻ chính: ưu tiên thẻ protected, rồi thẻ mạnh nhất; nguyên liệu: thẻ yếu nhất.
+    Trả về (số lần đột phá, {id thẻ chính: card đã cập nhật}, [id nguyên liệu]).
+    """
+    by_template = defaultdict(list)
+    for card in cards:
+        by_template[card["template_id"]].append(card)
+
+    total = 0
+    upgraded, consumed = {}, []
+    for group in by_template.values():
+        levels = defaultdict(list)
+        for card in group:
+            levels[card["star"]].append(card)
+
+        while levels:
+            star = min(levels)
+            pool = levels.pop(star)
+            mains = sorted((c for c in pool if c["protected"]), key=_power, reverse=True)
+            free = sorted((c for c in pool if not c["protected"]), key=_power, reverse=True)
+
+            promoted = []
+            while True:
+                if mains:
+                    if len(free) < FODDER_PER_BREAKTHROUGH:
+                        break
+                    main = mains.pop(0)
+                elif len(free) >= FODDER_PER_BREAKTHROUGH + 1:
+                    main = free.pop(0)
+                else:
+                    break
+                for _ in range(FODDER_PER_BREAKTHROUGH):
+                    consumed.append(free.pop()["id"])
+                _breakthrough(main)
+                upgraded[main["id"]] = main
+                promoted.append(main)
+                total += 1
+
+            # Thẻ vừa lên sao được xét tiếp cùng các thẻ sẵn có ở mức sao mới
+            if promoted:
+                levels[star + 1].extend(promoted)
+    return total, upgraded, consumed
+
+
+# =========================================================
+# 2. TỰ ĐỘNG GHÉP THẺ CHO 1 NGƯỜI CHƠI (1 transaction, không commit)
+# =========================================================
+def auto_merge(db: Session, player: Player, template_id: Optional[str] = None, dry_run: bool = False) -> dict:
+    """Đột phá nhiều nhất có thể cho mọi nhóm (phôi, sao); route commit 1 lần."""
+    locked_or_equipped = (Companion.is_locked == True) | (Companion.is_equipped == True)
+
+    # 1. Thẻ đang làm Chủ Tướng chiến dịch cũng không được đem làm nguyên liệu
+    commander_ids = set(db.exec(
+        select(CampaignPlayer.companion_id).where(
+            CampaignPlayer.player_id == player.id,
+            CampaignPlayer.companion_id != None
+        )
+    ).all())
+
+    # 2. 1 câu GROUP BY: chỉ các phôi có ít nhất 2 thẻ tự do cùng sao mới có thể ghép
+    eligible = (
+        select(Companion.template_id)
+        .where(Companion.player_id == player.id)
+        .group_by(Companion.template_id, Companion.star)
+        .having(func.sum(case((locked_or_equipped, 0), else_=1)) >= FODDER_PER_BREAKTHROUGH)
+    )
+    if template_id:
+        eligible = eligible.where(Companion.template_id == template_id)
+    template_ids = set(db.exec(eligible).all())
+    if not template_ids:
+        return {"breakthroughs": 0, "consumed": 0, "upgraded": []}
+
+    # 3. Nạp thẻ của các phôi đó (chỉ cột cần thiết)
+    rows = db.exec(
+        select(Companion.id, Companion.template_id, Companion.star, Companion.atk, Companion.hp,
+               Companion.temp_name, Companion.is_locked, Companion.is_equipped)
+        .where(Companion.player_id == player.id, Companion.template_id.in_(template_ids))
+    ).all()
+    cards = [
+        {
+            "id": r.id, "template_id": r.template_id, "star": r.star, "atk": r.atk, "hp": r.hp,
+            "name": r.temp_name, "equipped": r.is_equipped,
+            "protected": bool(r.is_locked or r.is_equipped or r.id in commander_ids),
+            "old": (r.star, r.atk, r.hp),
+        }
+        for r in rows
+    ]
+
+    total, upgraded, consumed = plan_merges(cards)
+    summary = {
+        "breakthroughs": total,
+        "consumed": len(consumed),
+        "upgraded": [
+            {"id": c["id"], "name": c["name"], "old_star": c["old"][0], "new_star": c["star"],
+             "new_hp": c["hp"], "new_atk": c["atk"]}
+            for c in upgraded.values()
+        ],
+    }
+    if dry_run or not total:
+        return summary
+
+    # 4. Ghi xuống DB: 1 DELETE nguyên liệu + 1 UPDATE hàng loạt thẻ chính
+    db.exec(delete(CompanionAlias).where(CompanionAlias.companion_id.in_(consumed)))
+    db.exec(delete(Companion).where(Companion.id.in_(consumed), Companion.player_id == player.id))
+    db.connection().execute(
+        update(Companion.__table__)
+        .where(Companion.__table__.c.id == bindparam("b_id"))
+        .values(star=bindparam("b_star"), atk=bindparam("b_atk"), hp=bindparam("b_hp")),
+        [{"b_id": c["id"], "b_star": c["star"], "b_atk": c["atk"], "b_hp": c["hp"]} for c in upgraded.values()]
+    )
+    # Đối tượng Companion đang nằm trong session (nếu có) phải đọc lại giá trị mới
+    db.expire_all()
+
+    # 5. Cộng chỉ số 1 lần cho các thẻ chính đang mặc
+    atk_delta = sum(c["atk"] - c["old"][1] for c in upgraded.values() if c["equipped"])
+    hp_delta = sum(c["hp"] - c["old"][2] for c in upgraded.values() if c["equipped"])
+    if atk_delta or hp_delta:
+        apply_stat_delta(db, player, atk_delta, hp_delta, heal_mode="MAINTAIN_PERCENT")
+    return summary
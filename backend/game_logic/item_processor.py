@@ -1,30 +1,22 @@
 import json
 import random
-import os
 import uuid
 import time
 import datetime
 from sqlmodel import Session, select
-from database import Inventory, Item, Player, PlayerItem, SystemConfig, ChatLog, Companion, CompanionTemplate, CompanionConfig
+from database import Inventory, Item, Player, PlayerItem, ChatLog, Companion, CompanionConfig
+from services import wallet
+from services.static_registry import registry
+from services.asset_pool import asset_pool
+from game_logic import loot_engine
+from game_logic.stats import charm_stats, set_charm_stats
 # =====================================================
 # CẤU HÌNH MẶC ĐỊNH (FALLBACK)
 # =====================================================
 # =====================================================
-# CẤU HÌNH ĐƯỜNG DẪN ẢNH (ĐÃ SỬA CHO CẤU TRÚC BACKEND/FRONTEND)
+# CẤU HÌNH ĐƯỜNG DẪN ẢNH (Thư mục ảnh Charm trên đĩa: asset_pool, nhóm "charms")
 # =====================================================
 
-# 1. Lấy vị trí file item_processor.py (đang ở: backend/game_logic)
-CURRENT_FILE_DIR = os.path.dirname(os.path.abspath(__file__))
-
-# 2. Lấy thư mục Backend (cha của game_logic)
-BACKEND_DIR = os.path.dirname(CURRENT_FILE_DIR)
-
-# 3. Lấy thư mục Gốc Dự Án (cha của Backend) - Nơi chứa cả folder backend và frontend
-PROJECT_ROOT = os.path.dirname(BACKEND_DIR)
-
-# 4. Tạo đường dẫn đến thư mục ảnh trong Frontend
-CHARM_DISK_PATH = os.path.join(PROJECT_ROOT, "frontend", "assets", "items", "charms")
-
 # Đường dẫn URL hiển thị trên web (Giữ nguyên)
 CHARM_URL_PREFIX = "/assets/items/charms/"
 
@@ -52,22 +44,29 @@ def calculate_max_hp_limit(player):
 # =====================================================
 # BỘ XỬ LÝ ITEM (BẢN ĐẦY ĐỦ: GACHA + TIỀN TỆ + HỒI SINH)
 # =====================================================
+def resolve_item_config(item) -> dict:
+    """Config của Item dưới dạng dict ({} nếu trống)."""
+    raw_config = item.config
+    if not raw_config:
+        return {}
+    # Item lấy từ registry đã có config_dict parse sẵn -> dùng luôn
+    if getattr(item, "config_dict", None) is not None:
+        return item.config_dict
+    # Nếu config là chuỗi (String) thì mới cần parse JSON, nếu là Dict rồi thì dùng luôn
+    if isinstance(raw_config, str):
+        try:
+            return json.loads(raw_config)
+        except Exception:
+            # Nếu admin nhập text thường (không phải JSON), coi đó là tên action luôn
+            return {"action": raw_config.strip()}
+    return raw_config
+
 def apply_item_effects(player: Player, item: Item, db: Session):
     try:
         # --- 1. LẤY CONFIG AN TOÀN ---
-        raw_config = item.config
-        if not raw_config: 
+        config = resolve_item_config(item)
+        if not config: 
             return False, "Item lỗi config: Trống dữ liệu", {}
-        
-        # Nếu config là chuỗi (String) thì mới cần parse JSON, nếu là Dict rồi thì dùng luôn
-        if isinstance(raw_config, str):
-            try:
-                config = json.loads(raw_config)
-            except Exception:
-                # Nếu admin nhập text thường (không phải JSON), coi đó là tên action luôn
-                config = {"action": raw_config.strip()}
-        else:
-            config = raw_config
 
         # --- 2. XÁC ĐỊNH HÀNH ĐỘNG (ACTION) ---
         # Ưu tiên lấy 'action' từ config, nếu không có mới lấy 'type'
@@ -83,62 +82,99 @@ def apply_item_effects(player: Player, item: Item, db: Session):
         # =====================================================
         if action == "gacha_open" or action == "Rương Gacha (Quay vật phẩm)":
             # Hỗ trợ mọi kiểu key mà admin có thể nhập
-            drops = (config.get("gacha_items") or config.get("drops") or config.get("pool") or config.get("loot_table") or [])           
+            drops = loot_engine.chest_drops(config)
             if not drops: return False, "Rương rỗng!", {}
             received_map = {} # Dùng để gộp đồ: {"Bình máu": 2}
             
-            # --- QUAY THƯỞNG ---
-            for drop in drops:
-                rate = int(drop.get("rate", 0))
-                # Random tỷ lệ rơi
-                if random.randint(1, 100) <= rate:
-                    target_id = int(drop.get("item_id") or drop.get("id"))
+            # --- QUAY THƯỞNG (bảng rơi đồ biên dịch sẵn, mỗi dòng quay độc lập) ---
+            for target_id, qty in loot_engine.drop_table(drops).roll(1).items():
                     
-                    # Random số lượng min-max
-                    min_q = int(drop.get("min", 1))
-                    max_q = int(drop.get("max", 1))
-                    qty = random.randint(min_q, max_q)
-                    
-                    # --- ĐOẠN KIỂM TRA CHARM MỚI ---
-                    item_obj = db.get(Item, target_id)
-                    if not item_obj: continue
-
-                    # Đọc config của item vừa quay trúng
-                    item_config = {}
-                    try:
-                        item_config = json.loads(item_obj.config) if item_obj.config else {}
-                    except: pass
+                # --- ĐOẠN KIỂM TRA CHARM MỚI ---
+                item_obj = registry.get_item(db, target_id)
+                if not item_obj: continue
+
+                # Đọc config của item vừa quay trúng (đã parse sẵn trong registry)
+                item_config = item_obj.config_dict or {}
                     
-                    item_action = item_config.get("action")
-
-                    # Nếu là Phôi Charm (Ma thuật, Sử thi, Huyền thoại)
-                    if item_action in ["charm_gen_magic", "charm_gen_epic", "charm_gen_legend"]:
-                        rarity_map = {
-                            "charm_gen_magic": "MAGIC",
-                            "charm_gen_epic": "EPIC",
-                            "charm_gen_legend": "LEGEND"
-                        }
-                        rarity_type = rarity_map.get(item_action)
-
-                        # Chạy dây chuyền sản xuất Charm theo số lượng qty
-                        for _ in range(qty):
-                            new_charm = generate_charm(db, player.id, rarity_type)
-                            # Lấy tên tiếng Việt của Charm vừa đúc xong để hiện thông báo
-                            clean_name = f"{new_charm.name} ({rarity_type})"
-                            received_map[clean_name] = received_map.get(clean_name, 0) + 1
-                        # 👇 THÊM ĐOẠN NÀY ĐỂ LOA THÔNG BÁO 👇
-                            if rarity_type == "LEGEND":
+                item_action = item_config.get("action")
+
+                # Nếu là Phôi Charm (Ma thuật, Sử thi, Huyền thoại)
+                if item_action in ["charm_gen_magic", "charm_gen_epic", "charm_gen_legend"]:
+                    rarity_map = {
+                        "charm_gen_magic": "MAGIC",
+                        "charm_gen_epic": "EPIC",
+                        "charm_gen_legend": "LEGEND"
+                    }
+                    rarity_type = rarity_map.get(item_action)
+
+                    # Chạy dây chuyền sản xuất Charm theo số lượng qty (commit chung ở cuối)
+                    for new_charm in generate_charms(db, player.id, rarity_type, qty, commit=False):
+                        # Lấy tên tiếng Việt của Charm vừa đúc xong để hiện thông báo
+                        clean_name = f"{new_charm.name} ({rarity_type})"
+                        received_map[clean_name] = received_map.get(clean_name, 0) + 1
+                    # 👇 THÊM ĐOẠN NÀY ĐỂ LOA THÔNG BÁO 👇
+                        if rarity_type == "LEGEND":
                                 
-                                now = datetime.datetime.now().strftime("%H:%M")
+                            now = datetime.datetime.now().strftime("%H:%M")
+                                
+                            # Tạo nội dung tin nhắn có chứa hiệu ứng "con rắn"
+                            announcement_content = (
+                                f"📢 Chúc mừng <b>{player.username}</b> đã may mắn mở rương được "
+                                f"Charm Huyền Thoại: <span class='name-admin-wrapper'><span class='name-admin'>{new_charm.name}</span></span>!"
+                            )
+                                
+                            # Tạo bản ghi tin nhắn mới vào bảng Chat của bạn
+                            # (Lưu ý: Bạn hãy kiểm tra tên bảng Chat của mình là 'Chat' hay 'ChatMessage' nhé)
+                            system_msg = ChatLog(
+                                player_name="HỆ THỐNG",
+                                content=announcement_content,
+                                role="SYSTEM",
+                                time=now
+                            )
+                            db.add(system_msg)
+                    continue 
+                # --- KẾT THÚC ĐOẠN KIỂM TRA CHARM ---
+
+                # --- LOGIC MỚI: XỬ LÝ THẺ BÀI (CARD) ---
+                if item_action in ["card_gen_r", "card_gen_sr", "card_gen_ssr", "card_gen_usr"]:
+                    # 1. Map action sang độ hiếm
+                    card_rarity_map = {
+                        "card_gen_r": "R",
+                        "card_gen_sr": "SR",
+                        "card_gen_ssr": "SSR",
+                        "card_gen_usr": "USR"
+                    }
+                    rarity_type = card_rarity_map.get(item_action)
+
+                    # 2. Chạy vòng lặp sinh thẻ
+                    for _ in range(qty):
+                        # Gọi hàm logic thật đã viết ở trên
+                        new_card = generate_companion_card(db, player.id, rarity_type)
+                            
+                        if new_card:
+                            # Lấy tên từ thuộc tính tạm temp_name hoặc ID nếu lỗi
+                            card_name = getattr(new_card, 'temp_name', 'Thẻ Ẩn Danh')
+                                
+                            # Tạo tên hiển thị kèm chỉ số để người chơi biết mình nhận được hàng ngon hay dở
+                            clean_name = f"{card_name} ({rarity_type}) [HP:{new_card.hp} ATK:{new_card.atk}]"
                                 
-                                # Tạo nội dung tin nhắn có chứa hiệu ứng "con rắn"
+                            # Cộng vào map hiển thị "Bạn nhận được..."
+                            received_map[clean_name] = received_map.get(clean_name, 0) + 1
+
+                            # 3. Loa thông báo (Chỉ báo nếu là SSR hoặc USR)
+                            if rarity_type in ["SSR", "USR"]:
+                                now = datetime.datetime.now().strftime("%H:%M")
+                                    
+                                # CSS: USR màu đỏ, SSR màu vàng cam
+                                rarity_color = "text-red-500" if rarity_type == "USR" else "text-yellow-400"
+                                    
                                 announcement_content = (
-                                    f"📢 Chúc mừng <b>{player.username}</b> đã may mắn mở rương được "
-                                    f"Charm Huyền Thoại: <span class='name-admin-wrapper'><span class='name-admin'>{new_charm.name}</span></span>!"
+                                    f"📢 Chúc mừng <b>{player.username}</b> nhân phẩm bùng nổ! "
+                                    f"Vừa triệu hồi được: <span class='{rarity_color} font-bold'>[{card_name}]</span> "
+                                    f"(Sức mạnh: {new_card.atk} - Máu: {new_card.hp})!"
                                 )
-                                
-                                # Tạo bản ghi tin nhắn mới vào bảng Chat của bạn
-                                # (Lưu ý: Bạn hãy kiểm tra tên bảng Chat của mình là 'Chat' hay 'ChatMessage' nhé)
+                                    
+                                # [cite_start]Lưu vào ChatLog [cite: 50]
                                 system_msg = ChatLog(
                                     player_name="HỆ THỐNG",
                                     content=announcement_content,
@@ -146,87 +182,37 @@ def apply_item_effects(player: Player, item: Item, db: Session):
                                     time=now
                                 )
                                 db.add(system_msg)
-                        continue 
-                    # --- KẾT THÚC ĐOẠN KIỂM TRA CHARM ---
-
-                    # --- LOGIC MỚI: XỬ LÝ THẺ BÀI (CARD) ---
-                    if item_action in ["card_gen_r", "card_gen_sr", "card_gen_ssr", "card_gen_usr"]:
-                        # 1. Map action sang độ hiếm
-                        card_rarity_map = {
-                            "card_gen_r": "R",
-                            "card_gen_sr": "SR",
-                            "card_gen_ssr": "SSR",
-                            "card_gen_usr": "USR"
-                        }
-                        rarity_type = card_rarity_map.get(item_action)
-
-                        # 2. Chạy vòng lặp sinh thẻ
-                        for _ in range(qty):
-                            # Gọi hàm logic thật đã viết ở trên
-                            new_card = generate_companion_card(db, player.id, rarity_type)
-                            
-                            if new_card:
-                                # Lấy tên từ thuộc tính tạm temp_name hoặc ID nếu lỗi
-                                card_name = getattr(new_card, 'temp_name', 'Thẻ Ẩn Danh')
-                                
-                                # Tạo tên hiển thị kèm chỉ số để người chơi biết mình nhận được hàng ngon hay dở
-                                clean_name = f"{card_name} ({rarity_type}) [HP:{new_card.hp} ATK:{new_card.atk}]"
-                                
-                                # Cộng vào map hiển thị "Bạn nhận được..."
-                                received_map[clean_name] = received_map.get(clean_name, 0) + 1
+                        else:
+                            # Trường hợp Admin chưa tạo Phôi trong database
+                            print(f"Lỗi: Không tìm thấy phôi thẻ loại {rarity_type}")
 
-                                # 3. Loa thông báo (Chỉ báo nếu là SSR hoặc USR)
-                                if rarity_type in ["SSR", "USR"]:
-                                    now = datetime.datetime.now().strftime("%H:%M")
-                                    
-                                    # CSS: USR màu đỏ, SSR màu vàng cam
-                                    rarity_color = "text-red-500" if rarity_type == "USR" else "text-yellow-400"
-                                    
-                                    announcement_content = (
-                                        f"📢 Chúc mừng <b>{player.username}</b> nhân phẩm bùng nổ! "
-                                        f"Vừa triệu hồi được: <span class='{rarity_color} font-bold'>[{card_name}]</span> "
-                                        f"(Sức mạnh: {new_card.atk} - Máu: {new_card.hp})!"
-                                    )
-                                    
-                                    # [cite_start]Lưu vào ChatLog [cite: 50]
-                                    system_msg = ChatLog(
-                                        player_name="HỆ THỐNG",
-                                        content=announcement_content,
-                                        role="SYSTEM",
-                                        time=now
-                                    )
-                                    db.add(system_msg)
-                            else:
-                                # Trường hợp Admin chưa tạo Phôi trong database
-                                print(f"Lỗi: Không tìm thấy phôi thẻ loại {rarity_type}")
-
-                        # Skip đoạn cộng item thường, vì đã sinh thẻ rồi
-                        continue
-                    # --- KẾT THÚC LOGIC THẺ BÀI ---
+                    # Skip đoạn cộng item thường, vì đã sinh thẻ rồi
+                    continue
+                # --- KẾT THÚC LOGIC THẺ BÀI ---
                     
 
-                    # --- CỘNG VÀO KHO (AN TOÀN) - Chỉ chạy cho Item thường ---
-                    inv_item = db.exec(select(Inventory).where(
-                        Inventory.player_id == player.id,
-                        Inventory.item_id == target_id
-                    )).first()
-
-                    if inv_item:
-                        current_amt = int(inv_item.amount)
-                        inv_item.amount = current_amt + qty
-                        db.add(inv_item)
-                    else:
-                        new_item = Inventory(player_id=player.id, item_id=target_id, amount=qty)
-                        db.add(new_item)
+                # --- CỘNG VÀO KHO (AN TOÀN) - Chỉ chạy cho Item thường ---
+                inv_item = db.exec(select(Inventory).where(
+                    Inventory.player_id == player.id,
+                    Inventory.item_id == target_id
+                )).first()
+
+                if inv_item:
+                    current_amt = int(inv_item.amount)
+                    inv_item.amount = current_amt + qty
+                    db.add(inv_item)
+                else:
+                    new_item = Inventory(player_id=player.id, item_id=target_id, amount=qty)
+                    db.add(new_item)
                     
-                    # Xử lý tên cho Item thường để hiện thông báo
-                    raw_name = item_obj.name if item_obj else f"Item {target_id}"
-                    clean_name = raw_name.replace("\xa0", " ").strip()
+                # Xử lý tên cho Item thường để hiện thông báo
+                raw_name = item_obj.name if item_obj else f"Item {target_id}"
+                clean_name = raw_name.replace("\xa0", " ").strip()
                     
-                    if clean_name in received_map:
-                        received_map[clean_name] += qty
-                    else:
-                        received_map[clean_name] = qty
+                if clean_name in received_map:
+                    received_map[clean_name] += qty
+                else:
+                    received_map[clean_name] = qty
 
             db.commit() # Lưu ngay
 
@@ -270,24 +256,12 @@ def apply_item_effects(player: Player, item: Item, db: Session):
             currency_type = config.get("target_currency") or config.get("type", "tri_thuc")
             amount = int(value)
             
-            msg = ""
-            if currency_type == "tri_thuc":
-                player.tri_thuc = (player.tri_thuc or 0) + amount
-                msg = f"+{amount} Tri Thức"
-            elif currency_type == "chien_tich":
-                player.chien_tich = (player.chien_tich or 0) + amount
-                msg = f"+{amount} Chiến Tích"
-            elif currency_type == "vinh_du":
-                player.vinh_du = (player.vinh_du or 0) + amount
-                msg = f"+{amount} Vinh Dự"
-            elif currency_type == "kpi":
-                player.kpi = (player.kpi or 0) + amount
-                msg = f"+{amount} KPI"
-            else:
+            labels = {"tri_thuc": "Tri Thức", "chien_tich": "Chiến Tích", "vinh_du": "Vinh Dự", "kpi": "KPI"}
+            if currency_type not in labels:
                 return False, f"Loại tiền tệ '{currency_type}' không hợp lệ", {}
-            
-            db.add(player)
-            return True, msg, {"currency": currency_type, "amount": amount}
+
+            wallet.adjust(db, player.id, {currency_type: amount}, reason="item_use", ref=item.id)
+            return True, f"+{amount} {labels[currency_type]}", {"currency": currency_type, "amount": amount}
 
         # =====================================================
         # CASE 4: XÓA THỜI GIAN CHỜ HỒI SINH (ĐÃ KHÔI PHỤC)
@@ -323,51 +297,157 @@ def apply_item_effects(player: Player, item: Item, db: Session):
         traceback.print_exc()
         return False, "Lỗi hệ thống xử lý vật phẩm.", {}
     
+# =====================================================
+# DÙNG VẬT PHẨM HÀNG LOẠT (MỞ NHIỀU RƯƠNG - 1 TRANSACTION)
+# =====================================================
+# Số vật phẩm tối đa mỗi lần dùng hàng loạt
+BULK_USE_MAX = 100
+
+CHARM_GEN_ACTIONS = {"charm_gen_magic": "MAGIC", "charm_gen_epic": "EPIC", "charm_gen_legend": "LEGEND"}
+CARD_GEN_ACTIONS = {"card_gen_r": "R", "card_gen_sr": "SR", "card_gen_ssr": "SSR", "card_gen_usr": "USR"}
+
+def apply_inventory_deltas(db: Session, player_id: int, deltas: dict):
+    """Cộng/trừ nhiều loại vật phẩm vào túi: 1 query đọc các ô hiện có, không commit."""
+    deltas = {item_id: qty for item_id, qty in deltas.items() if qty}
+    if not deltas:
+        return
+    rows = db.exec(select(Inventory).where(
+        Inventory.player_id == player_id,
+        Inventory.item_id.in_(list(deltas))
+    )).all()
+    existing = {row.item_id: row for row in rows}
+    for item_id, qty in deltas.items():
+        row = existing.get(item_id)
+        if row:
+            row.amount = int(row.amount) + qty
+            if row.amount <= 0:
+                db.delete(row)
+            else:
+                db.add(row)
+        elif qty > 0:
+            db.add(Inventory(player_id=player_id, item_id=item_id, amount=qty))
+
+def _announce(db: Session, content: str):
+    db.add(ChatLog(
+        player_name="HỆ THỐNG",
+        content=content,
+        role="SYSTEM",
+        time=datetime.datetime.now().strftime("%H:%M")
+    ))
+
+def apply_item_effects_bulk(player: Player, item: Item, count: int, db: Session):
+    """
+    Dùng `count` vật phẩm cùng loại trong 1 transaction.
+    - Rương Gacha: bảng rơi đồ quay cả lô 1 lần (loot_engine), gộp mọi món rồi ghi túi đồ 1 lần.
+    - KHÔNG commit, KHÔNG trừ vật phẩm đã dùng (route trừ `used` rồi commit 1 lần).
+    Trả về (success, message, data, used) - used: số vật phẩm thực sự tiêu hao.
+    """
+    config = resolve_item_config(item)
+    if not config:
+        return False, "Item lỗi config: Trống dữ liệu", {}, 0
+
+    action = config.get("action") or config.get("type")
+    value = config.get("value", 0)
+
+    # --- 1. RƯƠNG GACHA ---
+    if action == "gacha_open" or action == "Rương Gacha (Quay vật phẩm)":
+        drops = loot_engine.chest_drops(config)
+        if not drops:
+            return False, "Rương rỗng!", {}, 0
+
+        received_map = {}
+        deltas = {}
+        for target_id, qty in loot_engine.drop_table(drops).roll(count).items():
+            item_obj = registry.get_item(db, target_id)
+            if not item_obj:
+                continue
+            item_action = (item_obj.config_dict or {}).get("action")
+
+            if item_action in CHARM_GEN_ACTIONS:
+                rarity_type = CHARM_GEN_ACTIONS[item_action]
+                for new_charm in generate_charms(db, player.id, rarity_type, qty, commit=False):
+                    clean_name = f"{new_charm.name} ({rarity_type})"
+                    received_map[clean_name] = received_map.get(clean_name, 0) + 1
+                    if rarity_type == "LEGEND":
+                        _announce(db,
+                            f"📢 Chúc mừng <b>{player.username}</b> đã may mắn mở rương được "
+                            f"Charm Huyền Thoại: <span class='name-admin-wrapper'><span class='name-admin'>{new_charm.name}</span></span>!"
+                        )
+
+            elif item_action in CARD_GEN_ACTIONS:
+                rarity_type = CARD_GEN_ACTIONS[item_action]
+                for _ in range(qty):
+                    new_card = generate_companion_card(db, player.id, rarity_type, commit=False)
+                    if not new_card:
+                        print(f"Lỗi: Không tìm thấy phôi thẻ loại {rarity_type}")
+                        break
+                    card_name = getattr(new_card, 'temp_name', 'Thẻ Ẩn Danh')
+                    clean_name = f"{card_name} ({rarity_type}) [HP:{new_card.hp} ATK:{new_card.atk}]"
+                    received_map[clean_name] = received_map.get(clean_name, 0) + 1
+                    if rarity_type in ["SSR", "USR"]:
+                        rarity_color = "text-red-500" if rarity_type == "USR" else "text-yellow-400"
+                        _announce(db,
+                            f"📢 Chúc mừng <b>{player.username}</b> nhân phẩm bùng nổ! "
+                            f"Vừa triệu hồi được: <span class='{rarity_color} font-bold'>[{card_name}]</span> "
+                            f"(Sức mạnh: {new_card.atk} - Máu: {new_card.hp})!"
+                        )
+
+            else:
+                deltas[target_id] = deltas.get(target_id, 0) + qty
+                clean_name = (item_obj.name or f"Item {target_id}").replace("\xa0", " ").strip()
+                received_map[clean_name] = received_map.get(clean_name, 0) + qty
+
+        apply_inventory_deltas(db, player.id, deltas)
+
+        msg_parts = [f"{qty}x {name}" for name, qty in received_map.items()]
+        message = (
+            f"Mở {count} rương, bạn nhận được: " + ", ".join(msg_parts) if msg_parts
+            else f"Mở {count} rương trống rỗng (Chúc bạn may mắn lần sau)!"
+        )
+        return True, message, {"received": msg_parts, "opened": count, "hp": int(player.hp or 0), "mp": 100}, count
+
+    # --- 2. HỒI MÁU: chỉ dùng đủ số bình cần để đầy máu ---
+    if action == "heal" or action == "Hồi máu (HP)":
+        heal = int(value or config.get("hp_restore", 100))
+        p_max = calculate_max_hp_limit(player)
+        p_cur = int(player.hp or 0)
+        if p_cur >= p_max:
+            return False, "Máu đã đầy!", {}, 0
+        used = min(count, -(-(p_max - p_cur) // heal)) if heal > 0 else count
+        player.hp = min(p_cur + heal * used, p_max)
+        db.add(player)
+        return True, f"Dùng {used} lần, hồi {player.hp - p_cur} HP. (Máu: {player.hp}/{p_max})", {"hp": player.hp}, used
+
+    # --- 3. TIỀN TỆ / KPI: cộng 1 lần tổng giá trị ---
+    if action == "add_currency" or action == "Nhận tiền tệ/KPI":
+        currency_type = config.get("target_currency") or config.get("type", "tri_thuc")
+        labels = {"tri_thuc": "Tri Thức", "chien_tich": "Chiến Tích", "vinh_du": "Vinh Dự", "kpi": "KPI"}
+        if currency_type not in labels:
+            return False, f"Loại tiền tệ '{currency_type}' không hợp lệ", {}, 0
+        amount = int(value) * count
+        wallet.adjust(db, player.id, {currency_type: amount}, reason="item_use", ref=item.id)
+        return True, f"+{amount} {labels[currency_type]}", {"currency": currency_type, "amount": amount}, count
+
+    # --- 4. CÁC LOẠI CÒN LẠI: dùng nhiều lần không có ý nghĩa -> dùng 1 cái như cũ ---
+    success, message, data = apply_item_effects(player, item, db)
+    return success, message, data, 1 if success else 0
+
 def get_charm_config(db: Session):
     """Lấy cấu hình Charm từ DB hoặc dùng mặc định"""
-    record = db.exec(select(SystemConfig).where(SystemConfig.key == "charm_setup")).first()
-    return json.loads(record.value) if record else DEFAULT_CHARM_CONFIG
+    return registry.get_config(db, "charm_setup", DEFAULT_CHARM_CONFIG)
 
 def get_forge_config(db: Session):
     """Lấy cấu hình Lò rèn từ DB hoặc dùng mặc định"""
-    record = db.exec(select(SystemConfig).where(SystemConfig.key == "forge_setup")).first()
-    return json.loads(record.value) if record else DEFAULT_FORGE_CONFIG
+    return registry.get_config(db, "forge_setup", DEFAULT_FORGE_CONFIG)
 
 # ==========================================================
 # 🏭 PHẦN 1: NHÀ MÁY SẢN XUẤT CHARM (GENERATOR) - [MỚI]
 # ==========================================================
-def generate_charm(db: Session, player_id: int, rarity: str = "MAGIC"):
-    """
-    Tạo charm mới và bỏ thẳng vào túi người chơi.
-    rarity: 'MAGIC', 'EPIC', 'LEGEND'
-    """
-    # 1. Lấy cấu hình & Chuẩn bị
-    config = get_charm_config(db)
-    target_config = config.get(rarity, config["MAGIC"]) # Fallback về Magic nếu lỗi
+CHARM_NAMES = {"MAGIC": "Charm Ma Thuật", "EPIC": "Charm Sử Thi", "LEGEND": "Charm Huyền Thoại"}
+# Số Charm tối đa mỗi lần tạo hàng loạt (admin tặng / rương rơi nhiều)
+CHARM_BATCH_MAX = 1000
 
-    # 2. Bốc ảnh ngẫu nhiên
-    img_name = "default.png"
-    try:
-        if os.path.exists(CHARM_DISK_PATH):
-            # Lấy tất cả file ảnh (png, jpg, jpeg)
-            valid_exts = ('.png', '.jpg', '.jpeg', '.webp')
-            files = [f for f in os.listdir(CHARM_DISK_PATH) if f.lower().endswith(valid_exts)]
-            
-            if files: 
-                img_name = random.choice(files)
-            else:
-                print(f"⚠️ Thư mục {CHARM_DISK_PATH} có tồn tại nhưng KHÔNG CÓ ẢNH nào!")
-        else:
-            print(f"⚠️ Không tìm thấy thư mục ảnh tại: {CHARM_DISK_PATH}")
-            # In ra để debug xem nó đang tìm ở đâu
-            print(f"ℹ️ (Gợi ý: Kiểm tra xem folder 'frontend' có nằm ngang hàng với folder 'backend' không)")
-    except Exception as e:
-        print(f"⚠️ Lỗi quét ảnh Charm: {e}")
-    
-    # Tạo URL chuẩn cho Frontend
-    full_img_url = f"{CHARM_URL_PREFIX}{img_name}"
-
-    # 3. Roll chỉ số (Stats)
+def _roll_charm_stats(rarity: str, target_config: dict) -> dict:
     stats = {}
     
     # Logic: Ma thuật (MAGIC) chỉ có 1 dòng (ATK hoặc HP)
@@ -382,151 +462,223 @@ def generate_charm(db: Session, player_id: int, rarity: str = "MAGIC"):
         hp_min, hp_max = target_config.get("hp_range", [100, 500])
         stats["atk"] = random.randint(atk_min, atk_max)
         stats["hp"] = random.randint(hp_min, hp_max)
+    return stats
 
-    # 4. Đặt tên tiếng Việt
-    vn_name = "CHARM"
-    if rarity == "MAGIC": vn_name = "Charm Ma Thuật"
-    elif rarity == "EPIC": vn_name = "Charm Sử Thi"
-    elif rarity == "LEGEND": vn_name = "Charm Huyền Thoại"
+def generate_charms(db: Session, player_id: int, rarity: str = "MAGIC", n: int = 1, commit: bool = True) -> list:
+    """
+    Tạo n charm cùng độ hiếm và bỏ thẳng vào túi người chơi.
+    Ảnh bốc từ asset_pool (danh sách thư mục nằm sẵn trong RAM) -> n charm = 1 lần đọc config + 1 lần commit.
+    commit=False: chỉ add vào session (route / mở rương commit 1 lần ở ngoài)
+    """
+    if n < 1:
+        return []
 
-    # 5. Lưu vào DB
-    new_item = PlayerItem(
-        player_id=player_id,
-        image_url=full_img_url,
-        rarity=rarity,
-        name=vn_name,
-        stats_data=json.dumps(stats),
-        enhance_level=0,
-        is_equipped=False,
-        slot_index=0
-    )
-    
-    db.add(new_item)
-    db.commit()
-    db.refresh(new_item)
-    
-    return new_item
+    # 1. Lấy cấu hình & Chuẩn bị
+    config = get_charm_config(db)
+    target_config = config.get(rarity, config["MAGIC"]) # Fallback về Magic nếu lỗi
+
+    # 2. Bốc ảnh ngẫu nhiên cho cả lô
+    images = asset_pool.pick("charms", n)
+    if not images:
+        print(f"⚠️ Không có ảnh Charm nào tại: {asset_pool.folder('charms')}")
+        print(f"ℹ️ (Gợi ý: Kiểm tra xem folder 'frontend' có nằm ngang hàng với folder 'backend' không)")
+        images = ["default.png"] * n
+
+    # 3. Roll chỉ số + Đặt tên tiếng Việt
+    vn_name = CHARM_NAMES.get(rarity, "CHARM")
+    new_items = []
+    for img_name in images:
+        new_item = PlayerItem(
+            player_id=player_id,
+            image_url=f"{CHARM_URL_PREFIX}{img_name}", # URL chuẩn cho Frontend
+            rarity=rarity,
+            name=vn_name,
+            enhance_level=0,
+            is_equipped=False,
+            slot_index=0
+        )
+        set_charm_stats(new_item, _roll_charm_stats(rarity, target_config))
+        new_items.append(new_item)
+
+    # 4. Lưu vào DB
+    db.add_all(new_items)
+    if commit:
+        db.commit() # Thuộc tính (id...) tự nạp lại khi đọc tới, không refresh từng món
+    return new_items
+
+def generate_charm(db: Session, player_id: int, rarity: str = "MAGIC", commit: bool = True):
+    """
+    Tạo charm mới và bỏ thẳng vào túi người chơi.
+    rarity: 'MAGIC', 'EPIC', 'LEGEND'
+    commit=False: chỉ add vào session (dùng khi mở rương hàng loạt, commit 1 lần ở ngoài)
+    """
+    return generate_charms(db, player_id, rarity, 1, commit=commit)[0]
 
 # ==========================================================
 # 🔥 PHẦN 2: LÒ RÈN (FORGE SYSTEM) - [MỚI]
 # ==========================================================
-def forge_item(db: Session, item_id: int, player_id: int, stone_item_id: int = None):
-    """
-    Cường hóa Charm.
-    - item_id: ID của Charm trong túi (PlayerItem)
-    - stone_item_id: (Tùy chọn) Nếu để None, hệ thống sẽ tự quét túi để tìm đá.
-    """
-    # 1. Kiểm tra Item Charm
-    charm = db.exec(select(PlayerItem).where(PlayerItem.id == item_id, PlayerItem.player_id == player_id)).first()
-    if not charm: return {"status": "error", "message": "Không tìm thấy vật phẩm!"}
-    
-    if charm.enhance_level >= 10:
-        return {"status": "error", "message": "Vật phẩm đã đạt cấp tối đa (+10)!"}
+FORGE_MAX_LEVEL = 10
+# Số lần đập tối đa trong 1 lần "cường hóa tới +N" (chặn vòng lặp quá dài khi tỷ lệ cấu hình = 0)
+FORGE_MAX_ATTEMPTS = 500
 
-    # 2. Lấy cấu hình Forge & Xác định nhóm
-    forge_config = get_forge_config(db)
-    current_cfg = forge_config["group_3"] # Mặc định khó nhất
-    
+def _forge_group(forge_config: dict, level: int) -> dict:
     for group in forge_config.values():
-        if group["min"] <= charm.enhance_level < group["max"]:
-            current_cfg = group
-            break
+        if group["min"] <= level < group["max"]:
+            return group
+    return forge_config["group_3"] # Mặc định khó nhất
 
-    # =========================================================
-    # 3. TỰ ĐỘNG TÌM ĐÁ CƯỜNG HÓA TRONG TÚI
-    # =========================================================
-    stone_inv = None
-    
-    # Cách 1: Nếu API có truyền ID đá cụ thể (Ưu tiên tìm theo ID đó trước)
+def _stone_stacks(db: Session, player_id: int, stone_item_id: int = None) -> list:
+    """
+    Các ô Đá Cường Hóa trong túi: 1 query theo danh sách id đá mà registry đã lập sẵn
+    (không quét cả túi + đọc config từng món). Đá được chỉ định (stone_item_id) xếp đầu.
+    """
+    stone_ids = set(registry.item_ids_by_action(db, "enhance_stone"))
     if stone_item_id:
-        stone_inv = db.exec(select(Inventory).where(
-            Inventory.player_id == player_id, 
-            Inventory.item_id == stone_item_id
-        )).first()
-
-    # Cách 2: Nếu không truyền ID hoặc tìm không thấy -> Quét toàn bộ túi
-    if not stone_inv:
-        # Lấy tất cả item đang có trong túi
-        inventory_list = db.exec(
-            select(Inventory, Item)
-            .join(Item)
-            .where(Inventory.player_id == player_id)
-            .where(Inventory.amount > 0)
-        ).all()
-
-        for inv, item_def in inventory_list:
-            try:
-                # Đọc config của từng món đồ
-                cfg = json.loads(item_def.config)
-                
-                # Kiểm tra xem có phải là Đá Cường Hóa không?
-                # (Logic này khớp với cái else-if bạn vừa thêm ở Admin)
-                if cfg.get("action") == "enhance_stone" or cfg.get("type") == "enhance_stone":
-                    stone_inv = inv
-                    break # Tìm thấy rồi thì dừng lại
-            except: 
-                pass
-
-    # Xác định giá đá
-    cost = current_cfg["stone"]
-    
-    # Kiểm tra lần cuối
-    if not stone_inv or stone_inv.amount < cost:
-        return {"status": "error", "message": f"Không đủ Đá Cường Hóa! Cần {cost} viên."}
+        stone_ids.add(int(stone_item_id))
+    if not stone_ids:
+        return []
+    stacks = db.exec(
+        select(Inventory)
+        .where(Inventory.player_id == player_id, Inventory.item_id.in_(stone_ids), Inventory.amount > 0)
+        .order_by(Inventory.id)
+    ).all()
+    if stone_item_id:
+        stacks.sort(key=lambda inv: inv.item_id != int(stone_item_id))
+    return stacks
+
+def _take_stones(db: Session, stacks: list, cost: int) -> bool:
+    """Trừ cost viên, lần lượt từ các ô đá; không đủ thì không trừ gì."""
+    if sum(inv.amount for inv in stacks) < cost:
+        return False
+    while cost > 0:
+        inv = stacks[0]
+        used = min(inv.amount, cost)
+        inv.amount -= used
+        cost -= used
+        if inv.amount <= 0:
+            db.delete(inv) # Xóa nếu hết sạch
+            stacks.pop(0)
+        else:
+            db.add(inv)
+    return True
 
-    # 4. Trừ đá (Luôn trừ dù thành công hay thất bại)
-    stone_inv.amount -= cost
-    if stone_inv.amount <= 0:
-        db.delete(stone_inv) # Xóa nếu hết sạch
-    else:
-        db.add(stone_inv)
+def _forge_attempt(db: Session, charm: PlayerItem, forge_config: dict, stacks: list):
+    """1 lần đập: trừ đá (luôn trừ dù thành công hay thất bại) rồi roll. Không đủ đá -> None."""
+    current_cfg = _forge_group(forge_config, charm.enhance_level)
+    cost = current_cfg["stone"]
+    if not _take_stones(db, stacks, cost):
+        return None
 
-    # 5. Roll nhân phẩm (Giữ nguyên)
-    success_rate = current_cfg["rate"]
     roll = random.randint(1, 100)
-    is_success = roll <= success_rate
-
-    result_data = {
-        "consumed_stones": cost,
-        "old_level": charm.enhance_level,
-        "new_level": charm.enhance_level
+    entry = {
+        "level": charm.enhance_level,
+        "rate": current_cfg["rate"],
+        "roll": roll,
+        "stones": cost,
+        "success": roll <= current_cfg["rate"],
     }
-
-    if is_success:
-        # --- THÀNH CÔNG ---
+    if entry["success"]:
         charm.enhance_level += 1
-        
         # Tăng chỉ số (Bonus %)
         try:
             stats = json.loads(charm.stats_data)
             bonus_multiplier = 1 + (current_cfg["bonus_pct"] / 100)
-            
             for key in stats:
                 stats[key] = int(stats[key] * bonus_multiplier)
-                
-            charm.stats_data = json.dumps(stats)
+            set_charm_stats(charm, stats)
         except: pass
-        
-        result_data["status"] = "success"
-        result_data["message"] = f"Thành công! {charm.name} đã lên +{charm.enhance_level}"
-        result_data["new_level"] = charm.enhance_level
+    return entry
+
+def _forge(db: Session, item_id: int, player_id: int, stone_item_id, commit: bool, target_level=None):
+    # 1. Kiểm tra Item Charm
+    charm = db.exec(select(PlayerItem).where(PlayerItem.id == item_id, PlayerItem.player_id == player_id)).first()
+    if not charm: return {"status": "error", "message": "Không tìm thấy vật phẩm!"}
+    
+    if charm.enhance_level >= FORGE_MAX_LEVEL:
+        return {"status": "error", "message": f"Vật phẩm đã đạt cấp tối đa (+{FORGE_MAX_LEVEL})!"}
+    if target_level is not None and not charm.enhance_level < target_level <= FORGE_MAX_LEVEL:
+        return {"status": "error", "message": f"Cấp mục tiêu phải từ +{charm.enhance_level + 1} đến +{FORGE_MAX_LEVEL}!"}
+
+    # 2. Lấy cấu hình Forge + Đá Cường Hóa trong túi
+    forge_config = get_forge_config(db)
+    stacks = _stone_stacks(db, player_id, stone_item_id)
+    old_level = charm.enhance_level
+    old_atk, old_hp = charm_stats(charm)
+
+    # 3. Đập: 1 lần (target_level=None) hoặc tới khi đạt mục tiêu / hết đá
+    attempts = []
+    while True:
+        entry = _forge_attempt(db, charm, forge_config, stacks)
+        if entry is None:
+            break
+        attempts.append(entry)
+        if target_level is None or charm.enhance_level >= target_level or len(attempts) >= FORGE_MAX_ATTEMPTS:
+            break
+
+    if not attempts:
+        cost = _forge_group(forge_config, charm.enhance_level)["stone"]
+        return {"status": "error", "message": f"Không đủ Đá Cường Hóa! Cần {cost} viên."}
+
+    new_atk, new_hp = charm_stats(charm)
+    result_data = {
+        "consumed_stones": sum(a["stones"] for a in attempts),
+        "old_level": old_level,
+        "new_level": charm.enhance_level,
+        "is_equipped": charm.is_equipped,
+        "atk_delta": new_atk - old_atk,
+        "hp_delta": new_hp - old_hp
+    }
+
+    if target_level is None:
+        if attempts[0]["success"]:
+            result_data["status"] = "success"
+            result_data["message"] = f"Thành công! {charm.name} đã lên +{charm.enhance_level}"
+        else:
+            result_data["status"] = "fail"
+            result_data["message"] = "Cường hóa thất bại! Bạn bị mất nguyên liệu."
     else:
-        # --- THẤT BẠI ---
-        result_data["status"] = "fail"
-        result_data["message"] = "Cường hóa thất bại! Bạn bị mất nguyên liệu."
+        result_data["target_level"] = target_level
+        result_data["attempts"] = attempts
+        summary = (f"{len(attempts)} lần đập, {charm.name} +{old_level} -> +{charm.enhance_level} "
+                   f"(tốn {result_data['consumed_stones']} đá)")
+        if charm.enhance_level >= target_level:
+            result_data["status"] = "success"
+            result_data["message"] = f"Thành công! {summary}"
+        else:
+            result_data["status"] = "fail"
+            result_data["message"] = f"Chưa đạt +{target_level}: {summary}"
 
     db.add(charm)
-    db.commit()
-    db.refresh(charm) # Refresh để đảm bảo dữ liệu mới nhất
+    if commit:
+        db.commit()
+        db.refresh(charm) # Refresh để đảm bảo dữ liệu mới nhất
     
     return result_data
 
-def generate_companion_card(db: Session, player_id: int, rarity: str):
+def forge_item(db: Session, item_id: int, player_id: int, stone_item_id: int = None, commit: bool = True):
+    """
+    Cường hóa Charm (1 lần).
+    - item_id: ID của Charm trong túi (PlayerItem)
+    - stone_item_id: (Tùy chọn) Ưu tiên trừ loại đá này; None = dùng đá bất kỳ trong túi.
+    - commit=False: để route cộng chênh lệch chỉ số (atk_delta / hp_delta) rồi commit chung 1 lần.
+    """
+    return _forge(db, item_id, player_id, stone_item_id, commit)
+
+def forge_item_to(db: Session, item_id: int, player_id: int, target_level: int,
+                  stone_item_id: int = None, commit: bool = True):
+    """
+    Cường hóa tới +target_level trong 1 transaction: đập liên tục cho tới khi đạt mục tiêu,
+    hết đá hoặc chạm FORGE_MAX_ATTEMPTS. Trả thêm "attempts" (nhật ký từng lần đập).
+    """
+    return _forge(db, item_id, player_id, stone_item_id, commit, target_level=target_level)
+
+def generate_companion_card(db: Session, player_id: int, rarity: str, commit: bool = True):
     """
     Hàm sinh thẻ đồng hành (Companion) dựa trên cấu trúc bạn cung cấp.
+    commit=False: chỉ add vào session (dùng khi mở rương hàng loạt)
     """
     # 1. Lấy danh sách Phôi (Template) theo độ hiếm (R, SR, SSR, USR)
-    templates = db.exec(select(CompanionTemplate).where(CompanionTemplate.rarity == rarity)).all()
+    templates = registry.companion_templates(db, rarity)
     
     if not templates:
         return None # Không có phôi nào thì chịu, trả về None
@@ -559,7 +711,8 @@ def generate_companion_card(db: Session, player_id: int, rarity: str):
     # 5. Tạo ID duy nhất (Unique ID)
     # Format: {RARITY}_{TIMESTAMP}_{RANDOM} -> VD: SSR_170763_X9Y2
     # Cách này đảm bảo không trùng với Item ID và không trùng giữa các thẻ
-    unique_suffix = uuid.uuid4().hex[:4].upper()
+    # 8 ký tự: mở rương hàng loạt sinh nhiều thẻ trong cùng 1 giây, 4 ký tự dễ trùng khóa
+    unique_suffix = uuid.uuid4().hex[:8].upper()
     timestamp_code = int(time.time())
     new_card_id = f"{rarity}_{timestamp_code}_{unique_suffix}"
 
@@ -576,8 +729,9 @@ def generate_companion_card(db: Session, player_id: int, rarity: str):
     )
 
     db.add(new_companion)
-    db.commit()
-    db.refresh(new_companion)
+    if commit:
+        db.commit()
+        db.refresh(new_companion)
     
     # Trả về đối tượng vừa tạo để hàm gọi lấy tên hiển thị
     # Gắn tạm tên template vào object để tiện hiển thị (vì bảng Companion ko lưu tên)
@@ -1,4 +1,20 @@
 # --- FILE: backend/game_logic/level.py ---
+import threading
+from bisect import bisect_right
+from typing import Optional
+from sqlalchemy import bindparam, func, update
+from sqlmodel import Session, select
+from database import Player
+
+# Mỗi cấp: EXP yêu cầu cho cấp sau +10%
+EXP_GROWTH = 1.1
+# Hệ số tăng chỉ số gốc mỗi cấp theo Class: (ATK, HP)
+CLASS_GROWTH = {
+    "MAGE": (1.05, 1.02),
+    "WARRIOR": (1.02, 1.05),
+}
+DEFAULT_GROWTH = (1.02, 1.02)
+
 
 def safe_increase(current_val: int, multiplier: float) -> int:
     """
@@ -8,63 +24,191 @@ def safe_increase(current_val: int, multiplier: float) -> int:
     - Luôn đảm bảo tăng ít nhất 1 điểm để tránh lỗi làm tròn (10 * 1.02 = 10 -> Lỗi)
     """
     if current_val is None: current_val = 0
-    
+
     # Tính giá trị mới
     new_val = int(current_val * multiplier)
-    
+
     # Nếu nhân xong mà vẫn bằng số cũ (do số quá bé), thì cộng thủ công thêm 1
     if new_val <= current_val:
         return current_val + 1
-        
+
     return new_val
 
+def next_exp_requirement(current: int) -> int:
+    return int(current * EXP_GROWTH)
+
+
+# =========================================================
+# 1. BẢNG ĐƯỜNG CONG DỰNG SẴN (dùng chung cả tiến trình)
+# =========================================================
+class Curve:
+    """
+    Dãy v, f(v), f(f(v))... của 1 hàm tăng cấp (EXP yêu cầu, chỉ số gốc), tính 1 lần rồi nhớ.
+    Vì f chỉ phụ thuộc giá trị hiện tại, mọi người chơi đang ở cùng 1 giá trị dùng chung 1 dãy:
+    nhảy n cấp = tra bảng, kết quả giống hệt vòng lặp từng cấp (kể cả phần làm tròn).
+    """
+    def __init__(self, step):
+        self._step = step
+        self._lock = threading.Lock()
+        self._where = {}    # giá trị -> (dãy, vị trí)
+
+    def _locate(self, value: int):
+        loc = self._where.get(value)
+        if loc is None:
+            chain = {"values": [value], "cumulative": [0, value]}
+            loc = self._where[value] = (chain, 0)
+        return loc
+
+    def _extend(self, chain: dict):
+        nxt = self._step(chain["values"][-1])
+        chain["values"].append(nxt)
+        chain["cumulative"].append(chain["cumulative"][-1] + nxt)
+        self._where.setdefault(nxt, (chain, len(chain["values"]) - 1))
+
+    def jump(self, value: int, n: int) -> int:
+        """Giá trị sau n bước."""
+        if n <= 0:
+            return value
+        with self._lock:
+            chain, pos = self._locate(value)
+            while len(chain["values"]) <= pos + n:
+                self._extend(chain)
+            return chain["values"][pos + n]
+
+    def levels_for(self, value: int, budget: int) -> tuple:
+        """
+        Bắt đầu ở yêu cầu 'value', có 'budget' EXP: qua được bao nhiêu cấp (tìm nhị phân trên
+        tổng dồn), còn dư bao nhiêu EXP và yêu cầu của cấp kế tiếp.
+        """
+        if budget < value:
+            return 0, budget, value
+        with self._lock:
+            chain, pos = self._locate(value)
+            cumulative = chain["cumulative"]
+            target = cumulative[pos] + budget
+            # Nối dãy tới khi tổng dồn vượt ngân sách (dãy tăng theo cấp số nhân -> ít lần nối)
+            while cumulative[-1] <= target:
+                last = chain["values"][-1]
+                if self._step(last) == last:
+                    # Số quá nhỏ (VD yêu cầu < 10 EXP) -> dãy đứng yên, phần còn lại là phép chia
+                    extra = (target - cumulative[-1]) // last
+                    n = len(cumulative) - 1 + extra - pos
+                    return n, target - cumulative[-1] - extra * last, last
+                self._extend(chain)
+            n = bisect_right(cumulative, target) - 1 - pos
+            return n, target - cumulative[pos + n], chain["values"][pos + n]
+
+
+exp_curve = Curve(next_exp_requirement)
+_stat_curves = {}
+
+def stat_curve(multiplier: float) -> Curve:
+    curve = _stat_curves.get(multiplier)
+    if curve is None:
+        curve = _stat_curves.setdefault(multiplier, Curve(lambda v, m=multiplier: safe_increase(v, m)))
+    return curve
+
+
+# =========================================================
+# 2. CỘNG EXP (1 bước, không lặp từng cấp)
+# =========================================================
+def resolve_exp(level: int, exp: int, next_level_exp: int, class_type: Optional[str],
+                base_atk: int, base_hp: int, amount: int) -> dict:
+    """Kết quả sau khi cộng amount EXP: cấp, EXP dư, yêu cầu cấp sau, chỉ số gốc mới."""
+    # Yêu cầu <= 0 (dữ liệu hỏng) sẽ làm vòng lặp cũ chạy mãi -> coi như 1
+    requirement = max(1, next_level_exp or 0)
+    gained, exp_left, requirement = exp_curve.levels_for(requirement, (exp or 0) + amount)
+
+    user_class = str(class_type).strip().upper() if class_type else "NOVICE"
+    atk_mult, hp_mult = CLASS_GROWTH.get(user_class, DEFAULT_GROWTH)
+    return {
+        "levels": gained,
+        "level": level + gained,
+        "exp": exp_left,
+        "next_level_exp": requirement,
+        "base_atk": stat_curve(atk_mult).jump(base_atk, gained),
+        "base_hp": stat_curve(hp_mult).jump(base_hp, gained),
+    }
+
 def add_exp_to_player(player, amount: int):
     """
     Xử lý logic: Cộng EXP -> Check Level Up -> Tăng Stats theo %
+    Lên nhiều cấp 1 lúc được tính 1 lần bằng bảng đường cong (không lặp từng cấp).
     """
-    # 1. Cộng EXP
-    player.exp += amount
-    is_leveled_up = False
-    
-    # 2. Vòng lặp thăng cấp (Xử lý trường hợp lên nhiều cấp 1 lúc)
-    while player.exp >= player.next_level_exp:
-        
-        # --- A. XỬ LÝ EXP & LEVEL ---
-        player.exp -= player.next_level_exp
-        player.level += 1
-        is_leveled_up = True
-        
-        # Tăng độ khó cho cấp sau (+10% EXP yêu cầu)
-        player.next_level_exp = int(player.next_level_exp * 1.1)
-
-        # --- B. XỬ LÝ CLASS ---
-        user_class = str(player.class_type).strip().upper() if player.class_type else "NOVICE"
-        
-        # Log server để bạn dễ kiểm soát
-        print(f"⚡ Up Level {player.level} | Class: {user_class}")
-
-        # --- C. TĂNG CHỈ SỐ (THEO YÊU CẦU: 5% và 2%) ---
-        
-        # 1. Tách Item ra để lấy Base Stats
-        base_atk = player.atk - (player.item_atk_bonus or 0)
-        base_hp = player.hp_max - (player.item_hp_bonus or 0)
-
-        # 2. Nhân % vào Base Stats (Dùng hàm safe_increase của bạn )
-        if user_class == "MAGE":
-            base_atk = safe_increase(base_atk, 1.05)
-            base_hp = safe_increase(base_hp, 1.02)
-        elif user_class == "WARRIOR":
-            base_hp = safe_increase(base_hp, 1.05)
-            base_atk = safe_increase(base_atk, 1.02)
+    # 1. Tách Item ra để lấy Base Stats
+    item_atk = player.item_atk_bonus or 0
+    item_hp = player.item_hp_bonus or 0
+    result = resolve_exp(
+        player.level, player.exp, player.next_level_exp, player.class_type,
+        player.atk - item_atk, player.hp_max - item_hp, amount
+    )
+
+    player.exp = result["exp"]
+    if not result["levels"]:
+        return False
+
+    # 2. Cộng lại Item Bonus vào để ra chỉ số tổng mới + Hồi máu
+    player.level = result["level"]
+    player.next_level_exp = result["next_level_exp"]
+    player.atk = result["base_atk"] + item_atk
+    player.hp_max = result["base_hp"] + item_hp
+    player.hp = player.hp_max
+    print(f"⚡ Up Level {player.level} (+{result['levels']}) | Class: {player.class_type or 'NOVICE'}")
+    return True
+
+
+# =========================================================
+# 3. CỘNG EXP HÀNG LOẠT (cả tổ / cả Class / danh sách - 1 SELECT + 1 UPDATE)
+# =========================================================
+def grant_exp_bulk(db: Session, amount: int, team_id: Optional[int] = None,
+                   class_type: Optional[str] = None, player_ids: Optional[list] = None) -> dict:
+    """Cộng EXP cho nhiều học sinh (không gồm admin). Không commit."""
+    stmt = select(
+        Player.id, Player.level, Player.exp, Player.next_level_exp, Player.class_type,
+        Player.atk, Player.hp_max, Player.item_atk_bonus, Player.item_hp_bonus
+    ).where(Player.role != "admin")
+    if team_id is not None:
+        stmt = stmt.where(Player.team_id == team_id)
+    if class_type:
+        stmt = stmt.where(Player.class_type == class_type.upper())
+    if player_ids is not None:
+        stmt = stmt.where(Player.id.in_(player_ids))
+
+    params, leveled = [], []
+    for row in db.exec(stmt).all():
+        item_atk, item_hp = row.item_atk_bonus or 0, row.item_hp_bonus or 0
+        result = resolve_exp(
+            row.level, row.exp, row.next_level_exp, row.class_type,
+            row.atk - item_atk, row.hp_max - item_hp, amount
+        )
+        if result["levels"]:
+            leveled.append({"id": row.id, "old_level": row.level, "new_level": result["level"]})
+            hp_max = result["base_hp"] + item_hp
+            params.append({
+                "b_id": row.id, "b_level": result["level"], "b_exp": result["exp"],
+                "b_next": result["next_level_exp"], "b_atk": result["base_atk"] + item_atk,
+                "b_hp_max": hp_max, "b_hp": hp_max,   # Lên cấp -> Hồi đầy máu
+            })
         else:
-            base_hp = safe_increase(base_hp, 1.02)
-            base_atk = safe_increase(base_atk, 1.02)
-
-        # 3. Cộng lại Item Bonus vào để ra chỉ số tổng mới
-        player.atk = base_atk + (player.item_atk_bonus or 0)
-        player.hp_max = base_hp + (player.item_hp_bonus or 0)
-        
-        # Hồi máu
-        player.hp = player.hp_max
-        
-    return is_leveled_up
\ No newline at end of file
+            params.append({
+                "b_id": row.id, "b_level": row.level, "b_exp": result["exp"],
+                "b_next": row.next_level_exp, "b_atk": row.atk,
+                "b_hp_max": row.hp_max, "b_hp": None,
+            })
+
+    if params:
+        table = Player.__table__
+        db.connection().execute(
+            update(table)
+            .where(table.c.id == bindparam("b_id"))
+            .values(
+                level=bindparam("b_level"), exp=bindparam("b_exp"), next_level_exp=bindparam("b_next"),
+                atk=bindparam("b_atk"), hp_max=bindparam("b_hp_max"),
+                # Không lên cấp thì giữ nguyên máu hiện tại
+                hp=func.coalesce(bindparam("b_hp"), table.c.hp),
+            ),
+            params
+        )
+        # Đối tượng Player đang nằm trong session (nếu có) phải đọc lại giá trị mới
+        db.expire_all()
+    return {"players": len(params), "leveled_up": leveled}
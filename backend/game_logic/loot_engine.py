@@ -0,0 +1,163 @@
+import json
+import random
+from functools import lru_cache
+from typing import Optional
+
+try:
+    import numpy as np
+except ImportError:  # numpy thường có sẵn (đi kèm pandas); thiếu thì quay bằng random thuần
+    np = None
+
+# Số lượt mô phỏng tối đa (có / không có numpy)
+SIMULATE_MAX_ROLLS = 5_000_000
+SIMULATE_MAX_ROLLS_NO_NUMPY = 200_000
+# Mô phỏng theo từng khúc để không giữ ma trận quá lớn trong RAM
+SIMULATE_CHUNK = 100_000
+
+
+# =========================================================
+# 1. BẢNG RƠI ĐỒ ĐÃ BIÊN DỊCH
+# =========================================================
+class DropTable:
+    """
+    Bảng rơi đồ (rương Gacha, drop_pool của Boss) biên dịch thành các mảng song song:
+    mỗi dòng quay ĐỘC LẬP với xác suất rate/100, trúng thì nhận số lượng đều trong [min, max].
+    - roll(n): quay n lượt 1 lần -> số lần trúng mỗi dòng ~ Binomial(n, p) (1 phép bốc cho cả lô).
+    - simulate(n): quay n lượt có ghi lại từng lượt để đối chiếu tỷ lệ thực tế với cấu hình.
+    """
+    __slots__ = ("item_ids", "probs", "mins", "maxs", "rates")
+
+    def __init__(self, lines: list):
+        self.item_ids = [l[0] for l in lines]
+        self.rates = [l[1] for l in lines]
+        self.probs = [min(max(l[1], 0.0), 100.0) / 100 for l in lines]
+        self.mins = [l[2] for l in lines]
+        self.maxs = [l[3] for l in lines]
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def _qty(self, i: int, hits: int, rng) -> int:
+        lo, hi = self.mins[i], self.maxs[i]
+        if lo == hi:
+            return hits * lo
+        if rng is not None:
+            return int(rng.integers(lo, hi + 1, size=hits).sum())
+        return sum(random.choices(range(lo, hi + 1), k=hits))
+
+    def roll(self, n: int = 1) -> dict:
+        """Quay n lượt -> {item_id: tổng số lượng} (chỉ các món trúng)."""
+        totals = {}
+        if not self.item_ids or n < 1:
+            return totals
+        if np is not None:
+            rng = np.random.default_rng()
+            hits = rng.binomial(n, self.probs).tolist()
+        else:
+            rng = None
+            hits = []
+            for p in self.probs:
+                if p <= 0:
+                    hits.append(0)
+                elif p >= 1:
+                    hits.append(n)
+                else:
+                    hits.append(sum(1 for _ in range(n) if random.random() < p))
+
+        for i, h in enumerate(hits):
+            if h:
+                item_id = self.item_ids[i]
+                totals[item_id] = totals.get(item_id, 0) + self._qty(i, h, rng)
+        return totals
+
+    def expected(self) -> list:
+        return [
+            {
+                "item_id": self.item_ids[i],
+                "rate": self.rates[i],
+                "min": self.mins[i],
+                "max": self.maxs[i],
+                "expected_qty_per_roll": round(self.probs[i] * (self.mins[i] + self.maxs[i]) / 2, 6),
+            }
+            for i in range(len(self))
+        ]
+
+    def simulate(self, n: int) -> dict:
+        """
+        Quay thử n lượt (mỗi lượt = 1 lần mở rương / 1 lần hạ Boss).
+        Trả về tỷ lệ trúng + số lượng trung bình thực tế của từng dòng và tỷ lệ lượt không ra gì.
+        """
+        k = len(self)
+        hits = [0] * k
+        qty = [0] * k
+        empty = 0
+        done = 0
+        if np is not None:
+            rng = np.random.default_rng()
+            probs = np.array(self.probs)
+            while done < n:
+                size = min(SIMULATE_CHUNK, n - done)
+                matrix = rng.random((size, k)) < probs     # size x k: lượt nào trúng dòng nào
+                col_hits = matrix.sum(axis=0)
+                empty += int(size - matrix.any(axis=1).sum()) if k else size
+                for i in range(k):
+                    h = int(col_hits[i])
+                    hits[i] += h
+                    if h:
+                        qty[i] += self._qty(i, h, rng)
+                done += size
+        else:
+            for _ in range(n):
+                any_hit = False
+                for i, p in enumerate(self.probs):
+                    if random.random() < p:
+                        any_hit = True
+                        hits[i] += 1
+                        qty[i] += random.randint(self.mins[i], self.maxs[i])
+                if not any_hit:
+                    empty += 1
+            done = n
+
+        lines = self.expected()
+        for i, line in enumerate(lines):
+            line["observed_rate"] = round(hits[i] * 100 / done, 4) if done else 0.0
+            line["observed_qty_per_roll"] = round(qty[i] / done, 6) if done else 0.0
+            line["deviation"] = round(line["observed_rate"] - line["rate"], 4)
+        expected_empty = 1.0
+        for p in self.probs:
+            expected_empty *= 1 - p
+        return {
+            "rolls": done,
+            "engine": "numpy" if np is not None else "python",
+            "lines": lines,
+            "empty_rate": round(empty * 100 / done, 4) if done else 0.0,
+            "expected_empty_rate": round(expected_empty * 100, 4),
+        }
+
+
+# =========================================================
+# 2. BIÊN DỊCH 1 LẦN, DÙNG LẠI (cache theo nội dung bảng)
+# =========================================================
+def _parse_line(drop: dict) -> Optional[tuple]:
+    # Hỗ trợ mọi kiểu key mà admin có thể nhập (id / item_id)
+    raw_id = drop.get("item_id") or drop.get("id")
+    if not raw_id:
+        return None
+    min_q = int(drop.get("min", 1))
+    max_q = int(drop.get("max", min_q))
+    return int(raw_id), float(drop.get("rate", 0)), min_q, max(min_q, max_q)
+
+@lru_cache(maxsize=512)
+def _compile(key: str) -> DropTable:
+    lines = [_parse_line(d) for d in json.loads(key) if isinstance(d, dict)]
+    return DropTable([l for l in lines if l])
+
+def drop_table(drops) -> DropTable:
+    """drops: list dict hoặc chuỗi JSON. Cùng nội dung -> cùng bảng đã biên dịch."""
+    if isinstance(drops, str):
+        drops = json.loads(drops) if drops else []
+    return _compile(json.dumps(drops or [], sort_keys=True))
+
+def chest_drops(config: dict) -> list:
+    """Danh sách drop trong config của Rương Gacha."""
+    return config.get("gacha_items") or config.get("drops") or config.get("pool") or config.get("loot_table") or []
@@ -0,0 +1,206 @@
+import json
+import time
+import uuid
+from sqlmodel import Session, select, delete, update
+from sqlalchemy.exc import OperationalError
+from database import Player, MarketListing, Inventory, PlayerItem, Companion
+from services.market_browse import CHARM_ITEM_ID, COMPANION_ITEM_ID
+from services.market_prices import record_trade, refresh_price_index
+from game_logic.stats import parse_charm_stats
+from services import wallet
+from services.static_registry import registry
+from services.inventory_snapshot import inventory_snapshots
+
+# Cột tiền tệ trên bảng Player -> Tên hiển thị
+CURRENCY_NAMES = {
+    "tri_thuc": "Tri Thức (Vàng)",
+    "chien_tich": "Chiến Tích (Ruby)",
+    "vinh_du": "Vinh Dự (Badge)",
+}
+
+# Các cột cần khi "nhận" đơn hàng bằng DELETE ... RETURNING
+_CLAIM_COLUMNS = (
+    MarketListing.id, MarketListing.seller_id, MarketListing.item_id, MarketListing.amount,
+    MarketListing.price, MarketListing.currency, MarketListing.item_data_json, MarketListing.rarity,
+)
+
+
+class MarketManager:
+    """
+    Mua / hủy bán trên Chợ Đen theo kiểu nguyên tử (1 transaction):
+    - Giành đơn hàng bằng DELETE có điều kiện -> chỉ 1 người thắng, người sau nhận 0 dòng.
+    - Trừ tiền qua ví (UPDATE ... WHERE số dư >= giá) -> không bao giờ âm tiền, có sổ cái.
+    - Lỗi ở bất kỳ bước nào -> rollback, đơn hàng trở lại chợ.
+    """
+    def __init__(self, db: Session):
+        self.db = db
+
+    # =========================================================================
+    # 1. MUA HÀNG
+    # =========================================================================
+    def buy(self, listing_id: int, buyer_username: str):
+        # 1. Kiểm tra sơ bộ (chỉ đọc, chưa khóa gì)
+        buyer_id = self.db.exec(select(Player.id).where(Player.username == buyer_username)).first()
+        if buyer_id is None:
+            return {"success": False, "code": 404, "message": "User lỗi"}
+
+        listing = self.db.get(MarketListing, listing_id)
+        if not listing:
+            return {"success": False, "code": 404, "message": "Vật phẩm không còn tồn tại (hoặc đã bị ai đó mua mất)!"}
+        if listing.seller_id == buyer_id:
+            return {"success": False, "code": 400, "message": "Bạn không thể tự mua đồ của chính mình!"}
+        if listing.currency not in CURRENCY_NAMES:
+            return {"success": False, "code": 400, "message": f"Loại tiền tệ không hợp lệ: {listing.currency}"}
+
+        try:
+            # 2. Giành đơn hàng: câu lệnh ghi đầu tiên -> mở transaction ghi
+            claimed = self.db.exec(
+                delete(MarketListing)
+                .where(
+                    MarketListing.id == listing_id,
+                    MarketListing.seller_id != buyer_id,
+                    MarketListing.price >= 0
+                )
+                .returning(*_CLAIM_COLUMNS)
+            ).first()
+            if not claimed:
+                self.db.rollback()
+                return {"success": False, "code": 404, "message": "Vật phẩm không còn tồn tại (hoặc đã bị ai đó mua mất)!"}
+
+            cost, currency = claimed.price, claimed.currency
+
+            # 3. Trừ tiền người mua (UPDATE ... WHERE số dư >= giá)
+            if wallet.debit(self.db, buyer_id, currency, cost, reason="market_buy", ref=listing_id) is None:
+                self.db.rollback()  # Trả đơn hàng về chợ
+                return {"success": False, "code": 400, "message": f"Không đủ {CURRENCY_NAMES[currency]}!"}
+
+            # 4. Cộng tiền người bán
+            wallet.credit(self.db, claimed.seller_id, currency, cost, reason="market_sale", ref=listing_id)
+
+            # 5. Giao hàng, ghi nhật ký giá & chốt
+            self._deliver(buyer_id, claimed)
+            record_trade(self.db, claimed, buyer_id)
+            self.db.commit()
+            inventory_snapshots.touch(buyer_id)
+        except OperationalError as e:
+            self.db.rollback()
+            print(f"⚠️ Lỗi khóa DB khi mua đơn {listing_id}: {e}")
+            return {"success": False, "code": 409, "message": "Chợ đang đông, vui lòng thử lại!"}
+        except Exception as e:
+            self.db.rollback()
+            print(f"❌ Lỗi mua đơn {listing_id}: {e}")
+            return {"success": False, "code": 500, "message": "Lỗi dữ liệu vật phẩm!"}
+
+        return {
+            "success": True,
+            "message": f"Đã mua thành công bằng {cost} {currency}!",
+            "listing": dict(claimed._mapping)
+        }
+
+    # =========================================================================
+    # 2. HỦY BÁN (Thu hồi về túi người bán)
+    # =========================================================================
+    def cancel(self, listing_id: int, username: str):
+        user_id = self.db.exec(select(Player.id).where(Player.username == username)).first()
+        if user_id is None:
+            return {"success": False, "code": 404, "message": "User không tồn tại"}
+
+        listing = self.db.get(MarketListing, listing_id)
+        if not listing:
+            return {"success": False, "code": 404, "message": "Đơn hàng không tồn tại"}
+        if listing.seller_id != user_id:
+            return {"success": False, "code": 403, "message": "Không phải hàng của bạn"}
+
+        try:
+            # Cùng cơ chế giành đơn: nếu vừa có người mua thì DELETE trả về 0 dòng
+            claimed = self.db.exec(
+                delete(MarketListing)
+                .where(MarketListing.id == listing_id, MarketListing.seller_id == user_id)
+                .returning(*_CLAIM_COLUMNS)
+            ).first()
+            if not claimed:
+                self.db.rollback()
+                return {"success": False, "code": 404, "message": "Đơn hàng không tồn tại"}
+
+            self._deliver(user_id, claimed)
+            refresh_price_index(self.db, claimed.item_id, claimed.rarity, claimed.currency)
+            self.db.commit()
+            inventory_snapshots.touch(user_id)
+        except OperationalError as e:
+            self.db.rollback()
+            print(f"⚠️ Lỗi khóa DB khi hủy đơn {listing_id}: {e}")
+            return {"success": False, "code": 409, "message": "Chợ đang đông, vui lòng thử lại!"}
+        except Exception as e:
+            self.db.rollback()
+            print(f"❌ Lỗi thu hồi đơn {listing_id}: {e}")
+            return {"success": False, "code": 500, "message": "Lỗi dữ liệu vật phẩm, không thể thu hồi!"}
+
+        return {"success": True, "message": "Đã thu hồi vật phẩm về túi!", "listing": dict(claimed._mapping)}
+
+    # =========================================================================
+    # 3. GIAO HÀNG (Charm / Thẻ bài / Đồ thường) - chưa commit
+    # =========================================================================
+    def _deliver(self, player_id: int, listing):
+        if listing.item_id == CHARM_ITEM_ID and listing.item_data_json:
+            c_data = json.loads(listing.item_data_json)
+            stats_data = c_data.get("stats_data", "{}")
+            stat_atk, stat_hp = parse_charm_stats(stats_data)
+            self.db.add(PlayerItem(
+                player_id=player_id,
+                name=c_data.get("name", "Charm"),
+                image_url=c_data.get("image_url", "/assets/items/default.png"),
+                rarity=c_data.get("rarity", "COMMON"),
+                stats_data=stats_data,
+                stat_atk=stat_atk,
+                stat_hp=stat_hp,
+                enhance_level=c_data.get("enhance_level", 0),
+                is_equipped=False,
+                slot_index=0
+            ))
+
+        elif listing.item_id == COMPANION_ITEM_ID and listing.item_data_json:
+            self.db.add(self._restore_companion(player_id, json.loads(listing.item_data_json)))
+
+        else:
+            # Cộng dồn vào ô đồ sẵn có (ô đầu tiên nếu lỡ bị trùng), chưa có thì tạo mới
+            inv_id = self.db.exec(
+                select(Inventory.id)
+                .where(Inventory.player_id == player_id, Inventory.item_id == listing.item_id)
+                .order_by(Inventory.id)
+            ).first()
+            if inv_id is not None:
+                self.db.exec(
+                    update(Inventory)
+                    .where(Inventory.id == inv_id)
+                    .values(amount=Inventory.amount + listing.amount)
+                    .execution_options(synchronize_session=False)
+                )
+            else:
+                self.db.add(Inventory(player_id=player_id, item_id=listing.item_id, amount=listing.amount))
+
+    def _restore_companion(self, player_id: int, data: dict) -> Companion:
+        """Dựng lại thẻ bài từ gói JSON trên chợ (giữ nguyên sao & chỉ số)."""
+        template_id = data.get("template_id")
+        if not template_id:
+            # Đơn cũ chưa lưu template_id -> dò theo ảnh của phôi
+            template = registry.companion_template_by_image(self.db, data.get("image"))
+            template_id = template.template_id if template else None
+        if not template_id:
+            raise ValueError(f"Không xác định được phôi thẻ bài: {data.get('name')}")
+
+        card_id = data.get("ui_id")
+        if not card_id or self.db.get(Companion, card_id):
+            rarity = data.get("rarity") or "R"
+            card_id = f"{rarity}_{int(time.time())}_{uuid.uuid4().hex[:8].upper()}"
+
+        stats = data.get("stats") or {}
+        return Companion(
+            id=card_id,
+            player_id=player_id,
+            template_id=template_id,
+            star=data.get("star", 1),
+            hp=stats.get("hp", 0),
+            atk=stats.get("atk", 0),
+            temp_name=data.get("name"),
+            is_locked=False
+        )
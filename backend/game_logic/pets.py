@@ -0,0 +1,227 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Optional
+from sqlalchemy import bindparam, delete, func, insert, update
+from sqlmodel import Session, select
+from database import engine, Inventory, PlayerPet, Player, SystemConfig
+from services.static_registry import registry
+
+# 10 Mảnh -> 1 Pet 1 sao | 3 Pet cùng loại, cùng sao -> 1 Pet sao cao hơn
+FRAGMENTS_PER_PET = 10
+PETS_PER_EVOLVE = 3
+# Loại hiệu ứng Aura được cộng thẳng vào chỉ số (điểm cộng = value x số sao)
+AURA_STATS = {"atk_buff": "atk", "hp_buff": "hp"}
+# Khóa đánh dấu đã cộng Aura của Pet đang bật vào bonus trang bị (lưu trong SystemConfig)
+MIGRATION_KEY = "migration_pet_aura_v1"
+
+
+# =========================================================
+# 1. AURA (tính từ config Pet trong registry lúc bật, lưu lại trên PlayerPet)
+# =========================================================
+def pet_aura(db: Session, pet_item_id: int, star_level: int) -> tuple:
+    """(atk, hp) mà 1 Pet cộng cho chủ nếu bật ngay bây giờ (theo config hiện tại)."""
+    pet = registry.get_item(db, pet_item_id)
+    effect = ((pet.config_dict if pet else None) or {}).get("effect") or {}
+    stat = AURA_STATS.get(effect.get("type"))
+    try:
+        value = int(float(effect.get("value", 0)) * (star_level or 1))
+    except (TypeError, ValueError):
+        value = 0
+    if stat == "atk":
+        return value, 0
+    if stat == "hp":
+        return 0, value
+    return 0, 0
+
+def pet_aura_bonus(db: Session, player_id: int) -> tuple:
+    """
+    Tổng (atk, hp) đã cộng từ các Pet đang bật - dùng khi tính lại toàn bộ chỉ số (stats.equipment_bonus).
+    Đọc Aura đã lưu lúc bật, không tính lại theo config -> khớp với delta đã cộng vào bonus trang bị.
+    """
+    atk, hp = db.exec(
+        select(func.coalesce(func.sum(PlayerPet.aura_atk), 0), func.coalesce(func.sum(PlayerPet.aura_hp), 0))
+        .where(PlayerPet.player_id == player_id, PlayerPet.is_active == True)
+    ).one()
+    return int(atk), int(hp)
+
+
+# =========================================================
+# 2. GHÉP MẢNH (Mảnh nằm trong túi đồ Inventory, index (player_id, item_id))
+# =========================================================
+def fuse_fragments(db: Session, player_id: int, fragment_item_id: Optional[int] = None,
+                   max_pets: Optional[int] = None) -> dict:
+    """
+    Ghép Mảnh thành Pet 1 sao: 1 query lấy các ô Mảnh, 1 INSERT hàng loạt cho Pet mới. Không commit.
+    fragment_item_id=None: ghép mọi loại Mảnh; max_pets: tối đa bao nhiêu Pet (None = hết mức có thể).
+    """
+    targets = registry.pet_fragments(db)
+    if fragment_item_id is not None:
+        if fragment_item_id not in targets:
+            raise ValueError("Mảnh này bị lỗi config (Không trỏ tới Pet nào).")
+        targets = {fragment_item_id: targets[fragment_item_id]}
+    if not targets:
+        return {"created": 0, "fragments_used": 0, "pets": {}}
+
+    stacks = db.exec(
+        select(Inventory)
+        .where(Inventory.player_id == player_id, Inventory.item_id.in_(list(targets)), Inventory.amount > 0)
+        .order_by(Inventory.id)
+    ).all()
+
+    new_pets, created = [], defaultdict(int)
+    for stack in stacks:
+        count = stack.amount // FRAGMENTS_PER_PET
+        if max_pets is not None:
+            count = min(count, max_pets - len(new_pets))
+        if count <= 0:
+            continue
+        stack.amount -= count * FRAGMENTS_PER_PET
+        if stack.amount <= 0:
+            db.delete(stack) # Hết thì xóa dòng luôn
+        else:
+            db.add(stack)
+        target_pet_id = targets[stack.item_id]
+        created[target_pet_id] += count
+        new_pets.extend(
+            {"player_id": player_id, "item_id": target_pet_id, "star_level": 1, "level": 1, "exp": 0, "is_active": False}
+            for _ in range(count)
+        )
+
+    if new_pets:
+        db.exec(insert(PlayerPet), params=new_pets)
+    return {
+        "created": len(new_pets),
+        "fragments_used": len(new_pets) * FRAGMENTS_PER_PET,
+        "pets": dict(created),
+    }
+
+
+# =========================================================
+# 3. TIẾN HÓA 3-TRONG-1 (Pet đang bật không bao giờ bị đem tế)
+# =========================================================
+def evolve_pets(db: Session, player_id: int, pet_item_id: Optional[int] = None,
+                star_level: Optional[int] = None, max_evolutions: Optional[int] = None,
+                cascade: bool = True) -> dict:
+    """
+    Gom Pet chưa bật theo (loại, sao); mỗi 3 con -> giữ 1 con lên sao (reset level như API cũ), xóa 2 con.
+    cascade=True: Pet vừa lên sao được xét tiếp ở mức sao mới. 1 DELETE + 1 UPDATE hàng loạt. Không commit.
+    """
+    stmt = select(PlayerPet.id, PlayerPet.item_id, PlayerPet.star_level, PlayerPet.level).where(
+        PlayerPet.player_id == player_id,
+        PlayerPet.is_active == False
+    )
+    if pet_item_id is not None:
+        stmt = stmt.where(PlayerPet.item_id == pet_item_id)
+    if star_level is not None:
+        stmt = stmt.where(PlayerPet.star_level == star_level)
+
+    levels = defaultdict(lambda: defaultdict(list))    # item_id -> sao -> [pet]
+    for row in db.exec(stmt.order_by(PlayerPet.id)).all():
+        levels[row.item_id][row.star_level].append({"id": row.id, "level": row.level})
+
+    promoted, consumed = {}, []    # id -> sao mới | id bị tế
+    results = defaultdict(int)     # (item_id, sao mới) -> số lần
+    total = 0
+    for item_id, by_star in levels.items():
+        while by_star and (max_evolutions is None or total < max_evolutions):
+            star = min(by_star)
+            pool = by_star.pop(star)
+            # Giữ con cấp cao nhất làm gốc, tế các con còn lại
+            pool.sort(key=lambda p: p["level"], reverse=True)
+            risen = []
+            while len(pool) >= PETS_PER_EVOLVE and (max_evolutions is None or total < max_evolutions):
+                group, pool = pool[:PETS_PER_EVOLVE], pool[PETS_PER_EVOLVE:]
+                keeper = group[0]
+                for pet in group[1:]:
+                    consumed.append(pet["id"])
+                    promoted.pop(pet["id"], None)   # Con vừa lên sao ở vòng trước nay bị tế tiếp
+                promoted[keeper["id"]] = star + 1
+                results[(item_id, star + 1)] += 1
+                keeper["level"] = 1
+                risen.append(keeper)
+                total += 1
+            if cascade and risen:
+                by_star[star + 1].extend(risen)
+
+    if total:
+        db.exec(delete(PlayerPet).where(PlayerPet.id.in_(consumed), PlayerPet.player_id == player_id))
+        db.connection().execute(
+            update(PlayerPet.__table__)
+            .where(PlayerPet.__table__.c.id == bindparam("b_id"))
+            .values(star_level=bindparam("b_star"), level=1, exp=0),
+            [{"b_id": pid, "b_star": star} for pid, star in promoted.items()]
+        )
+        # Đối tượng PlayerPet đang nằm trong session (nếu có) phải đọc lại giá trị mới
+        db.expire_all()
+    return {
+        "evolutions": total,
+        "consumed": len(consumed),
+        "results": [
+            {"pet_item_id": item_id, "star_level": star, "count": count}
+            for (item_id, star), count in results.items()
+        ],
+    }
+
+
+# =========================================================
+# 4. BẬT AURA (chỉ 1 Pet bay theo chủ)
+# =========================================================
+def activate_pet(db: Session, player_id: int, pet_instance_id: int) -> dict:
+    """
+    Bật 1 Pet, tắt các Pet khác. Trả về chênh lệch Aura (atk_delta, hp_delta) để route cộng vào
+    bonus trang bị bằng stats.apply_stat_delta rồi commit 1 lần. Không commit.
+    Aura cũ trừ theo số đã lưu trên PlayerPet (không theo config hiện tại của phôi Pet).
+    """
+    target_pet = db.get(PlayerPet, pet_instance_id)
+    if not target_pet:
+        raise LookupError("Không tìm thấy Linh thú này.")
+    if target_pet.player_id != player_id:
+        raise PermissionError("Linh thú này không phải của bạn!")
+    if target_pet.is_active:
+        return {"changed": False, "atk_delta": 0, "hp_delta": 0, "pet": target_pet}
+
+    old_atk, old_hp = pet_aura_bonus(db, player_id)
+    for pet in db.exec(select(PlayerPet).where(PlayerPet.player_id == player_id, PlayerPet.is_active == True)).all():
+        pet.is_active = False
+        pet.aura_atk, pet.aura_hp = 0, 0
+        db.add(pet)
+
+    new_atk, new_hp = pet_aura(db, target_pet.item_id, target_pet.star_level)
+    target_pet.is_active = True
+    target_pet.aura_atk, target_pet.aura_hp = new_atk, new_hp
+    # active_start_time chỉ để biết "Bắt đầu nuôi từ bao giờ", Aura không hết hạn
+    target_pet.active_start_time = datetime.utcnow()
+    db.add(target_pet)
+    return {"changed": True, "atk_delta": new_atk - old_atk, "hp_delta": new_hp - old_hp, "pet": target_pet}
+
+
+# =========================================================
+# 5. CHUYỂN ĐỔI 1 LẦN: CỘNG AURA CỦA PET ĐANG BẬT VÀO CHỈ SỐ
+# =========================================================
+def sync_pet_auras():
+    """
+    Lúc bật server:
+    - DB cũ chưa lưu Aura trên PlayerPet -> ghi Aura theo config hiện tại (đúng số đã cộng trước đó).
+    - Chỉ chạy 1 lần: người chơi đang bật Pet từ trước -> tính lại chỉ số để có Aura.
+    """
+    from game_logic.stats import recalculate_player_stats
+
+    with Session(engine) as db:
+        pending = db.exec(select(PlayerPet).where(PlayerPet.aura_atk == None)).all()
+        for pet in pending:
+            pet.aura_atk, pet.aura_hp = pet_aura(db, pet.item_id, pet.star_level) if pet.is_active else (0, 0)
+            db.add(pet)
+        if pending:
+            db.commit()
+
+        if db.get(SystemConfig, MIGRATION_KEY):
+            return
+        player_ids = db.exec(select(PlayerPet.player_id).where(PlayerPet.is_active == True).distinct()).all()
+        for player_id in player_ids:
+            player = db.get(Player, player_id)
+            if player:
+                recalculate_player_stats(db, player)
+        db.add(SystemConfig(key=MIGRATION_KEY, value=str(len(player_ids))))
+        db.commit()
+        if player_ids:
+            print(f"🐾 Đã cộng Aura Pet vào chỉ số cho {len(player_ids)} người chơi")
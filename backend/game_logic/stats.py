@@ -1,71 +1,92 @@
 import json
-from sqlmodel import Session, select
-from database import Player, PlayerItem, Item, Companion
+from sqlalchemy import bindparam
+from sqlmodel import Session, select, update, func
+from database import engine, Player, PlayerItem, Item, Companion
+from game_logic.pets import pet_aura_bonus
+
+# Bật lên để mỗi lần cộng/trừ delta đều tính lại toàn bộ và so khớp (dùng khi kiểm thử)
+VERIFY_DELTAS = False
+
+
+class StatDriftError(AssertionError):
+    """Bonus cộng dồn bằng delta lệch với kết quả tính lại toàn bộ."""
 
-def recalculate_player_stats(db: Session, player: Player, heal_mode: str = "MAINTAIN_PERCENT"):
-    """
-    Tính lại toàn bộ chỉ số nhân vật dựa trên trang bị.
-    
-    Tham số heal_mode:
-    - "MAINTAIN_PERCENT" (Mặc định): Giữ nguyên % máu (Dùng khi Mặc/Tháo đồ).
-    - "HEAL_BONUS": Hồi phục đúng lượng Max HP vừa tăng thêm (Dùng khi Cường hóa).
-    - "FULL_HEAL": Hồi đầy 100% máu (Dùng khi Lên cấp).
-    """
-    
-    # [QUAN TRỌNG] Lưu lại chỉ số Máu cũ để tính toán tỷ lệ
-    old_max_hp = player.hp_max
-    old_current_hp = player.hp
 
-    # 1. Lấy tất cả đồ đang mặc
-    equipped_items = db.exec(
+# =========================================================
+# 1. CHỈ SỐ CHARM (TÁCH SẴN TỪ JSON)
+# =========================================================
+def parse_charm_stats(stats_data) -> tuple:
+    """stats_data JSON -> (atk, hp). JSON hỏng thì coi như (0, 0) như cách tính cũ."""
+    try:
+        stats = json.loads(stats_data) if isinstance(stats_data, str) else (stats_data or {})
+        return int(stats.get("atk", 0)), int(stats.get("hp", 0))
+    except Exception:
+        return 0, 0
+
+def charm_stats(charm: PlayerItem) -> tuple:
+    """(atk, hp) của 1 Charm: đọc cột đã tách, dòng cũ chưa tách thì tách rồi ghi lại luôn."""
+    if charm.stat_atk is None or charm.stat_hp is None:
+        charm.stat_atk, charm.stat_hp = parse_charm_stats(charm.stats_data)
+    return charm.stat_atk, charm.stat_hp
+
+def set_charm_stats(charm: PlayerItem, stats: dict):
+    """Ghi chỉ số Charm: JSON (cho Frontend) + cột số (cho tính lực chiến) luôn khớp nhau."""
+    charm.stats_data = json.dumps(stats)
+    charm.stat_atk, charm.stat_hp = parse_charm_stats(stats)
+
+def backfill_charm_stats():
+    """Lúc bật server: tách chỉ số cho các Charm cũ chưa có stat_atk / stat_hp."""
+    with Session(engine) as db:
+        rows = db.exec(
+            select(PlayerItem.id, PlayerItem.stats_data)
+            .where((PlayerItem.stat_atk == None) | (PlayerItem.stat_hp == None))
+        ).all()
+        if not rows:
+            return
+        db.connection().execute(
+            update(PlayerItem.__table__)
+            .where(PlayerItem.__table__.c.id == bindparam("b_id"))
+            .values(stat_atk=bindparam("b_atk"), stat_hp=bindparam("b_hp")),
+            [
+                {"b_id": row_id, "b_atk": atk, "b_hp": hp}
+                for row_id, (atk, hp) in ((r[0], parse_charm_stats(r[1])) for r in rows)
+            ]
+        )
+        db.commit()
+        print(f"🧮 Đã tách chỉ số cho {len(rows)} Charm cũ")
+
+
+# =========================================================
+# 2. TÍNH LẠI TOÀN BỘ (Nguồn sự thật - dùng để đối chiếu)
+# =========================================================
+def equipment_bonus(db: Session, player_id: int) -> tuple:
+    """Tổng (atk, hp) từ Charm + Thẻ Đồng Hành đang mặc + Aura của Pet đang bật."""
+    new_atk_bonus = 0
+    new_hp_bonus = 0
+    # A. Cộng từ Charm
+    for charm in db.exec(
         select(PlayerItem)
-        .where(PlayerItem.player_id == player.id)
+        .where(PlayerItem.player_id == player_id)
         .where(PlayerItem.is_equipped == True)
-    ).all()
-    # Lấy Thẻ Đồng Hành (MỚI)
-    equipped_companions = db.exec(
-        select(Companion)
-        .where(Companion.player_id == player.id)
+    ).all():
+        atk, hp = charm_stats(charm)
+        new_atk_bonus += atk
+        new_hp_bonus += hp
+    # B. Cộng từ Thẻ Đồng Hành
+    comp_atk, comp_hp = db.exec(
+        select(func.coalesce(func.sum(Companion.atk), 0), func.coalesce(func.sum(Companion.hp), 0))
+        .where(Companion.player_id == player_id)
         .where(Companion.is_equipped == True)
-    ).all()
-    # 2. TÍNH TỔNG BONUS MỚI
-    new_atk_bonus = 0 
-    new_hp_bonus = 0
-    # A. Cộng từ Charm
-    for item in equipped_items:
-        if item.stats_data:
-            try:
-                stats = json.loads(item.stats_data)
-                new_atk_bonus += int(stats.get("atk", 0))
-                new_hp_bonus += int(stats.get("hp", 0))
-            except: pass
-    # B. Cộng từ Thẻ Đồng Hành (MỚI)
-    for comp in equipped_companions:
-        new_atk_bonus += comp.atk
-        new_hp_bonus += comp.hp
-        
-    # 3. Lấy lại chỉ số gốc (Base Stats)
-    # Logic: Base = Tổng hiện tại - Bonus cũ đang lưu trong DB
-    current_base_atk = player.atk - (player.item_atk_bonus or 0)
-    current_base_hp = player.hp_max - (player.item_hp_bonus or 0) 
-
-    # 4. Áp dụng Bonus mới
-    # Logic: Tổng mới = Base + Bonus mới
-    player.atk = current_base_atk + new_atk_bonus
-    player.hp_max = current_base_hp + new_hp_bonus
-    
-    # Cập nhật thông tin bonus vào DB
-    player.item_atk_bonus = new_atk_bonus
-    player.item_hp_bonus = new_hp_bonus
+    ).one()
+    # C. Cộng từ Aura Pet
+    pet_atk, pet_hp = pet_aura_bonus(db, player_id)
+    return new_atk_bonus + int(comp_atk) + pet_atk, new_hp_bonus + int(comp_hp) + pet_hp
 
-    # ==========================================================
-    # 5. XỬ LÝ MÁU HIỆN TẠI (LOGIC MỚI - HYBRID)
-    # ==========================================================
-    
+def _apply_hp(player: Player, old_max_hp: int, old_current_hp: int, heal_mode: str):
     # Trường hợp 1: Lên cấp -> Hồi đầy máu
     if heal_mode == "FULL_HEAL":
         player.hp = player.hp_max
-        
+
     # Trường hợp 2: Cường hóa -> Tăng bao nhiêu Max thì hồi bấy nhiêu máu
     elif heal_mode == "HEAL_BONUS":
         hp_diff = player.hp_max - old_max_hp
@@ -82,7 +103,7 @@ def recalculate_player_stats(db: Session, player: Player, heal_mode: str = "MAIN
             # Áp dụng % đó cho Max HP mới (Ví dụ: 200 * 0.5 = 100)
             new_current_hp = int(player.hp_max * percent)
             player.hp = new_current_hp
-        
+
         # Đảm bảo tối thiểu 1 HP để ko bị chết oan khi tháo đồ
         if player.hp < 1: player.hp = 1
 
@@ -90,9 +111,71 @@ def recalculate_player_stats(db: Session, player: Player, heal_mode: str = "MAIN
     if player.hp > player.hp_max:
         player.hp = player.hp_max
 
-    # 6. Lưu vào DB
+def _set_bonus(player: Player, new_atk_bonus: int, new_hp_bonus: int, heal_mode: str):
+    # [QUAN TRỌNG] Lưu lại chỉ số Máu cũ để tính toán tỷ lệ
+    old_max_hp = player.hp_max
+    old_current_hp = player.hp
+
+    # Logic: Base = Tổng hiện tại - Bonus cũ đang lưu trong DB; Tổng mới = Base + Bonus mới
+    player.atk = player.atk - (player.item_atk_bonus or 0) + new_atk_bonus
+    player.hp_max = player.hp_max - (player.item_hp_bonus or 0) + new_hp_bonus
+    player.item_atk_bonus = new_atk_bonus
+    player.item_hp_bonus = new_hp_bonus
+
+    _apply_hp(player, old_max_hp, old_current_hp, heal_mode)
+    return old_max_hp, old_current_hp
+
+def recalculate_player_stats(db: Session, player: Player, heal_mode: str = "MAINTAIN_PERCENT"):
+    """
+    Tính lại toàn bộ chỉ số nhân vật dựa trên trang bị.
+
+    Tham số heal_mode:
+    - "MAINTAIN_PERCENT" (Mặc định): Giữ nguyên % máu (Dùng khi Mặc/Tháo đồ).
+    - "HEAL_BONUS": Hồi phục đúng lượng Max HP vừa tăng thêm (Dùng khi Cường hóa).
+    - "FULL_HEAL": Hồi đầy 100% máu (Dùng khi Lên cấp).
+    """
+    new_atk_bonus, new_hp_bonus = equipment_bonus(db, player.id)
+    old_max_hp, old_current_hp = _set_bonus(player, new_atk_bonus, new_hp_bonus, heal_mode)
+
+    # Lưu vào DB
     db.add(player)
     db.commit()
     db.refresh(player)
-    
-    print(f"🔄 Recalculate ({heal_mode}): HP {old_current_hp}/{old_max_hp} -> {player.hp}/{player.hp_max}")
\ No newline at end of file
+
+    print(f"🔄 Recalculate ({heal_mode}): HP {old_current_hp}/{old_max_hp} -> {player.hp}/{player.hp_max}")
+
+
+# =========================================================
+# 3. CỘNG / TRỪ DELTA (Mặc, tháo, rèn, đột phá - O(1), không commit)
+# =========================================================
+def apply_stat_delta(db: Session, player: Player, atk_delta: int, hp_delta: int,
+                     heal_mode: str = "MAINTAIN_PERCENT", verify: bool = None):
+    """
+    Cộng (atk_delta, hp_delta) vào bonus trang bị của người chơi trong transaction hiện tại.
+    Gọi SAU khi đã đổi trạng thái trang bị trong session; route tự commit 1 lần.
+    verify=True (hoặc VERIFY_DELTAS): tính lại toàn bộ và báo lỗi nếu lệch.
+    """
+    new_atk_bonus = (player.item_atk_bonus or 0) + atk_delta
+    new_hp_bonus = (player.item_hp_bonus or 0) + hp_delta
+
+    if VERIFY_DELTAS if verify is None else verify:
+        expected = equipment_bonus(db, player.id)
+        if expected != (new_atk_bonus, new_hp_bonus):
+            raise StatDriftError(
+                f"Lệch chỉ số trang bị của {player.username}: delta -> {(new_atk_bonus, new_hp_bonus)}, "
+                f"tính lại -> {expected}"
+            )
+
+    if atk_delta or hp_delta or heal_mode == "FULL_HEAL":
+        _set_bonus(player, new_atk_bonus, new_hp_bonus, heal_mode)
+        db.add(player)
+
+def check_player_stats(db: Session, player: Player) -> dict:
+    """So bonus đang lưu với kết quả tính lại toàn bộ (không sửa gì)."""
+    atk, hp = equipment_bonus(db, player.id)
+    return {
+        "username": player.username,
+        "stored": {"atk": player.item_atk_bonus or 0, "hp": player.item_hp_bonus or 0},
+        "recomputed": {"atk": atk, "hp": hp},
+        "ok": (player.item_atk_bonus or 0, player.item_hp_bonus or 0) == (atk, hp),
+    }
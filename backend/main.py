@@ -14,7 +14,7 @@ from datetime import datetime, timedelta
 from fastapi import FastAPI, Depends, HTTPException, status, Query, Body, APIRouter, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, Response
 
 # --- IMPORT CHUẨN CHO SQLMODEL & SQLALCHEMY ---
 from sqlmodel import Session, select, update, col, func, or_, and_
@@ -37,6 +37,24 @@ from routes import (
 )
 from routes.auth import get_password_hash
 from game_logic.level import add_exp_to_player
+from game_logic import loot_engine
+from game_logic.item_processor import apply_inventory_deltas
+from game_logic.stats import backfill_charm_stats
+from game_logic.companion_lookup import migrate_legacy_companion_ids
+from game_logic.pets import sync_pet_auras
+from services.skill_tree import migrate_skills_data
+from services.question_index import ensure_question_index
+from services.question_store import question_store, sync_question_files_on_startup
+from services.market_browse import ensure_market_index
+from services.market_prices import ensure_price_index
+from services import wallet
+from services.shop_catalog import shop_catalog, claim_purchase
+from services.static_registry import registry
+from services.inventory_snapshot import inventory_snapshots
+from services.companion_assets import watch_companion_assets
+from game_logic.campaign_settlement import (
+    queue_settlement, start_settlement, resume_pending_settlements, get_settlement_status
+)
 # 2. Viết hàm tạo Admin mặc định (Đây là giải pháp gốc rễ)
 def create_default_admin():
     with Session(engine) as session:
@@ -77,10 +95,22 @@ async def lifespan(app: FastAPI):
     # 1. Khởi tạo Database cơ bản
     create_db_and_tables() 
     create_default_admin() 
+    ensure_question_index()
+    sync_question_files_on_startup()
+    ensure_market_index()
+    ensure_price_index()
+    wallet.ensure_wallet_snapshot()
+    backfill_charm_stats()
+    migrate_legacy_companion_ids()
+    sync_pet_auras()
+    migrate_skills_data()
+    resume_pending_settlements()
     
     # 2. KÍCH HOẠT BATTLE ENGINE (Chạy ngầm liên tục)
     print("🚀 Khởi động luồng BATTLE ENGINE (asyncio)...")
     engine_task = asyncio.create_task(campaign_game_loop())
+    snapshot_task = asyncio.create_task(wallet.wallet_snapshot_loop())
+    asset_watch_task = asyncio.create_task(watch_companion_assets())
     
     # 3. Giao lại quyền điều khiển cho Web Server
     yield 
@@ -90,6 +120,8 @@ async def lifespan(app: FastAPI):
     # ==========================================
     print("🛑 Server shutting down... Đang dọn dẹp tài nguyên...")
     engine_task.cancel() # Ra lệnh dừng vòng lặp hành quân
+    snapshot_task.cancel()
+    asset_watch_task.cancel()
     try:
         await engine_task # Đợi nó dừng hẳn
     except asyncio.CancelledError:
@@ -308,30 +340,16 @@ async def read_index():
     
 # --- hàm lấy thông tin item  ---
 @app.get("/api/shop/items")
-def get_shop_items(db: Session = Depends(get_db)):
+def get_shop_items(request: Request, db: Session = Depends(get_db)):
     try:
-        # 1. TRUY VẤN
-        # Lấy tất cả item mà is_hidden = False (hoặc None)
-        statement = select(Item).where((Item.is_hidden == False) | (Item.is_hidden == 0) | (Item.is_hidden == None))
-        results = db.exec(statement).all()
-        
-        shop_items = []
-        for item in results:
-            # 2. MAP DỮ LIỆU (Khớp với model của bạn)
-            shop_items.append({
-                "id": item.id,
-                "name": item.name,
-                "description": item.description,
-                
-                # 👇 Sửa đúng tên cột trong model của bạn
-                "icon": item.image_url if item.image_url else "default.png", 
-                "price": item.price,
-                
-                # 👇 Sửa đúng tên cột tiền tệ
-                "currency": item.currency_type  # tri_thuc, vinh_du, chien_tich
-            })
-            
-        return {"status": "success", "items": shop_items}
+        # Danh mục dựng sẵn trong RAM (chỉ dựng lại khi Admin sửa vật phẩm)
+        etag, payload = shop_catalog.items(db)
+
+        # Trình duyệt đã có đúng bản này -> 304, không gửi lại cả danh sách
+        headers = {"ETag": etag, "Cache-Control": "no-cache"}
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers=headers)
+        return JSONResponse(content=payload, headers=headers)
 
     except Exception as e:
         print(f"❌ Lỗi lấy Shop Item: {e}")
@@ -350,24 +368,24 @@ def buy_item(data: BuyRequest, db: Session = Depends(get_db)):
             return {"status": "error", "message": "Người chơi không tồn tại!"}
 
         # 2. TÌM MÓN ĐỒ
-        item = db.get(Item, data.item_id)
+        item = registry.get_item(db, data.item_id)
         if not item:
             return {"status": "error", "message": "Món đồ không tồn tại!"}
         
-        # 3. KIỂM TRA TIỀN
+        # 3. GIỮ LƯỢT MUA (limit_type: 1 lần / mỗi tháng) - 1 câu UPSERT trên bảng đếm
+        limit_error = claim_purchase(db, current_user.id, item)
+        if limit_error:
+            db.rollback()
+            return {"status": "error", "message": limit_error}
+
+        # 4. TRỪ TIỀN (Chỉ trừ khi đủ số dư - kiểm tra & trừ trong cùng 1 câu lệnh)
         cost = item.price
         currency = item.currency_type # ví dụ: "tri_thuc"
-        
-        # Lấy số dư hiện tại
-        current_balance = getattr(current_user, currency, 0)
-        
-        if current_balance < cost:
-            return {"status": "error", "message": f"Bạn không đủ {currency}!"}
 
-        # 4. TRỪ TIỀN & LƯU
-        new_balance = current_balance - cost
-        setattr(current_user, currency, new_balance)
-        db.add(current_user)
+        new_balance = wallet.debit(db, current_user.id, currency, cost, reason="shop_buy", ref=item.id)
+        if new_balance is None:
+            db.rollback()
+            return {"status": "error", "message": f"Bạn không đủ {currency}!"}
 
         # 5. THÊM ĐỒ VÀO TÚI (INVENTORY)
         # Kiểm tra xem đã có món này trong túi chưa
@@ -393,6 +411,7 @@ def buy_item(data: BuyRequest, db: Session = Depends(get_db)):
 
         # 6. COMMIT (Chốt đơn)
         db.commit()
+        inventory_snapshots.touch(current_user.id)
         
         return {
             "status": "success", 
@@ -410,7 +429,7 @@ def buy_item(data: BuyRequest, db: Session = Depends(get_db)):
 def get_hall_of_fame(db: Session = Depends(get_db)):
     try:
         # 1. Lấy danh sách Danh Hiệu
-        titles = db.exec(select(Title).order_by(Title.min_kpi.desc())).all()
+        titles = registry.titles(db)  # Đã sắp KPI giảm dần
 
         # 2. Lấy Học sinh (Lấy dư ra khoảng 20 người để lọc dần là vừa)
         players = db.exec(
@@ -740,10 +759,10 @@ def attack_boss(req: AttackRequest, db: Session = Depends(get_db)):
                 rw_chien_tich = boss.reward_chien_tich or 0
                 rw_vinh_du = boss.reward_vinh_du or 0
 
-                player.kpi = (player.kpi or 0) + rw_kpi
-                player.tri_thuc = (player.tri_thuc or 0) + rw_tri_thuc
-                player.chien_tich = (player.chien_tich or 0) + rw_chien_tich
-                player.vinh_du = (player.vinh_du or 0) + rw_vinh_du
+                wallet.adjust(db, player.id, {
+                    "kpi": rw_kpi, "tri_thuc": rw_tri_thuc,
+                    "chien_tich": rw_chien_tich, "vinh_du": rw_vinh_du
+                }, reason="boss_reward", ref=boss.id)
                 
                 # Ghi vào thông báo
                 if rw_kpi > 0: rewards_list_str.append(f"+{rw_kpi} KPI")
@@ -753,36 +772,23 @@ def attack_boss(req: AttackRequest, db: Session = Depends(get_db)):
 
                 # --- B. XỬ LÝ DROP POOL (NHIỀU MÓN) ---
                 try:
-                    # Giải mã JSON: [{"id": "1", "rate": 50}, ...]
-                    pool = json.loads(boss.drop_pool) if boss.drop_pool else []
-                    
-                    for drop_config in pool:
-                        d_id = drop_config.get("id")
-                        d_rate = float(drop_config.get("rate", 0))
-                        
-                        # Quay số cho TỪNG MÓN
-                        if d_id and random.uniform(0, 100) <= d_rate:
-                            item_obj = db.get(Item, int(d_id))
-                            if item_obj:
-                                # Cộng vào kho
-                                inv_item = db.exec(select(Inventory).where(
-                                    Inventory.player_id == player.id, 
-                                    Inventory.item_id == item_obj.id
-                                )).first()
-
-                                if inv_item:
-                                    inv_item.amount += 1
-                                    db.add(inv_item)
-                                else:
-                                    new_inv = Inventory(player_id=player.id, item_id=item_obj.id, amount=1)
-                                    db.add(new_inv)
-                                
-                                # Thêm vào danh sách thông báo
-                                rewards_list_str.append(f"🎁 {item_obj.name}")
-                                frontend_rewards["items"].append({
-                                    "name": item_obj.name,
-                                    "image": item_obj.image_url
-                                })
+                    # JSON: [{"id": "1", "rate": 50}, ...] -> bảng rơi đồ biên dịch sẵn (cache theo nội dung)
+                    drops = loot_engine.drop_table(boss.drop_pool).roll(1)
+
+                    # Quay số cho TỪNG MÓN (độc lập), cộng vào kho 1 lần
+                    deltas = {}
+                    for d_id, qty in drops.items():
+                        item_obj = registry.get_item(db, d_id)
+                        if item_obj:
+                            deltas[item_obj.id] = qty
+
+                            # Thêm vào danh sách thông báo
+                            rewards_list_str.append(f"🎁 {item_obj.name}")
+                            frontend_rewards["items"].append({
+                                "name": item_obj.name,
+                                "image": item_obj.image_url
+                            })
+                    apply_inventory_deltas(db, player.id, deltas)
                 except Exception as e:
                     print(f"⚠️ Lỗi Drop Pool: {e}")
 
@@ -795,6 +801,8 @@ def attack_boss(req: AttackRequest, db: Session = Depends(get_db)):
             db.add(boss)
             db.commit()
             db.refresh(boss)
+            if player and frontend_rewards["items"]:
+                inventory_snapshots.touch(player.id)  # Đồ rơi đã vào túi -> snapshot túi đồ cũ
 
             return {
                 "success": True,
@@ -839,90 +847,43 @@ def get_boss_question(boss_id: int, db: Session = Depends(get_db)):
         elif boss.atk >= 200: target_diff = "hard"
         else: target_diff = "medium"
 
-        # 2. XÁC ĐỊNH ĐƯỜNG DẪN THƯ MỤC CHUẨN XÁC
+        # 2. TÌM CÁC BỘ ĐỀ BOSS CỦA MÔN (Đã nạp sẵn từ thư mục "data câu hỏi" vào kho chung)
         subject_str = boss.subject.lower() 
-        
-        # Lấy thư mục hiện tại (backend)
-        CURRENT_DIR = os.path.dirname(os.path.abspath(__file__))
-        
-        # 🔥 ĐIỂM CHỐT CHẶN: Sử dụng chính xác thư mục "data câu hỏi" của Lãnh chúa
-        folder_path = os.path.join(CURRENT_DIR, "..", "data câu hỏi", subject_str)
-        
-        print(f"👉 [BOSS API] Đang tìm thư mục: {folder_path}")
-        
-        if not os.path.exists(folder_path):
-            print(f"❌ LỖI BOSS: Thư mục không tồn tại: {folder_path}")
-            return JSONResponse(status_code=404, content={"message": f"Chưa có thư mục môn: {subject_str}"})
-
-        # 3. TÌM FILE BOSS VÀ ĐỘ KHÓ
-        all_files = os.listdir(folder_path)
-        
-        # Tìm file có đuôi json VÀ có chữ "boss"
-        boss_files = [f for f in all_files if "boss" in f.lower() and f.endswith(".json")]
+        boss_files = [src for src in question_store.sources(db, subject_str) if "boss" in src.lower()]
         
         if not boss_files:
-            print(f"❌ LỖI BOSS: Thư mục {subject_str} không có file nào chứa chữ 'boss' trong tên!")
+            print(f"❌ LỖI BOSS: Môn {subject_str} không có file nào chứa chữ 'boss' trong tên!")
             return JSONResponse(status_code=404, content={"message": f"Không có file câu hỏi Boss!"})
 
-        # Cố gắng tìm file khớp độ khó
+        # 3. Ưu tiên file khớp độ khó, không có thì bốc từ mọi file Boss
         diff_files = [f for f in boss_files if target_diff in f.lower()]
-        
-        # Nếu có file đúng độ khó -> Lấy file đó. Nếu không có -> Lấy bừa 1 file Boss bất kỳ.
         final_files_list = diff_files if diff_files else boss_files
-        
-        chosen_file = random.choice(final_files_list)
-        file_path = os.path.join(folder_path, chosen_file)
-        
-        print(f"👉 [BOSS API] Đã chọn bốc câu hỏi từ file: {chosen_file}")
-        
-        # 4. ĐỌC FILE VÀ BỐC CÂU HỎI
-        with open(file_path, 'r', encoding='utf-8') as f:
-            questions_list = json.load(f)
-            
-        if not questions_list:
-            print(f"❌ LỖI BOSS: File {chosen_file} đang trống rỗng!")
-            return JSONResponse(status_code=404, content={"message": f"File {chosen_file} đang trống!"})
-            
-        q_dict = random.choice(questions_list)
 
-        # 5. TÁCH ĐÁP ÁN
-        try:
-            options_list = q_dict.get("options", [])
-            while len(options_list) < 4:
-                options_list.append("---")
+        picked = question_store.sample(db, 1, sources=final_files_list)
+        if not picked:
+            return JSONResponse(status_code=404, content={"message": f"Bộ đề Boss môn {subject_str} đang trống!"})
+        q = picked[0]
 
-            opt_a = options_list[0]
-            opt_b = options_list[1]
-            opt_c = options_list[2]
-            opt_d = options_list[3]
+        # 4. TÁCH ĐÁP ÁN
+        options_list = list(q["options"])
+        while len(options_list) < 4:
+            options_list.append("---")
+        opt_a, opt_b, opt_c, opt_d = options_list[:4]
 
-            correct_text = q_dict.get("answer", "")
-            correct_char = "a" 
-            
-            if correct_text == opt_a: correct_char = "a"
-            elif correct_text == opt_b: correct_char = "b"
-            elif correct_text == opt_c: correct_char = "c"
-            elif correct_text == opt_d: correct_char = "d"
-            
-            print(f"✅ [BOSS API] Bốc thành công 1 câu! (Đáp án: {correct_char.upper()})")
+        correct_text = q["correct_answer"]
+        correct_char = "a" 
+        if correct_text == opt_a: correct_char = "a"
+        elif correct_text == opt_b: correct_char = "b"
+        elif correct_text == opt_c: correct_char = "c"
+        elif correct_text == opt_d: correct_char = "d"
 
-            return {
-                "id": random.randint(100000, 999999),
-                "content": q_dict.get("question", "Lỗi mất nội dung câu hỏi?"),
-                "options": {"a": opt_a, "b": opt_b, "c": opt_c, "d": opt_d},
-                "correct_ans": correct_char, 
-                "explanation": f"Đáp án đúng là: {correct_text}"
-            }
-
-        except Exception as parse_err:
-            print(f"❌ LỖI XỬ LÝ JSON BOSS: {parse_err}")
-            return {
-                "id": 999999,
-                "content": q_dict.get("question", "Lỗi dữ liệu câu hỏi"),
-                "options": {"a": "Lỗi", "b": "Lỗi", "c": "Lỗi", "d": "Lỗi"},
-                "correct_ans": "a",
-                "explanation": "Câu hỏi này bị lỗi định dạng JSON."
-            }
+        return {
+            "id": q["id"],
+            "content": q["content"],
+            "options": {"a": opt_a, "b": opt_b, "c": opt_c, "d": opt_d},
+            "correct_ans": correct_char, 
+            "explanation": q["explanation"] or f"Đáp án đúng là: {correct_text}"
+        }
 
     except Exception as e:
         print("\n================= 💥 LỖI API BOSS (HỆ THỐNG) 💥 =================")
@@ -1127,40 +1088,33 @@ def minigame_luyen_binh(req: MinigameRewardRequest, db: Session = Depends(get_db
         
     return {"success": True, "message": msg}
 # 1. API LẤY DANH SÁCH CÁC FILE JSON TRONG THƯ MỤC chien dich
-# Hàm công cụ tự động dò đúng đường dẫn thư mục
-def get_minigame_folder(game_type: str):
-    # Lấy thư mục chứa file main.py (tức là thư mục 'backend')
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    # Lùi ra 1 cấp (..), rồi vào 'data câu hỏi' -> 'chien dich'
-    return os.path.normpath(os.path.join(current_dir, "..", "data câu hỏi", "chien dich", "chieu binh" if game_type == "chieu-binh" else "luyen binh"))
+# Hàm công cụ: tên source (đường dẫn tương đối trong "data câu hỏi") của từng minigame
+def get_minigame_source(game_type: str):
+    return "chien dich/" + ("chieu binh" if game_type == "chieu-binh" else "luyen binh")
 
 # 1. API LẤY DANH SÁCH FILE
 @app.get("/api/campaign/minigame/files")
-def get_minigame_files(game_type: str):
-    folder_path = get_minigame_folder(game_type)
-    
-    if not os.path.exists(folder_path):
-        return {"success": False, "data": []}
+def get_minigame_files(game_type: str, db: Session = Depends(get_db)):
+    folder = get_minigame_source(game_type)
+    files = [src.split("/")[-1] for src in question_store.sources(db, folder)]
+    return {"success": bool(files), "data": files}
 
-    files = [f for f in os.listdir(folder_path) if f.endswith('.json')]
-    return {"success": True, "data": files}
-
-# 2. API ĐỌC NỘI DUNG FILE
+# 2. API ĐỌC NỘI DUNG FILE (Lấy từ kho câu hỏi chung, không đọc lại file)
 @app.get("/api/campaign/minigame/questions")
-def get_minigame_questions(game_type: str, file_name: str):
-    folder_path = get_minigame_folder(game_type)
-    file_path = os.path.join(folder_path, file_name)
-    
-    if not os.path.exists(file_path):
+def get_minigame_questions(game_type: str, file_name: str, db: Session = Depends(get_db)):
+    source = f"{get_minigame_source(game_type)}/{file_name}"
+    questions = question_store.source_questions(db, source)
+    if not questions:
         return {"success": False, "message": "Không tìm thấy file!"}
 
-    try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        if not isinstance(data, list): data = [data]
-        return {"success": True, "data": data}
-    except Exception as e:
-        return {"success": False, "message": f"Lỗi đọc file JSON: {e}"}
+    data = [{
+        "id": q["id"],
+        "question": q["content"],
+        "content": q["content"],
+        "options": [o for o in q["options"] if o],
+        "answer": q["correct_answer"]
+    } for q in questions]
+    return {"success": True, "data": data}
 # =====================================================================
 # [MODULE CHIẾN DỊCH] 5. API XUẤT QUÂN TỪ GIAO DIỆN (Dùng Node Code)
 # =====================================================================
@@ -1280,7 +1234,7 @@ def march_troops_by_code(campaign_id: int, req: MarchByCodeRequest, db: Session
         if player.companion_id:
             commander = db.get(Companion, player.companion_id)
             if commander:
-                template = db.get(CompanionTemplate, commander.template_id)
+                template = registry.get_companion_template(db, commander.template_id)
                 if template:
                     commander_name = commander.temp_name or template.name
                     
@@ -1573,7 +1527,7 @@ def get_campaign_state(username: str, db: Session = Depends(get_db)):
         commander_info = None
         if c_player and c_player.companion_id:
             comp = db.get(Companion, c_player.companion_id)
-            template = db.get(CompanionTemplate, comp.template_id) if comp else None
+            template = registry.get_companion_template(db, comp.template_id) if comp else None
             if comp and template:
                 base = {'R': getattr(cfg, 'BONUS_R', 0.02), 'SR': getattr(cfg, 'BONUS_SR', 0.04), 'SSR': getattr(cfg, 'BONUS_SSR', 0.06), 'USR': getattr(cfg, 'BONUS_USR', 0.08)}.get(template.rarity, 0)
                 commander_info = {
@@ -1688,7 +1642,7 @@ def get_campaign_state(username: str, db: Session = Depends(get_db)):
             # 2. Tính bonus từ Chủ Tướng (Copy y chang logic commander_info của bạn)
             if getattr(player, 'companion_id', None):
                 comp = db.get(Companion, player.companion_id)
-                template = db.get(CompanionTemplate, comp.template_id) if comp else None
+                template = registry.get_companion_template(db, comp.template_id) if comp else None
                 
                 if comp and template:
                     base = {'R': getattr(cfg, 'BONUS_R', 0.02), 'SR': getattr(cfg, 'BONUS_SR', 0.04), 'SSR': getattr(cfg, 'BONUS_SSR', 0.06), 'USR': getattr(cfg, 'BONUS_USR', 0.08)}.get(template.rarity, 0)
@@ -1805,6 +1759,26 @@ def admin_close_campaign(db: Session = Depends(get_db)):
         print(f"❌ LỖI ĐÓNG MÙA GIẢI: {e}")
         return {"success": False, "message": "Lỗi hệ thống khi đóng mùa giải!"}
 
+@app.get("/api/campaign/{campaign_id}/settlement")
+def get_campaign_settlement(campaign_id: int, db: Session = Depends(get_db)):
+    """Tiến độ phát thưởng cuối mùa (đã phát / tổng số lãnh chúa)."""
+    result = get_settlement_status(db, campaign_id)
+    if not result:
+        return {"success": False, "message": "Chiến dịch này chưa được quyết toán."}
+    return {"success": True, "data": result}
+
+@app.post("/api/admin/campaign/{campaign_id}/settle")
+def admin_retry_settlement(campaign_id: int, db: Session = Depends(get_db)):
+    """Chạy lại quyết toán bị lỗi (an toàn: ai đã nhận thưởng sẽ không nhận lần 2)."""
+    result = get_settlement_status(db, campaign_id)
+    if not result:
+        return {"success": False, "message": "Chiến dịch này chưa được quyết toán."}
+    if result["status"] == "DONE":
+        return {"success": False, "message": "Đã phát thưởng xong, không cần chạy lại.", "data": result}
+    if not start_settlement(campaign_id):
+        return {"success": False, "message": "Quyết toán đang chạy, vui lòng chờ.", "data": result}
+    return {"success": True, "message": "🎁 Đã bắt đầu phát thưởng lại.", "data": result}
+
 @app.post("/api/campaign/join")
 def join_campaign(req: JoinFactionRequest, db: Session = Depends(get_db)):
     campaign = db.exec(select(Campaign).where(Campaign.status == "REGISTERING")).first()
@@ -2154,7 +2128,7 @@ def replenish_troops(campaign_id: int, req: BaseRequest, db: Session = Depends(g
         if player.companion_id:
             comp = db.get(Companion, player.companion_id)
             if comp:
-                template = db.get(CompanionTemplate, comp.template_id)
+                template = registry.get_companion_template(db, comp.template_id)
                 if template:
                     b_rate = {'R': getattr(cfg, 'BONUS_R', 0.02), 'SR': getattr(cfg, 'BONUS_SR', 0.04), 'SSR': getattr(cfg, 'BONUS_SSR', 0.06), 'USR': getattr(cfg, 'BONUS_USR', 0.08)}.get(template.rarity, 0)
                     bonus_percent = b_rate + (comp.star * getattr(cfg, 'BONUS_PER_STAR', 0.01))
@@ -2256,7 +2230,7 @@ def set_campaign_commander(req: SetCommanderRequest, db: Session = Depends(get_d
             return {"success": False, "message": "Đồng hành không hợp lệ hoặc không thuộc quyền sở hữu của bạn!"}
 
         # LẤY TÊN TỪ BẢNG TEMPLATE
-        template = db.get(CompanionTemplate, companion.template_id)
+        template = registry.get_companion_template(db, companion.template_id)
         display_name = companion.temp_name or (template.name if template else "Vô Danh")
 
         c_player.companion_id = req.companion_id
@@ -2345,6 +2319,7 @@ async def campaign_game_loop():
         # Nếu không đóng băng thì reset lại flag log để lần sau in tiếp
         campaign_game_loop.frozen_logged = False
 
+        settled_campaign_id = None
         try:
             with Session(engine) as db:
                 # 1. XỬ LÝ TRẬN ĐÁNH (Sẽ bị dừng nếu ở trên continue)
@@ -2415,46 +2390,16 @@ async def campaign_game_loop():
                             )
                             db.add(victory_report)
                             
-                            # Quét danh sách người tham gia để phát thưởng
-                            participants = db.exec(select(CampaignPlayer).where(CampaignPlayer.campaign_id == campaign.id)).all()
-                            
-                            for p_record in participants:
-                                actual_player = db.get(Player, p_record.player_id)
-                                if not actual_player: continue
-                                
-                                # SỬ DỤNG ĐÚNG TÊN BIẾN TRONG FILE CONFIG CỦA BẠN
-                                if p_record.faction == winner_faction:
-                                    reward_kpi = getattr(cfg, 'WIN_REWARD_KPI', 20)
-                                    reward_tri_thuc = getattr(cfg, 'WIN_REWARD_TRI_THUC', 50)
-                                    reward_chien_tich = getattr(cfg, 'WIN_REWARD_CHIEN_TICH', 10)
-                                    status_text = "Chiến thắng"
-                                else:
-                                    reward_kpi = getattr(cfg, 'LOSE_REWARD_KPI', 10)
-                                    reward_tri_thuc = getattr(cfg, 'LOSE_REWARD_TRI_THUC', 10)
-                                    reward_chien_tich = getattr(cfg, 'LOSE_REWARD_CHIEN_TICH', 3)
-                                    status_text = "Tham gia"
-                                
-                                # Cộng tài nguyên cho người chơi
-                                actual_player.kpi = (actual_player.kpi or 0) + reward_kpi
-                                actual_player.tri_thuc = (actual_player.tri_thuc or 0) + reward_tri_thuc
-                                actual_player.chien_tich = (actual_player.chien_tich or 0) + reward_chien_tich
-                                db.add(actual_player)
-                                from database import ScoreLog
-                                # Ghi log nhận thưởng để user dễ theo dõi trong hồ sơ
-                                log = ScoreLog(
-                                    target_id=actual_player.id,
-                                    target_name=actual_player.username,
-                                    sender_id=0,
-                                    sender_name="Hệ Thống",
-                                    category="TÀI NGUYÊN",
-                                    description=f"Thưởng {status_text} chiến dịch mùa này: +{reward_kpi} KPI, +{reward_tri_thuc} Tri Thức, +{reward_chien_tich} Chiến Tích.",
-                                    value_change=reward_kpi
-                                )
-                                db.add(log)
-                                
-                            print(f"🎁 Đã phát thưởng thành công cho {len(participants)} lãnh chúa tham gia!")
+                            # Chỉ xếp hàng quyết toán - phát thưởng chạy ở thread riêng sau khi commit,
+                            # tick không phải chờ quét hàng trăm lãnh chúa
+                            queue_settlement(db, campaign.id, winner_faction)
+                            settled_campaign_id = campaign.id
 
                 db.commit() # Một lệnh Commit duy nhất cho tất cả thay đổi
+
+            # Phát thưởng mùa giải (set-based, chạy ngầm, có theo dõi tiến độ)
+            if settled_campaign_id:
+                start_settlement(settled_campaign_id)
                 
         except Exception as e:
             import traceback
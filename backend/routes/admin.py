@@ -23,8 +23,19 @@ from database import (
     PlayerPet, SystemStatus, generate_username,
     QuestionBank, ArenaMatch, ArenaParticipant,
     SkillTemplate, Title, SystemConfig,
-    ScoreLog, ShopHistory, ActiveEffect, PlayerSkill, MarketListing,
+    ScoreLog, ShopHistory, ShopPurchaseCounter, ActiveEffect, PlayerSkill, MarketListing,
+    QuestionTag, QuestionSource,
+    MarketTrade, MarketPriceIndex, WalletLedger, WalletSnapshot,
 )
+from services.question_index import search_questions, get_tag_counts, set_question_tags, parse_tags, remove_bank_questions
+from services.question_importer import import_questions, iter_question_file
+from services.question_store import question_store, sync_question_files, QUESTION_DATA_DIR
+from services import wallet
+from services.static_registry import registry
+from services.inventory_snapshot import inventory_snapshots
+from game_logic import loot_engine, item_processor
+from game_logic import level as level_engine
+from game_logic import stats as stat_engine
 
 from io import BytesIO
 from unidecode import unidecode
@@ -178,22 +189,15 @@ def update_player_stats(
                 raise HTTPException(status_code=404, detail="Không tìm thấy học sĩ")
             players = [player]
 
-        # 2. Vòng lặp cập nhật (Dùng chung cho cả 1 người hoặc ALL)
+        # 2. Cập nhật Tiền tệ cho tất cả trong 1 lệnh (ghi sổ cái ví)
+        wallet.batch_adjust(db, [p.id for p in players], {
+            "kpi": kpi_change, "tri_thuc": tri_thuc_change,
+            "chien_tich": chien_tich_change, "vinh_du": vinh_du_change
+        }, reason="admin_adjust", ref=player_identifier)
+
+        # 3. Vòng lặp cập nhật HP (Dùng chung cho cả 1 người hoặc ALL)
         count = 0
         for p in players:
-            # --- Cập nhật Tiền tệ (Các dòng bạn bị thiếu đây) ---
-            if kpi_change != 0:
-                p.kpi = (p.kpi or 0.0) + kpi_change
-            
-            if tri_thuc_change != 0:
-                p.tri_thuc = (p.tri_thuc or 0) + tri_thuc_change
-            
-            if chien_tich_change != 0:
-                p.chien_tich = (p.chien_tich or 0) + chien_tich_change
-            
-            if vinh_du_change != 0:
-                p.vinh_du = (p.vinh_du or 0) + vinh_du_change
-
             # --- Cập nhật HP (Giữ nguyên logic tính Max HP của bạn) ---
             if hp_change != 0:
                 c_type = p.class_type if p.class_type else "NOVICE"
@@ -227,6 +231,127 @@ def update_player_stats(
         raise HTTPException(status_code=500, detail=f"Lỗi server: {str(e)}")
 # Sửa tham số đầu vào thành 'player_identifier' (str) để nhận được cả số và chữ "ALL"
 
+# ==================================================================
+# 💰 VÍ: SỔ CÁI, SNAPSHOT & ĐỐI SOÁT
+# ==================================================================
+@router.post("/wallet/snapshot")
+def create_wallet_snapshot(db: Session = Depends(get_db)):
+    count = wallet.take_snapshot(db)
+    return {"success": True, "message": f"Đã chụp số dư ({count} dòng)."}
+
+@router.get("/wallet/audit")
+def audit_wallets(username: Optional[str] = None, show_all: bool = False, db: Session = Depends(get_db)):
+    """Số dư tính lại từ snapshot + sổ cái so với số dư thật (mặc định chỉ trả về các dòng lệch)."""
+    player_id = None
+    if username:
+        player_id = db.exec(select(Player.id).where(Player.username == username)).first()
+        if player_id is None:
+            raise HTTPException(status_code=404, detail="Không tìm thấy người chơi")
+    report = wallet.audit_balances(db, player_id=player_id, only_drift=not show_all)
+    return {"success": True, "drift_count": sum(1 for r in report if r["drift"]), "rows": report}
+
+@router.get("/wallet/ledger")
+def get_wallet_ledger(
+    username: str,
+    currency: Optional[str] = None,
+    before_id: Optional[int] = None,
+    limit: int = 50,
+    db: Session = Depends(get_db)
+):
+    player_id = db.exec(select(Player.id).where(Player.username == username)).first()
+    if player_id is None:
+        raise HTTPException(status_code=404, detail="Không tìm thấy người chơi")
+    return wallet.get_ledger(db, player_id, currency=currency, before_id=before_id, limit=limit)
+
+# --- CHỈ SỐ TRANG BỊ (Đối chiếu bonus cộng dồn bằng delta với tính lại toàn bộ) ---
+@router.get("/stats/verify")
+def verify_player_stats(username: Optional[str] = None, fix: bool = False, db: Session = Depends(get_db)):
+    """Mặc định chỉ trả về người chơi bị lệch; fix=True thì tính lại toàn bộ cho các dòng lệch."""
+    query = select(Player)
+    if username:
+        query = query.where(Player.username == username)
+    report = [r for r in (stat_engine.check_player_stats(db, p) for p in db.exec(query).all()) if username or not r["ok"]]
+    if username and not report:
+        raise HTTPException(status_code=404, detail="Không tìm thấy người chơi")
+
+    if fix:
+        for row in report:
+            if not row["ok"]:
+                player = db.exec(select(Player).where(Player.username == row["username"])).first()
+                stat_engine.recalculate_player_stats(db, player, heal_mode="MAINTAIN_PERCENT")
+    return {"success": True, "drift_count": sum(1 for r in report if not r["ok"]), "rows": report}
+
+@router.post("/stats/verify-mode")
+def set_stats_verify_mode(enabled: bool):
+    """Bật: mỗi lần mặc/tháo/rèn đều tính lại toàn bộ và báo lỗi nếu delta lệch (dùng khi kiểm thử)."""
+    stat_engine.VERIFY_DELTAS = enabled
+    return {"success": True, "verify_deltas": stat_engine.VERIFY_DELTAS}
+
+# --- KHO DỮ LIỆU TĨNH (Item / Skill / Phôi thẻ / Danh hiệu / Config) ---
+@router.get("/registry/stats")
+def get_registry_stats():
+    """Số lần đọc trúng RAM (hits) / phải nạp DB (misses) của từng nhóm."""
+    return registry.stats()
+
+@router.post("/registry/reload")
+def reload_registry(section: Optional[str] = None):
+    """Xóa cache để nạp lại từ DB (khi sửa tay trong DB)."""
+    try:
+        registry.invalidate(*([section] if section else []))
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"Nhóm dữ liệu không hợp lệ: {section}")
+    return {"success": True, "stats": registry.stats()}
+
+# =========================================================
+# MÔ PHỎNG TỶ LỆ RƠI ĐỒ (Kiểm tra rương / Boss trước khi phát hành)
+# =========================================================
+class LootSimulateRequest(BaseModel):
+    item_id: Optional[int] = None           # Rương Gacha đã có trong bảng Item
+    boss_id: Optional[int] = None           # drop_pool của Boss
+    drops: Optional[List[dict]] = None      # Hoặc bảng rơi đồ nháp chưa lưu
+    rolls: int = 1_000_000
+
+@router.post("/loot/simulate")
+def simulate_loot(req: LootSimulateRequest, db: Session = Depends(get_db)):
+    """Quay thử N lượt và so tỷ lệ thực tế với tỷ lệ cấu hình của từng dòng."""
+    if req.drops is not None:
+        drops, source = req.drops, "draft"
+    elif req.item_id is not None:
+        item = registry.get_item(db, req.item_id)
+        if not item:
+            raise HTTPException(status_code=404, detail="Không tìm thấy vật phẩm")
+        drops, source = loot_engine.chest_drops(item.config_dict or {}), f"item:{item.id}"
+    elif req.boss_id is not None:
+        boss = db.get(Boss, req.boss_id)
+        if not boss:
+            raise HTTPException(status_code=404, detail="Không tìm thấy Boss")
+        try:
+            drops = json.loads(boss.drop_pool) if boss.drop_pool else []
+        except Exception:
+            raise HTTPException(status_code=400, detail="drop_pool của Boss không phải JSON hợp lệ")
+        source = f"boss:{boss.id}"
+    else:
+        raise HTTPException(status_code=400, detail="Cần item_id, boss_id hoặc drops")
+
+    try:
+        table = loot_engine.drop_table(drops)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Bảng rơi đồ không hợp lệ: {e}")
+    if not len(table):
+        raise HTTPException(status_code=400, detail="Bảng rơi đồ trống")
+
+    max_rolls = loot_engine.SIMULATE_MAX_ROLLS if loot_engine.np is not None else loot_engine.SIMULATE_MAX_ROLLS_NO_NUMPY
+    rolls = max(1, min(req.rolls, max_rolls))
+
+    started = time.perf_counter()
+    result = table.simulate(rolls)
+    result["elapsed_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    result["source"] = source
+    for line in result["lines"]:
+        item = registry.get_item(db, line["item_id"])
+        line["name"] = item.name if item else None
+    return result
+
 # --- Giữ nguyên các hàm Vật phẩm (Item) không đổi ---
 # 1. API TẠO VẬT PHẨM (Sửa để lưu vào bảng ITEM mới)
 @router.post("/items/templates") # Giữ nguyên URL để frontend đỡ phải sửa
@@ -255,6 +380,7 @@ def create_item_template(
         db.add(new_item)
         db.commit()
         db.refresh(new_item)
+        registry.invalidate("items")
         
         return {"success": True, "item": new_item}
         
@@ -280,6 +406,7 @@ def delete_item_template(
         # 3. Thực hiện xóa
         db.delete(item)
         db.commit()
+        registry.invalidate("items")
         
         return {"success": True, "message": f"Đã xóa vật phẩm: {item.name}"}
 
@@ -341,11 +468,63 @@ def give_item_to_player(
                 db.add(new_item)
 
         db.commit()
+        inventory_snapshots.touch(*(p.id for p in players))
         return {"success": True, "message": "Thao tác vật phẩm thành công!"}
     except Exception as e:
         db.rollback()
         raise HTTPException(500, detail=str(e))
 
+# tặng Charm hàng loạt (1 transaction cho cả lô)
+@router.post("/players/{player_id}/charms")
+def give_charms_to_player(
+    player_id: str, # "ALL" = mọi học sinh
+    rarity: str = Query("MAGIC"),
+    amount: int = Query(1),
+    db: Session = Depends(get_db)
+):
+    rarity = rarity.upper()
+    if rarity not in item_processor.CHARM_NAMES:
+        raise HTTPException(400, detail=f"Độ hiếm phải là 1 trong {list(item_processor.CHARM_NAMES)}")
+    if not 1 <= amount <= item_processor.CHARM_BATCH_MAX:
+        raise HTTPException(400, detail=f"Số lượng phải từ 1 đến {item_processor.CHARM_BATCH_MAX}")
+
+    if player_id == "ALL":
+        player_ids = db.exec(select(Player.id).where(Player.role != "admin")).all()
+    else:
+        p = db.get(Player, int(player_id))
+        if not p: raise HTTPException(404)
+        player_ids = [p.id]
+
+    try:
+        for pid in player_ids:
+            item_processor.generate_charms(db, pid, rarity, amount, commit=False)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(500, detail=str(e))
+    inventory_snapshots.touch(*player_ids)
+    return {"success": True, "message": f"Đã tặng {amount} {item_processor.CHARM_NAMES[rarity]} cho {len(player_ids)} người chơi!"}
+
+# tặng EXP hàng loạt: cả lớp / 1 tổ / 1 Class (1 câu UPDATE cho cả lô)
+@router.post("/players/exp")
+def give_exp_to_players(
+    amount: int = Query(..., gt=0),
+    team_id: Optional[int] = Query(None),
+    class_type: Optional[str] = Query(None), # WARRIOR / MAGE / NOVICE
+    db: Session = Depends(get_db)
+):
+    try:
+        result = level_engine.grant_exp_bulk(db, amount, team_id=team_id, class_type=class_type)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        raise HTTPException(500, detail=str(e))
+    return {
+        "success": True,
+        "message": f"Đã cộng {amount} EXP cho {result['players']} học sinh ({len(result['leveled_up'])} người lên cấp)!",
+        "leveled_up": result["leveled_up"],
+    }
+
 # --- tặng và thu hồi tiền tệ ---
 
 # --- BỔ SUNG CÁC MODEL NHẬN DỮ LIỆU ---
@@ -745,7 +924,10 @@ async def reset_season(db: Session = Depends(get_db)):
         db.exec(delete(PlayerSkill))    # Xóa kỹ năng người chơi đã học [cite: 160]
         db.exec(delete(PlayerPet))      # Xóa thú cưng đang sở hữu [cite: 156]
         db.exec(delete(MarketListing))  # Xóa các món đang treo bán trên Chợ Đen [cite: 158]
+        db.exec(delete(MarketTrade))    # Xóa nhật ký giao dịch & bảng giá Chợ Đen
+        db.exec(delete(MarketPriceIndex))
         db.exec(delete(ShopHistory))    # Xóa lịch sử mua hàng tại Shop [cite: 153]
+        db.exec(delete(ShopPurchaseCounter))  # Xóa bộ đếm giới hạn lượt mua
 
         # --- NHÓM 2: XÓA LỊCH SỬ HOẠT ĐỘNG & TIẾN TRÌNH ---
         db.exec(delete(TowerProgress))  # Xóa tầng tháp cao nhất của từng người [cite: 154]
@@ -757,6 +939,11 @@ async def reset_season(db: Session = Depends(get_db)):
         db.exec(delete(ArenaParticipant)) # [cite: 165]
         db.exec(delete(ArenaMatch))       # [cite: 162]
 
+        # Xóa sổ cái ví & snapshot của học sinh
+        student_ids = select(Player.id).where(Player.role != "admin")
+        db.exec(delete(WalletLedger).where(WalletLedger.player_id.in_(student_ids)))
+        db.exec(delete(WalletSnapshot).where(WalletSnapshot.player_id.in_(student_ids)))
+
         # --- NHÓM 3: XÓA NGƯỜI CHƠI (GIỮ ADMIN) ---
         # Việc xóa Player sẽ tự động xóa sạch Level, Tiền tệ, KPI vì chúng nằm trong bảng này
         statement = delete(Player).where(Player.role != "admin") # 
@@ -849,96 +1036,100 @@ async def clear_boss_logs(db: Session = Depends(get_db)):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-#API Lấy Danh Sách Câu Hỏi   
+#API Tìm kiếm / Liệt kê Câu Hỏi (Phân trang)
 @router.get("/tower/questions") # Giữ nguyên URL để Frontend không phải sửa nhiều
-async def get_tower_questions(db: Session = Depends(get_db)):
-    statement = (
-        select(TowerQuestion.subject, TowerQuestion.difficulty, func.count(TowerQuestion.id))
-        .group_by(TowerQuestion.subject, TowerQuestion.difficulty)
+def get_tower_questions(
+    q: Optional[str] = None,
+    subject: Optional[str] = None,
+    difficulty: Optional[str] = None,
+    grade: Optional[int] = None,
+    tag: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 20,
+    db: Session = Depends(get_db)
+):
+    return search_questions(
+        db, q=q, subject=subject, difficulty=difficulty, grade=grade,
+        tag=tag, page=page, page_size=page_size
     )
-    results = db.exec(statement).all()
-    
-    stats = {}
-    for sub, diff, count in results:
-        if sub not in stats:
-            stats[sub] = {"total": 0, "details": {}}
-        stats[sub]["details"][diff] = count
-        stats[sub]["total"] += count
-    return stats
+
+@router.get("/tower/tags")
+def get_question_tags(db: Session = Depends(get_db)):
+    """Danh sách chủ đề kèm số câu hỏi"""
+    return get_tag_counts(db)
+
+@router.put("/tower/questions/{question_id}/tags")
+def update_question_tags(question_id: int, tags: List[str] = Body(..., embed=True), db: Session = Depends(get_db)):
+    if not db.get(QuestionBank, question_id):
+        raise HTTPException(status_code=404, detail="Không tìm thấy câu hỏi")
+    set_question_tags(db, question_id, tags)
+    db.commit()
+    return {"success": True, "tags": parse_tags(tags)}
 
 # ==================================================================
 # API NẠP CÂU HỎI (Vỏ cũ - Ruột mới thông minh)
 # ==================================================================
 @router.post("/tower/import-questions")
-async def import_tower_questions(
+def import_tower_questions(
     file: UploadFile = File(...), 
     mode: str = Form(...), 
     db: Session = Depends(get_db)
 ):
+    """Nạp file JSON / Excel kiểu streaming: đọc từng dòng, chèn theo lô, 1 transaction."""
     try:
-        contents = await file.read()
-        questions_raw = json.loads(contents)
-    except Exception:
-        raise HTTPException(status_code=400, detail="File lỗi format JSON!")
-
-    if not isinstance(questions_raw, list):
-        raise HTTPException(status_code=400, detail="JSON phải là một danh sách []!")
-
-    # --- XÓA CŨ (NẾU CHỌN REPLACE) ---
-    if mode == "replace":
-        combinations = set()
-        for q in questions_raw:
-            s = q.get('subject', 'General')
-            d = q.get('difficulty', 'medium')
-            combinations.add((s, d))
-        
-        for subject, diff in combinations:
-            statement = delete(QuestionBank).where(
-                QuestionBank.subject == subject, 
-                QuestionBank.difficulty == diff
-            )
-            db.exec(statement)
-        db.commit()
-
-    # --- NẠP MỚI ---
-    added_count = 0
-    for q in questions_raw:
-        try:
-            # 1. Lấy đáp án (Ưu tiên chữ thường a,b,c,d theo mẫu JSON của bạn)
-            val_a = str(q.get('a') or q.get('A') or '').strip()
-            val_b = str(q.get('b') or q.get('B') or '').strip()
-            val_c = str(q.get('c') or q.get('C') or '').strip()
-            val_d = str(q.get('d') or q.get('D') or '').strip()
+        report = import_questions(db, iter_question_file(file.file, file.filename or ""), mode=mode)
+    except ValueError as e:
+        # Lỗi cấu trúc file (không phải lỗi từng dòng) -> Không có gì được lưu
+        raise HTTPException(status_code=400, detail=f"File lỗi format: {e}")
+    question_store.invalidate()
+
+    message = f"Đã nạp thành công {report['added']} câu hỏi."
+    if report["duplicate_count"]:
+        message += f" Bỏ qua {report['duplicate_count']} câu trùng lặp."
+    if report["error_count"]:
+        message += f" {report['error_count']} dòng lỗi."
+    return {"success": True, "message": message, **report}
+
+@router.post("/tower/import-folder")
+def import_question_folder(
+    folder: str = Body(..., embed=True),
+    mode: str = Body("append", embed=True),
+    db: Session = Depends(get_db)
+):
+    """Nạp toàn bộ file JSON trong 1 thư mục con của 'data câu hỏi' (VD: 'toan')."""
+    # realpath + commonpath: chặn '../' và cả thư mục "anh em" trùng tiền tố (VD 'data câu hỏi_x')
+    base_dir = os.path.realpath(QUESTION_DATA_DIR)
+    folder_path = os.path.realpath(os.path.join(base_dir, folder))
+    if os.path.commonpath([folder_path, base_dir]) != base_dir or not os.path.isdir(folder_path):
+        raise HTTPException(status_code=404, detail=f"Không tìm thấy thư mục: {folder}")
+
+    def iter_folder():
+        # Nối các file thành 1 luồng -> 1 transaction, 'replace' không xóa nhầm dữ liệu của file trước
+        for name in sorted(os.listdir(folder_path)):
+            if not name.lower().endswith(".json"):
+                continue
+            with open(os.path.join(folder_path, name), "rb") as f:
+                for row_no, raw in iter_question_file(f, name):
+                    yield f"{name}#{row_no}", raw
 
-            options_list = [val_a, val_b, val_c, val_d]
+    try:
+        report = import_questions(db, iter_folder(), mode=mode)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"File lỗi format: {e}")
+    question_store.invalidate()
+    return {"success": True, **report}
+
+@router.post("/tower/sync-files")
+def sync_question_data_files(force: bool = Body(False, embed=True), db: Session = Depends(get_db)):
+    """Đồng bộ 'data câu hỏi' (Boss, minigame Chiến dịch) vào kho chung. force=True: nạp lại tất cả."""
+    results = sync_question_files(db, force=force)
+    return {
+        "success": True,
+        "synced": len(results),
+        "added": sum(r.get("added", 0) for r in results.values()),
+        "files": results
+    }
 
-            # 2. Xử lý đáp án đúng (Map từ 'b' sang '109')
-            raw_correct = str(q.get('correct') or '').strip().lower() # Chuyển về chữ thường để so sánh
-            
-            final_correct = raw_correct # Mặc định
-            
-            if raw_correct == 'a': final_correct = val_a
-            elif raw_correct == 'b': final_correct = val_b
-            elif raw_correct == 'c': final_correct = val_c
-            elif raw_correct == 'd': final_correct = val_d
-
-            # 3. Tạo câu hỏi
-            new_q = QuestionBank(
-                subject=q.get('subject', 'Khác'),
-                difficulty=q.get('difficulty', 'easy'),
-                content=q.get('content', 'Nội dung lỗi'),
-                options_json=json.dumps(options_list), # Lưu mảng JSON string
-                correct_answer=final_correct,
-                explanation=q.get('explain', "")
-            )
-            db.add(new_q)
-            added_count += 1
-        except Exception as e:
-            print(f"Lỗi dòng {added_count}: {e}")
-            continue 
-    
-    db.commit()
-    return {"success": True, "message": f"Đã nạp thành công {added_count} câu hỏi."}
 #API Thống kê đang có bn câu hỏi
 
 # ==================================================================
@@ -949,6 +1140,7 @@ async def get_tower_stats(db: Session = Depends(get_db)):
     # 1. Truy vấn dữ liệu từ bảng QuestionBank
     statement = (
         select(QuestionBank.subject, QuestionBank.difficulty, func.count(QuestionBank.id))
+        .where(QuestionBank.file_only == False)  # Chỉ đếm câu Tháp / Lôi Đài bốc được
         .group_by(QuestionBank.subject, QuestionBank.difficulty)
     )
     results = db.exec(statement).all()
@@ -978,10 +1170,11 @@ async def get_tower_stats(db: Session = Depends(get_db)):
 # ==================================================================
 @router.delete("/tower/delete-subject/{subject}")
 async def delete_tower_subject(subject: str, db: Session = Depends(get_db)):
-    statement = delete(QuestionBank).where(QuestionBank.subject == subject)
     try:
-        db.exec(statement)
+        # Câu Boss / minigame nạp từ 'data câu hỏi' không thuộc ngân hàng đề -> giữ nguyên
+        remove_bank_questions(db, QuestionBank.subject == subject)
         db.commit()
+        question_store.invalidate()
         return {"status": "success", "message": f"Đã xóa môn {subject}"}
     except Exception as e:
         db.rollback()
@@ -1165,6 +1358,7 @@ def create_pet(
     )
     db.add(new_pet)
     db.commit()
+    registry.invalidate("items")
     return {"success": True, "pet": new_pet}
 
 # 2. API Cấu hình Gacha
@@ -1206,6 +1400,7 @@ def setup_gacha(data: GachaSetupRequest, db: Session = Depends(get_db)):
     
     db.add(chest_item)
     db.commit()
+    registry.invalidate("items")
 
     return {"status": "success", "message": f"Đã cập nhật tỷ lệ Gacha cho rương: {chest_item.name}"}
 
@@ -1293,6 +1488,7 @@ def save_skill(req: SkillSchema, db: Session = Depends(get_db)):
             db.add(skill)
             
         db.commit()
+        registry.invalidate("skills")
         
         return {
             "status": "success", 
@@ -1333,6 +1529,7 @@ def create_title(req: TitleRequest, db: Session = Depends(get_db)):
     new_title = Title(name=req.name, min_kpi=req.min_kpi, color=req.color)
     db.add(new_title)
     db.commit()
+    registry.invalidate("titles")
     db.refresh(new_title)
     return {"status": "success", "data": new_title}
 
@@ -1345,6 +1542,7 @@ def delete_title(title_id: int, db: Session = Depends(get_db)):
     
     db.delete(title)
     db.commit()
+    registry.invalidate("titles")
     return {"status": "success", "message": "Đã xóa danh hiệu"}
 
 # Hệ thống quản lý loi đài admin
@@ -1438,6 +1636,7 @@ def save_system_config(
                 db.add(record)
 
         db.commit()
+        registry.invalidate("config")
         return {"status": "success", "message": "Đã cập nhật cấu hình hệ thống!"}
 
     except Exception as e:
@@ -1,14 +1,24 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, Body
+from fastapi import APIRouter, Depends, HTTPException, Query, Body, Request, WebSocket, WebSocketDisconnect
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, Response
 from sqlmodel import Session, select, func, or_
-from database import get_db, Player, ArenaMatch, ArenaParticipant, QuestionBank
+from database import get_db, engine, Player, ArenaMatch, ArenaParticipant, QuestionBank
 from game_logic.arena_manager import ArenaManager
+from game_logic.arena_lobby import lobby
+from services.question_index import pick_question_ids_by_tags
+from services.question_store import question_store
+from services import wallet
 from typing import Optional, Dict, List
 from pydantic import BaseModel
 import random
 import json
 import ast
+import asyncio
 router = APIRouter(prefix="/arena", tags=["Arena"])
 
+# Chu kỳ (giây) WebSocket kiểm tra version của sảnh chờ
+LOBBY_PUSH_INTERVAL = 1
+
 # --- DATA MODELS (Schema cho dữ liệu gửi lên) ---
 class ChallengeRequest(BaseModel):
     mode: str          # 1vs1, 2vs2
@@ -54,88 +64,11 @@ def create_challenge(
 
 @router.get("/list-my-matches")
 def list_my_matches(username: str = Query(...), db: Session = Depends(get_db)):
-    from sqlmodel import or_ 
     manager = ArenaManager(db)
     manager.process_lazy_timeouts()
-    
-    # 1. Incoming (Lời mời ĐẾN) -> CHỈ LẤY PENDING HOẶC ACTIVE (Chưa xong)
-    incoming_query = db.exec(
-        select(ArenaParticipant, ArenaMatch)
-        .join(ArenaMatch)
-        .where(ArenaParticipant.username == username)
-        .where(or_(ArenaMatch.status == "pending", ArenaMatch.status == "active")) # <--- Bỏ finished
-        .order_by(ArenaMatch.created_at.desc())
-    ).all()
-    
-    incoming_data = []
-    for p, m in incoming_query:
-        incoming_data.append({
-            "match_id": m.id,
-            "creator": m.created_by,
-            "bet": m.bet_amount,
-            "mode": m.mode,
-            "difficulty": m.difficulty,
-            "status": m.status,
-            "logs": m.logs,
-            "my_status": p.status
-        })
-
-    # 2. Outgoing (Lời mời ĐI) -> CHỈ LẤY PENDING HOẶC ACTIVE (Chưa xong)
-    outgoing_query = db.exec(
-        select(ArenaMatch)
-        .where(ArenaMatch.created_by == username)
-        .where(or_(ArenaMatch.status == "pending", ArenaMatch.status == "active")) # <--- Bỏ finished
-        .order_by(ArenaMatch.created_at.desc())
-    ).all()
-    
-    outgoing_data = []
-    for m in outgoing_query:
-        outgoing_data.append({
-            "match_id": m.id,
-            "created_at": m.created_at,
-            "bet": m.bet_amount,
-            "mode": m.mode,
-            "difficulty": m.difficulty,
-            "status": m.status,
-            "logs": m.logs,
-            "player_1": m.created_by,
-            "player_2": getattr(m, "player_2", "???") 
-        })
-
-    # 3. History (Lịch sử) -> CHỈ LẤY TRẬN ĐÃ KẾT THÚC (FINISHED)
-    # Lấy cả trận mình tạo VÀ trận mình tham gia
-    history_query = db.exec(
-        select(ArenaMatch)
-        .join(ArenaParticipant, isouter=True) # Join để tìm trận mình tham gia
-        .where(or_(
-            ArenaMatch.created_by == username,      # Mình tạo
-            ArenaParticipant.username == username   # Hoặc mình tham gia
-        ))
-        .where(ArenaMatch.status == "finished")     # Chỉ lấy trận đã xong
-        .order_by(ArenaMatch.created_at.desc())
-        .limit(5) # Chỉ lấy 20 trận gần nhất cho đỡ lag
-    ).all()
-    
-    # Lọc trùng (Do join có thể ra trùng nếu logic phức tạp, set cho chắc)
-    history_unique = {m.id: m for m in history_query}.values()
-    
-    history_data = []
-    for m in history_unique:
-         history_data.append({
-            "match_id": m.id,
-            "created_at": m.created_at,
-            "bet": m.bet_amount,
-            "mode": m.mode,
-            "winner_team": m.winner_team,
-            "logs": m.logs,
-            "created_by": m.created_by # Để biết mình là chủ hay khách
-        })
 
-    return {
-        "incoming": incoming_data,
-        "outgoing": outgoing_data,
-        "history": history_data # <--- Key mới
-    }
+    # Incoming + Outgoing + History (kèm tên đối thủ) trong 1 lượt query
+    return manager.get_match_inbox(username)
 
 @router.post("/accept")
 def accept_match(
@@ -171,30 +104,41 @@ def cancel_match(match_id: int = Body(..., embed=True), username: str = Body(...
 
 # --- PHẦN 2VS2 & LOBBY ---
 
+def _etag_response(request: Request, etag: str, payload):
+    """Trả 304 nếu client đã có bản mới nhất (If-None-Match), ngược lại trả dữ liệu kèm ETag."""
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    return JSONResponse(content=jsonable_encoder(payload), headers={"ETag": etag})
+
 @router.get("/lobby")
-def get_lobby(db: Session = Depends(get_db)):
-    """Lấy danh sách các phòng 2vs2 đang chờ (Pending)"""
-    manager = ArenaManager(db)
-    manager.process_lazy_timeouts()
-    
-    matches = db.exec(select(ArenaMatch).where(ArenaMatch.mode == "2vs2", ArenaMatch.status == "pending")).all()
-    
-    lobby_data = []
-    for m in matches:
-        # Lấy danh sách thành viên hiện tại
-        participants = db.exec(select(ArenaParticipant).where(ArenaParticipant.match_id == m.id)).all()
-        team_a = [p.username for p in participants if p.team == 'A']
-        team_b = [p.username for p in participants if p.team == 'B']
-        
-        lobby_data.append({
-            "id": m.id,
-            "bet": m.bet_amount,
-            "difficulty": m.difficulty,
-            "team_a": team_a,
-            "team_b": team_b,
-            "count": len(participants)
-        })
-    return lobby_data
+def get_lobby(request: Request, db: Session = Depends(get_db)):
+    """Lấy danh sách các phòng 2vs2 đang chờ (Pending) - đọc từ sảnh chờ trong RAM"""
+    lobby.ensure_loaded(db)
+
+    # Chỉ quét DB khi thực sự có phòng quá hạn
+    if lobby.has_expired():
+        ArenaManager(db).process_lazy_timeouts()
+
+    version, rooms = lobby.snapshot("2vs2")
+    return _etag_response(request, f'W/"lobby-{version}"', rooms)
+
+@router.websocket("/lobby/ws")
+async def lobby_websocket(websocket: WebSocket):
+    """Đẩy danh sách phòng 2vs2 mỗi khi sảnh chờ thay đổi (thay cho việc poll liên tục)."""
+    await websocket.accept()
+    with Session(engine) as db:
+        lobby.ensure_loaded(db)
+
+    last_version = None
+    try:
+        while True:
+            version, rooms = lobby.snapshot("2vs2")
+            if version != last_version:
+                await websocket.send_text(json.dumps({"type": "lobby", "version": version, "rooms": rooms}))
+                last_version = version
+            await asyncio.sleep(LOBBY_PUSH_INTERVAL)
+    except (WebSocketDisconnect, RuntimeError):
+        pass
 
 @router.post("/join-lobby")
 def join_lobby(match_id: int = Body(...), username: str = Body(...), team: str = Body(...), db: Session = Depends(get_db)):
@@ -210,57 +154,37 @@ def join_lobby(match_id: int = Body(...), username: str = Body(...), team: str =
 def get_arena_quiz(
     match_id: int, 
     username: str, 
+    tags: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
     print(f"⚡ [DEBUG] Lấy đề cho Match {match_id}")
 
-    # Lấy tất cả câu hỏi
-    all_questions = db.exec(select(QuestionBank)).all()
-    
-    if len(all_questions) < 5:
-        raise HTTPException(status_code=400, detail="Kho câu hỏi không đủ 5 câu!")
+    # Ưu tiên bốc theo chủ đề (tra index tag) nếu có yêu cầu
+    selected_questions = []
+    if tags:
+        ids = pick_question_ids_by_tags(db, tags, 5)
+        selected_questions = [q for q in (question_store.get(db, i) for i in ids) if q]
 
-    # Chọn ngẫu nhiên 5 câu
-    selected_questions = random.sample(all_questions, 5)
-    
-    quiz_data = []
-    for q in selected_questions:
-        try:
-            # --- XỬ LÝ OPTIONS (Vạn năng) ---
-            raw_data = q.options_json
-            
-            if isinstance(raw_data, list):
-                options = raw_data
-            elif isinstance(raw_data, str):
-                raw_str = raw_data.strip()
-                if "'" in raw_str: raw_str = raw_str.replace("'", '"')
-                try:
-                    options = json.loads(raw_str)
-                except:
-                    try:
-                        options = ast.literal_eval(raw_str)
-                    except:
-                        options = ["Lỗi data", "Lỗi data", "Lỗi data", "Lỗi data"]
-            else:
-                 options = ["Lỗi data", "Lỗi data", "Lỗi data", "Lỗi data"]
+    if len(selected_questions) < 5:
+        # Bốc ngẫu nhiên 5 câu từ kho chung (RAM)
+        selected_questions = question_store.sample(db, 5)
 
-            if not isinstance(options, list):
-                options = ["Lỗi format", "Lỗi format", "Lỗi format", "Lỗi format"]
+        if len(selected_questions) < 5:
+            raise HTTPException(status_code=400, detail="Kho câu hỏi không đủ 5 câu!")
 
-        except Exception as e:
-            print(f"❌ LỖI OPTIONS CÂU {q.id}: {e}")
-            options = ["Lỗi hiển thị", "Lỗi hiển thị", "Lỗi hiển thị", "Lỗi hiển thị"]
+    quiz_data = []
+    for q in selected_questions:
+        options = q["options"] or ["Lỗi data", "Lỗi data", "Lỗi data", "Lỗi data"]
 
         # --- TẠO DỮ LIỆU TRẢ VỀ ---
-        # Chú ý: Các dòng dưới đây phải có dấu phẩy ở cuối
         quiz_data.append({
-            "id": q.id,
-            "content": q.content,
+            "id": q["id"],
+            "content": q["content"],
             "options": options,
-            "subject": q.subject,
-            "difficulty": q.difficulty,          # <--- Đã có dấu phẩy
-            "correct_answer": q.correct_answer,  # <--- Đã có dấu phẩy
-            "explanation": q.explanation         # <--- Dòng cuối không bắt buộc phẩy nhưng có cũng không sao
+            "subject": q["subject"],
+            "difficulty": q["difficulty"],
+            "correct_answer": q["correct_answer"],
+            "explanation": q["explanation"]
         })
 
     print("✅ Đã tạo đề thi thành công.")
@@ -296,10 +220,10 @@ def submit_arena_quiz(
     
     for q_id, user_ans in payload.answers.items():
         try:
-            question = db.get(QuestionBank, int(q_id))
+            question = question_store.get(db, q_id)
             if question:
                 # So sánh đáp án (chuyển về chữ thường, bỏ khoảng trắng)
-                db_correct = str(question.correct_answer).strip().lower()
+                db_correct = str(question["correct_answer"]).strip().lower()
                 user_choice = str(user_ans).strip().lower()
                 
                 if db_correct == user_choice:
@@ -374,36 +298,21 @@ def submit_arena_quiz(
         if match.bet_amount > 0:
             # Lấy danh sách người chơi để cộng tiền
             # (Lưu ý: biến 'participants' đã được bạn query ở đoạn tính điểm Team rồi, dùng lại luôn)
-            for p in participants:
-                p_wallet = db.exec(select(Player).where(Player.username == p.username)).first()
-                if not p_wallet: continue
+            def is_winner(p):
+                # Check thắng 1vs1 / Check thắng Team (2vs2, 3vs3)
+                if match.mode == "1vs1" and winner == p.username:
+                    return True
+                return str(winner) == f"Team {p.team}" or str(winner) == p.team
+
+            # -- TRƯỜNG HỢP HÒA (Trả lại tiền) --
+            if winner == "Draw" or winner == "Hòa":
+                names, changes, reason = [p.username for p in participants], {"kpi": match.bet_amount}, "arena_refund"
+            # -- TRƯỜNG HỢP CÓ NGƯỜI THẮNG: Ăn gấp đôi tiền + 1 Chiến Tích --
+            else:
+                names, changes, reason = [p.username for p in participants if is_winner(p)], {"kpi": match.bet_amount * 2, "chien_tich": 1}, "arena_win"
 
-                # -- TRƯỜNG HỢP HÒA (Trả lại tiền) --
-                if winner == "Draw" or winner == "Hòa":
-                    p_wallet.kpi += match.bet_amount
-                
-                # -- TRƯỜNG HỢP CÓ NGƯỜI THẮNG --
-                else:
-                    is_winner = False
-                    # Check thắng 1vs1
-                    if match.mode == "1vs1" and winner == p.username:
-                        is_winner = True
-                
-                    # Check thắng Team (2vs2, 3vs3)
-                    elif str(winner) == f"Team {p.team}" or str(winner) == p.team: 
-                        is_winner = True
-                    
-                    # Nếu thắng -> Ăn gấp đôi tiền + 1 Chiến Tích
-                    if is_winner:
-                        # 1. Cộng KPI (Tiền)
-                        p_wallet.kpi += (match.bet_amount * 2)
-                        
-                        # 👇 2. CỘNG CHIẾN TÍCH (Thêm dòng này vào) 👇
-                        p_wallet.chien_tich = (p_wallet.chien_tich or 0) + 1
-                        
-                        print(f"✅ Đã cộng tiền và chiến tích cho {p.username}")
-
-                db.add(p_wallet)
+            ids = db.exec(select(Player.id).where(Player.username.in_(names))).all() if names else []
+            wallet.batch_credit(db, ids, changes, reason=reason, ref=match.id)
             
             print(f"💰 [ECONOMY] Đã phân định tiền thưởng cho Match {match.id}")
         db.add(match)
@@ -433,41 +342,14 @@ def submit_arena_quiz(
         }
 @router.get("/opponents")
 def get_arena_opponents(
+    request: Request,
     current_user: str = Query(...), 
     db: Session = Depends(get_db)
 ):
-    # 👇 LOG DEBUG 1: Xác nhận API đã được gọi
-    print(f"🐍 [DEBUG-BE] API Opponents được gọi bởi user: '{current_user}'")
-    
-    try:
-        # Tìm tất cả player có username KHÁC current_user
-        players = db.exec(
-            select(Player)
-            .where(Player.username != current_user)  # Không lấy chính mình
-            .where(Player.username != "admin")       # Không lấy Admin
-        ).all()
-        
-        # 👇 LOG DEBUG 2: Xem tìm được bao nhiêu người trong DB
-        print(f"🐍 [DEBUG-BE] Tìm thấy {len(players)} người chơi khác trong DB.")
-        
-        result = []
-        for p in players:
-            kpi_safe = p.kpi if p.kpi is not None else 0
-            result.append({
-                "username": p.username,
-                "full_name": p.full_name if p.full_name else p.username,
-                "class_type": p.class_type if p.class_type else "Novice",
-                "kpi": kpi_safe
-            })
-        
-        return result
-
-    except Exception as e:
-        # 👇 LOG DEBUG 3: Nếu code Python bị crash
-        print(f"❌ [DEBUG-BE] Lỗi code Python: {e}")
-        import traceback
-        traceback.print_exc()
-        raise e
+    # Danh sách người chơi được cache trong RAM, chỉ bỏ chính mình ra
+    version, players = lobby.get_opponents(db)
+    result = [p for p in players if p["username"] != current_user]
+    return _etag_response(request, f'W/"opponents-{version}"', result)
     
 # ==================================================================
 # API LẤY CHI TIẾT TRẬN ĐẤU (Để xem kết quả)
@@ -2,9 +2,13 @@ import os
 import random
 import traceback
 import json
+from typing import Optional
 from fastapi import APIRouter, Depends, HTTPException, Query
 from sqlmodel import SQLModel, Session, select
 from database import get_db, Companion, CompanionTemplate, CompanionConfig, Player
+from services.static_registry import registry
+from services.companion_collection import browse_collection
+from services.companion_assets import scan_companion_assets
 
 # Tạo Router riêng cho tính năng này
 router = APIRouter()
@@ -13,89 +17,24 @@ router = APIRouter()
 # 1. ADMIN: QUÉT ẢNH ĐỂ TẠO PHÔI (AUTO SCAN) - PHIÊN BẢN SỬA LỖI PATH
 # ==========================================
 @router.post("/admin/companions/scan")
-def scan_companion_templates(db: Session = Depends(get_db)):
+def scan_companion_templates(force: bool = False, db: Session = Depends(get_db)):
     """
-    Hàm này sẽ duyệt qua thư mục frontend/assets/card/
-    và tự động tạo dữ liệu vào bảng CompanionTemplate.
+    Đồng bộ thư mục frontend/assets/card/{r,sr,ssr,usr} vào bảng CompanionTemplate.
+    Chỉ đọc lại file mới / đã sửa / đã xóa (xem services/companion_assets.py); force=True để băm lại toàn bộ.
     """
-    
-    # --- FIX LỖI ĐƯỜNG DẪN ---
-    # 1. Lấy vị trí của file hiện tại (backend/routes/companion.py)
-    current_file_path = os.path.abspath(__file__)
-    
-    # 2. Lùi lại 2 cấp để ra thư mục gốc dự án (kpi_kingdom_v3)
-    # routes -> backend -> kpi_kingdom_v3
-    root_dir = os.path.dirname(os.path.dirname(os.path.dirname(current_file_path)))
-    
-    # 3. Nối vào đường dẫn frontend/assets/card (Tự động dùng \ hoặc / tùy window/linux)
-    base_path = os.path.join(root_dir, "frontend", "assets", "card")
-
-    print(f"🔍 Đang quét tại: {base_path}") # In ra CMD để debug
-
-    rarities = ["r", "sr", "ssr", "usr"]
-    
-    added_count = 0
-    updated_count = 0
-    
-    # Kiểm tra xem thư mục gốc có tồn tại không
-    if not os.path.exists(base_path):
-        print(f"❌ Không tìm thấy thư mục gốc: {base_path}")
-        return {"status": "error", "message": f"Không tìm thấy thư mục: {base_path}. Hãy kiểm tra lại tên folder!"}
-
-    for rarity in rarities:
-        folder_path = os.path.join(base_path, rarity)
-        
-        # Nếu chưa tạo thư mục con thì bỏ qua
-        if not os.path.exists(folder_path):
-            print(f"⚠️ Bỏ qua {rarity.upper()} vì chưa có thư mục: {folder_path}")
-            continue
-            
-        print(f"📂 Đang quét thư mục: {rarity.upper()}...")
-
-        # Duyệt qua từng file ảnh trong thư mục
-        for file_name in os.listdir(folder_path):
-            if file_name.lower().endswith((".png", ".webp", ".jpg", ".jpeg")):
-                
-                # --- XỬ LÝ TẠO ID ---
-                # Ví dụ file: "vo-nguyen-giap.png"
-                name_slug = file_name.rsplit(".", 1)[0] # Lấy "vo-nguyen-giap"
-                
-                # Tạo Template ID chuẩn: SR_VO_NGUYEN_GIAP
-                clean_slug = name_slug.replace("-", "_").replace(" ", "_").upper()
-                template_id = f"{rarity.upper()}_{clean_slug}"
-                
-                # Tạo Tên hiển thị: Võ Nguyên Giáp
-                display_name = name_slug.replace("-", " ").replace("_", " ").title()
-                
-                # Đường dẫn ảnh (Lưu vào DB đường dẫn tương đối để frontend load)
-                image_rel_path = f"/assets/card/{rarity}/{file_name}"
-
-                # --- LƯU VÀO DATABASE ---
-                existing = db.get(CompanionTemplate, template_id)
-                
-                if not existing:
-                    # Nếu chưa có -> Tạo mới
-                    new_tpl = CompanionTemplate(
-                        template_id=template_id,
-                        name=display_name,
-                        rarity=rarity.upper(),
-                        image_path=image_rel_path
-                    )
-                    db.add(new_tpl)
-                    print(f"   ➕ Thêm mới: {template_id}")
-                    added_count += 1
-                else:
-                    # Nếu có rồi -> Cập nhật lại đường dẫn ảnh
-                    if existing.image_path != image_rel_path:
-                        existing.image_path = image_rel_path
-                        db.add(existing)
-                        updated_count += 1
+    try:
+        result = scan_companion_assets(db, force=force)
+    except FileNotFoundError as e:
+        print(f"❌ Không tìm thấy thư mục gốc: {e}")
+        return {"status": "error", "message": f"Không tìm thấy thư mục: {e}. Hãy kiểm tra lại tên folder!"}
 
-    db.commit()
     return {
         "status": "success", 
-        "message": f"Quét hoàn tất! Đã thêm mới: {added_count}, Cập nhật: {updated_count}. (Xem Log CMD để biết chi tiết)",
-        "details": {"added": added_count, "updated": updated_count}
+        "message": (
+            f"Quét hoàn tất! Đã thêm mới: {result['added']}, Cập nhật: {result['updated']}, "
+            f"Gỡ: {result['removed']} ({result['touched']}/{result['files']} file cần đọc lại)."
+        ),
+        "details": result
     }
 
 # ==========================================
@@ -145,6 +84,31 @@ def update_companion_config(data: ConfigUpdate, db: Session = Depends(get_db)):
 # ==========================================
 # 4. PLAYER: LẤY DANH SÁCH THẺ ĐỒNG HÀNH ĐÃ SỞ HỮU
 # ==========================================
+@router.get("/companions/collection")
+def get_companion_collection(
+    username: str,
+    rarity: Optional[str] = None,
+    star: Optional[int] = None,
+    template_id: Optional[str] = None,
+    locked: Optional[bool] = None,
+    equipped: Optional[bool] = None,
+    sort: str = "power",                # power / star (giảm dần)
+    cursor: Optional[str] = None,
+    limit: int = 30,
+    db: Session = Depends(get_db)
+):
+    """Bộ sưu tập thẻ theo trang: truyền next_cursor để lấy trang sau; trang đầu kèm thống kê theo phôi."""
+    player_id = db.exec(select(Player.id).where(Player.username == username)).first()
+    if player_id is None:
+        raise HTTPException(status_code=404, detail="Người chơi không tồn tại")
+    try:
+        return browse_collection(
+            db, player_id, rarity=rarity, star=star, template_id=template_id,
+            locked=locked, equipped=equipped, sort=sort, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(400, f"Tham số không hợp lệ: {e}")
+
 @router.get("/my-cards")
 def get_player_companions(username: str, db: Session = Depends(get_db)):
     try:
@@ -164,25 +128,11 @@ def get_player_companions(username: str, db: Session = Depends(get_db)):
         cards_list = []
         for comp, temp in results:
             try:
-                # 3. Xử lý ID an toàn
-                raw_id = comp.id
-                ui_suffix = ""
-
-                # Kiểm tra xem ID là chuỗi hay số để lấy hậu tố phù hợp
-                if isinstance(raw_id, str):
-                    # Nếu ID là chuỗi, lấy 4 ký tự cuối
-                    ui_suffix = raw_id[-4:].upper()
-                else:
-                    # Nếu ID là số, chuyển sang hex
-                    ui_suffix = hex(int(raw_id))[2:].upper()
-                
-                # Tạo UI ID (Dòng này phải nằm ngang hàng với if/else, không được nằm trong else)
-                ui_id = f"{temp.rarity}_{temp.template_id}_{ui_suffix}"
-
-                # Thêm vào danh sách
+                # 3. ID chuẩn = Companion.id (giao diện gửi lại nguyên văn, tra bằng khóa chính)
+                # ID giao diện kiểu cũ {rarity}_{template_id}_{đuôi} vẫn dùng được nhờ bảng CompanionAlias
                 cards_list.append({
-                    "id": ui_id,           # Dùng cho giao diện (Chuỗi)
-                    "real_id": comp.id,    # Dùng cho DB (Số nguyên/Chuỗi gốc)
+                    "id": comp.id,         # Dùng cho giao diện
+                    "real_id": comp.id,    # Giữ cho code giao diện cũ (Bán chợ)
                     "name": comp.temp_name or temp.name,
                     "rarity": temp.rarity,
                     "star": comp.star,
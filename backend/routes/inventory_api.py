@@ -5,8 +5,12 @@ from typing import List, Optional
 from database import get_db, Player, Item, Inventory, MarketListing, PlayerItem, SystemConfig, Companion
 from pydantic import BaseModel
 from game_logic import item_processor  # Import bộ xử lý
-from game_logic.stats import recalculate_player_stats
-from game_logic.item_processor import forge_item
+from game_logic.stats import apply_stat_delta, charm_stats
+from game_logic.companion_lookup import resolve_companion, resolve_companions
+from game_logic.companion_merge import auto_merge
+from game_logic.item_processor import forge_item, forge_item_to
+from services.static_registry import registry
+from services.inventory_snapshot import inventory_snapshots
 import traceback
 import json
 
@@ -26,6 +30,11 @@ class UseItemRequest(BaseModel):
     username: str
     item_id: int
 
+class BulkUseRequest(BaseModel):
+    username: str
+    item_id: int
+    count: int
+
 class SellRequest(BaseModel):
     username: str
     item_id: int
@@ -40,6 +49,7 @@ class BuyRequest(BaseModel):
 class ForgeRequest(BaseModel):
     username: str
     charm_id: int
+    target_level: Optional[int] = None # Có giá trị -> đập liên tục tới +N (hết đá thì dừng)
 class EquipCompanionRequest(BaseModel):
     username: str
     companion_id: str  # ID của thẻ bài (Chuỗi)
@@ -58,151 +68,26 @@ class BreakthroughRequest(BaseModel):
     main_card_id: str
     fodder_ids: List[str]
 
+class AutoMergeRequest(BaseModel):
+    username: str
+    template_id: Optional[str] = None   # Chỉ ghép 1 loại phôi (bỏ trống = tất cả)
+    dry_run: bool = False               # Chỉ xem trước kết quả, không ghi
+
 # ==========================================
 # 1. API LẤY DỮ LIỆU KHO ĐỒ
 # ==========================================
 @router.get("/inventory/get")
-def get_inventory(username: str, db: Session = Depends(get_db)):
-    # 1. Tìm người chơi
-    player = db.exec(select(Player).where(Player.username == username)).first()
-    if not player: 
+def get_inventory(username: str, since: Optional[int] = None, db: Session = Depends(get_db)):
+    """
+    Túi đồ + trang bị trong 1 câu query (bản chụp dùng lại tới khi có thay đổi).
+    - Không có since: trả toàn bộ như cũ (bag / equipment / inventory) + version.
+    - since=N: chỉ trả các món thay đổi kể từ version N (nếu N quá cũ thì trả toàn bộ, full=True).
+    """
+    player_id = db.exec(select(Player.id).where(Player.username == username)).first()
+    if player_id is None:
         raise HTTPException(status_code=404, detail="Player not found")
 
-    inventory_list = []
-
-    # ==========================================================
-    # PHẦN 1: LẤY ITEM THƯỜNG (Code của bạn - Đã giữ nguyên logic tốt)
-    # ==========================================================
-    stmt = (
-        select(Inventory, Item)
-        .join(Item)
-        .where(Inventory.player_id == player.id)
-        .where(Inventory.amount > 0)
-    )
-    results = db.exec(stmt).all()
-
-    for inv, item in results:
-        item_config = {}
-        try:
-            if item.config: item_config = json.loads(item.config)
-        except: pass
-
-        is_usable = False
-        if item.type == "consumable" or item_config.get("action"):
-            is_usable = True
-
-        safe_amount = int(inv.amount)
-        clean_name = item.name.replace("\xa0", " ").strip() if item.name else f"Item {item.id}"
-        safe_image = item.image_url if item.image_url else "/assets/items/charms/default.png"
-
-        inventory_list.append({
-            "id": item.id,      # ID mẫu vật phẩm
-            "item_id": item.id,
-            "name": clean_name,
-            "image": safe_image,
-            "image_url": safe_image,
-            "description": item.description,
-            "amount": safe_amount,
-            "quantity": safe_amount,
-            "is_equippable": item.can_equip,
-            "is_usable": is_usable,
-            "config": item_config,
-            # Item thường không có rarity
-        })
-
-    # ==========================================================
-    # PHẦN 2: LẤY CHARM / ĐỒ ĐỘC BẢN (PHẦN MỚI BẮT BUỘC PHẢI CÓ)
-    # ==========================================================
-    # Lấy từ bảng PlayerItem, chỉ lấy những món ĐANG TRONG TÚI (chưa mặc)
-    charms = db.exec(
-        select(PlayerItem)
-        .where(PlayerItem.player_id == player.id)
-        .where(PlayerItem.is_equipped == False) 
-    ).all()
-
-    for charm in charms:
-        inventory_list.append({
-            "id": charm.id,          # ID riêng (quan trọng để rèn/bán)
-            "item_id": charm.id,     # Map tạm để frontend không lỗi
-            "name": charm.name,
-            "image": charm.image_url,
-            "image_url": charm.image_url,
-            "amount": 1,             # Charm luôn là 1
-            "quantity": 1,
-            "description": f"Cấp cường hóa: +{charm.enhance_level}",
-            
-            # 🔥 CÁC TRƯỜNG QUAN TRỌNG ĐỂ FRONTEND VẼ KHUNG MÀU:
-            "rarity": charm.rarity,          # MAGIC / EPIC / LEGEND
-            "stats_data": charm.stats_data,  # {"atk": 10...}
-            "enhance_level": charm.enhance_level,
-            
-            "is_usable": False,
-            "is_equippable": True,   
-            "type": "charm"          # Đánh dấu để Frontend biết xử lý
-        })
-
-    # =======================================================
-    # PHẦN 3: LẤY TRANG BỊ ĐANG MẶC
-    # =======================================================
-    equipped_data = {} 
-    
-    # A. Lấy Charm đang mặc (Giữ nguyên của bạn) 
-    equipped_charms = db.exec( 
-        select(PlayerItem) 
-        .where(PlayerItem.player_id == player.id) 
-        .where(PlayerItem.is_equipped == True) 
-    ).all() 
-
-    for charm in equipped_charms: 
-        current_slot = charm.slot_index if charm.slot_index and charm.slot_index > 0 else 1 
-        slot_key = f"slot_{current_slot}" 
-        equipped_data[slot_key] = { 
-            "id": charm.id, 
-            "name": charm.name, 
-            "image_url": charm.image_url, 
-            "image": charm.image_url, 
-            "rarity": charm.rarity, 
-            "stats_data": charm.stats_data, 
-            "enhance_level": charm.enhance_level, 
-            "type": "charm"  # Đánh dấu loại để Frontend phân biệt
-        }
-
-    # B. Lấy Thẻ Đồng Hành đang mặc (MỚI)
-    # Import joinedload nếu chưa có ở đầu file: from sqlalchemy.orm import joinedload
-    equipped_companions = db.exec(
-        select(Companion)
-        .options(joinedload(Companion.template)) # Lấy luôn info ảnh/tên từ template
-        .where(Companion.player_id == player.id)
-        .where(Companion.is_equipped == True)
-    ).all()
-
-    for comp in equipped_companions:
-        # Lưu vào key dạng comp_slot_1, comp_slot_2... để không đụng hàng với Charm
-        current_slot = comp.slot_index if comp.slot_index and comp.slot_index > 0 else 1
-        slot_key = f"comp_slot_{current_slot}"
-        
-        # Lấy thông tin an toàn
-        c_name = comp.temp_name or (comp.template.name if comp.template else "Lỗi Thẻ")
-        c_image = comp.template.image_path if comp.template else "/assets/card/back.png"
-        c_rarity = comp.template.rarity if comp.template else "N/A"
-
-        equipped_data[slot_key] = {
-            "id": comp.id,
-            "name": c_name,
-            "image_url": c_image,
-            "image": c_image,
-            "rarity": c_rarity,
-            "star": comp.star,
-            "stats_data": {"atk": comp.atk, "hp": comp.hp}, # Đóng gói lại cho giống Charm
-            "type": "companion" # Đánh dấu loại
-        }
-
-    # 4. Trả về kết quả đầy đủ (Giữ nguyên)
-    return { 
-        "bag": inventory_list, 
-        "equipment": equipped_data, 
-        "inventory": inventory_list 
-    }
+    return inventory_snapshots.get(db, player_id, since=since)
 
 # ==========================================
 # 2. API SỬ DỤNG VẬT PHẨM (ĐÃ SỬA LỖI CRASH)
@@ -231,7 +116,7 @@ def use_item(req: UseItemRequest, db: Session = Depends(get_db)):
             return {"status": "error", "message": "Số lượng không đủ!"}
 
         # 3. Lấy thông tin Item gốc
-        item_template = db.get(Item, req.item_id)
+        item_template = registry.get_item(db, req.item_id)
         if not item_template:
             return {"status": "error", "message": "Vật phẩm lỗi data"}
 
@@ -262,6 +147,7 @@ def use_item(req: UseItemRequest, db: Session = Depends(get_db)):
                     db.add(fresh_inv)
             
             db.commit() # Lưu thay đổi
+            inventory_snapshots.touch(player.id)
 
             # 3. Trả về kết quả (Vệ sinh cả message để Frontend không sập)
             return {
@@ -278,6 +164,61 @@ def use_item(req: UseItemRequest, db: Session = Depends(get_db)):
         traceback.print_exc() # In lỗi chi tiết ra CMD để debug
         return {"status": "error", "message": "Lỗi hệ thống khi dùng vật phẩm"}
 
+# ==========================================
+# 2b. API DÙNG HÀNG LOẠT (MỞ NHIỀU RƯƠNG 1 LẦN)
+# ==========================================
+@router.post("/inventory/use-bulk")
+def use_item_bulk(req: BulkUseRequest, db: Session = Depends(get_db)):
+    """Dùng tối đa `count` vật phẩm cùng loại: quay cả lô, gộp phần thưởng, commit 1 lần."""
+    if req.count < 1:
+        raise HTTPException(status_code=400, detail="Số lượng phải lớn hơn 0")
+    count = min(req.count, item_processor.BULK_USE_MAX)
+
+    player = db.exec(select(Player).where(Player.username == req.username)).first()
+    if not player:
+        raise HTTPException(status_code=404, detail="Không tìm thấy người chơi")
+
+    inventory_item = db.exec(select(Inventory).where(
+        Inventory.player_id == player.id,
+        Inventory.item_id == req.item_id
+    )).first()
+    if not inventory_item or int(inventory_item.amount) < 1:
+        raise HTTPException(status_code=400, detail="Bạn không có vật phẩm này!")
+    # Không đủ số lượng -> dùng hết số đang có
+    count = min(count, int(inventory_item.amount))
+
+    item_template = registry.get_item(db, req.item_id)
+    if not item_template:
+        raise HTTPException(status_code=400, detail="Vật phẩm lỗi data")
+
+    try:
+        success, message, data, used = item_processor.apply_item_effects_bulk(player, item_template, count, db)
+        if not success:
+            db.rollback()
+            return {"status": "error", "message": message}
+
+        # Trừ vật phẩm đã dùng trong cùng transaction (rương rơi ra chính nó thì cộng trừ trên cùng 1 ô)
+        item_processor.apply_inventory_deltas(db, player.id, {req.item_id: -used})
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"❌ LỖI USE ITEM BULK: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail="Lỗi hệ thống khi dùng vật phẩm")
+
+    inventory_snapshots.touch(player.id)
+    remaining = db.exec(select(Inventory.amount).where(
+        Inventory.player_id == player.id,
+        Inventory.item_id == req.item_id
+    )).first()
+    return {
+        "status": "success",
+        "message": str(message).replace("\xa0", " "),
+        "data": data or {},
+        "used": used,
+        "remaining": int(remaining or 0)
+    }
+
 # ==========================================================
 # API MẶC TRANG BỊ (CHARM)
 # ==========================================================
@@ -308,20 +249,29 @@ async def equip_item(req: EquipRequest, db: Session = Depends(get_db)):
         PlayerItem.slot_index == req.slot_index
     )).first()
 
-    if current_item_in_slot:
+    atk_delta = hp_delta = 0
+    if current_item_in_slot and current_item_in_slot.id != item_to_equip.id:
         # Tháo món cũ ra
         current_item_in_slot.is_equipped = False
         current_item_in_slot.slot_index = 0
         db.add(current_item_in_slot)
-
-    # 5. MẶC MÓN MỚI
+        atk, hp = charm_stats(current_item_in_slot)
+        atk_delta -= atk
+        hp_delta -= hp
+
+    # 5. MẶC MÓN MỚI (đang mặc ở slot khác thì chỉ đổi slot, chỉ số không đổi)
+    if not item_to_equip.is_equipped:
+        atk, hp = charm_stats(item_to_equip)
+        atk_delta += atk
+        hp_delta += hp
     item_to_equip.is_equipped = True
     item_to_equip.slot_index = req.slot_index
     db.add(item_to_equip)
-    db.commit() # Commit để lưu trạng thái mặc trước
 
-    # 🔥 GỌI HÀM TÍNH LẠI STATS
-    recalculate_player_stats(db, player, heal_mode="MAINTAIN_PERCENT")
+    # 🔥 CỘNG / TRỪ CHÊNH LỆCH CHỈ SỐ (cùng 1 lần commit)
+    apply_stat_delta(db, player, atk_delta, hp_delta, heal_mode="MAINTAIN_PERCENT")
+    db.commit()
+    inventory_snapshots.touch(player.id)
 
     return {"status": "success", "message": f"Đã trang bị và cập nhật lực chiến!"}
 
@@ -348,10 +298,12 @@ async def unequip_item(req: UnequipRequest, db: Session = Depends(get_db)):
     item_in_slot.is_equipped = False
     item_in_slot.slot_index = 0
     db.add(item_in_slot)
-    db.commit()
 
-    # 🔥 GỌI HÀM TÍNH LẠI STATS
-    recalculate_player_stats(db, player, heal_mode="MAINTAIN_PERCENT")
+    # 🔥 TRỪ CHỈ SỐ CỦA MÓN VỪA THÁO
+    atk, hp = charm_stats(item_in_slot)
+    apply_stat_delta(db, player, -atk, -hp, heal_mode="MAINTAIN_PERCENT")
+    db.commit()
+    inventory_snapshots.touch(player.id)
 
     return {"status": "success", "message": "Đã tháo và cập nhật lực chiến!"}
 
@@ -366,12 +318,18 @@ async def enhance_item_api(req: ForgeRequest, db: Session = Depends(get_db)):
     # B. Gọi hàm logic forge_item mà bạn đã viết trong item_processor
     # Lưu ý: stone_item_id là ID của Đá cường hóa trong DB (Ví dụ: 100)
     # Bạn cần đảm bảo trong bảng Item có item ID 100 là Đá Cường Hóa, hoặc sửa số này
-    result = forge_item(db, req.charm_id, player.id)
+    if req.target_level is None:
+        result = forge_item(db, req.charm_id, player.id, commit=False)
+    else:
+        result = forge_item_to(db, req.charm_id, player.id, req.target_level, commit=False)
 
-    # C. Nếu thành công -> Tính lại Stats nhân vật & Hồi máu thưởng
-    if result["status"] == "success":
+    # C. Nếu Charm đang mặc -> Cộng phần chỉ số vừa tăng & Hồi máu thưởng (delta = 0 thì không đổi gì)
+    if result["status"] in ("success", "fail") and result.get("is_equipped"):
         # Dùng chế độ HEAL_BONUS như đã thảo luận (Tăng bao nhiêu Max HP thì hồi bấy nhiêu)
-        recalculate_player_stats(db, player, heal_mode="HEAL_BONUS")
+        apply_stat_delta(db, player, result["atk_delta"], result["hp_delta"], heal_mode="HEAL_BONUS")
+    if result["status"] in ("success", "fail"):
+        db.commit()
+        inventory_snapshots.touch(player.id)  # Đá bị trừ dù thành công hay thất bại
     
     # D. Trả kết quả về cho Frontend
     return result
@@ -381,11 +339,11 @@ async def enhance_item_api(req: ForgeRequest, db: Session = Depends(get_db)):
 async def get_system_config(db: Session = Depends(get_db)):
     """API để Frontend lấy cấu hình (Tỷ lệ đập đồ, giá đá...)"""
     try:
-        # Tìm cấu hình forge_setup trong DB
-        record = db.exec(select(SystemConfig).where(SystemConfig.key == "forge_setup")).first()
+        # Tìm cấu hình forge_setup (registry đã parse sẵn)
+        forge_config = registry.get_config(db, "forge_setup")
         
-        if record and record.value:
-            return {"status": "success", "config": json.loads(record.value)}
+        if forge_config:
+            return {"status": "success", "config": forge_config}
         else:
             # Trả về mặc định nếu Admin chưa chỉnh gì
             return {"status": "default", "config": None}
@@ -404,42 +362,11 @@ async def equip_companion(req: EquipCompanionRequest, db: Session = Depends(get_
     if req.slot_index < 1 or req.slot_index > 3:
         raise HTTPException(status_code=400, detail="Slot thẻ bài chỉ từ 1 đến 3")
 
-    # --- BẮT ĐẦU LOGIC "LƯỚI QUÉT" THÔNG MINH ---
-    companion_to_equip = None
-    req_id_clean = str(req.companion_id).strip().lower() # Dọn dẹp khoảng trắng, đưa về chữ thường
-    
-    # Lấy tất cả thẻ của người chơi ra để tự soi bằng Python
-    all_comps = db.exec(select(Companion).where(Companion.player_id == player.id)).all()
-    
-    print(f"\n🔍 ĐANG TÌM THẺ GỬI LÊN TỪ WEB: '{req_id_clean}'")
-    
-    for c in all_comps:
-        db_id_clean = str(c.id).strip().lower()
-        db_template_clean = str(c.template_id).strip().lower()
-        
-        # 1. Khớp chính xác ID hoặc Template ID
-        if db_id_clean == req_id_clean or db_template_clean == req_id_clean:
-            companion_to_equip = c
-            break
-            
-        # 2. Logic bóc tách: So sánh phần "Đuôi" của ID
-        # Web gửi: 'r_r_11_7b94' -> Lấy đuôi '7b94'
-        # DB lưu: 'r_1770802315_7b94' -> Lấy đuôi '7b94'
-        req_suffix = req_id_clean.split('_')[-1]
-        db_suffix = db_id_clean.split('_')[-1]
-        
-        if req_suffix == db_suffix:
-            companion_to_equip = c
-            break
-
-    # Nếu lưới quét vẫn không tìm thấy -> Báo lỗi
+    # Tra theo ID chuẩn (khóa chính) hoặc ID giao diện cũ đã chuyển đổi - 1-2 query có index
+    companion_to_equip = resolve_companion(db, player.id, req.companion_id)
     if not companion_to_equip:
-        print("❌ KẾT QUẢ: KHÔNG TÌM THẤY THẺ NÀY!")
         raise HTTPException(status_code=404, detail="Không tìm thấy thẻ này trong kho")
 
-    print(f"✅ TÌM THẤY! Đang trang bị thẻ có ID gốc: {companion_to_equip.id}")
-    # --- KẾT THÚC LOGIC LƯỚI QUÉT ---
-
     # 3. Tháo thẻ cũ ở slot hiện tại
     current_companion_in_slot = db.exec(select(Companion).where(
         Companion.player_id == player.id,
@@ -447,12 +374,18 @@ async def equip_companion(req: EquipCompanionRequest, db: Session = Depends(get_
         Companion.slot_index == req.slot_index
     )).first()
 
-    if current_companion_in_slot:
+    atk_delta = hp_delta = 0
+    if current_companion_in_slot and current_companion_in_slot.id != companion_to_equip.id:
         current_companion_in_slot.is_equipped = False
         current_companion_in_slot.slot_index = 0
         db.add(current_companion_in_slot)
+        atk_delta -= current_companion_in_slot.atk
+        hp_delta -= current_companion_in_slot.hp
 
-    # 4. Mặc thẻ mới
+    # 4. Mặc thẻ mới (đang mặc ở slot khác thì chỉ đổi slot)
+    if not companion_to_equip.is_equipped:
+        atk_delta += companion_to_equip.atk
+        hp_delta += companion_to_equip.hp
     companion_to_equip.is_equipped = True
     companion_to_equip.slot_index = req.slot_index
     db.add(companion_to_equip)
@@ -461,12 +394,12 @@ async def equip_companion(req: EquipCompanionRequest, db: Session = Depends(get_
     if req.slot_index == 1: player.companion_slot_1 = str(companion_to_equip.id)
     elif req.slot_index == 2: player.companion_slot_2 = str(companion_to_equip.id)
     elif req.slot_index == 3: player.companion_slot_3 = str(companion_to_equip.id)
-    
+
+    # 6. Cộng / trừ chênh lệch chỉ số
+    apply_stat_delta(db, player, atk_delta, hp_delta, heal_mode="MAINTAIN_PERCENT")
     db.add(player)
     db.commit()
-
-    # 6. Tính lại Stats
-    recalculate_player_stats(db, player, heal_mode="MAINTAIN_PERCENT")
+    inventory_snapshots.touch(player.id)
 
     return {"status": "success", "message": "Đã trang bị Thẻ Đồng Hành thành công!"}
 
@@ -497,12 +430,12 @@ async def unequip_companion(req: UnequipCompanionRequest, db: Session = Depends(
     if req.slot_index == 1: player.companion_slot_1 = None
     elif req.slot_index == 2: player.companion_slot_2 = None
     elif req.slot_index == 3: player.companion_slot_3 = None
-    
+
+    # 🔥 TRỪ CHỈ SỐ CỦA THẺ VỪA THÁO
+    apply_stat_delta(db, player, -companion_in_slot.atk, -companion_in_slot.hp, heal_mode="MAINTAIN_PERCENT")
     db.add(player)
     db.commit()
-
-    # 🔥 TÍNH LẠI STATS
-    recalculate_player_stats(db, player, heal_mode="MAINTAIN_PERCENT")
+    inventory_snapshots.touch(player.id)
 
     return {"status": "success", "message": "Đã tháo Thẻ Đồng Hành!"}
 # ==========================================
@@ -514,19 +447,7 @@ async def discard_companion(req: DiscardCompanionRequest, db: Session = Depends(
     if not player:
         raise HTTPException(status_code=404, detail="Không tìm thấy người chơi")
 
-    # --- DÙNG LẠI LƯỚI QUÉT ID THÔNG MINH ---
-    companion_to_discard = None
-    req_id_clean = str(req.companion_id).strip().lower()
-    
-    all_comps = db.exec(select(Companion).where(Companion.player_id == player.id)).all()
-    
-    for c in all_comps:
-        db_id_clean = str(c.id).strip().lower()
-        # So sánh khớp hoàn toàn HOẶC khớp phần đuôi ID
-        if db_id_clean == req_id_clean or db_id_clean.split('_')[-1] == req_id_clean.split('_')[-1]:
-            companion_to_discard = c
-            break
-
+    companion_to_discard = resolve_companion(db, player.id, req.companion_id)
     if not companion_to_discard:
         raise HTTPException(status_code=404, detail="Không tìm thấy thẻ này trong kho")
 
@@ -544,11 +465,12 @@ async def discard_companion(req: DiscardCompanionRequest, db: Session = Depends(
 
     # 3. Tiến hành "hóa vàng" thẻ
     db.delete(companion_to_discard)
-    db.commit()
 
-    # 4. Tính lại lực chiến nếu vừa vứt cái thẻ đang mặc trên người
+    # 4. Trừ lực chiến nếu vừa vứt cái thẻ đang mặc trên người
     if was_equipped:
-        recalculate_player_stats(db, player, heal_mode="MAINTAIN_PERCENT")
+        apply_stat_delta(db, player, -companion_to_discard.atk, -companion_to_discard.hp, heal_mode="MAINTAIN_PERCENT")
+    db.commit()
+    inventory_snapshots.touch(player.id)
 
     return {"status": "success", "message": "Đã vứt bỏ thẻ thành công!"}
 
@@ -561,29 +483,21 @@ async def breakthrough_companion(req: BreakthroughRequest, db: Session = Depends
     if not player:
         raise HTTPException(status_code=404, detail="Không tìm thấy người chơi")
 
-    # Lấy toàn bộ thẻ của Player ra để lọc qua lưới ID thông minh
-    all_comps = db.exec(select(Companion).where(Companion.player_id == player.id)).all()
+    # 2. Tìm và kiểm tra các thẻ nguyên liệu (Phôi)
+    if len(req.fodder_ids) != 2:
+        raise HTTPException(status_code=400, detail="Cần đúng 2 thẻ nguyên liệu để đột phá.")
 
-    def find_smart_card(ui_id):
-        clean_ui = str(ui_id).strip().lower()
-        for c in all_comps:
-            clean_db = str(c.id).strip().lower()
-            if clean_db == clean_ui or clean_db.split('_')[-1] == clean_ui.split('_')[-1]:
-                return c
-        return None
+    # Tra thẻ chính + nguyên liệu cùng lúc (theo ID chuẩn hoặc ID giao diện cũ)
+    cards = resolve_companions(db, player.id, [req.main_card_id, *req.fodder_ids])
 
     # 1. Tìm thẻ chính
-    main_comp = find_smart_card(req.main_card_id)
+    main_comp = cards.get(req.main_card_id)
     if not main_comp:
         raise HTTPException(status_code=404, detail="Không tìm thấy thẻ chính.")
 
-    # 2. Tìm và kiểm tra các thẻ nguyên liệu (Phôi)
-    if len(req.fodder_ids) != 2:
-        raise HTTPException(status_code=400, detail="Cần đúng 2 thẻ nguyên liệu để đột phá.")
-
     fodder_comps = []
     for fid in req.fodder_ids:
-        f = find_smart_card(fid)
+        f = cards.get(fid)
         if not f:
             raise HTTPException(status_code=404, detail="Không tìm thấy thẻ nguyên liệu trong kho.")
         if f.id == main_comp.id:
@@ -613,17 +527,18 @@ async def breakthrough_companion(req: BreakthroughRequest, db: Session = Depends
 
     # Tăng sao cho thẻ chính
     main_comp.star += 1
+    old_atk, old_hp = main_comp.atk, main_comp.hp
     
     # Tính toán +5% Stats (Làm tròn số nguyên)
     main_comp.hp = int(main_comp.hp * 1.05)
     main_comp.atk = int(main_comp.atk * 1.05)
-    
     db.add(main_comp)
-    db.commit()
 
     # Nếu thẻ này đang được mặc trên người, phải báo hệ thống cộng thêm sức mạnh
     if main_comp.is_equipped:
-        recalculate_player_stats(db, player, heal_mode="MAINTAIN_PERCENT")
+        apply_stat_delta(db, player, main_comp.atk - old_atk, main_comp.hp - old_hp, heal_mode="MAINTAIN_PERCENT")
+    db.commit()
+    inventory_snapshots.touch(player.id)
 
     return {
         "status": "success", 
@@ -631,4 +546,34 @@ async def breakthrough_companion(req: BreakthroughRequest, db: Session = Depends
         "new_star": main_comp.star,
         "new_hp": main_comp.hp,
         "new_atk": main_comp.atk
-    }
\ No newline at end of file
+    }
+
+# ==========================================
+# API TỰ ĐỘNG ĐỘT PHÁ HÀNG LOẠT (GỘP THẺ TRÙNG)
+# ==========================================
+@router.post("/inventory/auto-merge-companions")
+def auto_merge_companions(req: AutoMergeRequest, db: Session = Depends(get_db)):
+    """Đột phá nhiều nhất có thể mọi nhóm thẻ cùng phôi, cùng sao (không đụng thẻ khóa / đang mặc)."""
+    player = db.exec(select(Player).where(Player.username == req.username)).first()
+    if not player:
+        raise HTTPException(status_code=404, detail="Không tìm thấy người chơi")
+
+    try:
+        result = auto_merge(db, player, template_id=req.template_id, dry_run=req.dry_run)
+        if req.dry_run or not result["breakthroughs"]:
+            db.rollback()
+        else:
+            db.commit()
+            inventory_snapshots.touch(player.id)
+    except Exception as e:
+        db.rollback()
+        print(f"❌ LỖI AUTO MERGE: {e}")
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail="Lỗi hệ thống khi gộp thẻ")
+
+    if not result["breakthroughs"]:
+        message = "Không có nhóm thẻ nào đủ điều kiện đột phá."
+    else:
+        verb = "Có thể đột phá" if req.dry_run else "Đã đột phá"
+        message = f"{verb} {result['breakthroughs']} lần, dùng {result['consumed']} thẻ nguyên liệu."
+    return {"status": "success", "message": message, "dry_run": req.dry_run, **result}
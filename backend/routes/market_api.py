@@ -7,6 +7,10 @@ from typing import List, Optional
 from datetime import datetime
 from routes.auth import get_current_user
 from sqlalchemy.orm import joinedload
+from services.market_browse import list_all_listings, browse_market
+from game_logic.market_manager import MarketManager
+from services.market_prices import refresh_price_index, get_price_summary, get_price_history
+from services.inventory_snapshot import inventory_snapshots
 
 router = APIRouter(prefix="/api/market", tags=["Market"])
 
@@ -42,79 +46,55 @@ class CharmActionRequest(BaseModel):
     price: int = 0
     currency: str = "tri_thuc" # Mặc định là Tri Thức
 # =======================================================
-# 1. API LẤY DANH SÁCH (Sửa để khớp với Model của bạn)
+# 1. API LẤY DANH SÁCH (1 query JOIN, không db.get từng dòng)
 # =======================================================
 @router.get("/list")
-async def get_market_list(db: Session = Depends(get_db)):
-    # Lấy danh sách mới nhất
-    listings = db.exec(select(MarketListing).order_by(MarketListing.created_at.desc())).all()
-    result = []
-    
-    for l in listings:
-        seller = db.get(Player, l.seller_id)
-        seller_name = seller.username if seller else "Ẩn danh"
-        
-        # Mở gói JSON (nếu có) dùng chung cho Charm và Thẻ bài
-        json_data = {}
-        if l.item_data_json:
-            try:
-                json_data = json.loads(l.item_data_json)
-            except:
-                pass
-
-        item_res = {
-            "id": l.id,
-            "seller_id": l.seller_id,
-            "seller_name": seller_name,
-            "item_id": l.item_id,      # 👈 QUAN TRỌNG: Frontend cần cái này để if/else
-            "price": l.price,
-            "currency": l.currency,
-            "amount": l.amount,        # 👈 Đừng quên số lượng
-            "item_data_json": l.item_data_json, # Frontend cần cái này để parse lại
-            
-            # Các giá trị mặc định
-            "item_name": "Vật phẩm lỗi",
-            "item_image": "/assets/items/default.png",
-            "is_charm": False,
-            "is_companion": False
-        }
-
-        # 👉 CASE 1: CHARM (999999)
-        if l.item_id == 999999:
-            item_res.update({
-                "item_name": json_data.get("name", "Charm Lỗi"),
-                "item_image": json_data.get("image_url", "/assets/items/default.png"),
-                "rarity": json_data.get("rarity"),
-                "enhance_level": json_data.get("enhance_level", 0),
-                "is_charm": True
-            })
-
-        # 👉 CASE 2: THẺ BÀI (999998) - QUAN TRỌNG
-        elif l.item_id == 999998:
-            item_res.update({
-                "item_name": json_data.get("name", "Thẻ bài ẩn"),
-                "item_image": json_data.get("image", "/assets/card/back.png"), # JSON thẻ bài dùng key 'image'
-                "rarity": json_data.get("rarity"),
-                "star": json_data.get("star", 1),
-                "is_companion": True # Cờ đánh dấu cho Frontend dễ xử lý
-            })
-
-        # 👉 CASE 3: ĐỒ THƯỜNG (1, 2, 3...)
-        else:
-            item = db.get(Item, l.item_id)
-            if item:
-                item_res.update({
-                    "item_name": item.name,
-                    "item_image": item.image_url,
-                    "is_charm": False
-                })
-            else:
-                # Nếu không tìm thấy item trong DB (dữ liệu rác), bỏ qua vòng lặp này
-                continue 
-
-        result.append(item_res)
-
-    return result
+def get_market_list(db: Session = Depends(get_db)):
+    # Toàn bộ chợ, mới nhất trước (màn hình Chợ Đen hiện tại tự lọc theo tab)
+    return list_all_listings(db)
+
+@router.get("/browse")
+def browse_market_list(
+    currency: Optional[str] = None,
+    rarity: Optional[str] = None,
+    kind: Optional[str] = None,         # charm / companion / item
+    min_price: Optional[int] = None,
+    max_price: Optional[int] = None,
+    sort: str = "newest",               # newest / price_asc / price_desc
+    cursor: Optional[str] = None,
+    limit: int = 30,
+    db: Session = Depends(get_db)
+):
+    """Duyệt chợ theo trang: truyền next_cursor của trang trước để lấy trang sau."""
+    try:
+        return browse_market(
+            db, currency=currency, rarity=rarity, kind=kind,
+            min_price=min_price, max_price=max_price,
+            sort=sort, cursor=cursor, limit=limit
+        )
+    except ValueError as e:
+        raise HTTPException(400, f"Tham số không hợp lệ: {e}")
+@router.get("/prices")
+def get_market_prices(
+    item_id: Optional[int] = None,
+    rarity: Optional[str] = None,
+    currency: Optional[str] = None,
+    only_listed: bool = False,
+    db: Session = Depends(get_db)
+):
+    """Bảng giá tổng hợp: giá thấp nhất / trung vị / số đơn đang treo + giá khớp gần nhất."""
+    return get_price_summary(db, item_id=item_id, rarity=rarity, currency=currency, only_listed=only_listed)
+
+@router.get("/prices/history")
+def get_market_price_history(
+    item_id: int,
+    currency: str,
+    rarity: Optional[str] = None,
+    days: int = 30,
+    db: Session = Depends(get_db)
+):
+    """Lịch sử giá khớp lệnh của 1 mặt hàng (Charm / Thẻ bài: truyền thêm rarity)."""
+    return get_price_history(db, item_id=item_id, currency=currency, rarity=rarity, days=days)
 # =======================================================
 # 2. API ĐĂNG BÁN
 # =======================================================
@@ -150,179 +130,33 @@ def sell_to_market(req: SellRequest, db: Session = Depends(get_db)):
         description=f"Bán bởi {player.username}"
     )
     db.add(listing)
+    db.flush()
+    refresh_price_index(db, listing.item_id, listing.rarity, listing.currency)
     db.commit()
+    inventory_snapshots.touch(player.id)
     
     return {"status": "success", "message": "Đã treo bán lên chợ!"}
 
 # =======================================================
-# 3. API MUA HÀNG
+# 3. API MUA HÀNG (Nguyên tử: giành đơn + trừ tiền có điều kiện)
 # =======================================================
 @router.post("/buy")
-async def buy_market_item(req: BuyRequest, db: Session = Depends(get_db)):
-    # 1. Tìm đơn hàng
-    listing = db.get(MarketListing, req.listing_id)
-    if not listing: 
-        raise HTTPException(404, "Vật phẩm không còn tồn tại (hoặc đã bị ai đó mua mất)!")
-
-    # 2. Tìm người mua
-    buyer = db.exec(select(Player).where(Player.username == req.buyer_username)).first()
-    if not buyer: raise HTTPException(404, "User lỗi")
-    
-    # Chặn tự mua đồ mình bán
-    if listing.seller_id == buyer.id:
-        raise HTTPException(400, "Bạn không thể tự mua đồ của chính mình!")
-
-    # ======================================================
-    # 👇 LOGIC MỚI: XỬ LÝ ĐỦ 3 LOẠI TIỀN TỆ 👇
-    # ======================================================
-    cost = listing.price
-    currency_type = listing.currency # tri_thuc / chien_tich / vinh_du
-
-    # --- BƯỚC A: TRỪ TIỀN NGƯỜI MUA ---
-    if currency_type == "tri_thuc":
-        if buyer.tri_thuc < cost: raise HTTPException(400, "Không đủ Tri Thức (Vàng)!")
-        buyer.tri_thuc -= cost
-        
-    elif currency_type == "chien_tich":
-        # (Lưu ý: Đảm bảo bảng Player có cột 'chien_tich')
-        if buyer.chien_tich < cost: raise HTTPException(400, "Không đủ Chiến Tích (Ruby)!")
-        buyer.chien_tich -= cost
-        
-    elif currency_type == "vinh_du":
-        # (Lưu ý: Đảm bảo bảng Player có cột 'vinh_du')
-        if buyer.vinh_du < cost: raise HTTPException(400, "Không đủ Vinh Dự (Badge)!")
-        buyer.vinh_du -= cost
-        
-    else:
-        raise HTTPException(400, f"Loại tiền tệ không hợp lệ: {currency_type}")
-
-    # --- BƯỚC B: CỘNG TIỀN CHO NGƯỜI BÁN ---
-    seller = db.get(Player, listing.seller_id)
-    if seller:
-        if currency_type == "tri_thuc": seller.tri_thuc += cost
-        elif currency_type == "chien_tich": seller.chien_tich += cost
-        elif currency_type == "vinh_du": seller.vinh_du += cost
-
-    # ======================================================
-    # 👇 PHẦN CÒN LẠI (GIAO HÀNG) GIỮ NGUYÊN 👇
-    # ======================================================
-    
-    # TRƯỜNG HỢP A: ĐÂY LÀ CHARM (Có dữ liệu JSON)
-    if listing.item_data_json: 
-        import json
-        try:
-            c_data = json.loads(listing.item_data_json)
-            new_charm = PlayerItem(
-                player_id=buyer.id,
-                name=c_data.get("name", "Charm"),
-                image_url=c_data.get("image_url", "/assets/items/default.png"),
-                rarity=c_data.get("rarity", "COMMON"),
-                stats_data=c_data.get("stats_data", "{}"),
-                enhance_level=c_data.get("enhance_level", 0),
-                is_equipped=False,
-                slot_index=0
-            )
-            db.add(new_charm)
-        except Exception as e:
-            print(f"Lỗi tạo charm: {e}")
-            raise HTTPException(500, "Lỗi dữ liệu vật phẩm!")
-
-    # TRƯỜNG HỢP B: ĐÂY LÀ ĐỒ THƯỜNG
-    else:
-        inv_item = db.exec(select(Inventory).where(
-            Inventory.player_id == buyer.id,
-            Inventory.item_id == listing.item_id
-        )).first()
-
-        if inv_item:
-            inv_item.amount += listing.amount
-        else:
-            new_inv = Inventory(
-                player_id=buyer.id,
-                item_id=listing.item_id,
-                amount=listing.amount
-            )
-            db.add(new_inv)
-
-    # Xóa đơn hàng & Lưu
-    db.delete(listing)
-    db.commit()
-
-    return {"status": "success", "message": f"Đã mua thành công bằng {cost} {currency_type}!"}
+def buy_market_item(req: BuyRequest, db: Session = Depends(get_db)):
+    result = MarketManager(db).buy(req.listing_id, req.buyer_username)
+    if not result["success"]:
+        raise HTTPException(result["code"], result["message"])
+    return {"status": "success", "message": result["message"]}
 
 # =======================================================
-# 4. API HỦY BÁN (PHIÊN BẢN ĐÃ FIX TRẢ CHARM)
+# 4. API HỦY BÁN (Trả Charm / Thẻ bài / Đồ thường về túi)
 # =======================================================
 @router.post("/cancel")
-async def cancel_market(req: CancelRequest, db: Session = Depends(get_db)):
-    # 1. Tìm đơn hàng
-    listing = db.get(MarketListing, req.listing_id)
-    if not listing: 
-        raise HTTPException(404, "Đơn hàng không tồn tại")
-
-    # 2. Xác thực người sở hữu
+def cancel_market(req: CancelRequest, db: Session = Depends(get_db)):
     # Lưu ý: req.buyer_username ở đây thực chất là người đang thao tác (người bán muốn hủy)
-    user = db.exec(select(Player).where(Player.username == req.buyer_username)).first()
-    if not user:
-        raise HTTPException(404, "User không tồn tại")
-    
-    if listing.seller_id != user.id: 
-        raise HTTPException(403, "Không phải hàng của bạn")
-
-    # ====================================================
-    # 👇 LOGIC MỚI: KIỂM TRA XEM LÀ CHARM HAY ĐỒ THƯỜNG
-    # ====================================================
-    
-    # TRƯỜNG HỢP 1: LÀ CHARM (Có dữ liệu JSON)
-    if listing.item_id == 999999 and listing.item_data_json:
-        try:
-            # Mở gói dữ liệu
-            c_data = json.loads(listing.item_data_json)
-            
-            # Tái tạo Charm mới dựa trên dữ liệu cũ
-            restored_charm = PlayerItem(
-                player_id=user.id,
-                name=c_data.get("name", "Charm Hồi Phục"),
-                image_url=c_data.get("image_url", "/assets/items/default.png"),
-                rarity=c_data.get("rarity", "COMMON"),
-                stats_data=c_data.get("stats_data", "{}"),   # Trả lại chỉ số ATK/HP
-                enhance_level=c_data.get("enhance_level", 0), # Trả lại cấp độ cộng
-                is_equipped=False, # Về túi thì phải tháo ra
-                slot_index=0
-            )
-            
-            db.add(restored_charm)
-            
-        except Exception as e:
-            print(f"Lỗi khi khôi phục Charm: {e}")
-            raise HTTPException(500, "Lỗi dữ liệu Charm, không thể thu hồi!")
-
-    # TRƯỜNG HỢP 2: LÀ ĐỒ THƯỜNG (Logic cũ)
-    else:
-        # Tìm xem trong túi đã có món này chưa để cộng dồn
-        inv = db.exec(select(Inventory).where(
-            Inventory.player_id == user.id, 
-            Inventory.item_id == listing.item_id
-        )).first()
-        
-        if inv: 
-            inv.amount += listing.amount
-        else: 
-            # Nếu chưa có thì tạo mới
-            new_item = Inventory(
-                player_id=user.id, 
-                item_id=listing.item_id, 
-                amount=listing.amount
-            )
-            db.add(new_item)
-
-    # 3. Xóa đơn hàng trên chợ
-    db.delete(listing)
-    
-    # 4. Lưu tất cả thay đổi
-    db.commit()
-    
-    return {"status": "success", "message": "Đã thu hồi vật phẩm về túi!"}
+    result = MarketManager(db).cancel(req.listing_id, req.buyer_username)
+    if not result["success"]:
+        raise HTTPException(result["code"], result["message"])
+    return {"status": "success", "message": result["message"]}
 
 # =======================================================
 # 5. [BỔ SUNG] API XỬ LÝ RIÊNG CHO CHARM (TRANG BỊ)
@@ -342,6 +176,7 @@ async def discard_charm_api(req: CharmActionRequest, db: Session = Depends(get_d
     # Xóa vĩnh viễn
     db.delete(charm)
     db.commit()
+    inventory_snapshots.touch(player.id)
     return {"status": "success", "message": f"Đã vứt bỏ {charm.name}!"}
 
 # --- API 5.2: TREO BÁN CHARM (ĐÃ CẬP NHẬT CHỌN TIỀN) ---
@@ -395,6 +230,7 @@ async def sell_charm(
         
         # 👇 QUAN TRỌNG: LƯU JSON VÀO DB 👇
         item_data_json=json_str,
+        rarity=item.rarity,
         
         created_at=datetime.now()
     )
@@ -402,9 +238,12 @@ async def sell_charm(
     # 4. Xóa Charm khỏi túi người bán (Chuyển lên chợ)
     db.delete(item)
     
-    # 5. Lưu đơn hàng
+    # 5. Lưu đơn hàng & cập nhật bảng giá
     db.add(new_listing)
+    db.flush()
+    refresh_price_index(db, new_listing.item_id, new_listing.rarity, new_listing.currency)
     db.commit()
+    inventory_snapshots.touch(current_user.id)
 
     return {"status": "success", "message": "Đã treo bán Charm thành công!"}
 
@@ -424,6 +263,11 @@ async def sell_companion(
     if not companion:
         return {"status": "error", "message": "Không tìm thấy thẻ bài hoặc bạn không sở hữu nó."}
 
+    # Thẻ đang ra trận: chỉ số của thẻ đang nằm trong bonus trang bị -> phải tháo trước
+    equipped_slots = (current_user.companion_slot_1, current_user.companion_slot_2, current_user.companion_slot_3)
+    if companion.is_equipped or companion.id in equipped_slots:
+        return {"status": "error", "message": "Phải tháo thẻ bài khỏi đội hình trước khi bán!"}
+
     try:
         # Tạm thời chuyển dữ liệu thẻ bài thành JSON để lưu lên Chợ (Giữ nguyên stats của bạn)
         item_data = {
@@ -435,6 +279,7 @@ async def sell_companion(
                 "hp": companion.hp, 
                 "atk": companion.atk
             },
+            "template_id": companion.template_id, # Để dựng lại thẻ khi mua / hủy bán
             "ui_id": req.companion_id # Lưu lại ID gốc để debug nếu cần
         }
 
@@ -444,16 +289,20 @@ async def sell_companion(
             seller_id=current_user.id,
             item_id=999998, # Mã riêng cho Companion trên chợ
             item_data_json=json.dumps(item_data), # Toàn bộ thông tin thẻ nằm ở đây
+            rarity=item_data["rarity"],
             price=req.price,
             currency=req.currency
         )
         db.add(new_listing)
+        db.flush()
+        refresh_price_index(db, new_listing.item_id, new_listing.rarity, new_listing.currency)
         
         # Xóa thẻ khỏi túi người chơi (Quan trọng: Đã mang lên chợ thì không còn trong túi)
         db.delete(companion)
         db.commit()
+        inventory_snapshots.touch(current_user.id)
         
-        return {"status": "success", "message": f"Đã treo thẻ {companion.temp_name} lên Chợ Đen!"}
+        return {"status": "success", "message": f"Đã treo thẻ {item_data['name']} lên Chợ Đen!"}
     except Exception as e:
         db.rollback()
         return {"status": "error", "message": str(e)}
\ No newline at end of file
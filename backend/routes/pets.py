@@ -1,8 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException
-from sqlmodel import Session, select
-from datetime import datetime
-from database import get_db, Player, Item, Inventory as PlayerItem, PlayerPet
+from sqlmodel import Session, select, func
+from typing import Optional
+from database import get_db, Player, PlayerPet
 from pydantic import BaseModel
+from game_logic import pets as pet_engine
+from game_logic.stats import apply_stat_delta
+from services.static_registry import registry
+from services.inventory_snapshot import inventory_snapshots
 
 router = APIRouter()
 
@@ -11,148 +15,130 @@ class FusionRequest(BaseModel):
     player_id: int
     fragment_item_id: int # ID của vật phẩm "Mảnh Pet"
 
+class FuseAllRequest(BaseModel):
+    player_id: int
+    fragment_item_id: Optional[int] = None # Bỏ trống = ghép mọi loại Mảnh
+
 class UpgradeStarRequest(BaseModel):
     player_id: int
     pet_item_id: int # Loại Pet muốn nâng sao (Vd: ID của Rồng Lửa)
     current_star: int # Muốn nâng từ sao mấy lên? (Vd: 1 lên 2)
 
+class EvolveAllRequest(BaseModel):
+    player_id: int
+    pet_item_id: Optional[int] = None # Bỏ trống = mọi loại Pet
+
 class ActivateRequest(BaseModel):
     player_id: int
     pet_instance_id: int # ID riêng của con Pet trong túi (PlayerPet.id)
 
+def _get_player(db: Session, player_id: int) -> Player:
+    player = db.get(Player, player_id)
+    if not player:
+        raise HTTPException(status_code=404, detail="Không tìm thấy người chơi")
+    return player
+
 # ==========================================================
 # 1. API GHÉP MẢNH (FRAGMENT FUSION)
 # Logic: Cần 10 mảnh để đổi lấy 1 Pet Level 1 (1 Sao)
+# Mảnh nằm trong túi đồ (Inventory), config của Mảnh có {"target_pet_id": 102}
 # ==========================================================
 @router.post("/fusion")
 def fuse_pet_fragments(req: FusionRequest, db: Session = Depends(get_db)):
-    # 1. Kiểm tra xem người chơi có đủ 10 mảnh không
-    # Tìm trong túi đồ (PlayerItem)
-    statement = select(PlayerItem).where(
-        PlayerItem.player_id == req.player_id,
-        PlayerItem.item_id == req.fragment_item_id
-    )
-    fragment_stack = db.exec(statement).first()
-
-    if not fragment_stack or fragment_stack.quantity < 10:
-        raise HTTPException(status_code=400, detail="Không đủ mảnh để ghép (Cần 10 mảnh)!")
+    _get_player(db, req.player_id)
+    try:
+        result = pet_engine.fuse_fragments(db, req.player_id, req.fragment_item_id, max_pets=1)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not result["created"]:
+        raise HTTPException(status_code=400, detail=f"Không đủ mảnh để ghép (Cần {pet_engine.FRAGMENTS_PER_PET} mảnh)!")
 
-    # 2. Xác định xem Mảnh này sẽ ra con Pet nào?
-    # Quy ước: Trong config của Mảnh, phải có dòng {"target_pet_id": 102}
-    # Hoặc đơn giản: Admin tự quy định ID. 
-    # Ở đây ta giả định: item_id của Mảnh và Pet được map trong config của Mảnh.
-    fragment_info = db.get(Item, req.fragment_item_id)
-    if not fragment_info:
-        raise HTTPException(status_code=404, detail="Không tìm thấy thông tin mảnh!")
+    db.commit()
+    inventory_snapshots.touch(req.player_id)
+    return {"success": True, "message": "Ghép thành công! Nhận được 1 Linh Thú mới."}
 
-    # Lấy ID pet mục tiêu từ config (Backend phải parse chuỗi JSON config)
-    import json
+@router.post("/fusion-all")
+def fuse_all_pet_fragments(req: FuseAllRequest, db: Session = Depends(get_db)):
+    """Ghép hết mức có thể (mọi loại Mảnh, hoặc 1 loại) trong 1 transaction."""
+    _get_player(db, req.player_id)
     try:
-        config = json.loads(fragment_info.config)
-        target_pet_id = config.get("target_pet_id")
-        if not target_pet_id:
-            raise HTTPException(status_code=400, detail="Mảnh này bị lỗi config (Không trỏ tới Pet nào).")
-    except:
-        raise HTTPException(status_code=400, detail="Lỗi đọc cấu hình mảnh.")
-
-    # 3. Trừ 10 mảnh
-    fragment_stack.quantity -= 10
-    if fragment_stack.quantity <= 0:
-        db.delete(fragment_stack) # Hết thì xóa dòng luôn
-    
-    # 4. Thêm Pet mới vào bảng PlayerPet
-    new_pet = PlayerPet(
-        player_id=req.player_id,
-        item_id=target_pet_id,
-        star_level=1, # Mặc định 1 sao
-        level=1,
-        is_active=False
-    )
-    db.add(new_pet)
-    
+        result = pet_engine.fuse_fragments(db, req.player_id, req.fragment_item_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if not result["created"]:
+        return {"success": False, "message": f"Không có loại Mảnh nào đủ {pet_engine.FRAGMENTS_PER_PET} mảnh.", **result}
+
     db.commit()
-    return {"success": True, "message": "Ghép thành công! Nhận được 1 Linh Thú mới."}
+    inventory_snapshots.touch(req.player_id)
+    return {"success": True, "message": f"Ghép thành công! Nhận được {result['created']} Linh Thú mới.", **result}
 
 
 # ==========================================================
 # 2. API TĂNG SAO (3-IN-1 EVOLUTION)
 # Logic: Hy sinh 3 con Pet cùng loại, cùng sao để tạo ra 1 con sao cao hơn
+# (Không được lấy con đang active ra tế)
 # ==========================================================
 @router.post("/upgrade-star")
 def upgrade_pet_star(req: UpgradeStarRequest, db: Session = Depends(get_db)):
-    # 1. Tìm tất cả Pet "rác" (cùng loại, cùng sao) mà người chơi đang có
-    statement = select(PlayerPet).where(
-        PlayerPet.player_id == req.player_id,
-        PlayerPet.item_id == req.pet_item_id,
-        PlayerPet.star_level == req.current_star,
-        PlayerPet.is_active == False # Không được lấy con đang active ra tế
-    )
-    pets = db.exec(statement).all()
-
-    if len(pets) < 3:
-        raise HTTPException(status_code=400, detail=f"Cần 3 Pet {req.current_star} sao để nâng cấp. Bạn chỉ có {len(pets)} con.")
-
-    # 2. Thực hiện "Hiến tế"
-    # Lấy 3 con đầu tiên trong danh sách
-    sacrifices = pets[:3]
-    
-    # Xóa 3 con này đi
-    for p in sacrifices:
-        db.delete(p)
-    
-    # 3. Tạo 1 con mới cấp cao hơn (Hoặc giữ lại 1 con và nâng cấp nó - Ở đây ta chọn tạo mới cho sạch data)
-    new_high_pet = PlayerPet(
-        player_id=req.player_id,
-        item_id=req.pet_item_id,
-        star_level=req.current_star + 1, # Tăng 1 sao
-        level=1, # Reset level hoặc giữ nguyên tùy logic game (tạm thời reset)
-        is_active=False
+    _get_player(db, req.player_id)
+    result = pet_engine.evolve_pets(
+        db, req.player_id, pet_item_id=req.pet_item_id, star_level=req.current_star,
+        max_evolutions=1, cascade=False
     )
-    db.add(new_high_pet)
-    
+    if not result["evolutions"]:
+        owned = db.exec(select(func.count(PlayerPet.id)).where(
+            PlayerPet.player_id == req.player_id,
+            PlayerPet.item_id == req.pet_item_id,
+            PlayerPet.star_level == req.current_star,
+            PlayerPet.is_active == False
+        )).one()
+        raise HTTPException(
+            status_code=400,
+            detail=f"Cần {pet_engine.PETS_PER_EVOLVE} Pet {req.current_star} sao để nâng cấp. Bạn chỉ có {owned} con."
+        )
+
     db.commit()
     return {"success": True, "message": f"Nâng cấp thành công! Nhận được Pet {req.current_star + 1} Sao."}
 
+@router.post("/evolve-all")
+def evolve_all_pets(req: EvolveAllRequest, db: Session = Depends(get_db)):
+    """Tiến hóa hết mức có thể, Pet vừa lên sao được ghép tiếp ở mức sao mới (1 transaction)."""
+    _get_player(db, req.player_id)
+    result = pet_engine.evolve_pets(db, req.player_id, pet_item_id=req.pet_item_id)
+    if not result["evolutions"]:
+        return {"success": False, "message": f"Không có nhóm {pet_engine.PETS_PER_EVOLVE} Pet cùng loại, cùng sao nào.", **result}
+
+    db.commit()
+    return {"success": True, "message": f"Tiến hóa {result['evolutions']} lần!", **result}
+
 
 # ==========================================================
 # 3. API KÍCH HOẠT AURA (CẬP NHẬT: VĨNH VIỄN - TOGGLE)
 # Logic: Kích hoạt Pet này -> Tự động tắt Pet đang chạy trước đó.
-# Không có giới hạn thời gian.
+# Không có giới hạn thời gian. Aura được cộng sẵn vào chỉ số (item_atk_bonus / item_hp_bonus)
+# nên các đường chiến đấu chỉ đọc Player.atk / hp_max, không phải đọc lại Pet.
 # ==========================================================
 @router.post("/activate")
 def activate_pet_aura(req: ActivateRequest, db: Session = Depends(get_db)):
-    # 1. Tìm con Pet mà người chơi muốn bật
-    target_pet = db.get(PlayerPet, req.pet_instance_id)
-    if not target_pet:
-        raise HTTPException(status_code=404, detail="Không tìm thấy Linh thú này.")
-    
-    if target_pet.player_id != req.player_id:
-        raise HTTPException(status_code=403, detail="Linh thú này không phải của bạn!")
-
-    # 2. Nếu con này đang bật rồi thì thôi, không làm gì cả (hoặc có thể làm logic tắt nếu muốn)
-    if target_pet.is_active:
+    player = _get_player(db, req.player_id)
+    try:
+        result = pet_engine.activate_pet(db, req.player_id, req.pet_instance_id)
+    except LookupError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e))
+
+    if not result["changed"]:
         return {"success": True, "message": "Linh thú này đang bảo vệ bạn rồi!"}
 
-    # 3. TẮT TẤT CẢ Linh thú khác của người chơi này (Reset)
-    # Tìm tất cả pet đang active của user
-    statement = select(PlayerPet).where(
-        PlayerPet.player_id == req.player_id,
-        PlayerPet.is_active == True
-    )
-    active_pets = db.exec(statement).all()
-    
-    # Duyệt qua và tắt hết
-    for pet in active_pets:
-        pet.is_active = False
-        db.add(pet) # Đánh dấu update vào DB
-    
-    # 4. BẬT con mới lên
-    target_pet.is_active = True
-    # active_start_time vẫn có thể lưu để biết "Bắt đầu nuôi từ bao giờ", 
-    # nhưng logic game sẽ không dùng nó để tính hết hạn nữa.
-    target_pet.active_start_time = datetime.utcnow() 
-    
-    db.add(target_pet)
+    apply_stat_delta(db, player, result["atk_delta"], result["hp_delta"])
     db.commit()
-    
-    return {"success": True, "message": f"Đã triệu hồi {target_pet.item_id}! Hào quang đã kích hoạt vĩnh viễn."}
\ No newline at end of file
+
+    pet = registry.get_item(db, result["pet"].item_id)
+    pet_name = pet.name if pet else result["pet"].item_id
+    return {
+        "success": True,
+        "message": f"Đã triệu hồi {pet_name}! Hào quang đã kích hoạt vĩnh viễn.",
+        "atk_delta": result["atk_delta"],
+        "hp_delta": result["hp_delta"],
+    }
@@ -2,14 +2,15 @@ from fastapi import APIRouter, Depends, HTTPException
 from sqlmodel import Session, select
 from database import get_db, Inventory, Item, Player
 from typing import List
+from services.shop_catalog import shop_catalog
+from services.static_registry import registry
 
 router = APIRouter(prefix="/admin/shop", tags=["Admin Shop"])
 
 # 1. API LẤY DANH SÁCH TẤT CẢ VẬT PHẨM (Để Admin quản lý)
 @router.get("/items", response_model=List[Item])
 async def get_all_items(db: Session = Depends(get_db)):
-    items = db.exec(select(Item)).all()
-    return items
+    return shop_catalog.all_items(db)
 
 # 2. API TẠO VẬT PHẨM MỚI
 @router.post("/items/add")
@@ -17,6 +18,7 @@ async def add_item(item_data: Item, db: Session = Depends(get_db)):
     db.add(item_data)
     db.commit()
     db.refresh(item_data)
+    registry.invalidate("items")
     return {"message": f"Đã thêm vật phẩm: {item_data.name}", "item": item_data}
 
 # 3. API XÓA VẬT PHẨM
@@ -27,4 +29,5 @@ async def delete_item(item_id: int, db: Session = Depends(get_db)):
         raise HTTPException(status_code=404, detail="Không tìm thấy vật phẩm")
     db.delete(item)
     db.commit()
+    registry.invalidate("items")
     return {"message": "Đã xóa vật phẩm thành công"}
\ No newline at end of file
@@ -1,8 +1,11 @@
-import json
 from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.exc import IntegrityError
 from sqlmodel import Session, select
-from database import get_db, Player, SkillTemplate
+from database import get_db, Player, PlayerSkill
+from services.static_registry import registry
+from services.skill_tree import skill_tree, learned_skills, has_skill, set_equipped
 from routes.auth import get_current_user
+from services import wallet
 
 router = APIRouter()
 
@@ -18,24 +21,20 @@ def learn_skill(
     # Lưu ý: Code dưới đây dùng 'current_user' thay vì 'player'
     
     # 1. Lấy thông tin Skill
-    skill_temp = db.exec(select(SkillTemplate).where(SkillTemplate.skill_id == skill_id)).first()
+    skill_temp = registry.get_skill(db, skill_id)
     if not skill_temp:
         raise HTTPException(status_code=404, detail="Kỹ năng không tồn tại")
 
-    # 2. Lấy giá tiền từ Config
-    config = {}
-    if skill_temp.config_data:
-        try:
-            config = json.loads(skill_temp.config_data)
-        except:
-            pass
-    
-    cost = config.get("base_cost", 0) 
+    # 2. Lấy giá tiền + điều kiện từ cây kỹ năng dựng sẵn
+    node = skill_tree.node(db, skill_id)
+    if not node:
+        raise HTTPException(status_code=404, detail="Kỹ năng không tồn tại")
+    cost = node["cost"]
 
     # --- KIỂM TRA ĐIỀU KIỆN ---
 
     # A. Kiểm tra Level
-    required_level = skill_temp.min_level
+    required_level = node["min_level"]
     if current_user.level < required_level:
         raise HTTPException(
             status_code=400, 
@@ -50,29 +49,45 @@ def learn_skill(
             detail=f"Không đủ Tri Thức! Cần {cost} (Thiếu {missing} điểm). Yêu cầu Level {required_level}."
         )
 
-    # C. Kiểm tra đã học chưa
-    player_skills = json.loads(current_user.skills_data or "{}")
-    if skill_id in player_skills:
+    # C. Kiểm tra đã học chưa (1 query theo index player_id + skill_id)
+    if has_skill(db, current_user.id, skill_id):
         raise HTTPException(status_code=400, detail="Bạn đã học kỹ năng này rồi!")
 
+    # D. Kiểm tra skill cha (cây kỹ năng)
+    parent_id = node["prerequisite_id"]
+    if parent_id and not has_skill(db, current_user.id, parent_id):
+        parent = registry.get_skill(db, parent_id)
+        raise HTTPException(
+            status_code=400,
+            detail=f"Cần lĩnh ngộ {parent.name if parent else parent_id} trước khi học kỹ năng này!"
+        )
+
     # --- XỬ LÝ GIAO DỊCH ---
     
-    # 1. Trừ tiền
-    current_user.tri_thuc -= cost
+    # 1. Trừ tiền (chỉ trừ khi đủ số dư)
+    if wallet.debit(db, current_user.id, "tri_thuc", cost, reason="skill_learn", ref=skill_id) is None:
+        db.rollback()
+        raise HTTPException(status_code=400, detail=f"Không đủ Tri Thức! Cần {cost}.")
     
-    # 2. Lưu skill vào danh sách
-    player_skills[skill_id] = 1
-    current_user.skills_data = json.dumps(player_skills)
+    # 2. Lưu skill vào bảng PlayerSkill
+    is_active = skill_temp.skill_type == "ACTIVE"
+    db.add(PlayerSkill(player_id=current_user.id, skill_id=skill_id, level=1))
 
     # 3. Auto trang bị nếu là Active
     message = "Lĩnh ngộ thành công!"
-    if skill_temp.skill_type == "ACTIVE":
+    if is_active:
+        db.flush()
+        set_equipped(db, current_user.id, skill_id)
         current_user.equipped_skill = skill_id
         message += " Đã tự động trang bị."
     
-    # 4. Lưu vào Database
+    # 4. Lưu vào Database (bấm học 2 lần cùng lúc -> index unique chặn, tiền được hoàn do rollback)
     db.add(current_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Bạn đã học kỹ năng này rồi!")
     
     return {"status": "success", "message": message}
 
@@ -83,16 +98,20 @@ def equip_skill(
     db: Session = Depends(get_db),
     current_user: Player = Depends(get_current_user) # 👈 Dùng User thật
 ):
-    # Tìm skill trong DB để kiểm tra xem có phải skill ACTIVE không
-    skill_temp = db.exec(select(SkillTemplate).where(SkillTemplate.skill_id == skill_id)).first()
+    # Tìm skill để kiểm tra xem có phải skill ACTIVE không
+    skill_temp = registry.get_skill(db, skill_id)
     
     if not skill_temp:
         raise HTTPException(404, detail="Kỹ năng không tồn tại")
     
     if skill_temp.skill_type != "ACTIVE":
         raise HTTPException(400, detail="Chỉ trang bị được skill Chủ Động (Active)")
+
+    if not has_skill(db, current_user.id, skill_id):
+        raise HTTPException(400, detail="Bạn chưa học kỹ năng này!")
         
     # Cập nhật cho user hiện tại
+    set_equipped(db, current_user.id, skill_id)
     current_user.equipped_skill = skill_id
     
     db.add(current_user)
@@ -106,6 +125,7 @@ def unequip_skill(
     db: Session = Depends(get_db),
     current_user: Player = Depends(get_current_user) # 👈 Dùng User thật
 ):
+    set_equipped(db, current_user.id, None)
     current_user.equipped_skill = None
     
     db.add(current_user)
@@ -116,29 +136,20 @@ def unequip_skill(
 # 4. API LẤY TRẠNG THÁI NGƯỜI CHƠI
 @router.get("/my-status")
 def get_status(
+    db: Session = Depends(get_db),
     current_user: Player = Depends(get_current_user) # 👈 Dùng User thật
 ):
-    # Hàm này chỉ cần đọc dữ liệu từ current_user, không cần query DB thêm
+    # Skill đã học: 1 query theo index (player_id, skill_id), giữ dạng {skill_id: cấp} như skills_data cũ
     return {
         "tri_thuc": current_user.tri_thuc,
-        # Parse JSON an toàn (tránh lỗi nếu data null)
-        "learned": json.loads(current_user.skills_data or "{}"),
+        "learned": learned_skills(db, current_user.id),
         "equipped": current_user.equipped_skill,
         "class_type": current_user.class_type
     }
 @router.get("/get-all")
 def get_all_skills(
     db: Session = Depends(get_db),
-    # 👇 Thay get_fake_user bằng dòng này
     current_user: Player = Depends(get_current_user) 
 ):
-    print(f"DEBUG: Đang lấy skill cho {current_user.username} - Class: {current_user.class_type}")
-
-    # Query chỉ lấy skill đúng Class hoặc skill Chung
-    statement = select(SkillTemplate).where(
-        (SkillTemplate.class_type == current_user.class_type) | 
-        (SkillTemplate.class_type == "COMMON")
-    )
-    
-    skills = db.exec(statement).all()
-    return skills
\ No newline at end of file
+    # Chỉ lấy skill đúng Class hoặc skill Chung (danh sách dựng sẵn trong cây kỹ năng)
+    return skill_tree.for_class(db, current_user.class_type)
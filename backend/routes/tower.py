@@ -14,6 +14,10 @@ from game_logic.level import add_exp_to_player
 # 1. Import Database & Models
 # Lưu ý: Import Inventory as PlayerItem để code ngữ nghĩa hơn (giống pets.py)
 from database import get_db, Player, QuestionBank, TowerProgress, TowerSetting, Item, Inventory as PlayerItem
+from services.question_store import question_store
+from services import wallet
+from services.static_registry import registry
+from services.inventory_snapshot import inventory_snapshots
 
 current_dir = os.path.dirname(os.path.abspath(__file__)) # Đang ở backend/routes
 parent_dir = os.path.dirname(current_dir)              # Ra ngoài thư mục cha (backend)
@@ -93,12 +97,10 @@ async def start_floor_combat(
 
     # 2. LẤY CÂU HỎI
     target_diff = get_difficulty_by_floor(floor)
-    statement = select(QuestionBank).where(func.lower(QuestionBank.difficulty) == target_diff.lower()).order_by(func.random()).limit(10)
-    questions_db = db.exec(statement).all()
+    questions_db = question_store.sample(db, 10, difficulty=target_diff)
 
     if not questions_db:
-        fallback_stmt = select(QuestionBank).order_by(func.random()).limit(10)
-        questions_db = db.exec(fallback_stmt).all()
+        questions_db = question_store.sample(db, 10)
 
     if not questions_db:
          raise HTTPException(status_code=404, detail="Kho câu hỏi rỗng!")
@@ -120,7 +122,7 @@ async def start_floor_combat(
     
     for q in questions_db:
         try:
-            options_list = json.loads(q.options_json)
+            options_list = list(q["options"])
             while len(options_list) < 4: options_list.append("")
 
             val_a = options_list[0]
@@ -129,7 +131,7 @@ async def start_floor_combat(
             val_d = options_list[3]
 
             # Làm sạch đáp án đúng từ DB
-            raw_correct = str(q.correct_answer).strip()
+            raw_correct = str(q["correct_answer"]).strip()
             target_ans = clean_text(raw_correct)
             
             # --- CHIẾN THUẬT SO SÁNH 3 LỚP ---
@@ -160,25 +162,25 @@ async def start_floor_combat(
 
             # CỨU CÁNH CUỐI CÙNG: Nếu vẫn không tìm thấy -> Buộc phải gán A và in Log lỗi
             if final_char is None:
-                print(f"❌ LỖI DATA ID {q.id}: Không khớp đáp án nào!")
-                print(f"   - DB Correct: '{q.correct_answer}' (Clean: {target_ans})")
+                print(f"❌ LỖI DATA ID {q['id']}: Không khớp đáp án nào!")
+                print(f"   - DB Correct: '{q['correct_answer']}' (Clean: {target_ans})")
                 print(f"   - Option A: '{val_a}' (Clean: {clean_text(val_a)})")
                 print(f"   - Option B: '{val_b}' (Clean: {clean_text(val_b)})")
                 final_char = "a" # Fallback để game không crash
 
             formatted_questions.append({
-                "id": q.id,
-                "content": q.content,
+                "id": q["id"],
+                "content": q["content"],
                 "option_a": val_a,
                 "option_b": val_b,
                 "option_c": val_c,
                 "option_d": val_d,
                 "correct_ans": final_char, 
-                "explain": q.explanation if hasattr(q, "explanation") else f"Đáp án đúng: {final_char.upper()}"
+                "explain": q["explanation"] or f"Đáp án đúng: {final_char.upper()}"
             })
 
         except Exception as e:
-            print(f"Lỗi parse câu hỏi ID {q.id}: {e}")
+            print(f"Lỗi parse câu hỏi ID {q['id']}: {e}")
             continue
 
     return {
@@ -208,6 +210,7 @@ async def complete_floor(
     new_floor_val = progress.current_floor 
     is_new_record = False
     received_rewards = []
+    inventory_changed = False  # Có đồ / Charm vào túi -> báo snapshot túi đồ sau khi commit
 
     # Ép kiểu dữ liệu ngay từ đầu để so sánh chuẩn xác
     client_floor = int(req.floor)
@@ -278,35 +281,24 @@ async def complete_floor(
                     
                     # --- 2. XỬ LÝ TIỀN TỆ (ĐÃ NÂNG CẤP NHẬN DIỆN) ---
                     elif item_type == "currency":
-                        is_added = False
-                        
                         # Chuyển về chữ thường để so sánh tìm từ khóa
                         name_lower = raw_name.lower()
                         
                         # 🔥 LOGIC MAP TÊN HIỂN THỊ -> TÊN BIẾN TRONG DB
+                        currency = None
                         if "kpi" in name_lower:
-                            current_user.kpi = float(current_user.kpi or 0.0) + float(qty)
-                            received_rewards.append(f"+{qty} KPI")
-                            is_added = True
-                            
+                            currency, label = "kpi", "KPI"
                         elif "tri th" in name_lower or "tri_thuc" in name_lower: # Bắt dính "Tri Thức (Xanh)"
-                            current_user.tri_thuc = int(current_user.tri_thuc or 0) + qty
-                            received_rewards.append(f"+{qty} Tri Thức")
-                            is_added = True
-                            
+                            currency, label = "tri_thuc", "Tri Thức"
                         elif "chien tich" in name_lower or "chiến tích" in name_lower:
-                            current_user.chien_tich = int(current_user.chien_tich or 0) + qty
-                            received_rewards.append(f"+{qty} Chiến Tích")
-                            is_added = True
-                            
+                            currency, label = "chien_tich", "Chiến Tích"
                         elif "vinh du" in name_lower or "vinh dự" in name_lower:
-                            current_user.vinh_du = int(current_user.vinh_du or 0) + qty
-                            received_rewards.append(f"+{qty} Vinh Dự")
-                            is_added = True
+                            currency, label = "vinh_du", "Vinh Dự"
                         
-                        # Nếu cộng thành công thì lưu ngay
-                        if is_added:
-                            db.add(current_user)
+                        # Cộng qua ví (ghi sổ cái)
+                        if currency:
+                            wallet.credit(db, current_user.id, currency, qty, reason="tower_reward", ref=client_floor)
+                            received_rewards.append(f"+{qty} {label}")
                     
                     # --- 3. XỬ LÝ VẬT PHẨM ---
                     elif item_type == "item":
@@ -320,14 +312,15 @@ async def complete_floor(
                                 )).first()
                                 
                                 if inv_item: 
-                                    inv_item.quantity += qty
+                                    inv_item.amount += qty
                                     db.add(inv_item)
                                 else: 
-                                    db.add(PlayerItem(player_id=current_user.id, item_id=item_id, quantity=qty))
+                                    db.add(PlayerItem(player_id=current_user.id, item_id=item_id, amount=qty))
                                 
-                                game_item = db.get(Item, item_id)
+                                game_item = registry.get_item(db, item_id)
                                 item_name = game_item.name if game_item else f"Item {item_id}"
                                 received_rewards.append(f"+{qty} {item_name}")
+                                inventory_changed = True
                         except: pass
                     # --- 4. XỬ LÝ CHARM (MỚI) ---
                     elif item_type == "charm":
@@ -337,10 +330,11 @@ async def complete_floor(
                             rarity = raw_name.replace("RANDOM_CHARM_", "")
                             
                             # Gọi hàm tạo Charm
-                            new_charm = item_processor.generate_charm(db, current_user.id, rarity)
+                            new_charm = item_processor.generate_charm(db, current_user.id, rarity, commit=False)
                             
                             if new_charm:
                                 received_rewards.append(f"Trang bị: {new_charm.name}")
+                                inventory_changed = True
                         except Exception as e:
                             print(f"❌ Lỗi tạo Charm: {e}")
 
@@ -379,6 +373,8 @@ async def complete_floor(
         
         db.refresh(progress)
         db.refresh(current_user)
+        if inventory_changed:
+            inventory_snapshots.touch(current_user.id)
         
     except Exception as e:
         print(f"❌ LỖI DATABASE: {e}")
@@ -5,6 +5,7 @@ from sqlmodel import Session, select
 from jose import JWTError, jwt
 from database import get_db, Player, Inventory, Item, ScoreLog
 from routes.auth import SECRET_KEY, ALGORITHM, get_current_user
+from services import wallet
 from datetime import datetime
 from typing import List
 from pydantic import BaseModel
@@ -445,7 +446,7 @@ def submit_academic_score(
 
     # 👇 [MỚI] CỘNG KPI TỰ ĐỘNG CHO MỌI LOẠI ĐIỂM 👇
     # Logic: Nhập bao nhiêu điểm học tập -> Cộng bấy nhiêu KPI
-    target.kpi += req.value
+    wallet.adjust(db, target.id, {"kpi": req.value}, reason="academic_score", ref=req.score_type)
     # ----------------------------------------------------
 
     # --- Lưu lịch sử ---
@@ -481,7 +482,7 @@ def submit_violation(
 
     # Cộng điểm vi phạm và Trừ KPI
     target.diem_vi_pham += req.penalty # Cộng số âm (VD: -3)
-    target.kpi += req.penalty          # Trừ KPI
+    wallet.adjust(db, target.id, {"kpi": req.penalty}, reason="violation")  # Trừ KPI
     
     # --- 👇 LƯU LỊCH SỬ (LOG) 👇 ---
     new_log = ScoreLog(
@@ -0,0 +1,75 @@
+import os
+import random
+import threading
+from typing import Dict, List, Tuple
+
+IMAGE_EXTS = (".png", ".jpg", ".jpeg", ".webp")
+
+# Thư mục frontend (ngang hàng với backend)
+FRONTEND_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "..", "frontend")
+)
+
+
+class AssetPool:
+    """
+    Danh sách ảnh theo từng loại (charm, ...) nằm trong RAM.
+    - Chỉ listdir lại khi mtime của thư mục đổi (thêm / xóa / đổi tên ảnh) -> mỗi lần bốc chỉ tốn 1 os.stat.
+    - pick(category, k): bốc k ảnh ngẫu nhiên cùng lúc (tạo charm hàng loạt chỉ đọc thư mục tối đa 1 lần).
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._categories: Dict[str, str] = {}                   # loại -> đường dẫn thư mục
+        self._cache: Dict[str, Tuple[float, List[str]]] = {}    # loại -> (mtime thư mục, [tên file])
+        self.listings = 0                                       # Số lần thật sự đọc thư mục (để theo dõi)
+
+    def register(self, category: str, folder: str):
+        with self._lock:
+            self._categories[category] = folder
+            self._cache.pop(category, None)
+
+    def folder(self, category: str) -> str:
+        return self._categories[category]
+
+    def files(self, category: str) -> List[str]:
+        """Tên các file ảnh của 1 loại. Thư mục không tồn tại -> []."""
+        folder = self._categories[category]
+        try:
+            mtime = os.stat(folder).st_mtime
+        except FileNotFoundError:
+            return []
+
+        cached = self._cache.get(category)
+        if cached and cached[0] == mtime:
+            return cached[1]
+
+        with self._lock:
+            cached = self._cache.get(category)
+            if cached and cached[0] == mtime:
+                return cached[1]
+            names = sorted(f for f in os.listdir(folder) if f.lower().endswith(IMAGE_EXTS))
+            self._cache[category] = (mtime, names)
+            self.listings += 1
+            return names
+
+    def pick(self, category: str, k: int = 1) -> List[str]:
+        """Bốc k ảnh ngẫu nhiên (có lặp lại). Không có ảnh nào -> []."""
+        names = self.files(category)
+        return random.choices(names, k=k) if names and k > 0 else []
+
+    def invalidate(self, category: str = None):
+        with self._lock:
+            if category:
+                self._cache.pop(category, None)
+            else:
+                self._cache.clear()
+
+    def stats(self) -> dict:
+        return {
+            "listings": self.listings,
+            "categories": {c: len(v[1]) for c, v in self._cache.items()},
+        }
+
+
+asset_pool = AssetPool()
+asset_pool.register("charms", os.path.join(FRONTEND_DIR, "assets", "items", "charms"))
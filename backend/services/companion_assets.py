@@ -0,0 +1,232 @@
+import os
+import json
+import asyncio
+import hashlib
+import threading
+from typing import Iterable, Optional
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, select, delete, func
+from database import engine, CompanionTemplate, CompanionAssetFile, Companion, MarketListing
+from services.static_registry import registry
+from services.market_browse import COMPANION_ITEM_ID
+
+try:
+    from watchfiles import awatch  # Đi kèm uvicorn[standard]; thiếu thì chỉ quét tay
+except ImportError:
+    awatch = None
+
+# frontend/assets/card/{r,sr,ssr,usr}/*.png
+CARD_ASSET_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "..", "frontend", "assets", "card")
+)
+CARD_RARITIES = ("r", "sr", "ssr", "usr")
+IMAGE_EXTS = (".png", ".webp", ".jpg", ".jpeg")
+# Bật theo dõi thư mục ảnh lúc chạy server (thả ảnh mới vào là có phôi, không cần bấm Quét)
+WATCH_ASSETS = True
+HASH_CHUNK = 1 << 20
+
+_scan_lock = threading.Lock()
+
+
+# =========================================================
+# 1. FILE ẢNH -> PHÔI (giữ nguyên quy tắc đặt tên cũ)
+# =========================================================
+def template_from_file(rarity: str, file_name: str) -> dict:
+    # Ví dụ file: "vo-nguyen-giap.png" -> SR_VO_NGUYEN_GIAP / "Vo Nguyen Giap"
+    name_slug = file_name.rsplit(".", 1)[0]
+    clean_slug = name_slug.replace("-", "_").replace(" ", "_").upper()
+    return {
+        "template_id": f"{rarity.upper()}_{clean_slug}",
+        "name": name_slug.replace("-", " ").replace("_", " ").title(),
+        "rarity": rarity.upper(),
+        "image_path": f"/assets/card/{rarity}/{file_name}",
+    }
+
+def _file_hash(full_path: str) -> str:
+    h = hashlib.sha1()
+    with open(full_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _split(rel_path: str):
+    """'sr/abc.png' -> ('sr', 'abc.png') nếu là ảnh thẻ hợp lệ, ngược lại None."""
+    parts = rel_path.split("/")
+    if len(parts) != 2 or parts[0] not in CARD_RARITIES or not parts[1].lower().endswith(IMAGE_EXTS):
+        return None
+    return parts[0], parts[1]
+
+def _list_files() -> dict:
+    """{đường dẫn tương đối: os.stat_result} của mọi ảnh thẻ (scandir: stat có sẵn, không mở file)."""
+    found = {}
+    for rarity in CARD_RARITIES:
+        folder = os.path.join(CARD_ASSET_DIR, rarity)
+        if not os.path.isdir(folder):
+            continue
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTS):
+                    found[f"{rarity}/{entry.name}"] = entry.stat()
+    return found
+
+def _stat_paths(paths: Iterable[str]) -> dict:
+    """Chỉ stat các file được chỉ định (file đã xóa thì không có trong kết quả)."""
+    found = {}
+    for rel in paths:
+        if not _split(rel):
+            continue
+        try:
+            found[rel] = os.stat(os.path.join(CARD_ASSET_DIR, *rel.split("/")))
+        except FileNotFoundError:
+            pass
+    return found
+
+
+def _listed_templates(db: Session, template_ids: set) -> set:
+    """
+    Phôi của các thẻ đang treo trên Chợ Đen (thẻ lúc đó chỉ còn là gói JSON trong MarketListing).
+    Mua / hủy bán sẽ dựng lại thẻ từ phôi -> phôi phải còn.
+    """
+    if not template_ids:
+        return set()
+    images = dict(db.exec(
+        select(CompanionTemplate.image_path, CompanionTemplate.template_id)
+        .where(CompanionTemplate.template_id.in_(list(template_ids)))
+    ).all())
+    listed = set()
+    for raw in db.exec(select(MarketListing.item_data_json).where(MarketListing.item_id == COMPANION_ITEM_ID)).all():
+        try:
+            data = json.loads(raw or "{}")
+        except ValueError:
+            continue
+        # Đơn cũ chưa lưu template_id -> dựng lại theo ảnh của phôi
+        template_id = data.get("template_id") or images.get(data.get("image"))
+        if template_id in template_ids:
+            listed.add(template_id)
+    return listed
+
+
+# =========================================================
+# 2. QUÉT TĂNG DẦN: CHỈ ĐỤNG FILE MỚI / ĐÃ SỬA / ĐÃ XÓA
+# =========================================================
+def scan_companion_assets(db: Session, force: bool = False, paths: Optional[Iterable[str]] = None) -> dict:
+    """
+    So thư mục ảnh với CompanionAssetFile:
+    - File cùng mtime + size -> bỏ qua (không mở file).
+    - File mới / đổi mtime-size -> tính hash; hash giống thì chỉ cập nhật mtime.
+    - Phôi của file mới / đổi chỗ được UPSERT 1 lượt; phôi của file đã xóa bị gỡ nếu chưa ai sở hữu thẻ.
+    paths: chỉ xét các file này (dùng cho chế độ theo dõi thư mục); None = quét cả thư mục.
+    """
+    if not os.path.isdir(CARD_ASSET_DIR):
+        raise FileNotFoundError(CARD_ASSET_DIR)
+
+    with _scan_lock:
+        if paths is None:
+            on_disk = _list_files()
+            known = {f.path: f for f in db.exec(select(CompanionAssetFile)).all()}
+        else:
+            paths = {p for p in paths if _split(p)}
+            on_disk = _stat_paths(paths)
+            known = {
+                f.path: f for f in db.exec(
+                    select(CompanionAssetFile).where(CompanionAssetFile.path.in_(paths))
+                ).all()
+            } if paths else {}
+
+        templates = {}     # template_id -> dict phôi cần UPSERT
+        touched = 0
+        unchanged = 0
+        for rel, st in on_disk.items():
+            row = known.get(rel)
+            if not force and row and row.mtime == st.st_mtime and row.size == st.st_size:
+                continue
+            touched += 1
+            content_hash = _file_hash(os.path.join(CARD_ASSET_DIR, *rel.split("/")))
+            tpl = template_from_file(*_split(rel))
+            if row and row.content_hash == content_hash and not force:
+                unchanged += 1
+            else:
+                templates[tpl["template_id"]] = tpl
+            if row is None:
+                row = CompanionAssetFile(path=rel, template_id=tpl["template_id"])
+            row.mtime, row.size, row.content_hash = st.st_mtime, st.st_size, content_hash
+            db.add(row)
+
+        # Phôi: thêm mới hoặc cập nhật đường dẫn ảnh (tên do admin sửa thì giữ nguyên)
+        added, updated = 0, 0
+        if templates:
+            existing = dict(db.exec(
+                select(CompanionTemplate.template_id, CompanionTemplate.image_path)
+                .where(CompanionTemplate.template_id.in_(list(templates)))
+            ).all())
+            added = sum(1 for t in templates if t not in existing)
+            updated = sum(1 for t, tpl in templates.items() if t in existing and existing[t] != tpl["image_path"])
+            stmt = sqlite_insert(CompanionTemplate).values(list(templates.values()))
+            db.exec(stmt.on_conflict_do_update(
+                index_elements=["template_id"],
+                set_={"image_path": stmt.excluded.image_path}
+            ))
+
+        # File đã bị xóa khỏi ổ đĩa
+        removed_paths = [p for p in known if p not in on_disk]
+        removed, kept = 0, []
+        if removed_paths:
+            gone = {known[p].template_id for p in removed_paths}
+            db.exec(delete(CompanionAssetFile).where(CompanionAssetFile.path.in_(removed_paths)))
+            # Phôi còn file khác trỏ tới (VD: đổi đuôi .png -> .webp) thì giữ
+            still_indexed = set(db.exec(
+                select(CompanionAssetFile.template_id).where(CompanionAssetFile.template_id.in_(gone))
+            ).all())
+            owned = dict(db.exec(
+                select(Companion.template_id, func.count(Companion.id))
+                .where(Companion.template_id.in_(gone))
+                .group_by(Companion.template_id)
+            ).all())
+            listed = _listed_templates(db, gone - still_indexed)
+            for template_id in gone - still_indexed:
+                if owned.get(template_id) or template_id in listed:
+                    kept.append(template_id)   # Có người sở hữu / đang treo bán thẻ -> không xóa phôi
+                    continue
+                tpl = db.get(CompanionTemplate, template_id)
+                if tpl:
+                    db.delete(tpl)
+                    removed += 1
+
+        db.commit()
+        if added or updated or removed:
+            registry.invalidate("companions")
+
+    result = {
+        "files": len(on_disk),
+        "touched": touched,
+        "unchanged": unchanged,
+        "added": added,
+        "updated": updated,
+        "removed": removed,
+        "kept_orphans": kept,
+    }
+    if touched or removed_paths:
+        print(f"🖼️ Quét ảnh thẻ: {result}")
+    return result
+
+
+# =========================================================
+# 3. THEO DÕI THƯ MỤC (chạy ngầm, chỉ quét lại file vừa đổi)
+# =========================================================
+async def watch_companion_assets():
+    if not WATCH_ASSETS or awatch is None or not os.path.isdir(CARD_ASSET_DIR):
+        return
+
+    def job(changed):
+        with Session(engine) as db:
+            return scan_companion_assets(db, paths=changed)
+
+    try:
+        async for changes in awatch(CARD_ASSET_DIR):
+            changed = {os.path.relpath(p, CARD_ASSET_DIR).replace(os.sep, "/") for _, p in changes}
+            try:
+                await asyncio.to_thread(job, changed)
+            except Exception as e:
+                print(f"❌ Lỗi quét ảnh thẻ: {e}")
+    except asyncio.CancelledError:
+        pass
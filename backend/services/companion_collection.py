@@ -0,0 +1,132 @@
+from typing import Optional
+from sqlalchemy import case
+from sqlmodel import Session, select, or_, and_, func
+from database import Companion
+from services.static_registry import registry
+
+COLLECTION_SORTS = ("power", "star")
+MAX_PAGE_SIZE = 100
+
+# Lực chiến của 1 thẻ = ATK + HP (dùng để sắp xếp)
+POWER = Companion.atk + Companion.hp
+
+
+# =========================================================
+# 1. ĐỊNH DẠNG 1 THẺ (thông tin phôi lấy từ registry, không JOIN)
+# =========================================================
+def format_card(db: Session, comp) -> dict:
+    template = registry.get_companion_template(db, comp.template_id)
+    return {
+        "id": comp.id,
+        "real_id": comp.id,
+        "template_id": comp.template_id,
+        "name": comp.temp_name or (template.name if template else "Lỗi Thẻ"),
+        "rarity": template.rarity if template else "N/A",
+        "image": template.image_path if template else "/assets/card/back.png",
+        "star": comp.star,
+        "hp": comp.hp,
+        "atk": comp.atk,
+        "power": comp.atk + comp.hp,
+        "is_locked": comp.is_locked,
+        "is_equipped": comp.is_equipped,
+        "slot_index": comp.slot_index,
+    }
+
+
+# =========================================================
+# 2. THỐNG KÊ THEO PHÔI (1 câu GROUP BY trên index player_id, template_id, star)
+# =========================================================
+def template_counts(db: Session, player_id: int) -> list:
+    """Mỗi phôi: tổng số thẻ, sao cao nhất, số thẻ tự do (không khóa, không mặc) - để UI nhóm thẻ trùng."""
+    free = func.sum(case(((Companion.is_locked == True) | (Companion.is_equipped == True), 0), else_=1))
+    rows = db.exec(
+        select(Companion.template_id, func.count(Companion.id), func.max(Companion.star), free)
+        .where(Companion.player_id == player_id)
+        .group_by(Companion.template_id)
+    ).all()
+
+    result = []
+    for template_id, count, max_star, free_count in rows:
+        template = registry.get_companion_template(db, template_id)
+        result.append({
+            "template_id": template_id,
+            "name": template.name if template else template_id,
+            "rarity": template.rarity if template else "N/A",
+            "image": template.image_path if template else "/assets/card/back.png",
+            "count": count,
+            "max_star": max_star,
+            "free": int(free_count or 0),
+        })
+    result.sort(key=lambda r: (-r["count"], r["template_id"]))
+    return result
+
+
+# =========================================================
+# 3. DUYỆT BỘ SƯU TẬP (lọc + sắp xếp phía server, phân trang bằng cursor)
+# =========================================================
+def _parse_cursor(cursor: str):
+    """Cursor dạng 'giá_trị_sắp_xếp:id'. Sai định dạng -> ValueError."""
+    value, last_id = cursor.split(":", 1)
+    return int(value), last_id
+
+def browse_collection(
+    db: Session,
+    player_id: int,
+    rarity: Optional[str] = None,
+    star: Optional[int] = None,
+    template_id: Optional[str] = None,
+    locked: Optional[bool] = None,
+    equipped: Optional[bool] = None,
+    sort: str = "power",
+    cursor: Optional[str] = None,
+    limit: int = 30
+) -> dict:
+    """Bộ sưu tập thẻ của 1 người chơi theo trang (mạnh nhất trước), trang đầu kèm thống kê theo phôi."""
+    if sort not in COLLECTION_SORTS:
+        raise ValueError(f"sort phải là 1 trong {COLLECTION_SORTS}")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    stmt = select(Companion).where(Companion.player_id == player_id)
+    if template_id:
+        stmt = stmt.where(Companion.template_id == template_id)
+    if rarity:
+        # Độ hiếm nằm ở phôi -> đổi thành danh sách template_id từ registry (không JOIN)
+        # Phôi lưu độ hiếm viết hoa (R, SR...) -> ?rarity=ssr vẫn khớp
+        templates = registry.companion_templates(db, rarity.strip().upper())
+        stmt = stmt.where(Companion.template_id.in_([t.template_id for t in templates]))
+    if star is not None:
+        stmt = stmt.where(Companion.star == star)
+    if locked is not None:
+        stmt = stmt.where(Companion.is_locked == locked)
+    if equipped is not None:
+        stmt = stmt.where(Companion.is_equipped == equipped)
+
+    key = POWER if sort == "power" else Companion.star
+    # Cursor = khóa sắp xếp của dòng cuối trang trước (giảm dần, hòa thì theo id giảm dần)
+    if cursor:
+        value, last_id = _parse_cursor(cursor)
+        stmt = stmt.where(or_(key < value, and_(key == value, Companion.id < last_id)))
+    stmt = stmt.order_by(key.desc(), Companion.id.desc())
+
+    # Lấy dư 1 dòng để biết còn trang sau không
+    rows = db.exec(stmt.limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1]
+        value = last.atk + last.hp if sort == "power" else last.star
+        next_cursor = f"{value}:{last.id}"
+
+    page = {
+        "cards": [format_card(db, c) for c in rows],
+        "next_cursor": next_cursor,
+        "has_more": has_more,
+    }
+    if not cursor:
+        counts = template_counts(db, player_id)
+        page["templates"] = counts
+        # Tổng cả bộ sưu tập (không theo bộ lọc của trang)
+        page["collection_total"] = sum(t["count"] for t in counts)
+    return page
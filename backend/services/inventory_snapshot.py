@@ -0,0 +1,236 @@
+import itertools
+import threading
+import time
+from typing import Optional
+from sqlalchemy import String, Integer, cast, literal, null, union_all
+from sqlmodel import Session, select
+from database import Inventory, PlayerItem, Companion
+from services.static_registry import registry
+
+# Bản chụp túi đồ được dùng lại tối đa bao lâu khi chưa bị touch() (giây)
+SNAPSHOT_TTL = 10
+# Số phiên bản thay đổi gần nhất được giữ lại để trả "thay đổi kể từ version N"
+HISTORY_LIMIT = 50
+
+# Version tăng dần toàn tiến trình, bắt đầu theo mili-giây lúc bật server
+# -> version của tiến trình cũ không bao giờ trùng nghĩa với tiến trình mới
+_versions = itertools.count(int(time.time() * 1000))
+
+
+# =========================================================
+# 1. ĐỌC TÚI ĐỒ + TRANG BỊ TRONG 1 CÂU QUERY (UNION ALL)
+# =========================================================
+def _snapshot_query(player_id: int):
+    def cols(kind, key, amount, name, image, rarity, stats, level, equipped, slot, template_id, atk, hp):
+        return (
+            literal(kind).label("kind"), cast(key, String).label("key"), amount.label("amount"),
+            name.label("name"), image.label("image"), rarity.label("rarity"), stats.label("stats"),
+            level.label("level"), equipped.label("equipped"), slot.label("slot"),
+            template_id.label("template_id"), atk.label("atk"), hp.label("hp"),
+        )
+
+    n = lambda t=String: null().cast(t)
+    stackables = select(*cols(
+        "item", Inventory.id, Inventory.amount, n(), n(), n(), n(), Inventory.item_id,
+        literal(False), n(Integer), n(), n(Integer), n(Integer)
+    )).where(Inventory.player_id == player_id, Inventory.amount > 0)
+
+    charms = select(*cols(
+        "charm", PlayerItem.id, literal(1), PlayerItem.name, PlayerItem.image_url, PlayerItem.rarity,
+        PlayerItem.stats_data, PlayerItem.enhance_level, PlayerItem.is_equipped, PlayerItem.slot_index,
+        n(), n(Integer), n(Integer)
+    )).where(PlayerItem.player_id == player_id)
+
+    companions = select(*cols(
+        "companion", Companion.id, literal(1), Companion.temp_name, n(), n(), n(), Companion.star,
+        Companion.is_equipped, Companion.slot_index, Companion.template_id, Companion.atk, Companion.hp
+    )).where(Companion.player_id == player_id, Companion.is_equipped == True)
+
+    return union_all(stackables, charms, companions)
+
+def _format_stackable(db: Session, row) -> Optional[dict]:
+    # row.level = item_id (mượn cột), thông tin mẫu + config đã parse lấy từ registry
+    item = registry.get_item(db, row.level)
+    if not item:
+        return None
+    item_config = item.config_dict or {}
+    safe_amount = int(row.amount)
+    clean_name = item.name.replace("\xa0", " ").strip() if item.name else f"Item {item.id}"
+    safe_image = item.image_url if item.image_url else "/assets/items/charms/default.png"
+    return {
+        "key": f"inv:{row.key}",
+        "id": item.id,      # ID mẫu vật phẩm
+        "item_id": item.id,
+        "name": clean_name,
+        "image": safe_image,
+        "image_url": safe_image,
+        "description": item.description,
+        "amount": safe_amount,
+        "quantity": safe_amount,
+        "is_equippable": item.can_equip,
+        "is_usable": item.type == "consumable" or bool(item_config.get("action")),
+        "config": item_config,
+    }
+
+def _format_charm(row) -> dict:
+    return {
+        "key": f"charm:{row.key}",
+        "id": int(row.key),
+        "item_id": int(row.key),
+        "name": row.name,
+        "image": row.image,
+        "image_url": row.image,
+        "amount": 1,
+        "quantity": 1,
+        "description": f"Cấp cường hóa: +{row.level}",
+        "rarity": row.rarity,
+        "stats_data": row.stats,
+        "enhance_level": row.level,
+        "is_usable": False,
+        "is_equippable": True,
+        "type": "charm"
+    }
+
+def _format_equipped_charm(row) -> dict:
+    return {
+        "id": int(row.key),
+        "name": row.name,
+        "image_url": row.image,
+        "image": row.image,
+        "rarity": row.rarity,
+        "stats_data": row.stats,
+        "enhance_level": row.level,
+        "type": "charm"
+    }
+
+def _format_companion(db: Session, row) -> dict:
+    template = registry.get_companion_template(db, row.template_id)
+    c_image = template.image_path if template else "/assets/card/back.png"
+    return {
+        "id": row.key,
+        "name": row.name or (template.name if template else "Lỗi Thẻ"),
+        "image_url": c_image,
+        "image": c_image,
+        "rarity": template.rarity if template else "N/A",
+        "star": row.level,
+        "stats_data": {"atk": row.atk, "hp": row.hp},
+        "type": "companion"
+    }
+
+def build_snapshot(db: Session, player_id: int):
+    """Trả về (bag, equipment): bag = {khóa: món}, equipment = {slot: món} (giữ thứ tự hiển thị)."""
+    rows = db.exec(_snapshot_query(player_id)).all()
+    # Sắp ổn định theo id (thứ tự UNION không được đảm bảo)
+    rows.sort(key=lambda r: (r.kind, int(r.key) if r.kind != "companion" else 0, r.key))
+    stackables, charms, equipment = {}, {}, {}
+    for row in rows:
+        if row.kind == "item":
+            entry = _format_stackable(db, row)
+            if entry:
+                stackables[f"inv:{row.key}"] = entry
+        elif row.kind == "charm" and not row.equipped:
+            charms[f"charm:{row.key}"] = _format_charm(row)
+        elif row.kind == "charm":
+            slot = row.slot if row.slot and row.slot > 0 else 1
+            equipment[f"slot_{slot}"] = _format_equipped_charm(row)
+        else:
+            # Thẻ đồng hành dùng key comp_slot_N để không đụng hàng với Charm
+            slot = row.slot if row.slot and row.slot > 0 else 1
+            equipment[f"comp_slot_{slot}"] = _format_companion(db, row)
+
+    # Item thường trước, Charm sau (như thứ tự cũ)
+    return {**stackables, **charms}, equipment
+
+
+# =========================================================
+# 2. BỘ NHỚ ĐỆM THEO NGƯỜI CHƠI + VERSION TĂNG DẦN
+# =========================================================
+class _PlayerState:
+    __slots__ = ("version", "floor", "bag", "equipment", "built_at", "touched", "built_touch", "history")
+
+    def __init__(self, version, bag, equipment):
+        self.version = version
+        self.floor = version      # Version nhỏ nhất còn trả được diff
+        self.bag = bag
+        self.equipment = equipment
+        self.built_at = time.monotonic()
+        self.touched = 0          # Số lần bị touch()
+        self.built_touch = 0      # Giá trị touched lúc bắt đầu dựng bản chụp hiện tại
+        self.history = []         # [(version, khóa bag đổi, slot equipment đổi)]
+
+
+class InventorySnapshots:
+    """
+    Bản chụp túi đồ theo từng người chơi.
+    - Dùng lại bản chụp cho tới khi touch() (dùng đồ, mặc, rèn, mua, bán...) hoặc quá SNAPSHOT_TTL.
+    - Mỗi lần nội dung đổi -> version mới + ghi lại khóa nào đổi,
+      để client gửi since=N nhận đúng phần thay đổi thay vì tải lại cả túi.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._states = {}
+
+    def touch(self, *player_ids):
+        with self._lock:
+            for pid in player_ids:
+                state = self._states.get(pid)
+                if state:
+                    state.touched += 1
+
+    def _refresh(self, db: Session, player_id: int) -> _PlayerState:
+        state = self._states.get(player_id)
+        if state and state.touched == state.built_touch and time.monotonic() - state.built_at < SNAPSHOT_TTL:
+            return state
+        # touch() xảy ra trong lúc đang dựng -> lần sau vẫn phải dựng lại
+        touch_mark = state.touched if state else 0
+
+        bag, equipment = build_snapshot(db, player_id)
+        with self._lock:
+            state = self._states.get(player_id)
+            if state is None:
+                state = self._states[player_id] = _PlayerState(next(_versions), bag, equipment)
+                return state
+
+            bag_keys = {k for k in bag.keys() | state.bag.keys() if bag.get(k) != state.bag.get(k)}
+            eq_keys = {k for k in equipment.keys() | state.equipment.keys() if equipment.get(k) != state.equipment.get(k)}
+            if bag_keys or eq_keys or list(bag) != list(state.bag):
+                state.version = next(_versions)
+                state.history.append((state.version, bag_keys, eq_keys))
+                if len(state.history) > HISTORY_LIMIT:
+                    state.floor = state.history.pop(0)[0]
+            state.bag, state.equipment = bag, equipment
+            state.built_at = time.monotonic()
+            state.built_touch = touch_mark
+            return state
+
+    def get(self, db: Session, player_id: int, since: Optional[int] = None) -> dict:
+        state = self._refresh(db, player_id)
+        with self._lock:
+            version, bag, equipment = state.version, state.bag, state.equipment
+            changes = None
+            if since is not None and state.floor <= since <= version:
+                changes = [(b, e) for v, b, e in state.history if v > since]
+
+        if changes is None:
+            # Toàn bộ túi (định dạng cũ + version)
+            bag_list = list(bag.values())
+            return {"version": version, "full": True, "bag": bag_list, "equipment": equipment, "inventory": bag_list}
+
+        bag_keys = set().union(*(b for b, _ in changes)) if changes else set()
+        eq_keys = set().union(*(e for _, e in changes)) if changes else set()
+        return {
+            "version": version,
+            "full": False,
+            "changes": {
+                "bag": [bag[k] for k in bag if k in bag_keys],
+                "equipment": {k: equipment[k] for k in eq_keys if k in equipment},
+            },
+            "removed": {
+                "bag": sorted(k for k in bag_keys if k not in bag),
+                "equipment": sorted(k for k in eq_keys if k not in equipment),
+            },
+            "order": list(bag),
+        }
+
+
+inventory_snapshots = InventorySnapshots()
@@ -0,0 +1,184 @@
+import json
+from typing import Optional
+from sqlmodel import Session, select, or_, and_
+from database import engine, MarketListing, Player, Item
+
+# Mã item giả trên chợ cho hàng không nằm trong bảng Item
+CHARM_ITEM_ID = 999999
+COMPANION_ITEM_ID = 999998
+SPECIAL_ITEM_IDS = (CHARM_ITEM_ID, COMPANION_ITEM_ID)
+
+MARKET_KINDS = ("charm", "companion", "item")
+MARKET_SORTS = ("newest", "price_asc", "price_desc")
+MAX_PAGE_SIZE = 100
+
+
+# =========================================================
+# 1. CHUẨN BỊ DỮ LIỆU (Chạy 1 lần lúc bật server)
+# =========================================================
+def listing_rarity(item_data_json: Optional[str]) -> Optional[str]:
+    """Lấy độ hiếm từ gói JSON của Charm / Thẻ bài (đồ thường không có)."""
+    if not item_data_json:
+        return None
+    try:
+        return json.loads(item_data_json).get("rarity")
+    except Exception:
+        return None
+
+def ensure_market_index():
+    """Điền cột rarity cho các đơn hàng cũ (trước đây chỉ nằm trong item_data_json)."""
+    with Session(engine) as db:
+        rows = db.exec(select(MarketListing).where(
+            MarketListing.rarity == None, MarketListing.item_data_json != None
+        )).all()
+        for l in rows:
+            l.rarity = listing_rarity(l.item_data_json)
+            db.add(l)
+        if rows:
+            db.commit()
+            print(f"🏷️ Đã bổ sung độ hiếm cho {len(rows)} đơn hàng trên chợ.")
+
+
+# =========================================================
+# 2. ĐỊNH DẠNG 1 ĐƠN HÀNG (Khớp với Frontend cũ)
+# =========================================================
+def format_listing(l: MarketListing, seller_name: Optional[str], item_name: Optional[str], item_image: Optional[str]) -> dict:
+    json_data = {}
+    if l.item_data_json:
+        try:
+            json_data = json.loads(l.item_data_json)
+        except Exception:
+            pass
+
+    res = {
+        "id": l.id,
+        "seller_id": l.seller_id,
+        "seller_name": seller_name or "Ẩn danh",
+        "item_id": l.item_id,
+        "price": l.price,
+        "currency": l.currency,
+        "amount": l.amount,
+        "item_data_json": l.item_data_json,
+        "item_name": "Vật phẩm lỗi",
+        "item_image": "/assets/items/default.png",
+        "is_charm": False,
+        "is_companion": False
+    }
+
+    if l.item_id == CHARM_ITEM_ID:
+        res.update({
+            "item_name": json_data.get("name", "Charm Lỗi"),
+            "item_image": json_data.get("image_url", "/assets/items/default.png"),
+            "rarity": json_data.get("rarity"),
+            "enhance_level": json_data.get("enhance_level", 0),
+            "is_charm": True
+        })
+    elif l.item_id == COMPANION_ITEM_ID:
+        res.update({
+            "item_name": json_data.get("name", "Thẻ bài ẩn"),
+            "item_image": json_data.get("image", "/assets/card/back.png"),
+            "rarity": json_data.get("rarity"),
+            "star": json_data.get("star", 1),
+            "is_companion": True
+        })
+    else:
+        res.update({"item_name": item_name, "item_image": item_image})
+    return res
+
+
+# =========================================================
+# 3. TRUY VẤN CHỢ (1 query JOIN người bán + vật phẩm)
+# =========================================================
+def _listing_query():
+    return (
+        select(MarketListing, Player.username, Item.name, Item.image_url)
+        .outerjoin(Player, Player.id == MarketListing.seller_id)
+        .outerjoin(Item, Item.id == MarketListing.item_id)
+        # Đồ thường mà Item đã bị xóa (dữ liệu rác) thì bỏ qua
+        .where(or_(MarketListing.item_id.in_(SPECIAL_ITEM_IDS), Item.id != None))
+    )
+
+def list_all_listings(db: Session) -> list:
+    """Toàn bộ chợ, mới nhất trước (cho màn hình Chợ Đen hiện tại)."""
+    rows = db.exec(_listing_query().order_by(MarketListing.id.desc())).all()
+    return [format_listing(*row) for row in rows]
+
+def _parse_cursor(cursor: str, sort: str):
+    """Cursor dạng 'id' (newest) hoặc 'price:id' (sắp theo giá). Sai định dạng -> ValueError."""
+    if sort == "newest":
+        return None, int(cursor)
+    price, last_id = cursor.split(":", 1)
+    return int(price), int(last_id)
+
+def browse_market(
+    db: Session,
+    currency: Optional[str] = None,
+    rarity: Optional[str] = None,
+    kind: Optional[str] = None,
+    min_price: Optional[int] = None,
+    max_price: Optional[int] = None,
+    sort: str = "newest",
+    cursor: Optional[str] = None,
+    limit: int = 30
+) -> dict:
+    """Duyệt chợ có lọc + sắp xếp phía server, phân trang bằng cursor (không OFFSET)."""
+    if sort not in MARKET_SORTS:
+        raise ValueError(f"sort phải là 1 trong {MARKET_SORTS}")
+    if kind and kind not in MARKET_KINDS:
+        raise ValueError(f"kind phải là 1 trong {MARKET_KINDS}")
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+
+    stmt = _listing_query()
+    if currency:
+        stmt = stmt.where(MarketListing.currency == currency)
+    if rarity:
+        stmt = stmt.where(MarketListing.rarity == rarity)
+    if kind == "charm":
+        stmt = stmt.where(MarketListing.item_id == CHARM_ITEM_ID)
+    elif kind == "companion":
+        stmt = stmt.where(MarketListing.item_id == COMPANION_ITEM_ID)
+    elif kind == "item":
+        stmt = stmt.where(MarketListing.item_id.not_in(SPECIAL_ITEM_IDS))
+    if min_price is not None:
+        stmt = stmt.where(MarketListing.price >= min_price)
+    if max_price is not None:
+        stmt = stmt.where(MarketListing.price <= max_price)
+
+    # Cursor = khóa sắp xếp của dòng cuối trang trước
+    if cursor:
+        price, last_id = _parse_cursor(cursor, sort)
+        if sort == "newest":
+            stmt = stmt.where(MarketListing.id < last_id)
+        elif sort == "price_asc":
+            stmt = stmt.where(or_(
+                MarketListing.price > price,
+                and_(MarketListing.price == price, MarketListing.id > last_id)
+            ))
+        else:
+            stmt = stmt.where(or_(
+                MarketListing.price < price,
+                and_(MarketListing.price == price, MarketListing.id < last_id)
+            ))
+
+    if sort == "newest":
+        stmt = stmt.order_by(MarketListing.id.desc())
+    elif sort == "price_asc":
+        stmt = stmt.order_by(MarketListing.price.asc(), MarketListing.id.asc())
+    else:
+        stmt = stmt.order_by(MarketListing.price.desc(), MarketListing.id.desc())
+
+    # Lấy dư 1 dòng để biết còn trang sau không
+    rows = db.exec(stmt.limit(limit + 1)).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+
+    next_cursor = None
+    if has_more:
+        last = rows[-1][0]
+        next_cursor = str(last.id) if sort == "newest" else f"{last.price}:{last.id}"
+
+    return {
+        "items": [format_listing(*row) for row in rows],
+        "next_cursor": next_cursor,
+        "has_more": has_more
+    }
@@ -0,0 +1,181 @@
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, select, func
+from database import engine, MarketListing, MarketTrade, MarketPriceIndex
+from services.market_browse import SPECIAL_ITEM_IDS
+
+# Số giao dịch gần nhất trả về kèm lịch sử giá
+RECENT_TRADES_LIMIT = 50
+
+
+# =========================================================
+# 1. KHÓA BẢNG GIÁ
+# =========================================================
+def price_key(item_id: int, rarity: Optional[str], currency: str):
+    """Đồ thường gom theo item_id; Charm / Thẻ bài gom theo độ hiếm."""
+    rarity = (rarity or "") if item_id in SPECIAL_ITEM_IDS else ""
+    return item_id, rarity, currency
+
+def _unit_price():
+    # Giá 1 cái (đơn đồ thường có thể bán theo lô)
+    return MarketListing.price * 1.0 / func.max(MarketListing.amount, 1)
+
+def _listing_filter(stmt, item_id: int, rarity: str, currency: str):
+    stmt = stmt.where(MarketListing.item_id == item_id, MarketListing.currency == currency)
+    if item_id in SPECIAL_ITEM_IDS:
+        stmt = stmt.where(func.coalesce(MarketListing.rarity, "") == rarity)
+    return stmt
+
+
+# =========================================================
+# 2. CẬP NHẬT (Gọi trong cùng transaction với bán / mua / hủy, chưa commit)
+# =========================================================
+def _upsert_index(db: Session, key: tuple, values: dict, on_conflict: Optional[dict] = None):
+    """
+    1 câu INSERT ... ON CONFLICT(item_id, rarity, currency) DO UPDATE (không đọc rồi mới ghi):
+    2 giao dịch cùng tạo / cộng dồn 1 khóa không vướng unique index, không đè mất lượt của nhau.
+    values: giá trị cho dòng mới; on_conflict: giá trị khi khóa đã có (mặc định = values).
+    """
+    item_id, rarity, currency = key
+    now = datetime.now()
+    stmt = sqlite_insert(MarketPriceIndex).values(
+        item_id=item_id, rarity=rarity, currency=currency, updated_at=now, **values
+    )
+    db.exec(stmt.on_conflict_do_update(
+        index_elements=["item_id", "rarity", "currency"],
+        set_={"updated_at": now, **(values if on_conflict is None else on_conflict)}
+    ))
+
+def refresh_price_index(db: Session, item_id: int, rarity: Optional[str], currency: str):
+    """Tính lại min / median / số đơn của 1 khóa (dùng index item_id + price)."""
+    item_id, rarity, currency = price_key(item_id, rarity, currency)
+    unit = _unit_price()
+
+    count, min_price = db.exec(
+        _listing_filter(select(func.count(MarketListing.id), func.min(unit)), item_id, rarity, currency)
+    ).one()
+    median = None
+    if count:
+        # Trung vị (lệch dưới): bỏ qua (count-1)//2 đơn rẻ nhất
+        median = db.exec(
+            _listing_filter(select(unit), item_id, rarity, currency)
+            .order_by(unit).offset((count - 1) // 2).limit(1)
+        ).first()
+
+    _upsert_index(db, (item_id, rarity, currency), {
+        "listing_count": count, "min_price": min_price, "median_price": median
+    })
+
+def record_trade(db: Session, listing, buyer_id: int):
+    """Ghi 1 giao dịch (listing = dòng vừa giành được khi mua) và cập nhật giá khớp gần nhất."""
+    item_id, rarity, currency = price_key(listing.item_id, listing.rarity, listing.currency)
+    amount = max(listing.amount or 1, 1)
+    unit_price = listing.price / amount
+    now = datetime.now()
+
+    db.add(MarketTrade(
+        listing_id=listing.id, item_id=item_id, rarity=rarity, currency=currency,
+        price=listing.price, amount=amount, unit_price=unit_price,
+        seller_id=listing.seller_id, buyer_id=buyer_id, created_at=now
+    ))
+    last_trade = {"last_trade_price": unit_price, "last_trade_at": now}
+    _upsert_index(db, (item_id, rarity, currency), {"trade_count": 1, **last_trade},
+                  on_conflict={"trade_count": MarketPriceIndex.trade_count + 1, **last_trade})
+    refresh_price_index(db, item_id, rarity, currency)
+
+def ensure_price_index():
+    """Lần đầu chạy: dựng bảng giá từ các đơn đang treo."""
+    with Session(engine) as db:
+        if db.exec(select(MarketPriceIndex.id).limit(1)).first():
+            return
+        keys = db.exec(
+            select(MarketListing.item_id, MarketListing.rarity, MarketListing.currency).distinct()
+        ).all()
+        keys = {price_key(*k) for k in keys}
+        for key in keys:
+            refresh_price_index(db, *key)
+        if keys:
+            db.commit()
+            print(f"📈 Đã dựng bảng giá Chợ Đen cho {len(keys)} mặt hàng.")
+
+
+# =========================================================
+# 3. TRUY VẤN
+# =========================================================
+def _format_index(row: MarketPriceIndex) -> dict:
+    return {
+        "item_id": row.item_id,
+        "rarity": row.rarity or None,
+        "currency": row.currency,
+        "listing_count": row.listing_count,
+        "min_price": row.min_price,
+        "median_price": row.median_price,
+        "last_trade_price": row.last_trade_price,
+        "last_trade_at": row.last_trade_at,
+        "trade_count": row.trade_count,
+    }
+
+def get_price_summary(
+    db: Session,
+    item_id: Optional[int] = None,
+    rarity: Optional[str] = None,
+    currency: Optional[str] = None,
+    only_listed: bool = False
+) -> list:
+    """Bảng giá: tra 'giá thấp nhất' của 1 món / 1 độ hiếm mà không phải tải cả chợ."""
+    stmt = select(MarketPriceIndex)
+    if item_id is not None:
+        stmt = stmt.where(MarketPriceIndex.item_id == item_id)
+    if rarity:
+        stmt = stmt.where(MarketPriceIndex.rarity == rarity)
+    if currency:
+        stmt = stmt.where(MarketPriceIndex.currency == currency)
+    if only_listed:
+        stmt = stmt.where(MarketPriceIndex.listing_count > 0)
+    rows = db.exec(stmt.order_by(MarketPriceIndex.item_id, MarketPriceIndex.rarity, MarketPriceIndex.currency)).all()
+    return [_format_index(r) for r in rows]
+
+def get_price_history(
+    db: Session,
+    item_id: int,
+    currency: str,
+    rarity: Optional[str] = None,
+    days: int = 30
+) -> dict:
+    """Lịch sử giá khớp lệnh: các giao dịch gần nhất + tổng hợp theo ngày (vẽ biểu đồ)."""
+    item_id, rarity, currency = price_key(item_id, rarity, currency)
+    since = datetime.now() - timedelta(days=max(1, days))
+    key_filter = (
+        MarketTrade.item_id == item_id,
+        MarketTrade.rarity == rarity,
+        MarketTrade.currency == currency,
+        MarketTrade.created_at >= since,
+    )
+
+    recent = db.exec(
+        select(MarketTrade).where(*key_filter)
+        .order_by(MarketTrade.created_at.desc()).limit(RECENT_TRADES_LIMIT)
+    ).all()
+
+    day = func.date(MarketTrade.created_at)
+    daily = db.exec(
+        select(
+            day, func.min(MarketTrade.unit_price), func.max(MarketTrade.unit_price),
+            func.avg(MarketTrade.unit_price), func.count(MarketTrade.id), func.sum(MarketTrade.amount)
+        ).where(*key_filter).group_by(day).order_by(day)
+    ).all()
+
+    return {
+        "item_id": item_id,
+        "rarity": rarity or None,
+        "currency": currency,
+        "recent": [
+            {"price": t.price, "amount": t.amount, "unit_price": t.unit_price, "created_at": t.created_at}
+            for t in recent
+        ],
+        "daily": [
+            {"date": d, "min": lo, "max": hi, "avg": round(avg, 2), "trades": n, "volume": vol}
+            for d, lo, hi, avg, n, vol in daily
+        ]
+    }
@@ -0,0 +1,340 @@
+import io
+import re
+import json
+import unicodedata
+from typing import Optional, Iterator, Tuple
+from unidecode import unidecode
+from sqlalchemy import insert, update
+from sqlmodel import Session
+from database import QuestionBank, QuestionTag, QuestionSource
+from services.question_index import question_hash, find_existing_ids, parse_tags, remove_bank_questions
+
+# Số câu hỏi gom lại cho mỗi lần INSERT hàng loạt
+CHUNK_ROWS = 500
+# Số ký tự đọc mỗi lần khi parse JSON kiểu streaming
+CHUNK_CHARS = 64 * 1024
+# Chỉ giữ chi tiết N lỗi / N câu trùng đầu tiên (tránh báo cáo phình to)
+MAX_REPORTED = 200
+
+
+# =========================================================
+# 1. ĐỌC FILE KIỂU STREAMING (Không nạp cả file vào RAM)
+# =========================================================
+def iter_json_array(fp, chunk_size: int = CHUNK_CHARS) -> Iterator[dict]:
+    """Đọc lần lượt từng phần tử của mảng JSON gốc '[{...}, {...}]'."""
+    if isinstance(fp.read(0), bytes):
+        fp = io.TextIOWrapper(fp, encoding="utf-8-sig")
+
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def read_more():
+        nonlocal buf, pos, eof
+        chunk = fp.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip_spaces():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos].isspace():
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            read_more()
+
+    # 1. Mở mảng
+    skip_spaces()
+    if pos >= len(buf):
+        raise ValueError("File JSON rỗng!")
+    if buf[pos] != "[":
+        raise ValueError("JSON phải là một danh sách []!")
+    pos += 1
+
+    # 2. Từng phần tử
+    expect_item = True
+    first = True
+    while True:
+        skip_spaces()
+        if pos >= len(buf):
+            raise ValueError("File JSON bị cắt cụt (thiếu dấu ']')!")
+        ch = buf[pos]
+        if ch == "]" and (first or not expect_item):
+            return
+        if ch == "," and not expect_item:
+            pos += 1
+            expect_item = True
+            continue
+        if not expect_item:
+            raise ValueError(f"JSON lỗi cú pháp gần ký tự '{ch}'")
+
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise ValueError(f"JSON lỗi cú pháp: {e.msg}")
+            read_more()
+            continue
+        # Phần tử chạm cuối bộ đệm -> có thể chưa trọn vẹn, đọc thêm rồi parse lại
+        if end >= len(buf) and not eof:
+            read_more()
+            continue
+
+        yield obj
+        pos = end
+        expect_item = False
+        first = False
+
+
+# Tên cột Excel (đã bỏ dấu, chữ thường) -> key chuẩn
+EXCEL_HEADERS = {
+    "subject": "subject", "mon": "subject", "mon hoc": "subject",
+    "difficulty": "difficulty", "do kho": "difficulty", "muc do": "difficulty",
+    "grade": "grade", "khoi": "grade", "lop": "grade",
+    "content": "content", "question": "content", "cau hoi": "content", "noi dung": "content",
+    "correct": "correct", "answer": "correct", "dap an dung": "correct", "dap an": "correct",
+    "explain": "explain", "explanation": "explain", "giai thich": "explain", "loi giai": "explain",
+    "tags": "tags", "tag": "tags", "topic": "tags", "chu de": "tags",
+}
+
+def _excel_key(header) -> Optional[str]:
+    name = unidecode(str(header or "")).strip().lower()
+    if name in EXCEL_HEADERS:
+        return EXCEL_HEADERS[name]
+    # "A", "Đáp án A", "Phương án B", "Option C"...
+    m = re.fullmatch(r"(?:(?:dap an|phuong an|option|lua chon)\s*)?([abcd])", name)
+    return m.group(1) if m else None
+
+def iter_xlsx_rows(fp) -> Iterator[Tuple[int, dict]]:
+    """Đọc sheet đầu tiên ở chế độ read_only (openpyxl stream từng dòng)."""
+    from openpyxl import load_workbook
+
+    wb = load_workbook(fp, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if not header:
+            return
+        keys = [_excel_key(h) for h in header]
+        for row_no, values in enumerate(rows, start=2):
+            if not values or all(v is None or str(v).strip() == "" for v in values):
+                continue
+            yield row_no, {k: v for k, v in zip(keys, values) if k and v is not None}
+    finally:
+        wb.close()
+
+def iter_question_file(fp, filename: str) -> Iterator[Tuple[int, dict]]:
+    """Chọn bộ đọc theo đuôi file, trả về (số thứ tự dòng, dict thô)."""
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        yield from iter_xlsx_rows(fp)
+    else:
+        for idx, obj in enumerate(iter_json_array(fp), start=1):
+            yield idx, obj
+
+
+# =========================================================
+# 2. CHUẨN HÓA & KIỂM TRA 1 CÂU HỎI
+# =========================================================
+def _clean(value) -> str:
+    return unicodedata.normalize("NFC", str(value if value is not None else "")).strip()
+
+def resolve_answer(correct, options: list) -> str:
+    """
+    Trả về NỘI DUNG đáp án đúng (QuestionBank lưu text, không lưu chữ cái).
+    Nhận: 'b' / 'B.' / 'B)' hoặc chính nội dung đáp án.
+    """
+    raw = _clean(correct)
+    if not raw:
+        raise ValueError("Thiếu đáp án đúng")
+
+    key = raw.lower().rstrip(".)").strip()
+    if key in ("a", "b", "c", "d"):
+        idx = "abcd".index(key)
+        if idx < len(options) and options[idx]:
+            return options[idx]
+        raise ValueError(f"Đáp án '{raw}' trỏ vào phương án trống")
+
+    target = raw.lower().rstrip(".")
+    for opt in options:
+        if opt and opt.lower().rstrip(".") == target:
+            return opt
+    raise ValueError(f"Đáp án '{raw[:40]}' không khớp phương án nào")
+
+def normalize_question(raw: dict, defaults: Optional[dict] = None) -> dict:
+    """
+    Chấp nhận 3 định dạng đang có trong 'data câu hỏi/':
+    - {subject, difficulty, content, a, b, c, d, correct, explain}
+    - {question, options: [...], answer, explanation}
+    - {id, content} (câu luyện gõ, chỉ khi defaults có question_type='statement')
+    """
+    if not isinstance(raw, dict):
+        raise ValueError("Dòng không phải object {}")
+    defaults = defaults or {}
+
+    content = _clean(raw.get("content") or raw.get("question"))
+    if not content:
+        raise ValueError("Thiếu nội dung câu hỏi")
+
+    if defaults.get("question_type") == "statement":
+        return {
+            "subject": _clean(raw.get("subject")) or defaults.get("subject", "Khác"),
+            "difficulty": _clean(raw.get("difficulty")) or defaults.get("difficulty", "easy"),
+            "grade": defaults.get("grade", 6),
+            "content": content,
+            "options_json": "[]",
+            "correct_answer": "",
+            "explanation": "",
+            "content_hash": question_hash(content, []),
+            "question_type": "statement",
+            "tags": parse_tags(raw.get("tags") or raw.get("topic")),
+        }
+
+    if isinstance(raw.get("options"), list):
+        options = [_clean(o) for o in raw["options"]][:4]
+    else:
+        options = [_clean(raw.get(k) or raw.get(k.upper())) for k in "abcd"]
+    while len(options) < 4:
+        options.append("")
+    if sum(1 for o in options if o) < 2:
+        raise ValueError("Cần ít nhất 2 phương án trả lời")
+
+    correct = resolve_answer(raw.get("correct") or raw.get("answer"), options)
+
+    grade = raw.get("grade", defaults.get("grade", 6))
+    try:
+        grade = int(grade)
+    except (TypeError, ValueError):
+        raise ValueError(f"Khối lớp không hợp lệ: {grade}")
+
+    return {
+        "subject": _clean(raw.get("subject")) or defaults.get("subject", "Khác"),
+        "difficulty": _clean(raw.get("difficulty")) or defaults.get("difficulty", "easy"),
+        "grade": grade,
+        "content": content,
+        "options_json": json.dumps(options, ensure_ascii=False),
+        "correct_answer": correct,
+        "explanation": _clean(raw.get("explain") or raw.get("explanation")),
+        "content_hash": question_hash(content, options),
+        "question_type": "mcq",
+        "tags": parse_tags(raw.get("tags") or raw.get("topic")),
+    }
+
+
+# =========================================================
+# 3. NẠP HÀNG LOẠT (1 TRANSACTION, INSERT THEO LÔ)
+# =========================================================
+def import_questions(
+    db: Session,
+    rows: Iterator[Tuple[int, dict]],
+    mode: str = "append",
+    defaults: Optional[dict] = None,
+    chunk_size: int = CHUNK_ROWS,
+    source: Optional[str] = None
+) -> dict:
+    """
+    - Chuẩn hóa + kiểm tra từng dòng, lỗi dòng nào ghi nhận dòng đó (không dừng cả file).
+    - Chống trùng theo content_hash (trong file và trong DB).
+    - mode='replace': gỡ bộ (môn, độ khó) cũ của ngân hàng đề ngay lần đầu gặp trong file.
+    - source: ghi nhận câu hỏi thuộc file nào (kể cả câu trùng đã có sẵn trong DB);
+      câu mới nạp từ file được đánh dấu file_only (không vào đề Tháp / Lôi Đài).
+    - Toàn bộ nằm trong 1 transaction: lỗi hệ thống -> rollback sạch sẽ.
+    """
+    report = {
+        "added": 0,
+        "duplicate_count": 0, "duplicates": [],
+        "error_count": 0, "errors": []
+    }
+    seen_hashes = set()
+    cleared = set()
+    batch = []
+
+    def note(kind: str, row_no: int, detail: str):
+        # kind: "duplicate" (chi tiết = nội dung) hoặc "error" (chi tiết = lý do)
+        report[f"{kind}_count"] += 1
+        if len(report[f"{kind}s"]) < MAX_REPORTED:
+            key = "content" if kind == "duplicate" else "error"
+            report[f"{kind}s"].append({"row": row_no, key: detail})
+
+    def flush():
+        if not batch:
+            return
+        # A. Chế độ thay thế: xóa dữ liệu cũ của (môn, độ khó) lần đầu xuất hiện
+        if mode == "replace":
+            for _, q, _ in batch:
+                combo = (q["subject"], q["difficulty"])
+                if combo in cleared:
+                    continue
+                cleared.add(combo)
+                # Chỉ thay câu của ngân hàng đề; câu Boss / minigame nạp từ file giữ nguyên
+                remove_bank_questions(db, QuestionBank.subject == combo[0], QuestionBank.difficulty == combo[1])
+
+        # B. Lọc câu đã có trong DB (1 query cho cả lô)
+        existing = find_existing_ids(db, [q["content_hash"] for _, q, _ in batch])
+        fresh = []
+        source_rows = []
+        claimed = []
+        for row_no, q, position in batch:
+            if q["content_hash"] in existing:
+                note("duplicate", row_no, q["content"][:80])
+                if source:
+                    source_rows.append({"question_id": existing[q["content_hash"]], "source": source, "position": position})
+                else:
+                    claimed.append(existing[q["content_hash"]])
+            else:
+                fresh.append((q, position))
+        batch.clear()
+        # Admin nạp lại câu vốn chỉ có trong file -> câu đó thành câu của ngân hàng đề
+        if claimed:
+            db.exec(update(QuestionBank).where(QuestionBank.id.in_(claimed)).values(file_only=False))
+        if not fresh:
+            if source_rows:
+                db.execute(insert(QuestionSource), source_rows)
+            return
+
+        # C. INSERT hàng loạt, lấy lại id để gắn tag
+        inserted = db.execute(
+            insert(QuestionBank).returning(QuestionBank.id, QuestionBank.content_hash, sort_by_parameter_order=True),
+            [{**{k: v for k, v in q.items() if k != "tags"}, "file_only": bool(source)} for q, _ in fresh]
+        ).all()
+        tags_by_hash = {q["content_hash"]: q["tags"] for q, _ in fresh}
+        tag_rows = [
+            {"question_id": qid, "tag": tag}
+            for qid, q_hash in inserted for tag in tags_by_hash.get(q_hash, [])
+        ]
+        if tag_rows:
+            db.execute(insert(QuestionTag), tag_rows)
+        if source:
+            position_by_hash = {q["content_hash"]: position for q, position in fresh}
+            source_rows += [
+                {"question_id": qid, "source": source, "position": position_by_hash[q_hash]}
+                for qid, q_hash in inserted
+            ]
+        if source_rows:
+            db.execute(insert(QuestionSource), source_rows)
+        report["added"] += len(inserted)
+
+    try:
+        for position, (row_no, raw) in enumerate(rows):
+            try:
+                q = normalize_question(raw, defaults)
+            except ValueError as e:
+                note("error", row_no, str(e))
+                continue
+
+            if q["content_hash"] in seen_hashes:
+                note("duplicate", row_no, q["content"][:80])
+                continue
+            seen_hashes.add(q["content_hash"])
+
+            batch.append((row_no, q, position))
+            if len(batch) >= chunk_size:
+                flush()
+        flush()
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    return report
@@ -0,0 +1,244 @@
+import re
+import json
+import random
+import hashlib
+from typing import Optional, List
+from unidecode import unidecode
+from sqlalchemy import text, table, column, update
+from sqlalchemy.exc import OperationalError
+from sqlmodel import Session, select, func, delete
+from database import engine, QuestionBank, QuestionTag, QuestionSource
+
+# Bảng FTS5 "ngoài" (external content) trỏ vào questionbank -> không nhân đôi dữ liệu
+FTS_TABLE = "questionbank_fts"
+fts_table = table(FTS_TABLE, column("rowid"), column("rank"))
+
+# False nếu bản SQLite không hỗ trợ FTS5 -> tìm kiếm lùi về LIKE
+FTS_ENABLED = True
+
+
+# =========================================================
+# 1. KHỞI TẠO INDEX (Chạy 1 lần lúc bật server)
+# =========================================================
+def ensure_question_index():
+    """
+    - Tạo bảng FTS5 + trigger đồng bộ với questionbank (nếu chưa có).
+    - Bổ sung content_hash cho các câu hỏi cũ chưa có dấu vân tay.
+    """
+    global FTS_ENABLED
+    try:
+        with engine.begin() as conn:
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (FTS_TABLE,)
+            ).first()
+            if not exists:
+                conn.exec_driver_sql(f"""
+                    CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5(
+                        content, explanation,
+                        content='questionbank', content_rowid='id',
+                        tokenize='unicode61 remove_diacritics 2'
+                    )
+                """)
+                conn.exec_driver_sql(f"""
+                    CREATE TRIGGER IF NOT EXISTS questionbank_fts_ai AFTER INSERT ON questionbank BEGIN
+                        INSERT INTO {FTS_TABLE}(rowid, content, explanation) VALUES (new.id, new.content, new.explanation);
+                    END
+                """)
+                conn.exec_driver_sql(f"""
+                    CREATE TRIGGER IF NOT EXISTS questionbank_fts_ad AFTER DELETE ON questionbank BEGIN
+                        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content, explanation) VALUES ('delete', old.id, old.content, old.explanation);
+                    END
+                """)
+                conn.exec_driver_sql(f"""
+                    CREATE TRIGGER IF NOT EXISTS questionbank_fts_au AFTER UPDATE ON questionbank BEGIN
+                        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content, explanation) VALUES ('delete', old.id, old.content, old.explanation);
+                        INSERT INTO {FTS_TABLE}(rowid, content, explanation) VALUES (new.id, new.content, new.explanation);
+                    END
+                """)
+                # Nạp toàn bộ câu hỏi đang có vào index
+                conn.exec_driver_sql(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+                print("🔎 Đã tạo chỉ mục tìm kiếm FTS5 cho ngân hàng câu hỏi.")
+    except OperationalError as e:
+        FTS_ENABLED = False
+        print(f"⚠️ SQLite không hỗ trợ FTS5, tìm kiếm dùng LIKE: {e}")
+
+    # Bổ sung dấu vân tay cho câu hỏi cũ
+    with Session(engine) as db:
+        missing = db.exec(select(QuestionBank).where(QuestionBank.content_hash == None)).all()
+        for q in missing:
+            q.content_hash = question_hash(q.content, parse_options(q.options_json))
+            db.add(q)
+        if missing:
+            db.commit()
+            print(f"🧬 Đã tạo content_hash cho {len(missing)} câu hỏi cũ.")
+
+
+# =========================================================
+# 2. TIỆN ÍCH CHUẨN HÓA
+# =========================================================
+def _normalize(value) -> str:
+    return re.sub(r"\s+", " ", str(value or "")).strip().lower()
+
+def parse_options(options_json) -> list:
+    try:
+        options = json.loads(options_json) if isinstance(options_json, str) else options_json
+        return options if isinstance(options, list) else []
+    except Exception:
+        return []
+
+def question_hash(content: str, options: list) -> str:
+    """Dấu vân tay câu hỏi: nội dung + tập đáp án (không phụ thuộc thứ tự A/B/C/D)."""
+    opts = sorted(_normalize(o) for o in (options or []))
+    raw = _normalize(content) + "|" + "|".join(opts)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def normalize_tag(tag: str) -> str:
+    """'Phân số' -> 'phan-so'"""
+    return re.sub(r"\s+", "-", unidecode(str(tag)).strip().lower())
+
+def parse_tags(raw) -> List[str]:
+    """Nhận list hoặc chuỗi 'a, b, c' (key 'tags' hoặc 'topic' trong file JSON)."""
+    if not raw:
+        return []
+    if isinstance(raw, str):
+        raw = raw.split(",")
+    tags = [normalize_tag(t) for t in raw if str(t).strip()]
+    return list(dict.fromkeys(tags))
+
+def _fts_query(q: str) -> str:
+    # Mỗi từ thành 1 cụm tìm tiền tố: "phuong"* "trinh"*
+    tokens = re.findall(r"\w+", q)
+    return " ".join(f'"{t}"*' for t in tokens)
+
+
+# =========================================================
+# 3. CHỐNG TRÙNG & GẮN TAG
+# =========================================================
+def find_existing_ids(db: Session, hashes) -> dict:
+    """content_hash -> id của các câu đã có trong DB"""
+    hashes = list(set(hashes))
+    found = {}
+    # Chia nhỏ để không vượt giới hạn tham số của SQLite
+    for i in range(0, len(hashes), 500):
+        chunk = hashes[i:i + 500]
+        rows = db.exec(select(QuestionBank.content_hash, QuestionBank.id).where(QuestionBank.content_hash.in_(chunk))).all()
+        found.update({h: qid for h, qid in rows})
+    return found
+
+def remove_bank_questions(db: Session, *conditions) -> int:
+    """
+    Gỡ các câu của ngân hàng đề khớp điều kiện (chưa commit), không đụng câu chỉ có trong file.
+    Câu còn nằm trong file 'data câu hỏi' chỉ chuyển thành file_only (Boss / minigame vẫn dùng),
+    còn lại xóa hẳn kèm tag. Trả về số câu đã gỡ.
+    """
+    bank = (QuestionBank.file_only == False, *conditions)
+    demoted = db.exec(
+        update(QuestionBank)
+        .where(*bank, QuestionBank.id.in_(select(QuestionSource.question_id)))
+        .values(file_only=True)
+    ).rowcount
+    old_ids = select(QuestionBank.id).where(*bank)
+    db.exec(delete(QuestionTag).where(QuestionTag.question_id.in_(old_ids)))
+    return demoted + db.exec(delete(QuestionBank).where(*bank)).rowcount
+
+def set_question_tags(db: Session, question_id: int, tags: List[str]):
+    """Ghi đè danh sách tag của 1 câu hỏi (chưa commit)."""
+    db.exec(delete(QuestionTag).where(QuestionTag.question_id == question_id))
+    for tag in parse_tags(tags):
+        db.add(QuestionTag(question_id=question_id, tag=tag))
+
+def get_tag_counts(db: Session) -> dict:
+    rows = db.exec(
+        select(QuestionTag.tag, func.count(QuestionTag.id)).group_by(QuestionTag.tag).order_by(QuestionTag.tag)
+    ).all()
+    return {tag: count for tag, count in rows}
+
+
+# =========================================================
+# 4. TÌM KIẾM & BỐC ĐỀ
+# =========================================================
+def search_questions(
+    db: Session,
+    q: Optional[str] = None,
+    subject: Optional[str] = None,
+    difficulty: Optional[str] = None,
+    grade: Optional[int] = None,
+    tag: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 20
+):
+    """Tìm kiếm có phân trang cho trang Admin (FTS5 + lọc theo cột có index)."""
+    page = max(1, page)
+    page_size = max(1, min(page_size, 100))
+
+    # Trang Admin chỉ quản lý ngân hàng đề (câu chỉ có trong file do thư mục 'data câu hỏi' quản lý)
+    stmt = select(QuestionBank).where(QuestionBank.file_only == False)
+    if subject:
+        stmt = stmt.where(QuestionBank.subject == subject)
+    if difficulty:
+        stmt = stmt.where(QuestionBank.difficulty == difficulty)
+    if grade is not None:
+        stmt = stmt.where(QuestionBank.grade == grade)
+    if tag:
+        stmt = stmt.where(QuestionBank.id.in_(
+            select(QuestionTag.question_id).where(QuestionTag.tag == normalize_tag(tag))
+        ))
+
+    order = [QuestionBank.id.desc()]
+    if q and q.strip():
+        if FTS_ENABLED and _fts_query(q):
+            stmt = (
+                stmt.join(fts_table, fts_table.c.rowid == QuestionBank.id)
+                .where(text(f"{FTS_TABLE} MATCH :fts_q").bindparams(fts_q=_fts_query(q)))
+            )
+            order = [fts_table.c.rank, QuestionBank.id.desc()]
+        else:
+            like = f"%{q.strip()}%"
+            stmt = stmt.where((QuestionBank.content.like(like)) | (QuestionBank.explanation.like(like)))
+
+    total = db.exec(select(func.count()).select_from(stmt.subquery())).one()
+    rows = db.exec(stmt.order_by(*order).offset((page - 1) * page_size).limit(page_size)).all()
+
+    # Lấy tag cho các câu trong trang (1 query)
+    ids = [r.id for r in rows]
+    tags_by_q = {}
+    if ids:
+        for qid, t in db.exec(select(QuestionTag.question_id, QuestionTag.tag).where(QuestionTag.question_id.in_(ids))).all():
+            tags_by_q.setdefault(qid, []).append(t)
+
+    items = [{
+        "id": r.id,
+        "subject": r.subject,
+        "difficulty": r.difficulty,
+        "grade": r.grade,
+        "content": r.content,
+        "options": parse_options(r.options_json),
+        "correct_answer": r.correct_answer,
+        "explanation": r.explanation,
+        "tags": tags_by_q.get(r.id, [])
+    } for r in rows]
+
+    return {"total": total, "page": page, "page_size": page_size, "items": items}
+
+def pick_question_ids_by_tags(
+    db: Session,
+    tags: List[str],
+    k: int,
+    subject: Optional[str] = None,
+    difficulty: Optional[str] = None
+) -> List[int]:
+    """Bốc ngẫu nhiên k id câu hỏi thuộc các tag cho trước (chỉ tra index tag -> id)."""
+    tags = parse_tags(tags)
+    if not tags:
+        return []
+
+    stmt = select(QuestionTag.question_id).where(QuestionTag.tag.in_(tags)).distinct()
+    if subject or difficulty:
+        stmt = stmt.join(QuestionBank, QuestionBank.id == QuestionTag.question_id)
+        if subject:
+            stmt = stmt.where(QuestionBank.subject == subject)
+        if difficulty:
+            stmt = stmt.where(QuestionBank.difficulty == difficulty)
+
+    ids = db.exec(stmt).all()
+    return random.sample(ids, min(k, len(ids)))
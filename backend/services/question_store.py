@@ -0,0 +1,278 @@
+import os
+import json
+import random
+import threading
+from typing import Optional, List
+from sqlalchemy import update
+from sqlmodel import Session, select, delete
+from database import engine, QuestionBank, QuestionSource, SystemConfig
+from services.question_index import parse_options
+from services.question_importer import import_questions, iter_question_file
+
+# Thư mục gốc chứa các bộ câu hỏi JSON (boss, minigame chiến dịch...)
+QUESTION_DATA_DIR = os.path.normpath(
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "..", "data câu hỏi")
+)
+# Nhãn mặc định theo thư mục (câu trong file không ghi môn / độ khó / loại câu).
+# Thư mục con thừa hưởng nhãn của thư mục cha gần nhất (VD: "chien dich/chieu binh/hide")
+FOLDER_DEFAULTS = {
+    "toan": {"subject": "Toán"},
+    "ly": {"subject": "Vật lý"},
+    "hoa": {"subject": "Hóa học"},
+    "sinh": {"subject": "Sinh học"},
+    "van": {"subject": "Ngữ Văn"},
+    "chien dich/chieu binh": {"subject": "Chiến dịch", "difficulty": "chieu binh"},
+    # Câu luyện gõ (không có đáp án)
+    "chien dich/luyen binh": {"subject": "Chiến dịch", "difficulty": "luyen binh", "question_type": "statement"},
+}
+# Độ khó đoán từ tên file khi thư mục không quy định (thứ tự = ưu tiên)
+DIFFICULTY_HINTS = (
+    ("hell", "hell"), ("extreme", "extreme"), ("hard", "hard"), ("kho", "hard"),
+    ("medium", "medium"), ("vua", "medium"), ("easy", "easy"), ("de", "easy"),
+)
+# Nhãn cũ normalize_question gán khi file không ghi môn / độ khó
+FALLBACK_LABELS = ("Khác", "easy")
+# Key trong SystemConfig lưu mtime của các file đã nạp (v2: nạp lại để sửa nhãn theo thư mục)
+SOURCES_CONFIG_KEY = "question_sources_v2"
+# Khóa đánh dấu đã tách câu hỏi chỉ có trong file khỏi đề mặc định
+MIGRATION_KEY = "migration_question_file_only_v1"
+
+
+class QuestionStore:
+    """
+    Kho câu hỏi hợp nhất (nằm trong RAM) cho Boss, Tháp, Lôi Đài và minigame Chiến dịch.
+    - Nạp QuestionBank + QuestionSource 1 lần, sau đó chỉ đọc RAM.
+    - Mỗi bộ lọc (môn, độ khó, file...) được nhớ sẵn danh sách id -> bốc k câu là O(k).
+    - Admin nạp/xóa câu hỏi -> gọi invalidate() để nạp lại lần sau.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}       # id -> dict câu hỏi
+        self._sources = {}    # "sinh/sinh-hard-boss.json" -> [id theo thứ tự trong file]
+        self._pools = {}      # bộ lọc -> [id]
+        self._loaded = False
+        self.version = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._rows, self._sources, self._pools = {}, {}, {}
+            self._loaded = False
+            self.version += 1
+
+    def ensure_loaded(self, db: Session):
+        if self._loaded:
+            return
+        rows = {}
+        for q in db.exec(select(QuestionBank)).all():
+            rows[q.id] = {
+                "id": q.id,
+                "subject": q.subject,
+                "difficulty": q.difficulty,
+                "grade": q.grade,
+                "content": q.content,
+                "options": parse_options(q.options_json),
+                "correct_answer": q.correct_answer,
+                "explanation": q.explanation or "",
+                "question_type": q.question_type or "mcq",
+                "file_only": bool(q.file_only),
+            }
+        sources = {}
+        links = db.exec(select(QuestionSource).order_by(QuestionSource.source, QuestionSource.position)).all()
+        for link in links:
+            if link.question_id in rows:
+                sources.setdefault(link.source, []).append(link.question_id)
+
+        with self._lock:
+            if self._loaded:
+                return
+            self._rows, self._sources, self._pools = rows, sources, {}
+            self._loaded = True
+
+    # --- 1. TRUY VẤN ---
+
+    def get(self, db: Session, question_id) -> Optional[dict]:
+        self.ensure_loaded(db)
+        try:
+            return self._rows.get(int(question_id))
+        except (TypeError, ValueError):
+            return None
+
+    def sources(self, db: Session, folder: str = "") -> List[str]:
+        """Các file nằm TRỰC TIẾP trong thư mục (không tính thư mục con như 'hide/')."""
+        self.ensure_loaded(db)
+        prefix = f"{folder.strip('/')}/" if folder else ""
+        return sorted(
+            s for s in self._sources
+            if s.startswith(prefix) and "/" not in s[len(prefix):]
+        )
+
+    def source_questions(self, db: Session, source: str) -> List[dict]:
+        self.ensure_loaded(db)
+        return [self._rows[qid] for qid in self._sources.get(source, [])]
+
+    def _pool(self, subject, difficulty, grade, sources, question_type) -> list:
+        key = (subject, difficulty, grade, sources, question_type)
+        pool = self._pools.get(key)
+        if pool is not None:
+            return pool
+
+        if sources is not None:
+            candidate_ids = list(dict.fromkeys(qid for s in sources for qid in self._sources.get(s, [])))
+        else:
+            # Đề mặc định (Tháp, Lôi Đài) chỉ lấy ngân hàng đề; câu Boss / minigame phải xin đúng file
+            candidate_ids = [qid for qid, q in self._rows.items() if not q["file_only"]]
+
+        pool = []
+        for qid in candidate_ids:
+            q = self._rows[qid]
+            if question_type and q["question_type"] != question_type:
+                continue
+            if subject and str(q["subject"]).lower() != subject:
+                continue
+            if difficulty and str(q["difficulty"]).lower() != difficulty:
+                continue
+            if grade is not None and q["grade"] != grade:
+                continue
+            pool.append(qid)
+
+        with self._lock:
+            self._pools[key] = pool
+        return pool
+
+    def sample(
+        self,
+        db: Session,
+        k: int,
+        subject: Optional[str] = None,
+        difficulty: Optional[str] = None,
+        grade: Optional[int] = None,
+        sources: Optional[List[str]] = None,
+        question_type: Optional[str] = "mcq"
+    ) -> List[dict]:
+        """Bốc ngẫu nhiên tối đa k câu (không trùng) theo bộ lọc. sources=None: không gồm câu chỉ có trong file."""
+        self.ensure_loaded(db)
+        pool = self._pool(
+            subject.lower() if subject else None,
+            difficulty.lower() if difficulty else None,
+            grade,
+            tuple(sources) if sources is not None else None,
+            question_type
+        )
+        return [self._rows[qid] for qid in random.sample(pool, min(k, len(pool)))]
+
+
+question_store = QuestionStore()
+
+
+# =========================================================
+# NẠP CÁC FILE JSON TRONG 'data câu hỏi' VÀO KHO
+# =========================================================
+def folder_defaults(source: str) -> dict:
+    """Nhãn mặc định cho 1 file: theo thư mục gần nhất trong FOLDER_DEFAULTS, độ khó đoán theo tên file."""
+    folder = os.path.dirname(source)
+    defaults = {}
+    while True:
+        if folder in FOLDER_DEFAULTS:
+            defaults = dict(FOLDER_DEFAULTS[folder])
+            break
+        if not folder:
+            break
+        folder = os.path.dirname(folder)
+
+    if "difficulty" not in defaults:
+        words = os.path.splitext(os.path.basename(source))[0].lower().replace("_", "-").split("-")
+        for hint, difficulty in DIFFICULTY_HINTS:
+            if hint in words:
+                defaults["difficulty"] = difficulty
+                break
+    return defaults
+
+def _relabel_fallback(db: Session, source: str, defaults: dict):
+    """Câu đã nạp từ file trước đây mang nhãn dự phòng ('Khác', 'easy') -> gắn lại nhãn theo thư mục."""
+    labels = {k: defaults[k] for k in ("subject", "difficulty") if k in defaults}
+    if not labels:
+        return
+    linked = select(QuestionSource.question_id).where(QuestionSource.source == source)
+    db.exec(
+        update(QuestionBank)
+        .where(
+            QuestionBank.id.in_(linked),
+            QuestionBank.file_only == True,
+            QuestionBank.subject == FALLBACK_LABELS[0],
+            QuestionBank.difficulty == FALLBACK_LABELS[1],
+        )
+        .values(labels)
+    )
+
+def sync_question_files(db: Session, force: bool = False) -> dict:
+    """
+    Quét 'data câu hỏi' và nạp các file mới / đã sửa (so theo mtime) vào QuestionBank.
+    Mỗi file = 1 source; nạp lại 1 file thì liên kết cũ của file đó được thay mới.
+    """
+    if not os.path.isdir(QUESTION_DATA_DIR):
+        return {}
+
+    config = db.get(SystemConfig, SOURCES_CONFIG_KEY)
+    known = json.loads(config.value) if config and config.value else {}
+
+    results = {}
+    seen = set()
+    for root, dirs, files in os.walk(QUESTION_DATA_DIR):
+        dirs.sort()
+        for name in sorted(files):
+            if not name.lower().endswith(".json"):
+                continue
+            path = os.path.join(root, name)
+            source = os.path.relpath(path, QUESTION_DATA_DIR).replace(os.sep, "/")
+            seen.add(source)
+            mtime = os.path.getmtime(path)
+            if not force and known.get(source) == mtime:
+                continue
+
+            defaults = folder_defaults(source)
+            db.exec(delete(QuestionSource).where(QuestionSource.source == source))
+            try:
+                with open(path, "rb") as f:
+                    results[source] = import_questions(
+                        db, iter_question_file(f, name), defaults=defaults, source=source
+                    )
+                _relabel_fallback(db, source, defaults)
+                known[source] = mtime
+            except ValueError as e:
+                results[source] = {"added": 0, "error_count": 1, "errors": [{"row": 0, "error": str(e)}]}
+
+    # File đã bị xóa khỏi ổ đĩa -> gỡ liên kết
+    for source in set(known) - seen:
+        db.exec(delete(QuestionSource).where(QuestionSource.source == source))
+        known.pop(source, None)
+
+    if config is None:
+        config = SystemConfig(key=SOURCES_CONFIG_KEY, value="{}")
+    config.value = json.dumps(known, ensure_ascii=False)
+    db.add(config)
+    db.commit()
+
+    if results:
+        question_store.invalidate()
+        print(f"📚 Đã đồng bộ {len(results)} file câu hỏi vào kho chung.")
+    return results
+
+def mark_file_only_questions(db: Session):
+    """
+    Chuyển đổi 1 lần: câu đã nạp từ file trước khi có cột file_only -> đánh dấu file_only.
+    Câu admin nạp trùng với file cũng bị tách ra; admin nạp lại file đó thì câu trở về ngân hàng đề.
+    """
+    if db.get(SystemConfig, MIGRATION_KEY):
+        return
+    linked = select(QuestionSource.question_id)
+    result = db.exec(update(QuestionBank).where(QuestionBank.id.in_(linked)).values(file_only=True))
+    db.exec(update(QuestionBank).where(QuestionBank.file_only == None).values(file_only=False))
+    db.add(SystemConfig(key=MIGRATION_KEY, value=str(result.rowcount)))
+    db.commit()
+    if result.rowcount:
+        print(f"📚 Đã tách {result.rowcount} câu hỏi chỉ có trong file khỏi đề Tháp / Lôi Đài")
+
+def sync_question_files_on_startup():
+    with Session(engine) as db:
+        mark_file_only_questions(db)
+        sync_question_files(db)
@@ -0,0 +1,111 @@
+import json
+import hashlib
+import threading
+from datetime import datetime
+from typing import Optional
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlmodel import Session, select
+from database import ShopPurchaseCounter
+from services.static_registry import registry
+
+# limit_type của Item -> (Tên kỳ, Số lượt tối đa mỗi kỳ)
+#   0: Không giới hạn | 1: Mua 1 lần duy nhất | 2: Mỗi tháng 1 lần
+LIMIT_RULES = {
+    1: ("lifetime", 1),
+    2: ("monthly", 1),
+}
+LIMIT_MESSAGES = {
+    "lifetime": "Bạn đã mua vật phẩm này rồi (giới hạn 1 lần duy nhất)!",
+    "monthly": "Tháng này bạn đã mua vật phẩm này rồi (giới hạn mỗi tháng 1 lần)!",
+}
+
+
+class ShopCatalog:
+    """
+    Danh mục Shop dựng sẵn từ kho dữ liệu tĩnh (registry nhóm "items").
+    - items(): danh sách hiển thị cho học sinh (đã lọc đồ ẩn) + ETag để trả 304.
+    - all_items(): toàn bộ bảng Item cho trang Admin.
+    - Admin sửa vật phẩm -> registry.invalidate("items") -> version đổi -> tự dựng lại.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None   # (version, etag, payload công khai, toàn bộ Item)
+
+    def _build(self, db: Session, version: int):
+        all_items = [entry.to_dict() for entry in registry.items(db).values()]
+
+        shop_items = []
+        for item in all_items:
+            if item["is_hidden"]:
+                continue
+            shop_items.append({
+                "id": item["id"],
+                "name": item["name"],
+                "description": item["description"],
+                "icon": item["image_url"] if item["image_url"] else "default.png",
+                "price": item["price"],
+                "currency": item["currency_type"],  # tri_thuc, vinh_du, chien_tich
+                "limit_type": item["limit_type"] or 0,
+            })
+        public = {"status": "success", "items": shop_items}
+
+        # ETag theo nội dung -> khởi động lại server mà Shop không đổi thì trình duyệt vẫn dùng cache
+        digest = hashlib.sha1(json.dumps(public, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()
+        return version, f'"shop-{digest[:16]}"', public, all_items
+
+    def _get(self, db: Session):
+        version = registry.version("items")
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] == version:
+            return snapshot
+        snapshot = self._build(db, version)
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def items(self, db: Session):
+        """Trả về (etag, payload) của Shop công khai."""
+        _, etag, public, _ = self._get(db)
+        return etag, public
+
+    def all_items(self, db: Session) -> list:
+        return self._get(db)[3]
+
+
+shop_catalog = ShopCatalog()
+
+
+# =========================================================
+# GIỚI HẠN LƯỢT MUA (Gọi trong transaction mua hàng, chưa commit)
+# =========================================================
+def limit_period(limit_type: int, now: Optional[datetime] = None) -> Optional[str]:
+    rule = LIMIT_RULES.get(limit_type or 0)
+    if not rule:
+        return None
+    now = now or datetime.now()
+    return "" if rule[0] == "lifetime" else now.strftime("%Y-%m")
+
+def claim_purchase(db: Session, player_id: int, item) -> Optional[str]:
+    """
+    Giữ 1 lượt mua theo limit_type bằng 1 câu UPSERT có điều kiện (count < giới hạn).
+    Trả về None nếu được mua, hoặc thông báo lỗi nếu đã hết lượt.
+    """
+    rule = LIMIT_RULES.get(item.limit_type or 0)
+    if not rule:
+        return None
+    name, max_count = rule
+    period = limit_period(item.limit_type)
+    now = datetime.now()
+
+    stmt = sqlite_insert(ShopPurchaseCounter).values(
+        player_id=player_id, item_id=item.id, period=period, count=1, updated_at=now
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=["player_id", "item_id", "period"],
+        set_={"count": ShopPurchaseCounter.count + 1, "updated_at": now},
+        where=ShopPurchaseCounter.count < max_count
+    ).returning(ShopPurchaseCounter.count)
+
+    if db.exec(stmt).first() is None:
+        return LIMIT_MESSAGES[name]
+    return None
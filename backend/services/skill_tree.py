@@ -0,0 +1,164 @@
+import json
+import threading
+from typing import Dict, List, Optional
+from sqlalchemy import insert, update
+from sqlmodel import Session, select
+from database import engine, Player, PlayerSkill, SystemConfig
+from services.static_registry import registry
+
+# Cấp tối đa của 1 kỹ năng (độ dài đường cong giá / sức mạnh dựng sẵn)
+MAX_SKILL_LEVEL = 10
+# Khóa đánh dấu đã chuyển Player.skills_data sang bảng PlayerSkill (lưu trong SystemConfig)
+MIGRATION_KEY = "migration_player_skill_v1"
+
+
+def _number(config: dict, key: str, default: float) -> float:
+    try:
+        return float(config.get(key, default))
+    except (TypeError, ValueError):
+        return default
+
+def compile_skill(entry) -> dict:
+    """1 SkillTemplate -> nút cây đã tính sẵn giá học / giá lên cấp và hệ số sức mạnh theo cấp."""
+    config = entry.config_dict or {}
+    base_cost = int(_number(config, "base_cost", 0))
+    base_mult = _number(config, "base_mult", 1.0)
+    scaling = _number(config, "scaling", 0.0)
+    # "scaling" là hệ số nhân mỗi cấp (VD 1.2 = +20%/cấp); <= 1 thì giữ nguyên giá trị gốc
+    growth = [scaling ** (lv - 1) if scaling > 1 else 1.0 for lv in range(1, MAX_SKILL_LEVEL + 1)]
+    return {
+        "skill_id": entry.skill_id,
+        "class_type": entry.class_type,
+        "skill_type": entry.skill_type,
+        "min_level": entry.min_level or 1,
+        "prerequisite_id": entry.prerequisite_id or None,
+        "currency": config.get("currency") or "tri_thuc",
+        "cost": base_cost,
+        # Phần tử thứ L-1 = giá trị ở cấp L: base x scaling^(L-1)
+        "cost_curve": [int(base_cost * g) for g in growth],
+        "mult_curve": [round(base_mult * g, 4) for g in growth],
+        "children": [],
+        "depth": 0,
+    }
+
+
+class SkillTree:
+    """
+    Cây kỹ năng dựng sẵn từ registry (nhóm "skills"):
+    - Mỗi nút: điều kiện học (cấp, skill cha), giá và đường cong sức mạnh đã tính sẵn.
+    - Danh sách skill theo Class (kèm skill COMMON) dựng 1 lần, trả thẳng cho /api/skills/get-all.
+    - Admin sửa skill -> registry.invalidate("skills") -> version đổi -> tự dựng lại.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._snapshot = None   # (version, {skill_id: nút}, {class_type: [dict skill]})
+
+    def _build(self, db: Session, version: int):
+        entries = registry.skills(db)
+        nodes = {skill_id: compile_skill(entry) for skill_id, entry in entries.items()}
+        for node in nodes.values():
+            parent = nodes.get(node["prerequisite_id"])
+            if parent:
+                parent["children"].append(node["skill_id"])
+
+        # Độ sâu trong cây (skill gốc = 0); vòng lặp cha-con do nhập sai thì dừng ở số nút
+        for node in nodes.values():
+            depth, parent_id = 0, node["prerequisite_id"]
+            while parent_id in nodes and depth < len(nodes):
+                depth += 1
+                parent_id = nodes[parent_id]["prerequisite_id"]
+            node["depth"] = depth
+
+        by_class = {}
+        for class_type in {e.class_type for e in entries.values()} | {None}:
+            by_class[class_type] = [
+                {**e.to_dict(), "cost": nodes[e.skill_id]["cost"], "depth": nodes[e.skill_id]["depth"]}
+                for e in entries.values() if e.class_type in (class_type, "COMMON")
+            ]
+        return version, nodes, by_class
+
+    def _get(self, db: Session):
+        version = registry.version("skills")
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] == version:
+            return snapshot
+        snapshot = self._build(db, version)
+        with self._lock:
+            self._snapshot = snapshot
+        return snapshot
+
+    def node(self, db: Session, skill_id: str) -> Optional[dict]:
+        return self._get(db)[1].get(skill_id)
+
+    def for_class(self, db: Session, class_type: Optional[str]) -> List[dict]:
+        """Skill đúng Class hoặc skill Chung (COMMON) - danh sách dựng sẵn."""
+        by_class = self._get(db)[2]
+        if class_type not in by_class:
+            # Class chưa có skill riêng -> chỉ skill COMMON
+            return by_class[None]
+        return by_class[class_type]
+
+
+skill_tree = SkillTree()
+
+
+# =========================================================
+# KỸ NĂNG CỦA NGƯỜI CHƠI (bảng PlayerSkill, index (player_id, skill_id))
+# =========================================================
+def learned_skills(db: Session, player_id: int) -> Dict[str, int]:
+    """{skill_id: cấp} - cùng dạng với skills_data cũ mà Frontend đang đọc."""
+    return dict(db.exec(
+        select(PlayerSkill.skill_id, PlayerSkill.level).where(PlayerSkill.player_id == player_id)
+    ).all())
+
+def has_skill(db: Session, player_id: int, skill_id: str) -> bool:
+    return db.exec(
+        select(PlayerSkill.id).where(PlayerSkill.player_id == player_id, PlayerSkill.skill_id == skill_id)
+    ).first() is not None
+
+def set_equipped(db: Session, player_id: int, skill_id: Optional[str]):
+    """Đánh dấu is_equipped cho đúng 1 skill (None = gỡ hết). Không commit."""
+    db.exec(
+        update(PlayerSkill)
+        .where(PlayerSkill.player_id == player_id)
+        .values(is_equipped=(PlayerSkill.skill_id == skill_id) if skill_id else False)
+    )
+
+
+# =========================================================
+# CHUYỂN ĐỔI 1 LẦN: Player.skills_data (JSON) -> PlayerSkill
+# =========================================================
+def migrate_skills_data():
+    """Lúc bật server (chỉ chạy 1 lần): tách JSON skills_data của mọi người chơi thành dòng PlayerSkill."""
+    with Session(engine) as db:
+        if db.get(SystemConfig, MIGRATION_KEY):
+            return
+
+        existing = set(db.exec(select(PlayerSkill.player_id, PlayerSkill.skill_id)).all())
+        rows = []
+        for player_id, skills_data, equipped in db.exec(
+            select(Player.id, Player.skills_data, Player.equipped_skill)
+            .where(Player.skills_data != None, Player.skills_data != "{}", Player.skills_data != "")
+        ).all():
+            try:
+                learned = json.loads(skills_data)
+            except Exception:
+                continue
+            if not isinstance(learned, dict):
+                continue
+            for skill_id, level in learned.items():
+                if (player_id, skill_id) in existing:
+                    continue
+                existing.add((player_id, skill_id))
+                rows.append({
+                    "player_id": player_id,
+                    "skill_id": skill_id,
+                    "level": level if isinstance(level, int) and level > 0 else 1,
+                    "is_equipped": skill_id == equipped,
+                })
+        if rows:
+            db.exec(insert(PlayerSkill), params=rows)
+        db.add(SystemConfig(key=MIGRATION_KEY, value=str(len(rows))))
+        db.commit()
+        if rows:
+            print(f"📘 Đã chuyển {len(rows)} kỹ năng từ skills_data sang bảng PlayerSkill")
@@ -0,0 +1,188 @@
+import json
+import threading
+from types import SimpleNamespace
+from typing import Optional, List
+from sqlmodel import Session, select
+from database import Item, SkillTemplate, CompanionTemplate, Title, SystemConfig
+
+# Các nhóm dữ liệu tĩnh (Admin mới sửa, người chơi chỉ đọc)
+SECTIONS = ("items", "skills", "companions", "titles", "config")
+# Các khóa SystemConfig được nạp sẵn (đã parse JSON)
+CONFIG_KEYS = ("charm_setup", "forge_setup")
+
+
+class Entry(SimpleNamespace):
+    """Bản chỉ-đọc của 1 dòng dữ liệu tĩnh, kèm config_dict đã parse sẵn."""
+    def to_dict(self) -> dict:
+        return {k: v for k, v in vars(self).items() if k != "config_dict"}
+
+def parse_config(raw) -> Optional[dict]:
+    """JSON object -> dict; chuỗi rỗng / không phải JSON object -> None."""
+    if isinstance(raw, dict):
+        return raw
+    if not raw:
+        return None
+    try:
+        data = json.loads(raw)
+    except Exception:
+        return None
+    return data if isinstance(data, dict) else None
+
+def _entry(row, config_field: Optional[str] = None) -> Entry:
+    data = row.model_dump()
+    config = parse_config(data.get(config_field)) if config_field else None
+    return Entry(**data, config_dict=config)
+
+
+class StaticRegistry:
+    """
+    Kho dữ liệu tĩnh dùng chung cả tiến trình: Item, SkillTemplate, CompanionTemplate, Title
+    và SystemConfig (charm_setup, forge_setup).
+    - Mỗi nhóm nạp 1 lần (config JSON parse sẵn), sau đó chỉ đọc RAM.
+    - Admin ghi dữ liệu -> invalidate(nhóm) -> tăng version, lần đọc sau nạp lại.
+    - hits / misses theo từng nhóm để kiểm chứng DB không còn bị hỏi lại.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+        self.versions = {s: 0 for s in SECTIONS}
+        self.hits = {s: 0 for s in SECTIONS}
+        self.misses = {s: 0 for s in SECTIONS}
+        self._indexes = {}    # chỉ mục dẫn xuất: khóa -> (dict nguồn, kết quả)
+
+    def invalidate(self, *sections):
+        with self._lock:
+            for s in sections or SECTIONS:
+                self._data.pop(s, None)
+                self.versions[s] += 1
+
+    def version(self, section: str) -> int:
+        return self.versions[section]
+
+    def stats(self) -> dict:
+        return {
+            s: {
+                "version": self.versions[s],
+                "loaded": s in self._data,
+                "size": len(self._data[s]) if s in self._data else 0,
+                "hits": self.hits[s],
+                "misses": self.misses[s],
+            }
+            for s in SECTIONS
+        }
+
+    # --- NẠP TỪ DB ---
+
+    def _load(self, db: Session, section: str):
+        if section == "items":
+            return {r.id: _entry(r, "config") for r in db.exec(select(Item).order_by(Item.id)).all()}
+        if section == "skills":
+            return {r.skill_id: _entry(r, "config_data") for r in db.exec(select(SkillTemplate).order_by(SkillTemplate.id)).all()}
+        if section == "companions":
+            return {r.template_id: _entry(r) for r in db.exec(select(CompanionTemplate)).all()}
+        if section == "titles":
+            # Sắp KPI giảm dần: gặp mốc đầu tiên <= KPI là danh hiệu cao nhất
+            return [_entry(r) for r in db.exec(select(Title).order_by(Title.min_kpi.desc())).all()]
+        if section == "config":
+            rows = db.exec(select(SystemConfig).where(SystemConfig.key.in_(CONFIG_KEYS))).all()
+            return {r.key: parse_config(r.value) for r in rows}
+        raise ValueError(f"Nhóm dữ liệu không hợp lệ: {section}")
+
+    def _section(self, db: Session, section: str):
+        data = self._data.get(section)
+        if data is not None:
+            self.hits[section] += 1
+            return data
+        version = self.versions[section]
+        data = self._load(db, section)
+        with self._lock:
+            self.misses[section] += 1
+            # Admin vừa ghi trong lúc đang nạp -> không lưu bản cũ
+            if self.versions[section] == version:
+                self._data[section] = data
+        return data
+
+    # --- 1. VẬT PHẨM ---
+
+    def items(self, db: Session) -> dict:
+        return self._section(db, "items")
+
+    def get_item(self, db: Session, item_id) -> Optional[Entry]:
+        try:
+            return self.items(db).get(int(item_id))
+        except (TypeError, ValueError):
+            return None
+
+    def _item_index(self, db: Session, key: str, build):
+        """Chỉ mục dẫn xuất từ nhóm items: tính 1 lần, tự tính lại khi items được nạp lại."""
+        items = self.items(db)
+        cached = self._indexes.get(("items", key))
+        if cached and cached[0] is items:
+            return cached[1]
+        value = build(items)
+        self._indexes[("items", key)] = (items, value)
+        return value
+
+    def item_ids_by_action(self, db: Session, action: str) -> tuple:
+        """Id các Item có config action (hoặc type) = action, tăng dần."""
+        return self._item_index(db, f"action:{action}", lambda items: tuple(
+            i.id for i in items.values()
+            if i.config_dict and action in (i.config_dict.get("action"), i.config_dict.get("type"))
+        ))
+
+    def pet_fragments(self, db: Session) -> dict:
+        """{id Mảnh Pet: id Pet sẽ ghép ra} - Mảnh là Item có config target_pet_id."""
+        def build(items):
+            result = {}
+            for i in items.values():
+                try:
+                    target = int((i.config_dict or {}).get("target_pet_id") or 0)
+                except (TypeError, ValueError):
+                    continue
+                if target:
+                    result[i.id] = target
+            return result
+        return self._item_index(db, "pet_fragments", build)
+
+    # --- 2. KỸ NĂNG ---
+
+    def skills(self, db: Session) -> dict:
+        return self._section(db, "skills")
+
+    def get_skill(self, db: Session, skill_id: str) -> Optional[Entry]:
+        return self._section(db, "skills").get(skill_id)
+
+    def skills_for_class(self, db: Session, class_type: Optional[str]) -> List[Entry]:
+        """Skill đúng Class hoặc skill Chung (COMMON)."""
+        return [s for s in self._section(db, "skills").values() if s.class_type in (class_type, "COMMON")]
+
+    # --- 3. PHÔI THẺ BÀI ---
+
+    def get_companion_template(self, db: Session, template_id: str) -> Optional[Entry]:
+        return self._section(db, "companions").get(template_id)
+
+    def companion_templates(self, db: Session, rarity: Optional[str] = None) -> List[Entry]:
+        templates = self._section(db, "companions").values()
+        return [t for t in templates if rarity is None or t.rarity == rarity]
+
+    def companion_template_by_image(self, db: Session, image_path: str) -> Optional[Entry]:
+        return next((t for t in self._section(db, "companions").values() if t.image_path == image_path), None)
+
+    # --- 4. DANH HIỆU ---
+
+    def titles(self, db: Session) -> List[Entry]:
+        return self._section(db, "titles")
+
+    def title_for_kpi(self, db: Session, kpi) -> Optional[Entry]:
+        return next((t for t in self.titles(db) if (kpi or 0) >= t.min_kpi), None)
+
+    # --- 5. CẤU HÌNH HỆ THỐNG ---
+
+    def get_config(self, db: Session, key: str, default=None):
+        if key not in CONFIG_KEYS:
+            raise ValueError(f"Khóa cấu hình không được nạp sẵn: {key}")
+        value = self._section(db, "config").get(key)
+        return value if value is not None else default
+
+
+registry = StaticRegistry()
@@ -0,0 +1,227 @@
+import asyncio
+from datetime import datetime
+from typing import Optional, Dict, List
+from sqlalchemy import insert, literal
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import Session, select, update, func
+from database import engine, Player, WalletLedger, WalletSnapshot
+
+# Các cột tiền tệ trên bảng Player
+CURRENCIES = ("tri_thuc", "chien_tich", "vinh_du", "kpi")
+# Chu kỳ chụp số dư (giây)
+WALLET_SNAPSHOT_INTERVAL = 6 * 60 * 60
+
+
+# =========================================================
+# 1. TIỆN ÍCH NỘI BỘ
+# =========================================================
+def _check_currency(currency: str):
+    if currency not in CURRENCIES:
+        raise ValueError(f"Loại tiền tệ không hợp lệ: {currency}")
+
+def _column(currency: str):
+    _check_currency(currency)
+    return getattr(Player, currency)
+
+def _cast(currency: str, value):
+    # kpi là số thực, các loại còn lại là số nguyên
+    return float(value) if currency == "kpi" else int(value)
+
+def _sync_loaded_players(db: Session, rows, currencies):
+    """Cập nhật các object Player đang nằm trong session (không đánh dấu 'dirty')."""
+    for row in rows:
+        player = db.identity_map.get(db.identity_key(Player, row.id))
+        if player is not None:
+            for cur in currencies:
+                set_committed_value(player, cur, getattr(row, cur))
+
+def _apply(db: Session, player_ids: List[int], changes: Dict[str, float], reason: str, ref, guard: bool):
+    """
+    1 câu UPDATE ... RETURNING cho mọi người chơi + 1 lần chèn sổ cái.
+    guard=True: chỉ trừ khi đủ số dư (người thiếu tiền sẽ không có trong kết quả).
+    """
+    changes = {cur: _cast(cur, amt) for cur, amt in changes.items() if amt}
+    for cur in changes:
+        _check_currency(cur)
+    if not changes or not player_ids:
+        return {}
+
+    cols = {cur: getattr(Player, cur) for cur in changes}
+    stmt = (
+        update(Player)
+        .where(Player.id.in_(player_ids))
+        .values({cols[cur]: func.coalesce(cols[cur], 0) + amt for cur, amt in changes.items()})
+        .returning(Player.id, *cols.values())
+        .execution_options(synchronize_session=False)
+    )
+    if guard:
+        for cur, amt in changes.items():
+            if amt < 0:
+                stmt = stmt.where(func.coalesce(cols[cur], 0) >= -amt)
+
+    rows = db.exec(stmt).all()
+    _sync_loaded_players(db, rows, changes)
+
+    now = datetime.now()
+    ledger = [
+        {
+            "player_id": row.id, "currency": cur, "delta": amt,
+            "balance_after": getattr(row, cur), "reason": reason,
+            "ref": str(ref) if ref is not None else None, "created_at": now
+        }
+        for row in rows for cur, amt in changes.items()
+    ]
+    if ledger:
+        db.exec(insert(WalletLedger), params=ledger)
+    return {row.id: {cur: getattr(row, cur) for cur in changes} for row in rows}
+
+
+# =========================================================
+# 2. API VÍ (Không tự commit - chạy chung transaction với nghiệp vụ gọi nó)
+# =========================================================
+def debit(db: Session, player_id: int, currency: str, amount, reason: str, ref=None) -> Optional[float]:
+    """Trừ tiền nếu đủ số dư. Trả về số dư mới, hoặc None nếu không đủ tiền."""
+    if amount < 0:
+        raise ValueError("Số tiền trừ phải >= 0")
+    if not amount:
+        return get_balance(db, player_id, currency)
+    result = _apply(db, [player_id], {currency: -amount}, reason, ref, guard=True)
+    return result[player_id][currency] if player_id in result else None
+
+def credit(db: Session, player_id: int, currency: str, amount, reason: str, ref=None) -> Optional[float]:
+    """Cộng tiền. Trả về số dư mới (None nếu người chơi không tồn tại)."""
+    if amount < 0:
+        raise ValueError("Số tiền cộng phải >= 0")
+    if not amount:
+        return get_balance(db, player_id, currency)
+    result = _apply(db, [player_id], {currency: amount}, reason, ref, guard=False)
+    return result[player_id][currency] if player_id in result else None
+
+def adjust(db: Session, player_id: int, changes: Dict[str, float], reason: str, ref=None) -> Optional[dict]:
+    """Cộng / trừ nhiều loại tiền cùng lúc, KHÔNG chặn âm (Admin chỉnh tay, phạt KPI...)."""
+    result = _apply(db, [player_id], changes, reason, ref, guard=False)
+    return result.get(player_id)
+
+def batch_credit(db: Session, player_ids: List[int], changes: Dict[str, float], reason: str, ref=None) -> int:
+    """Phát thưởng hàng loạt cùng mức: 1 UPDATE + 1 lần chèn sổ cái. Trả về số người được cộng."""
+    if any(amt < 0 for amt in changes.values()):
+        raise ValueError("batch_credit chỉ dùng để cộng tiền")
+    return batch_adjust(db, player_ids, changes, reason, ref)
+
+def batch_adjust(db: Session, player_ids: List[int], changes: Dict[str, float], reason: str, ref=None) -> int:
+    """Như batch_credit nhưng cho phép số âm, KHÔNG chặn âm (Admin chỉnh hàng loạt)."""
+    total = 0
+    ids = list(dict.fromkeys(player_ids))
+    # Chia nhỏ để không vượt giới hạn tham số của SQLite
+    for i in range(0, len(ids), 500):
+        total += len(_apply(db, ids[i:i + 500], changes, reason, ref, guard=False))
+    return total
+
+def get_balance(db: Session, player_id: int, currency: str) -> Optional[float]:
+    return db.exec(select(_column(currency)).where(Player.id == player_id)).first()
+
+
+# =========================================================
+# 3. SỔ CÁI, SNAPSHOT & ĐỐI SOÁT
+# =========================================================
+def get_ledger(db: Session, player_id: int, currency: Optional[str] = None, before_id: Optional[int] = None, limit: int = 50) -> list:
+    stmt = select(WalletLedger).where(WalletLedger.player_id == player_id)
+    if currency:
+        stmt = stmt.where(WalletLedger.currency == currency)
+    if before_id:
+        stmt = stmt.where(WalletLedger.id < before_id)
+    return db.exec(stmt.order_by(WalletLedger.id.desc()).limit(max(1, min(limit, 200)))).all()
+
+def take_snapshot(db: Session) -> int:
+    """Chụp số dư mọi người chơi (INSERT ... SELECT, cùng 1 câu lệnh với mốc sổ cái)."""
+    last_ledger = select(func.coalesce(func.max(WalletLedger.id), 0)).scalar_subquery()
+    now = datetime.now()
+    total = 0
+    for cur in CURRENCIES:
+        src = select(
+            Player.id, literal(cur), func.coalesce(getattr(Player, cur), 0), last_ledger, literal(now)
+        )
+        result = db.exec(insert(WalletSnapshot).from_select(
+            ["player_id", "currency", "balance", "ledger_id", "created_at"], src
+        ))
+        total += result.rowcount
+    db.commit()
+    return total
+
+def ensure_wallet_snapshot():
+    """Lần đầu chạy: chụp số dư hiện có làm mốc đối soát."""
+    with Session(engine) as db:
+        if not db.exec(select(WalletSnapshot.id).limit(1)).first():
+            count = take_snapshot(db)
+            print(f"💰 Đã chụp số dư ví ban đầu ({count} dòng).")
+
+async def wallet_snapshot_loop():
+    """Chạy ngầm: chụp số dư mỗi WALLET_SNAPSHOT_INTERVAL giây (trong thread riêng, không chặn server)."""
+    def job():
+        with Session(engine) as db:
+            return take_snapshot(db)
+
+    while True:
+        await asyncio.sleep(WALLET_SNAPSHOT_INTERVAL)
+        try:
+            count = await asyncio.to_thread(job)
+            print(f"💰 Đã chụp số dư ví định kỳ ({count} dòng).")
+        except Exception as e:
+            print(f"❌ Lỗi chụp số dư ví: {e}")
+
+def audit_balances(db: Session, player_id: Optional[int] = None, only_drift: bool = True) -> list:
+    """
+    Tính lại số dư = snapshot gần nhất + tổng delta sổ cái phát sinh sau đó,
+    rồi so với số dư thật trên bảng Player.
+    """
+    latest = (
+        select(WalletSnapshot.player_id, WalletSnapshot.currency, func.max(WalletSnapshot.id).label("snap_id"))
+        .group_by(WalletSnapshot.player_id, WalletSnapshot.currency)
+    )
+    if player_id is not None:
+        latest = latest.where(WalletSnapshot.player_id == player_id)
+    latest = latest.subquery()
+
+    snaps = db.exec(
+        select(WalletSnapshot).join(latest, WalletSnapshot.id == latest.c.snap_id)
+    ).all()
+    if not snaps:
+        return []
+
+    # Tổng phát sinh sau snapshot (1 query, dùng index player_id + currency + id)
+    baseline = {(snap.player_id, snap.currency): snap.balance for snap in snaps}
+    deltas = db.exec(
+        select(WalletLedger.player_id, WalletLedger.currency, func.sum(WalletLedger.delta))
+        .join(
+            WalletSnapshot,
+            (WalletSnapshot.player_id == WalletLedger.player_id)
+            & (WalletSnapshot.currency == WalletLedger.currency)
+            & (WalletLedger.id > WalletSnapshot.ledger_id)
+        )
+        .join(latest, WalletSnapshot.id == latest.c.snap_id)
+        .group_by(WalletLedger.player_id, WalletLedger.currency)
+    ).all()
+    delta_map = {(pid, cur): total for pid, cur, total in deltas}
+
+    pids = list({s.player_id for s in snaps})
+    players = {}
+    for i in range(0, len(pids), 500):
+        chunk = pids[i:i + 500]
+        for row in db.exec(select(Player.id, Player.username, *[getattr(Player, c) for c in CURRENCIES]).where(Player.id.in_(chunk))).all():
+            players[row.id] = row
+
+    report = []
+    for (pid, cur), base in baseline.items():
+        row = players.get(pid)
+        if row is None:
+            continue
+        expected = base + (delta_map.get((pid, cur)) or 0)
+        actual = getattr(row, cur) or 0
+        drift = round(actual - expected, 4)
+        if only_drift and not drift:
+            continue
+        report.append({
+            "player_id": pid, "username": row.username, "currency": cur,
+            "expected": expected, "actual": actual, "drift": drift
+        })
+    return report
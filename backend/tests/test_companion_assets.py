@@ -0,0 +1,54 @@
+import json
+import os
+import sys
+
+import pytest
+from sqlmodel import SQLModel, Session, create_engine
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Player, MarketListing, CompanionTemplate
+from services import companion_assets
+from services.market_browse import COMPANION_ITEM_ID
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """DB tạm + thư mục ảnh thẻ tạm có sẵn 2 ảnh SR."""
+    card_dir = tmp_path / "card"
+    (card_dir / "sr").mkdir(parents=True)
+    for name in ("listed.png", "orphan.png"):
+        (card_dir / "sr" / name).write_bytes(name.encode())
+    monkeypatch.setattr(companion_assets, "CARD_ASSET_DIR", str(card_dir))
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'assets.db'}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as db:
+        db.add(Player(username="seller", password_hash="x", full_name="Seller"))
+        db.commit()
+        assert companion_assets.scan_companion_assets(db)["added"] == 2
+        yield db
+    engine.dispose()
+
+
+def _list_card(db, **card):
+    db.add(MarketListing(seller_id=1, item_id=COMPANION_ITEM_ID, price=10, currency="tri_thuc",
+                         rarity="SR", item_data_json=json.dumps({"name": "X", "rarity": "SR", "star": 1, **card})))
+    db.commit()
+
+
+@pytest.mark.parametrize("card", [
+    {"template_id": "SR_LISTED"},
+    {"image": "/assets/card/sr/listed.png"},   # Đơn cũ chưa lưu template_id
+])
+def test_scan_keeps_templates_of_listed_cards(db, card):
+    _list_card(db, **card)
+    for name in ("listed.png", "orphan.png"):
+        os.remove(os.path.join(companion_assets.CARD_ASSET_DIR, "sr", name))
+
+    result = companion_assets.scan_companion_assets(db)
+
+    assert result["removed"] == 1
+    assert result["kept_orphans"] == ["SR_LISTED"]
+    assert db.get(CompanionTemplate, "SR_LISTED") is not None
+    assert db.get(CompanionTemplate, "SR_ORPHAN") is None
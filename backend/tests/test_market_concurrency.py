@@ -0,0 +1,117 @@
+import json
+import os
+import sys
+import threading
+
+import pytest
+from sqlmodel import SQLModel, Session, create_engine, select, func
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Player, Item, Inventory, MarketListing, MarketPriceIndex, Companion, CompanionTemplate
+from game_logic.market_manager import MarketManager
+from services.market_browse import COMPANION_ITEM_ID
+
+BUYERS = 50
+PRICE = 60
+START_BALANCE = 100
+
+
+@pytest.fixture
+def engine(tmp_path):
+    """DB SQLite riêng (file thật để các luồng tranh khóa ghi như server chạy thật)."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'market.db'}", connect_args={"check_same_thread": False})
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as db:
+        db.add(Player(username="seller", password_hash="x", full_name="Seller", tri_thuc=0))
+        for i in range(BUYERS):
+            db.add(Player(username=f"b{i}", password_hash="x", full_name=f"Buyer {i}", tri_thuc=START_BALANCE))
+        db.add(Item(name="Đá Cường Hóa", image_url="/assets/items/stone.png"))
+        db.add(CompanionTemplate(template_id="SR_X", name="X", rarity="SR", image_path="/assets/card/sr/x.png"))
+        db.commit()
+    yield engine
+    engine.dispose()
+
+
+def _race(engine, listing_id=None):
+    """50 người mua cùng bấm mua 1 đơn hàng cùng lúc (listing_id=None: mỗi người 1 đơn riêng, id = i + 1)."""
+    barrier = threading.Barrier(BUYERS)
+    results = []
+
+    def buyer(i):
+        with Session(engine) as db:
+            barrier.wait()
+            results.append(MarketManager(db).buy(listing_id or i + 1, f"b{i}"))
+
+    threads = [threading.Thread(target=buyer, args=(i,)) for i in range(BUYERS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def _assert_money(db, winners):
+    balances = {p.username: p.tri_thuc for p in db.exec(select(Player)).all()}
+    assert min(balances.values()) >= 0
+    assert balances["seller"] == PRICE * len(winners)
+    # Tiền chỉ chuyển từ người thắng sang người bán, không sinh ra / mất đi
+    assert sum(balances.values()) == START_BALANCE * BUYERS
+    for i in range(BUYERS):
+        expected = START_BALANCE - PRICE if f"b{i}" in winners else START_BALANCE
+        assert balances[f"b{i}"] == expected
+
+
+def test_fifty_buyers_one_item_listing(engine):
+    with Session(engine) as db:
+        db.add(MarketListing(id=1, seller_id=1, item_id=1, amount=3, price=PRICE, currency="tri_thuc"))
+        db.commit()
+
+    results = _race(engine, 1)
+    winners = [r for r in results if r["success"]]
+    assert len(results) == BUYERS
+    assert len(winners) == 1
+
+    with Session(engine) as db:
+        assert db.get(MarketListing, 1) is None
+        stacks = db.exec(select(Inventory)).all()
+        assert [(s.item_id, s.amount) for s in stacks] == [(1, 3)]
+        winner = db.get(Player, stacks[0].player_id).username
+        _assert_money(db, {winner})
+
+
+def test_fifty_buyers_one_companion_listing(engine):
+    card = {"name": "X", "rarity": "SR", "star": 3, "stats": {"hp": 50, "atk": 7},
+            "template_id": "SR_X", "ui_id": "SR_1_ABCDEF12"}
+    with Session(engine) as db:
+        db.add(MarketListing(id=1, seller_id=1, item_id=COMPANION_ITEM_ID, price=PRICE, currency="tri_thuc",
+                             rarity="SR", item_data_json=json.dumps(card)))
+        db.commit()
+
+    results = _race(engine, 1)
+    assert len([r for r in results if r["success"]]) == 1
+
+    with Session(engine) as db:
+        cards = db.exec(select(Companion)).all()
+        assert len(cards) == 1
+        assert (cards[0].id, cards[0].star, cards[0].atk, cards[0].hp) == ("SR_1_ABCDEF12", 3, 7, 50)
+        assert db.exec(select(func.count(MarketListing.id))).one() == 0
+        _assert_money(db, {db.get(Player, cards[0].player_id).username})
+
+
+def test_fifty_trades_same_price_key(engine):
+    """50 giao dịch cùng 1 khóa bảng giá cùng lúc: không trùng unique index, không mất lượt đếm."""
+    with Session(engine) as db:
+        for i in range(BUYERS):
+            db.add(MarketListing(id=i + 1, seller_id=1, item_id=1, amount=1, price=PRICE, currency="tri_thuc"))
+        db.commit()
+
+    results = _race(engine)
+    assert all(r["success"] for r in results)
+
+    with Session(engine) as db:
+        rows = db.exec(select(MarketPriceIndex)).all()
+        assert [(r.item_id, r.rarity, r.currency) for r in rows] == [(1, "", "tri_thuc")]
+        assert rows[0].trade_count == BUYERS
+        assert rows[0].listing_count == 0
+        assert rows[0].last_trade_price == PRICE
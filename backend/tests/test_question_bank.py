@@ -0,0 +1,77 @@
+import os
+import sys
+
+import pytest
+from sqlmodel import SQLModel, Session, create_engine, select, func
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import QuestionBank, QuestionSource
+from services.question_importer import import_questions
+from services.question_index import remove_bank_questions
+from services.question_store import sync_question_files, QUESTION_DATA_DIR
+
+BOSS_FILE = "congnghe-hard-boss.json"
+
+pytestmark = pytest.mark.skipif(
+    not os.path.isfile(os.path.join(QUESTION_DATA_DIR, BOSS_FILE)), reason="Thiếu thư mục 'data câu hỏi'"
+)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """DB tạm đã đồng bộ toàn bộ file trong 'data câu hỏi' (Boss, minigame, các môn)."""
+    engine = create_engine(f"sqlite:///{tmp_path / 'questions.db'}")
+    SQLModel.metadata.create_all(engine)
+    with Session(engine) as db:
+        sync_question_files(db)
+        yield db
+    engine.dispose()
+
+
+def _linked(db, source):
+    return db.exec(select(func.count(QuestionSource.id)).where(QuestionSource.source == source)).one()
+
+def _bank(db, *conditions):
+    return db.exec(select(func.count(QuestionBank.id)).where(QuestionBank.file_only == False, *conditions)).one()
+
+
+def test_replace_import_keeps_synced_file_questions(db):
+    before = _linked(db, BOSS_FILE)
+    assert before > 0
+
+    row = {"subject": "Công nghệ", "difficulty": "medium", "content": "Câu mới của ngân hàng đề?",
+           "a": "Đúng", "b": "Sai", "correct": "a"}
+    report = import_questions(db, iter([(1, row)]), mode="replace")
+
+    assert report["added"] == 1
+    assert _linked(db, BOSS_FILE) == before
+    assert _bank(db, QuestionBank.subject == "Công nghệ", QuestionBank.difficulty == "medium") == 1
+
+
+def test_replace_import_of_a_file_question_keeps_its_source_link(db):
+    """Câu vừa thuộc ngân hàng đề vừa nằm trong file: thay bộ đề không được làm file mất câu."""
+    boss_ids = db.exec(select(QuestionSource.question_id).where(QuestionSource.source == BOSS_FILE)).all()
+    shared = db.get(QuestionBank, boss_ids[0])
+    shared.file_only = False
+    db.add(shared)
+    db.commit()
+    subject, difficulty = shared.subject, shared.difficulty
+
+    row = {"subject": subject, "difficulty": difficulty, "content": "Câu thay thế?", "a": "1", "b": "2", "correct": "b"}
+    import_questions(db, iter([(1, row)]), mode="replace")
+
+    assert _linked(db, BOSS_FILE) == len(boss_ids)
+    assert db.get(QuestionBank, shared.id).file_only is True
+    assert _bank(db, QuestionBank.subject == subject, QuestionBank.difficulty == difficulty) == 1
+
+
+def test_remove_subject_only_touches_bank_questions(db):
+    before = _linked(db, BOSS_FILE)
+    row = {"subject": "Công nghệ", "difficulty": "hard", "content": "Câu ngân hàng đề?", "a": "1", "b": "2", "correct": "a"}
+    import_questions(db, iter([(1, row)]))
+
+    assert remove_bank_questions(db, QuestionBank.subject == "Công nghệ") == 1
+    db.commit()
+    assert _bank(db, QuestionBank.subject == "Công nghệ") == 0
+    assert _linked(db, BOSS_FILE) == before